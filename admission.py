@@ -0,0 +1,300 @@
+# 准入控制
+# 限制同时进行的大语言模型请求数量，超出时进入有界等待队列；队列已满或等待超时时
+# 立即返回503和Retry-After，让突发流量下的服务降级而不是全部超时。
+# 支持按客户端(X-API-Key或客户端IP)的令牌桶配额，以及交互式请求优先于批量请求。
+# 多工作进程服务中每个进程各有一个准入控制器，配置的上限按工作进程数量平分，合计不超过配置值。
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+
+# 请求优先级，数值越小越先被放行
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BATCH: "batch"}
+
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge(
+    "kb_admission_queue_depth",
+    "等待准入的请求数",
+)
+ADMISSION_ACTIVE = REGISTRY.gauge(
+    "kb_admission_active",
+    "已准入、正在执行的请求数",
+)
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    "kb_admission_wait_seconds",
+    "请求在准入队列中的等待时间(秒)",
+    ["priority"],
+)
+ADMISSION_REJECTED = REGISTRY.counter(
+    "kb_admission_rejected_total",
+    "被拒绝的请求数(queue_full: 队列已满, queue_timeout: 等待超时, quota: 超出客户端配额)",
+    ["reason"],
+)
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    try:
+        return float(value) if value not in (None, "") else default
+    except ValueError:
+        return default
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    try:
+        return int(value) if value not in (None, "") else default
+    except ValueError:
+        return default
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入时抛出，携带建议的HTTP状态码和重试等待秒数"""
+
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """有界并发 + 有界优先级队列 + 客户端令牌桶配额
+
+    只在事件循环中使用(acquire/release都在请求处理协程中调用)，不需要额外加锁。
+    """
+
+    def __init__(self, max_concurrent=16, max_queue=64, queue_timeout=30.0,
+                 client_rate=0.0, client_burst=10):
+        """
+        Args:
+            max_concurrent: 同时执行的请求上限，0表示不限制
+            max_queue: 等待队列长度上限
+            queue_timeout: 在队列中等待的最长时间(秒)
+            client_rate: 每个客户端每秒允许的请求数，0表示不限制
+            client_burst: 每个客户端允许的突发请求数(令牌桶容量)
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.client_rate = client_rate
+        self.client_burst = max(1, client_burst)
+        self._active = 0
+        # 等待者堆: (优先级, 序号, future)
+        self._waiters = []
+        self._sequence = itertools.count()
+        # 客户端令牌桶: {客户端: [剩余令牌, 上次更新时间]}
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._buckets_swept = time.monotonic()
+        # 请求执行时间的指数滑动平均，用于估算Retry-After
+        self._service_ewma = None
+
+    @classmethod
+    def from_env(cls, workers=1):
+        """根据ADMISSION_*和CLIENT_*环境变量创建准入控制器
+
+        Args:
+            workers: 共享这些上限的工作进程数量，并发、队列和客户端配额按该数量平分(至少为1)
+        """
+        workers = max(1, workers)
+
+        def share(value):
+            return max(1, math.ceil(value / workers)) if value > 0 else value
+
+        return cls(
+            max_concurrent=share(_env_int('ADMISSION_MAX_CONCURRENT', 16)),
+            max_queue=share(_env_int('ADMISSION_MAX_QUEUE', 64)),
+            queue_timeout=_env_float('ADMISSION_QUEUE_TIMEOUT', 30.0),
+            client_rate=_env_float('CLIENT_RATE_LIMIT', 0.0) / workers,
+            client_burst=share(_env_int('CLIENT_BURST', 10)),
+        )
+
+    def _retry_after(self, waiting):
+        """根据平均执行时间和排在前面的请求数估算多久后重试"""
+        service = self._service_ewma or 1.0
+        slots = max(1, self.max_concurrent)
+        return max(1, math.ceil(service * (waiting + 1) / slots))
+
+    def _check_quota(self, client):
+        """消耗客户端的一个令牌，令牌不足时抛出AdmissionRejected(429)"""
+        if not client or self.client_rate <= 0:
+            return
+        now = time.monotonic()
+        with self._buckets_lock:
+            self._sweep_buckets(now)
+            tokens, updated = self._buckets.get(client, (self.client_burst, now))
+            tokens = min(self.client_burst, tokens + (now - updated) * self.client_rate)
+            if tokens < 1:
+                self._buckets[client] = [tokens, now]
+                ADMISSION_REJECTED.inc(reason="quota")
+                raise AdmissionRejected(429, "超出客户端请求配额，请稍后重试",
+                                        max(1, math.ceil((1 - tokens) / self.client_rate)))
+            self._buckets[client] = [tokens - 1, now]
+
+    def _sweep_buckets(self, now):
+        """删除已经空闲到令牌回满的客户端令牌桶(与新建的令牌桶等价)，避免大量不同的客户端标识使内存无限增长
+
+        每经过一次回满所需的时间才扫描一次，调用方需持有_buckets_lock。
+        """
+        refill_seconds = self.client_burst / self.client_rate
+        if now - self._buckets_swept < refill_seconds:
+            return
+        self._buckets_swept = now
+        idle = [client for client, (_, updated) in self._buckets.items() if now - updated >= refill_seconds]
+        for client in idle:
+            del self._buckets[client]
+
+    async def acquire(self, client=None, priority=PRIORITY_INTERACTIVE):
+        """获取一个执行名额，必要时排队等待
+
+        Args:
+            client: 客户端标识，用于配额统计
+            priority: PRIORITY_INTERACTIVE或PRIORITY_BATCH
+
+        Raises:
+            AdmissionRejected: 超出配额、队列已满或等待超时
+        """
+        self._check_quota(client)
+        priority_name = PRIORITY_NAMES.get(priority, "interactive")
+
+        if self.max_concurrent <= 0 or (self._active < self.max_concurrent and not self._waiters):
+            self._active += 1
+            ADMISSION_ACTIVE.set(self._active)
+            ADMISSION_WAIT_SECONDS.observe(0.0, priority=priority_name)
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            ADMISSION_REJECTED.inc(reason="queue_full")
+            raise AdmissionRejected(503, "服务繁忙，请稍后重试", self._retry_after(len(self._waiters)))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._sequence), future)
+        heapq.heappush(self._waiters, entry)
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 名额已经分配给本请求但请求已放弃，转交给下一个等待者
+                self.release(observe=False)
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+            if isinstance(e, asyncio.TimeoutError):
+                ADMISSION_REJECTED.inc(reason="queue_timeout")
+                raise AdmissionRejected(503, "排队等待超时，请稍后重试", self._retry_after(len(self._waiters)))
+            raise
+        finally:
+            ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, priority=priority_name)
+
+    def release(self, service_time=None, observe=True):
+        """释放执行名额，优先交给等待时间最久的高优先级请求
+
+        Args:
+            service_time: 本次请求的执行时间(秒)，用于估算Retry-After
+            observe: 是否记录执行时间
+        """
+        if observe and service_time is not None:
+            if self._service_ewma is None:
+                self._service_ewma = service_time
+            else:
+                self._service_ewma = 0.8 * self._service_ewma + 0.2 * service_time
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # 名额直接转交，不减少_active
+                future.set_result(None)
+                ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+                return
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+        self._active = max(0, self._active - 1)
+        ADMISSION_ACTIVE.set(self._active)
+
+    def status(self):
+        """返回准入控制的当前状态"""
+        return {
+            "active": self._active,
+            "queued": len(self._waiters),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "queue_timeout_seconds": self.queue_timeout,
+            "client_rate_limit": self.client_rate,
+            "average_service_seconds": round(self._service_ewma, 3) if self._service_ewma else None,
+        }
+
+
+# 进程内唯一的准入控制器，所有服务共享同一个模型调用名额
+_controller = None
+_controller_lock = threading.Lock()
+# 共享准入上限的工作进程数量，由serve_workers.py设置
+_workers = 1
+
+
+def set_worker_count(workers):
+    """设置共享准入上限的工作进程数量，已创建的准入控制器作废，下次获取时按新的数量创建"""
+    global _controller, _workers
+    with _controller_lock:
+        _workers = max(1, workers)
+        _controller = None
+
+
+def get_admission_controller():
+    """获取进程内唯一的准入控制器"""
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController.from_env(workers=_workers)
+        return _controller
+
+
+def client_key(request):
+    """客户端标识：优先使用X-API-Key，否则使用客户端IP"""
+    api_key = request.headers.get("x-api-key")
+    if api_key:
+        return f"key:{api_key}"
+    return f"ip:{request.client.host}" if request.client else None
+
+
+def request_priority(request):
+    """请求优先级：X-Request-Priority为batch时作为批量请求，其余作为交互式请求"""
+    if request.headers.get("x-request-priority", "").lower() == "batch":
+        return PRIORITY_BATCH
+    return PRIORITY_INTERACTIVE
+
+
+async def admit(request):
+    """为请求获取执行名额，未被准入时抛出带Retry-After的HTTPException
+
+    Args:
+        request: FastAPI的Request对象
+
+    Returns:
+        function: 请求处理完成后调用的释放函数(适用于流式响应，在响应结束后释放)
+    """
+    from fastapi import HTTPException
+
+    controller = get_admission_controller()
+    try:
+        await controller.acquire(client_key(request), request_priority(request))
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail,
+                            headers={"Retry-After": str(e.retry_after)})
+    start = time.perf_counter()
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            controller.release(time.perf_counter() - start)
+
+    return release
@@ -0,0 +1,83 @@
+# 近似检索索引
+# 知识库的向量存储始终使用IndexFlat(精确检索)：快照格式、按来源删除片段和元数据过滤都依赖它。
+# 配置了近似索引(kb_config.py中index.type为hnsw或ivf)时，从IndexFlat中的向量另外构建一个HNSW或IVF索引，
+# 只用于不带过滤条件的检索；近似索引的内部ID与IndexFlat一致，返回的距离与精确检索的距离相同。
+# 额外的内存约为一份向量加上图或倒排表的开销。
+#   hnsw: m(每个节点的邻居数，默认32)、ef_construction(构建时的候选数，默认40)、ef_search(检索时的候选数，默认64)
+#   ivf:  nlist(聚类数，默认约为4*sqrt(片段数))、nprobe(检索时访问的聚类数，默认8)
+import math
+
+HNSW_DEFAULTS = {"m": 32, "ef_construction": 40, "ef_search": 64}
+IVF_DEFAULTS = {"nlist": None, "nprobe": 8}
+
+
+def default_nlist(ntotal):
+    """IVF的默认聚类数：约4*sqrt(片段数)，不超过片段数"""
+    return max(1, min(ntotal, int(4 * math.sqrt(ntotal))))
+
+
+def build_search_index(vectors, metric, index_config):
+    """按索引配置为向量构建近似检索索引
+
+    Args:
+        vectors: 形状为(片段数, 维度)的float32向量，行号即FAISS内部ID
+        metric: faiss.METRIC_L2或faiss.METRIC_INNER_PRODUCT
+        index_config: 索引配置，如{"type": "hnsw", "ef_search": 64}
+
+    Returns:
+        faiss.Index或None: 近似检索索引，index.type为flat或没有向量时返回None
+    """
+    import faiss
+
+    index_type = index_config.get("type", "flat")
+    if index_type == "flat" or len(vectors) == 0:
+        return None
+    dimension = vectors.shape[1]
+    if index_type == "hnsw":
+        params = {**HNSW_DEFAULTS, **index_config}
+        index = faiss.index_factory(dimension, f"HNSW{int(params['m'])},Flat", metric)
+        index.hnsw.efConstruction = int(params["ef_construction"])
+        index.add(vectors)
+    elif index_type == "ivf":
+        params = {**IVF_DEFAULTS, **index_config}
+        nlist = min(len(vectors), int(params["nlist"] or default_nlist(len(vectors))))
+        index = faiss.index_factory(dimension, f"IVF{nlist},Flat", metric)
+        index.train(vectors)
+        index.add(vectors)
+    else:
+        raise ValueError(f"不支持的索引类型: {index_type}")
+    set_search_params(index, index_config)
+    return index
+
+
+def set_search_params(index, index_config):
+    """设置检索参数(HNSW的efSearch或IVF的nprobe)，不需要重建索引"""
+    index_type = index_config.get("type", "flat")
+    if index_type == "hnsw":
+        index.hnsw.efSearch = int(index_config.get("ef_search") or HNSW_DEFAULTS["ef_search"])
+    elif index_type == "ivf":
+        index.nprobe = min(index.nlist, int(index_config.get("nprobe") or IVF_DEFAULTS["nprobe"]))
+
+
+def build_for_vector_store(vector_store, index_config):
+    """从FAISS向量存储的IndexFlat中取出向量构建近似检索索引
+
+    Returns:
+        faiss.Index或None: 近似检索索引
+    """
+    import numpy as np
+
+    index = vector_store.index
+    if index_config.get("type", "flat") == "flat" or index.ntotal == 0:
+        return None
+    vectors = np.ascontiguousarray(index.reconstruct_n(0, index.ntotal), dtype="float32")
+    return build_search_index(vectors, index.metric_type, index_config)
+
+
+def index_bytes(index):
+    """索引序列化后的大小(字节)，近似为其占用的内存"""
+    import faiss
+
+    if index is None:
+        return 0
+    return int(faiss.serialize_index(index).nbytes)
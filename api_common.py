@@ -0,0 +1,247 @@
+# API服务的公共组件
+# api_rag_knowledge.py和api_feishu_knowledge.py的问答接口逻辑相同，集中在这里实现
+import inspect
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Union
+
+from fastapi import HTTPException
+from fastapi.datastructures import Default
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
+
+
+# JSON响应的序列化方式：较新的FastAPI在声明了response_model时由pydantic直接序列化为JSON字节，
+# 无需再指定响应类；旧版本在安装了orjson时使用ORJSONResponse，比标准库json快数倍
+def _select_json_response_class():
+    try:
+        from fastapi.routing import serialize_response
+        if "dump_json" in inspect.signature(serialize_response).parameters:
+            # 以Default包装，FastAPI才视为未指定响应类并走pydantic直接序列化的路径
+            return Default(JSONResponse)
+        import orjson  # noqa: F401
+        from fastapi.responses import ORJSONResponse
+        return Default(ORJSONResponse)
+    except ImportError:
+        return Default(JSONResponse)
+
+
+JSON_RESPONSE_CLASS = _select_json_response_class()
+
+# 响应体超过该字节数且客户端支持时以gzip压缩，0表示不压缩
+GZIP_MIN_SIZE = int(os.getenv('RESPONSE_GZIP_MIN_SIZE', '1024') or 0)
+# 压缩级别，较低的级别压缩率略低但CPU开销小得多
+GZIP_COMPRESS_LEVEL = 5
+
+
+def install_response_compression(app):
+    """为应用注册gzip压缩中间件；流式回答(text/plain)不压缩，避免压缩缓冲推迟首字输出"""
+    if GZIP_MIN_SIZE > 0:
+        options = {"minimum_size": GZIP_MIN_SIZE, "compresslevel": GZIP_COMPRESS_LEVEL}
+        # 旧版starlette不支持exclude_content_types，只默认跳过text/event-stream
+        if "exclude_content_types" in inspect.signature(GZipMiddleware.__init__).parameters:
+            options["exclude_content_types"] = ("text/plain", "text/event-stream")
+        app.add_middleware(GZipMiddleware, **options)
+
+
+class ResponseOptions(BaseModel):
+    """问答接口返回来源片段的方式，默认返回完整来源以保持兼容"""
+    include_sources: bool = Field(True, description="是否返回来源片段")
+    source_preview_chars: Optional[int] = Field(
+        None, ge=0, description="来源片段内容只返回前N个字符，完整内容可通过/knowledge/chunks/{id}获取")
+    source_ids_only: bool = Field(False, description="来源片段只返回ID和元数据，不返回内容")
+
+
+def shape_result(result, options):
+    """按响应选项裁剪问答结果中的来源片段
+
+    Args:
+        result: 知识库返回的{"answer", "sources", ...}字典
+        options: ResponseOptions(或包含同名字段的请求)
+
+    Returns:
+        dict: 裁剪后的结果(不修改传入的字典)
+    """
+    if not result or "sources" not in result:
+        return result
+    shaped = dict(result)
+    if not options.include_sources:
+        shaped.pop("sources")
+        return shaped
+    preview = options.source_preview_chars
+    if not options.source_ids_only and preview is None:
+        return shaped
+    sources = []
+    for source in result["sources"]:
+        source = dict(source)
+        content = source.pop("content", "")
+        if not options.source_ids_only:
+            source["content"] = content[:preview]
+            source["truncated"] = len(content) > preview
+        source["length"] = len(content)
+        sources.append(source)
+    shaped["sources"] = sources
+    return shaped
+
+
+class KnowledgeResponse(BaseModel):
+    success: bool = Field(..., description="操作是否成功")
+    message: str = Field(..., description="操作结果消息")
+    answer: Optional[str] = Field(None, description="问题答案")
+    processing_time: Optional[float] = Field(None, description="处理时间(秒)")
+    usage: Optional[Dict[str, Optional[int]]] = Field(
+        None, description="模型token用量: prompt_tokens、completion_tokens，以及命中和未命中供应商提示词缓存的"
+                          "cached_prompt_tokens、uncached_prompt_tokens(供应商不报告缓存时为null)")
+
+
+class SearchRequest(BaseModel):
+    query: str = Field(..., description="检索文本")
+    k: int = Field(5, ge=1, le=100, description="返回的片段数量")
+    filters: Optional[Dict[str, Union[str, List[str]]]] = Field(
+        None, description="元数据精确匹配条件，可用字段: source(文件路径或文件名)、title、document_id")
+    ingested_after: Optional[datetime] = Field(None, description="只检索该时间之后(含)入库的片段")
+    ingested_before: Optional[datetime] = Field(None, description="只检索该时间之前入库的片段")
+    preview_chars: Optional[int] = Field(
+        None, ge=0, description="片段内容只返回前N个字符，完整内容可通过/knowledge/chunks/{id}获取")
+
+
+class SearchResult(BaseModel):
+    id: str = Field(..., description="片段ID")
+    content: str = Field(..., description="片段内容")
+    metadata: dict = Field(..., description="片段元数据")
+    score: float = Field(..., description="与检索文本的L2距离，越小越相似")
+    truncated: bool = Field(False, description="内容是否被截断")
+
+
+class SearchResponse(BaseModel):
+    success: bool = Field(..., description="操作是否成功")
+    message: str = Field(..., description="操作结果消息")
+    results: List[SearchResult] = Field(default_factory=list, description="检索到的片段")
+    processing_time: Optional[float] = Field(None, description="处理时间(秒)")
+
+
+class Chunk(BaseModel):
+    id: str = Field(..., description="片段ID")
+    content: str = Field(..., description="片段内容")
+    metadata: dict = Field(..., description="片段元数据")
+
+
+async def answer_question(knowledge_base, question, use_fallback, start_time):
+    """使用知识库回答问题并构造响应
+
+    检索和模型调用是同步阻塞的，放到线程池中执行，避免阻塞事件循环；
+    同时到达的相同问题由知识库合并为一次执行；已预计算的术语直接返回预先生成的回答。
+
+    Args:
+        knowledge_base: 已初始化的知识库实例
+        question: 查询问题
+        use_fallback: 未找到答案时是否返回默认回复
+        start_time: 请求开始时间，用于计算处理时间
+
+    Returns:
+        KnowledgeResponse: 问答响应
+    """
+    # 预计算的名词解释只是一次内存查找，直接返回；其余问题执行检索和模型调用
+    result = knowledge_base.precomputed_answer(question) or await run_in_threadpool(knowledge_base.query_knowledge_base, question)
+
+    if not result or not result.get('answer'):
+        if use_fallback:
+            return KnowledgeResponse(
+                success=True,
+                message="查询成功，但知识库中没有找到相关信息",
+                answer="抱歉，我无法从现有知识库中找到相关信息。",
+                processing_time=round(time.time() - start_time, 2)
+            )
+        else:
+            raise HTTPException(status_code=404, detail="在知识库中未找到相关信息")
+
+    # 检索到的片段相关性不足时知识库没有调用模型
+    low_relevance = (result.get('relevance') or {}).get('decision') == 'low'
+    return KnowledgeResponse(
+        success=True,
+        message="知识库中没有足够相关的内容" if low_relevance else "查询成功",
+        answer=result['answer'],
+        processing_time=round(time.time() - start_time, 2),
+        usage=result.get('usage')
+    )
+
+
+def stream_answer(knowledge_base, question, on_complete=None):
+    """以纯文本流的方式返回知识库回答
+
+    Args:
+        knowledge_base: 知识库实例，未初始化时为None
+        question: 查询问题
+        on_complete: 可选，响应输出结束后调用的函数(如释放准入名额)
+
+    Returns:
+        StreamingResponse: 逐段输出回答的响应
+    """
+    chunks = knowledge_base.stream_knowledge_base(question) if knowledge_base else None
+    if chunks is None:
+        raise HTTPException(status_code=503, detail="知识库尚未创建或加载")
+    # 同步迭代器由StreamingResponse在线程池中逐段读取
+    background = BackgroundTask(on_complete) if on_complete else None
+    return StreamingResponse(chunks, media_type="text/plain; charset=utf-8", background=background)
+
+
+async def search_chunks(knowledge_base, request, start_time):
+    """只检索不调用大语言模型，返回最相似的片段
+
+    Args:
+        knowledge_base: 知识库实例，未初始化时为None
+        request: SearchRequest检索请求
+        start_time: 请求开始时间，用于计算处理时间
+
+    Returns:
+        SearchResponse: 检索响应
+    """
+    if not knowledge_base or not knowledge_base.vector_store:
+        raise HTTPException(status_code=503, detail="知识库尚未创建或加载")
+
+    try:
+        # 嵌入和FAISS检索是同步的CPU计算，放到线程池中执行，避免阻塞事件循环
+        results = await run_in_threadpool(
+            knowledge_base.search_knowledge_base,
+            request.query,
+            k=request.k,
+            filters=request.filters,
+            ingested_after=request.ingested_after.timestamp() if request.ingested_after else None,
+            ingested_before=request.ingested_before.timestamp() if request.ingested_before else None,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if request.preview_chars is not None:
+        for result in results or []:
+            result["truncated"] = len(result["content"]) > request.preview_chars
+            result["content"] = result["content"][:request.preview_chars]
+
+    return SearchResponse(
+        success=True,
+        message="检索成功" if results else "没有满足条件的片段",
+        results=results or [],
+        processing_time=round(time.time() - start_time, 4)
+    )
+
+
+def get_chunk(knowledge_base, chunk_id):
+    """按ID获取片段的完整内容(配合来源预览和只返回ID的响应按需读取全文)
+
+    Args:
+        knowledge_base: 知识库实例，未初始化时为None
+        chunk_id: 片段ID
+
+    Returns:
+        Chunk: 片段内容和元数据
+    """
+    if not knowledge_base or not knowledge_base.vector_store:
+        raise HTTPException(status_code=503, detail="知识库尚未创建或加载")
+    chunk = knowledge_base.get_chunk(chunk_id)
+    if chunk is None:
+        raise HTTPException(status_code=404, detail=f"片段 {chunk_id} 不存在")
+    return Chunk(**chunk)
@@ -1,7 +1,7 @@
 # 导入必要的库
 import os
 import logging
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from typing import Optional
@@ -11,6 +11,23 @@ import time
 # 导入项目中的飞书文档处理类
 from process_feishu_knowledge import FeishuKnowledgeProcessor
 
+# 导入进程内共享的知识库管理器和公共问答逻辑
+from knowledge_manager import get_manager
+from api_common import (KnowledgeResponse, answer_question, stream_answer, SearchRequest, SearchResponse,
+                        search_chunks, Chunk, get_chunk, JSON_RESPONSE_CLASS, install_response_compression)
+
+# 导入指标模块，用于暴露/metrics端点
+from metrics import install_metrics
+from profiling import install_profiling
+from query_log import install_request_id
+
+# 导入准入控制，限制同时进行的模型调用并在过载时快速拒绝
+from admission import admit, get_admission_controller
+
+# 导入飞书事件订阅，文档被编辑后只重建该文档的索引
+from feishu_events import (EventRejected, EventDeduplicator, DocumentReindexQueue, FEISHU_EVENTS,
+                           parse_event, document_change)
+
 # 从.env文件加载环境变量
 from dotenv import load_dotenv
 load_dotenv()
@@ -19,11 +36,12 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """应用生命周期管理"""
-    global knowledge_base
-    # 启动时初始化
+# 本服务在知识库管理器中的名称
+KB_NAME = "feishu"
+
+
+def initialize_knowledge_base():
+    """启动时处理飞书文档创建知识库并登记到知识库管理器"""
     try:
         # 输出当前使用的模型信息
         model_type = os.getenv('MODEL_TYPE', 'deepseek').lower()
@@ -35,6 +53,7 @@ async def lifespan(app: FastAPI):
         
         # 处理飞书文档并创建知识库
         knowledge_base = feishu_processor.process_feishu_documents()
+        get_manager().set(KB_NAME, knowledge_base)
         
         if knowledge_base:
             logger.info("飞书知识库实例已成功初始化")
@@ -43,29 +62,81 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"初始化飞书知识库失败: {str(e)}")
         # 即使初始化失败，应用仍能启动，后续请求会返回错误
+
+
+def rebuild_knowledge_base(knowledge_base_path="feishu_knowledge_base"):
+    """重新处理飞书文档创建知识库，成功后登记到知识库管理器
     
-    yield
+    Args:
+        knowledge_base_path: 知识库保存路径
+        
+    Returns:
+        DeepSeekKnowledgeBase: 新的知识库实例，若失败则返回None
+    """
+    # 初始化飞书知识处理器
+    feishu_processor = FeishuKnowledgeProcessor()
+    knowledge_base = feishu_processor.process_feishu_documents(save_path=knowledge_base_path)
+    if knowledge_base:
+        get_manager().set(KB_NAME, knowledge_base)
+    return knowledge_base
+
+
+def update_feishu_documents(changed_ids, removed_ids, knowledge_base_path="feishu_knowledge_base"):
+    """只重建变化和已删除的飞书文档的索引，并保存知识库
     
-    # 关闭时清理
-    logger.info("应用正在关闭...")
+    Args:
+        changed_ids: 内容或标题发生变化的文档ID列表
+        removed_ids: 已删除的文档ID列表
+        knowledge_base_path: 知识库保存路径
+        
+    Returns:
+        list: 获取内容失败、需要稍后重试的文档ID
+    """
+    manager = get_manager()
+    knowledge_base = manager.get(KB_NAME) or manager.new_knowledge_base()
+    result = FeishuKnowledgeProcessor().reindex_documents(knowledge_base, changed_ids, removed_ids)
+    if result['removed_chunks'] or result['added_chunks']:
+        knowledge_base.save_knowledge_base(knowledge_base_path)
+        manager.set(KB_NAME, knowledge_base)
+    logger.info(f"飞书文档增量更新完成: 删除 {result['removed_chunks']} 个片段，新增 {result['added_chunks']} 个片段"
+                + (f"，获取失败 {len(result['failed'])} 个文档" if result['failed'] else "")
+                + (f"，忽略不属于本知识库的 {len(result['ignored'])} 个文档" if result['ignored'] else ""))
+    return result['failed']
 
-# 创建FastAPI应用
-app = FastAPI(title="飞书知识库问答API", 
-              description="一个基于飞书云文档和直属库的RAG知识库问答接口",
-              version="1.0.0",
-              lifespan=lifespan)
 
-# 配置CORS，允许所有来源
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+def _on_feishu_documents_changed(changed_ids, removed_ids):
+    """重建队列回调：多工作进程模式下转交主进程执行，否则在本进程内增量更新
+    
+    Returns:
+        list: 需要稍后重试的文档ID
+    """
+    if get_manager().forward_change(KB_NAME, document_ids=changed_ids, removed_document_ids=removed_ids):
+        return []
+    return update_feishu_documents(changed_ids, removed_ids)
+
+
+# 飞书事件的去重记录和待重建文档队列，收到第一个事件时启动
+_event_deduplicator = EventDeduplicator(ttl=float(os.getenv('FEISHU_EVENT_DEDUP_TTL', '21600') or 21600))
+_reindex_queue = DocumentReindexQueue(
+    _on_feishu_documents_changed,
+    debounce=float(os.getenv('FEISHU_EVENT_DEBOUNCE', '1') or 1),
 )
 
-# 全局知识库实例
-knowledge_base = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期管理"""
+    # 启动时初始化
+    initialize_knowledge_base()
+    
+    yield
+    
+    # 关闭时清理
+    logger.info("应用正在关闭...")
+    _reindex_queue.stop()
+
+# 路由集合，既用于本服务独立运行，也可挂载到合并服务中
+router = APIRouter(default_response_class=JSON_RESPONSE_CLASS)
 
 # 请求和响应模型
 class QueryRequest(BaseModel):
@@ -73,35 +144,35 @@ class QueryRequest(BaseModel):
     use_fallback: bool = Field(False, description="查询失败时是否使用默认回复")
     knowledge_base_path: Optional[str] = Field("feishu_knowledge_base", description="知识库路径")
 
-class KnowledgeResponse(BaseModel):
-    success: bool = Field(..., description="操作是否成功")
-    message: str = Field(..., description="操作结果消息")
-    answer: Optional[str] = Field(None, description="问题答案")
-    processing_time: Optional[float] = Field(None, description="处理时间(秒)")
-
 
 # API端点
-@app.get("/", tags=["基础接口"])
+@router.get("/", tags=["基础接口"])
 async def root():
     return {"message": "欢迎使用飞书知识库问答API", "status": "running"}
 
-@app.get("/status", tags=["基础接口"])
+@router.get("/status", tags=["基础接口"])
 async def get_status():
     """获取API服务状态"""
+    knowledge_base = get_manager().get(KB_NAME)
     model_type = os.getenv('MODEL_TYPE', 'deepseek').lower()
     kb_status = "已初始化" if knowledge_base else "未初始化"
     return {
         "status": "running",
         "model_type": model_type,
-        "knowledge_base_status": kb_status
+        "knowledge_base_status": kb_status,
+        "llm_providers": knowledge_base.llm_router.status() if knowledge_base else [],
+        "admission": get_admission_controller().status(),
+        "feishu_events": _reindex_queue.status()
     }
 
-@app.post("/query", tags=["问答接口"], response_model=KnowledgeResponse)
-async def query_knowledge(request: QueryRequest):
+@router.post("/query", tags=["问答接口"], response_model=KnowledgeResponse)
+async def query_knowledge(request: QueryRequest, http_request: Request):
     """用户上传问题，获取飞书知识库回答"""
     start_time = time.time()
+    # 获取模型调用名额，过载时直接返回503/429和Retry-After
+    release = await admit(http_request)
     try:
-        global knowledge_base
+        knowledge_base = get_manager().get(KB_NAME)
         
         # 检查知识库是否初始化，如果没有初始化则尝试初始化
         if not knowledge_base:
@@ -116,46 +187,99 @@ async def query_knowledge(request: QueryRequest):
             if not knowledge_base:
                 raise HTTPException(status_code=503, detail="飞书知识库初始化失败，请检查飞书配置和文档访问权限")
             
+            get_manager().set(KB_NAME, knowledge_base)
             logger.info("飞书知识库初始化成功")
         
         # 处理用户问题
-        result = knowledge_base.query_knowledge_base(request.question)
-        
-        if not result or not result.get('answer'):
-            if request.use_fallback:
-                return KnowledgeResponse(
-                    success=True,
-                    message="查询成功，但知识库中没有找到相关信息",
-                    answer="抱歉，我无法从现有知识库中找到相关信息。",
-                    processing_time=round(time.time() - start_time, 2)
-                )
-            else:
-                raise HTTPException(status_code=404, detail="在知识库中未找到相关信息")
-        
-        return KnowledgeResponse(
-            success=True,
-            message="查询成功",
-            answer=result['answer'],
-            processing_time=round(time.time() - start_time, 2)
-        )
+        return await answer_question(knowledge_base, request.question, request.use_fallback, start_time)
     except HTTPException as he:
         raise he
     except Exception as e:
         logger.error(f"查询飞书知识库出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"查询飞书知识库出错: {str(e)}")
+    finally:
+        release()
+
+@router.post("/query/stream", tags=["问答接口"])
+async def stream_query_knowledge(request: QueryRequest, http_request: Request):
+    """以流式文本返回飞书知识库回答，与同时到达的相同问题共享一次检索和模型调用"""
+    # 流式响应在输出结束后才释放模型调用名额
+    release = await admit(http_request)
+    try:
+        return stream_answer(get_manager().get(KB_NAME), request.question, on_complete=release)
+    except HTTPException as he:
+        release()
+        raise he
+    except Exception as e:
+        release()
+        logger.error(f"查询知识库出错: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"查询知识库出错: {str(e)}")
+
+@router.post("/knowledge/search", tags=["问答接口"], response_model=SearchResponse)
+async def search_knowledge(request: SearchRequest):
+    """只检索飞书知识库中的相关片段，不调用大语言模型，支持按元数据过滤"""
+    start_time = time.time()
+    try:
+        return await search_chunks(get_manager().get(KB_NAME), request, start_time)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"检索知识库出错: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"检索知识库出错: {str(e)}")
+
+@router.get("/knowledge/chunks/{chunk_id}", tags=["问答接口"], response_model=Chunk)
+async def get_knowledge_chunk(chunk_id: str):
+    """按ID获取飞书知识库片段的完整内容，配合来源预览或只返回ID的响应按需读取全文"""
+    return get_chunk(get_manager().get(KB_NAME), chunk_id)
+
+@router.post("/feishu/events", tags=["知识库操作"])
+async def receive_feishu_event(request: Request):
+    """飞书事件订阅的请求地址：响应URL校验，收到云文档变更事件后只重建该文档的索引
+    
+    飞书要求3秒内响应，这里只校验、去重并放入重建队列，重建在后台线程中进行。
+    """
+    body = await request.body()
+    try:
+        payload = parse_event(body, request.headers,
+                              verification_token=os.getenv('FEISHU_EVENT_VERIFICATION_TOKEN', ''),
+                              encrypt_key=os.getenv('FEISHU_EVENT_ENCRYPT_KEY', ''))
+    except EventRejected as e:
+        FEISHU_EVENTS.inc(event_type="unknown", result="rejected")
+        logger.warning(f"拒绝飞书事件: {e.detail}")
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    
+    if payload.get("type") == "url_verification":
+        return {"challenge": payload.get("challenge")}
+    
+    event_id, event_type, document_id, action, created_at = document_change(payload)
+    if event_id and _event_deduplicator.seen(event_id):
+        FEISHU_EVENTS.inc(event_type=event_type, result="duplicate")
+        return {"code": 0, "msg": "duplicate"}
+    if not document_id:
+        FEISHU_EVENTS.inc(event_type=event_type, result="ignored")
+        return {"code": 0, "msg": "ignored"}
+    
+    _reindex_queue.submit(document_id, action, created_at)
+    FEISHU_EVENTS.inc(event_type=event_type, result="accepted")
+    logger.info(f"收到飞书事件 {event_type}，文档 {document_id} 已加入重建队列")
+    return {"code": 0, "msg": "accepted"}
 
-@app.post("/reload_knowledge_base", tags=["知识库操作"], response_model=KnowledgeResponse)
+@router.post("/reload_knowledge_base", tags=["知识库操作"], response_model=KnowledgeResponse)
 async def reload_knowledge_base(knowledge_base_path: str = "feishu_knowledge_base"):
     """重新加载飞书知识库"""
     try:
-        global knowledge_base
         logger.info(f"正在重新加载飞书知识库: {knowledge_base_path}")
         
-        # 初始化飞书知识处理器
-        feishu_processor = FeishuKnowledgeProcessor()
+        # 多工作进程模式下转交主进程执行，所有工作进程统一切换到新知识库
+        if get_manager().forward_change(KB_NAME, knowledge_base_path=knowledge_base_path):
+            return KnowledgeResponse(
+                success=True,
+                message="已提交飞书知识库重新加载，所有工作进程将依次切换",
+                answer=None
+            )
         
         # 重新处理飞书文档并创建知识库
-        knowledge_base = feishu_processor.process_feishu_documents(save_path=knowledge_base_path)
+        knowledge_base = rebuild_knowledge_base(knowledge_base_path)
         
         if not knowledge_base:
             raise HTTPException(status_code=500, detail="飞书知识库重新加载失败")
@@ -169,6 +293,33 @@ async def reload_knowledge_base(knowledge_base_path: str = "feishu_knowledge_bas
         logger.error(f"重新加载飞书知识库出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"重新加载飞书知识库出错: {str(e)}")
 
+# 创建FastAPI应用
+app = FastAPI(title="飞书知识库问答API", 
+              description="一个基于飞书云文档和直属库的RAG知识库问答接口",
+              version="1.0.0",
+              lifespan=lifespan)
+
+# 配置CORS，允许所有来源
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# 注册请求计时中间件和Prometheus指标端点
+install_metrics(app, "feishu")
+
+# 较大的JSON响应以gzip压缩
+install_response_compression(app)
+# 按需性能剖析(PROFILING_ENABLED)，未启用时不注册
+install_profiling(app)
+# 请求ID(X-Request-ID)，写入知识库日志和慢查询日志
+install_request_id(app)
+
+app.include_router(router)
+
 # 运行服务器
 if __name__ == "__main__":
     import uvicorn
@@ -176,4 +327,4 @@ if __name__ == "__main__":
     port_str = os.getenv("FEISHU_API_PORT", "8002")
     # 如果环境变量存在但为空，使用默认值
     port = int(port_str) if port_str and port_str.strip() else 8002
-    uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
@@ -1,7 +1,7 @@
 # 导入必要的库
 import os
 import logging
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from typing import Optional
@@ -11,6 +11,19 @@ import time
 # 导入项目中的Word文档处理类
 from process_word_knowledge import WordKnowledgeProcessor
 
+# 导入进程内共享的知识库管理器和公共问答逻辑
+from knowledge_manager import get_manager
+from api_common import (KnowledgeResponse, answer_question, stream_answer, SearchRequest, SearchResponse,
+                        search_chunks, Chunk, get_chunk, JSON_RESPONSE_CLASS, install_response_compression)
+
+# 导入指标模块，用于暴露/metrics端点
+from metrics import install_metrics
+from profiling import install_profiling
+from query_log import install_request_id
+
+# 导入准入控制，限制同时进行的模型调用并在过载时快速拒绝
+from admission import admit, get_admission_controller
+
 # 从.env文件加载环境变量
 from dotenv import load_dotenv
 load_dotenv()
@@ -19,48 +32,120 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """应用生命周期管理"""
-    global knowledge_base
-    # 启动时初始化
+# 本服务在知识库管理器中的名称
+KB_NAME = "rag"
+
+# 文档目录监听器(WORD_DOC_WATCH开启时创建)
+_watcher = None
+
+
+def initialize_knowledge_base():
+    """启动时初始化Word文档知识库并登记到知识库管理器"""
     try:
         # 输出当前使用的模型信息
         model_type = os.getenv('MODEL_TYPE', 'deepseek').lower()
         logger.info(f"当前使用的模型类型: {model_type}")
         
+        # 在首次入库之前记录文档目录快照，入库期间发生的变化也会被增量处理
+        watcher = create_document_watcher()
+        
         # 初始化知识库
         knowledge_base = WordKnowledgeProcessor.process_word_document()
+        get_manager().set(KB_NAME, knowledge_base)
         if knowledge_base:
             logger.info("知识库实例已成功初始化")
         else:
             logger.warning("知识库初始化失败，将在首次请求时尝试重新初始化")
+        if watcher:
+            watcher.start()
     except Exception as e:
         logger.error(f"初始化知识库失败: {str(e)}")
         # 即使初始化失败，应用仍能启动，后续请求会返回错误
+
+
+def create_document_watcher():
+    """WORD_DOC_WATCH开启时创建WORD_DOC_PATH的监听器(尚未启动)，已创建过时返回None
+    
+    Returns:
+        DocumentWatcher: 新建的监听器，未开启监听或已存在时返回None
+    """
+    global _watcher
+    doc_path = os.getenv('WORD_DOC_PATH')
+    if _watcher is not None or not doc_path or os.getenv('WORD_DOC_WATCH', 'false').lower() != 'true':
+        return None
+    from doc_watcher import DocumentWatcher
+    _watcher = DocumentWatcher(
+        doc_path,
+        on_change=_on_documents_changed,
+        debounce=float(os.getenv('WORD_DOC_WATCH_DEBOUNCE', '2') or 2),
+        poll_interval=float(os.getenv('WORD_DOC_WATCH_POLL_INTERVAL', '5') or 5),
+    )
+    return _watcher
+
+
+def _on_documents_changed(changed_paths, removed_paths):
+    """监听器回调：多工作进程模式下转交主进程执行，否则在本进程内增量更新
+    
+    Returns:
+        list: 未能加载、需要稍后重试的文件
+    """
+    if get_manager().forward_change(KB_NAME, changed_paths=changed_paths, removed_paths=removed_paths):
+        return []
+    return update_documents(changed_paths, removed_paths)
+
+
+def update_documents(changed_paths, removed_paths, knowledge_base_path="word_knowledge_base"):
+    """只对新增、修改和删除的文档增量重建索引，并保存知识库
+    
+    Args:
+        changed_paths: 新增或修改的文档路径列表
+        removed_paths: 已删除的文档路径列表
+        knowledge_base_path: 知识库保存路径
+        
+    Returns:
+        list: 未能加载、需要稍后重试的文件
+    """
+    manager = get_manager()
+    knowledge_base = manager.get(KB_NAME) or manager.new_knowledge_base()
+    result = knowledge_base.update_sources(changed_paths, removed_paths)
+    if knowledge_base.vector_store:
+        knowledge_base.save_knowledge_base(knowledge_base_path)
+        manager.set(KB_NAME, knowledge_base)
+    logger.info(f"文档增量更新完成: 删除 {result['removed_chunks']} 个片段，新增 {result['added_chunks']} 个片段"
+                + (f"，加载失败 {len(result['failed'])} 个文件" if result['failed'] else ""))
+    return result['failed']
+
+
+def rebuild_knowledge_base(knowledge_base_path="word_knowledge_base"):
+    """重新处理Word文档创建知识库，成功后登记到知识库管理器
+    
+    Args:
+        knowledge_base_path: 知识库保存路径
+        
+    Returns:
+        DeepSeekKnowledgeBase: 新的知识库实例，若失败则返回None
+    """
+    knowledge_base = WordKnowledgeProcessor.process_word_document(save_path=knowledge_base_path)
+    if knowledge_base:
+        get_manager().set(KB_NAME, knowledge_base)
+    return knowledge_base
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期管理"""
+    # 启动时初始化
+    initialize_knowledge_base()
     
     yield
     
     # 关闭时清理
     logger.info("应用正在关闭...")
+    if _watcher:
+        _watcher.stop()
 
-# 创建FastAPI应用
-app = FastAPI(title="RAG知识库问答API", 
-              description="一个简单的RAG知识库问答接口，用户只需上传问题即可获取答案",
-              version="1.0.0",
-              lifespan=lifespan)
-
-# 配置CORS，允许所有来源
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# 全局知识库实例
-knowledge_base = None
+# 路由集合，既用于本服务独立运行，也可挂载到合并服务中
+router = APIRouter(default_response_class=JSON_RESPONSE_CLASS)
 
 # 请求和响应模型
 class QueryRequest(BaseModel):
@@ -68,35 +153,35 @@ class QueryRequest(BaseModel):
     use_fallback: bool = Field(False, description="查询失败时是否使用默认回复")
     knowledge_base_path: Optional[str] = Field("word_knowledge_base", description="知识库路径")
 
-class KnowledgeResponse(BaseModel):
-    success: bool = Field(..., description="操作是否成功")
-    message: str = Field(..., description="操作结果消息")
-    answer: Optional[str] = Field(None, description="问题答案")
-    processing_time: Optional[float] = Field(None, description="处理时间(秒)")
-
 
 # API端点
-@app.get("/", tags=["基础接口"])
+@router.get("/", tags=["基础接口"])
 async def root():
     return {"message": "欢迎使用RAG知识库问答API", "status": "running"}
 
-@app.get("/status", tags=["基础接口"])
+@router.get("/status", tags=["基础接口"])
 async def get_status():
     """获取API服务状态"""
+    knowledge_base = get_manager().get(KB_NAME)
     model_type = os.getenv('MODEL_TYPE', 'deepseek').lower()
     kb_status = "已初始化" if knowledge_base else "未初始化"
     return {
         "status": "running",
         "model_type": model_type,
-        "knowledge_base_status": kb_status
+        "knowledge_base_status": kb_status,
+        "llm_providers": knowledge_base.llm_router.status() if knowledge_base else [],
+        "admission": get_admission_controller().status(),
+        "document_watcher": _watcher.status() if _watcher else None
     }
 
-@app.post("/query", tags=["问答接口"], response_model=KnowledgeResponse)
-async def query_knowledge(request: QueryRequest):
+@router.post("/query", tags=["问答接口"], response_model=KnowledgeResponse)
+async def query_knowledge(request: QueryRequest, http_request: Request):
     """用户上传问题，获取知识库回答"""
     start_time = time.time()
+    # 获取模型调用名额，过载时直接返回503/429和Retry-After
+    release = await admit(http_request)
     try:
-        global knowledge_base
+        knowledge_base = get_manager().get(KB_NAME)
         
         # 检查知识库是否初始化，如果没有初始化则尝试初始化
         if not knowledge_base:
@@ -106,43 +191,67 @@ async def query_knowledge(request: QueryRequest):
             if not knowledge_base:
                 raise HTTPException(status_code=503, detail="知识库初始化失败，请检查Word文档路径和模型配置")
             
+            get_manager().set(KB_NAME, knowledge_base)
             logger.info("知识库初始化成功")
         
         # 处理用户问题
-        result = knowledge_base.query_knowledge_base(request.question)
-        
-        if not result or not result.get('answer'):
-            if request.use_fallback:
-                return KnowledgeResponse(
-                    success=True,
-                    message="查询成功，但知识库中没有找到相关信息",
-                    answer="抱歉，我无法从现有知识库中找到相关信息。",
-                    processing_time=round(time.time() - start_time, 2)
-                )
-            else:
-                raise HTTPException(status_code=404, detail="在知识库中未找到相关信息")
-        
-        return KnowledgeResponse(
-            success=True,
-            message="查询成功",
-            answer=result['answer'],
-            processing_time=round(time.time() - start_time, 2)
-        )
+        return await answer_question(knowledge_base, request.question, request.use_fallback, start_time)
     except HTTPException as he:
         raise he
     except Exception as e:
         logger.error(f"查询知识库出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"查询知识库出错: {str(e)}")
+    finally:
+        release()
+
+@router.post("/query/stream", tags=["问答接口"])
+async def stream_query_knowledge(request: QueryRequest, http_request: Request):
+    """以流式文本返回知识库回答，与同时到达的相同问题共享一次检索和模型调用"""
+    # 流式响应在输出结束后才释放模型调用名额
+    release = await admit(http_request)
+    try:
+        return stream_answer(get_manager().get(KB_NAME), request.question, on_complete=release)
+    except HTTPException as he:
+        release()
+        raise he
+    except Exception as e:
+        release()
+        logger.error(f"查询知识库出错: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"查询知识库出错: {str(e)}")
+
+@router.post("/knowledge/search", tags=["问答接口"], response_model=SearchResponse)
+async def search_knowledge(request: SearchRequest):
+    """只检索Word知识库中的相关片段，不调用大语言模型，支持按元数据过滤"""
+    start_time = time.time()
+    try:
+        return await search_chunks(get_manager().get(KB_NAME), request, start_time)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"检索知识库出错: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"检索知识库出错: {str(e)}")
+
+@router.get("/knowledge/chunks/{chunk_id}", tags=["问答接口"], response_model=Chunk)
+async def get_knowledge_chunk(chunk_id: str):
+    """按ID获取Word知识库片段的完整内容，配合来源预览或只返回ID的响应按需读取全文"""
+    return get_chunk(get_manager().get(KB_NAME), chunk_id)
 
-@app.post("/reload_knowledge_base", tags=["知识库操作"], response_model=KnowledgeResponse)
+@router.post("/reload_knowledge_base", tags=["知识库操作"], response_model=KnowledgeResponse)
 async def reload_knowledge_base(knowledge_base_path: str = "word_knowledge_base"):
     """重新加载知识库"""
     try:
-        global knowledge_base
         logger.info(f"正在重新加载知识库: {knowledge_base_path}")
         
+        # 多工作进程模式下转交主进程执行，所有工作进程统一切换到新知识库
+        if get_manager().forward_change(KB_NAME, knowledge_base_path=knowledge_base_path):
+            return KnowledgeResponse(
+                success=True,
+                message="已提交知识库重新加载，所有工作进程将依次切换",
+                answer=None
+            )
+        
         # 重新加载知识库
-        knowledge_base = WordKnowledgeProcessor.process_word_document(save_path=knowledge_base_path)
+        knowledge_base = rebuild_knowledge_base(knowledge_base_path)
         
         if not knowledge_base:
             raise HTTPException(status_code=500, detail="知识库重新加载失败")
@@ -156,6 +265,33 @@ async def reload_knowledge_base(knowledge_base_path: str = "word_knowledge_base"
         logger.error(f"重新加载知识库出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"重新加载知识库出错: {str(e)}")
 
+# 创建FastAPI应用
+app = FastAPI(title="RAG知识库问答API", 
+              description="一个简单的RAG知识库问答接口，用户只需上传问题即可获取答案",
+              version="1.0.0",
+              lifespan=lifespan)
+
+# 配置CORS，允许所有来源
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# 注册请求计时中间件和Prometheus指标端点
+install_metrics(app, "rag")
+
+# 较大的JSON响应以gzip压缩
+install_response_compression(app)
+# 按需性能剖析(PROFILING_ENABLED)，未启用时不注册
+install_profiling(app)
+# 请求ID(X-Request-ID)，写入知识库日志和慢查询日志
+install_request_id(app)
+
+app.include_router(router)
+
 # 运行服务器
 if __name__ == "__main__":
     import uvicorn
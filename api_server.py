@@ -1,16 +1,28 @@
 # 导入必要的库
 import os
 import logging
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from contextlib import asynccontextmanager
 from pydantic import BaseModel, Field
 from typing import List, Optional
 import tempfile
 import shutil
+import time
 
-# 导入项目中的知识库类
-from langchain_knowledge import DeepSeekKnowledgeBase
+# 导入进程内共享的知识库管理器
+from knowledge_manager import get_manager
+from api_common import (SearchRequest, SearchResponse, search_chunks, Chunk, get_chunk, ResponseOptions, shape_result,
+                        JSON_RESPONSE_CLASS, install_response_compression)
+
+# 导入指标模块，用于暴露/metrics端点
+from metrics import install_metrics
+from profiling import install_profiling
+from query_log import install_request_id
+
+# 导入准入控制，限制同时进行的模型调用并在过载时快速拒绝
+from admission import admit, get_admission_controller
 
 # 从.env文件加载环境变量
 from dotenv import load_dotenv
@@ -20,41 +32,60 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """应用生命周期管理"""
-    global knowledge_base
-    # 启动时初始化
+# 本服务在知识库管理器中的名称
+KB_NAME = "server"
+
+
+def initialize_knowledge_base():
+    """启动时创建知识库实例并登记到知识库管理器"""
     try:
-        # 创建知识库实例
-        knowledge_base = DeepSeekKnowledgeBase()
+        # 创建知识库实例，与进程内其他服务共享嵌入模型和模型路由层
+        get_manager().set(KB_NAME, get_manager().new_knowledge_base())
         logger.info("知识库实例已成功初始化")
     except Exception as e:
         logger.error(f"初始化知识库失败: {str(e)}")
         # 即使初始化失败，应用仍能启动，后续请求会返回错误
+
+
+def apply_change(action, **params):
+    """在本进程内执行知识库变更(多工作进程模式下由主进程调用)
+    
+    Args:
+        action: 变更类型，'create'、'load'或'process_word'
+        params: 变更参数，与对应接口的请求字段一致
+        
+    Returns:
+        bool: 是否执行成功
+    """
+    knowledge_base = get_manager().get(KB_NAME)
+    if not knowledge_base:
+        return False
+    if action == "create":
+        return knowledge_base.create_knowledge_base(params["file_paths"])
+    if action == "load":
+        return knowledge_base.load_knowledge_base(params["file_path"])
+    if action == "process_word":
+        if not knowledge_base.create_knowledge_base([params["doc_path"]]):
+            return False
+        knowledge_base.save_knowledge_base(params["save_path"])
+        return True
+    logger.warning(f"未知的知识库变更类型: {action}")
+    return False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期管理"""
+    # 启动时初始化
+    initialize_knowledge_base()
     
     yield
     
     # 关闭时清理
     logger.info("应用正在关闭...")
 
-# 创建FastAPI应用
-app = FastAPI(title="LangChain多模型知识库API", 
-              description="基于FastAPI的知识库问答系统接口，支持多种大语言模型",
-              version="1.0.0",
-              lifespan=lifespan)
-
-# 配置CORS，允许所有来源
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# 全局知识库实例
-knowledge_base = None
+# 路由集合，既用于本服务独立运行，也可挂载到合并服务中
+router = APIRouter(default_response_class=JSON_RESPONSE_CLASS)
 
 # 请求和响应模型
 class CreateKnowledgeBaseRequest(BaseModel):
@@ -64,7 +95,7 @@ class ProcessWordDocumentRequest(BaseModel):
     doc_path: Optional[str] = Field(None, description="Word文档路径，未提供时从环境变量获取")
     save_path: str = Field("word_knowledge_base", description="知识库保存路径")
 
-class QueryRequest(BaseModel):
+class QueryRequest(ResponseOptions):
     question: str = Field(..., description="查询问题")
     use_fallback: bool = Field(False, description="查询失败时是否使用默认回复")
 
@@ -74,7 +105,7 @@ class SaveKnowledgeBaseRequest(BaseModel):
 class LoadKnowledgeBaseRequest(BaseModel):
     file_path: str = Field(..., description="知识库文件路径")
 
-class CreateAndQueryRequest(BaseModel):
+class CreateAndQueryRequest(ResponseOptions):
     file_paths: List[str] = Field(..., description="文档文件路径列表")
     query: str = Field(..., description="查询问题")
     save_path: Optional[str] = Field(None, description="可选的知识库保存路径")
@@ -86,27 +117,39 @@ class KnowledgeBaseResponse(BaseModel):
 
 
 # API端点
-@app.get("/", tags=["基础接口"])
+@router.get("/", tags=["基础接口"])
 async def root():
     return {"message": "欢迎使用LangChain多模型知识库API", "status": "running"}
 
-@app.get("/status", tags=["基础接口"])
+@router.get("/status", tags=["基础接口"])
 async def get_status():
     """获取API服务状态"""
+    knowledge_base = get_manager().get(KB_NAME)
     model_type = os.getenv('MODEL_TYPE', 'deepseek').lower()
     vector_store_status = "已初始化" if (knowledge_base and knowledge_base.vector_store) else "未初始化"
     return {
         "status": "running",
         "model_type": model_type,
-        "vector_store_status": vector_store_status
+        "vector_store_status": vector_store_status,
+        "llm_providers": knowledge_base.llm_router.status() if knowledge_base else [],
+        "admission": get_admission_controller().status()
     }
 
-@app.post("/knowledge/create", tags=["知识库操作"], response_model=KnowledgeBaseResponse)
+@router.post("/knowledge/create", tags=["知识库操作"], response_model=KnowledgeBaseResponse)
 async def create_knowledge_base(request: CreateKnowledgeBaseRequest):
     """创建知识库"""
     try:
+        knowledge_base = get_manager().get(KB_NAME)
         if not knowledge_base:
             raise HTTPException(status_code=500, detail="知识库未初始化")
+        
+        # 多工作进程模式下转交主进程执行，所有工作进程统一切换到新知识库
+        if get_manager().forward_change(KB_NAME, action="create", file_paths=request.file_paths):
+            return KnowledgeBaseResponse(
+                success=True,
+                message="已提交知识库创建，所有工作进程将依次切换",
+                data={"file_count": len(request.file_paths)}
+            )
             
         success = knowledge_base.create_knowledge_base(request.file_paths)
         if not success:
@@ -125,14 +168,18 @@ async def create_knowledge_base(request: CreateKnowledgeBaseRequest):
         logger.error(f"创建知识库出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"创建知识库出错: {str(e)}")
 
-@app.post("/knowledge/query", tags=["知识库操作"], response_model=KnowledgeBaseResponse)
-async def query_knowledge_base(request: QueryRequest):
+@router.post("/knowledge/query", tags=["知识库操作"], response_model=KnowledgeBaseResponse)
+async def query_knowledge_base(request: QueryRequest, http_request: Request):
     """查询知识库"""
+    # 获取模型调用名额，过载时直接返回503/429和Retry-After
+    release = await admit(http_request)
     try:
+        knowledge_base = get_manager().get(KB_NAME)
         if not knowledge_base:
             raise HTTPException(status_code=500, detail="知识库未初始化")
         
-        result = knowledge_base.get_knowledge_answer(request.question, request.use_fallback)
+        # 检索和模型调用放到线程池中执行，避免阻塞事件循环
+        result = await run_in_threadpool(knowledge_base.get_knowledge_answer, request.question, request.use_fallback)
         if not result:
             return KnowledgeBaseResponse(
                 success=False,
@@ -143,16 +190,36 @@ async def query_knowledge_base(request: QueryRequest):
         return KnowledgeBaseResponse(
             success=True,
             message="查询成功",
-            data=result
+            data=shape_result(result, request)
         )
     except Exception as e:
         logger.error(f"查询知识库出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"查询知识库出错: {str(e)}")
+    finally:
+        release()
 
-@app.post("/knowledge/save", tags=["知识库操作"], response_model=KnowledgeBaseResponse)
+@router.post("/knowledge/search", tags=["知识库操作"], response_model=SearchResponse)
+async def search_knowledge_base(request: SearchRequest):
+    """只检索相关片段，不调用大语言模型，支持按来源文件、飞书文档和入库时间过滤"""
+    start_time = time.time()
+    try:
+        return await search_chunks(get_manager().get(KB_NAME), request, start_time)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"检索知识库出错: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"检索知识库出错: {str(e)}")
+
+@router.get("/knowledge/chunks/{chunk_id}", tags=["知识库操作"], response_model=Chunk)
+async def get_knowledge_chunk(chunk_id: str):
+    """按ID获取知识库中片段的完整内容，配合来源预览或只返回ID的响应按需读取全文"""
+    return get_chunk(get_manager().get(KB_NAME), chunk_id)
+
+@router.post("/knowledge/save", tags=["知识库操作"], response_model=KnowledgeBaseResponse)
 async def save_knowledge_base(request: SaveKnowledgeBaseRequest):
     """保存知识库"""
     try:
+        knowledge_base = get_manager().get(KB_NAME)
         if not knowledge_base:
             raise HTTPException(status_code=500, detail="知识库未初始化")
         
@@ -173,13 +240,22 @@ async def save_knowledge_base(request: SaveKnowledgeBaseRequest):
         logger.error(f"保存知识库出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"保存知识库出错: {str(e)}")
 
-@app.post("/knowledge/load", tags=["知识库操作"], response_model=KnowledgeBaseResponse)
+@router.post("/knowledge/load", tags=["知识库操作"], response_model=KnowledgeBaseResponse)
 async def load_knowledge_base(request: LoadKnowledgeBaseRequest):
     """加载知识库"""
     try:
+        knowledge_base = get_manager().get(KB_NAME)
         if not knowledge_base:
             raise HTTPException(status_code=500, detail="知识库未初始化")
         
+        # 多工作进程模式下转交主进程执行，所有工作进程统一切换到新知识库
+        if get_manager().forward_change(KB_NAME, action="load", file_path=request.file_path):
+            return KnowledgeBaseResponse(
+                success=True,
+                message="已提交知识库加载，所有工作进程将依次切换",
+                data={"file_path": request.file_path}
+            )
+        
         success = knowledge_base.load_knowledge_base(request.file_path)
         if not success:
             return KnowledgeBaseResponse(
@@ -197,10 +273,13 @@ async def load_knowledge_base(request: LoadKnowledgeBaseRequest):
         logger.error(f"加载知识库出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"加载知识库出错: {str(e)}")
 
-@app.post("/knowledge/create_and_query", tags=["知识库操作"], response_model=KnowledgeBaseResponse)
-async def create_and_query_knowledge_base(request: CreateAndQueryRequest):
+@router.post("/knowledge/create_and_query", tags=["知识库操作"], response_model=KnowledgeBaseResponse)
+async def create_and_query_knowledge_base(request: CreateAndQueryRequest, http_request: Request):
     """一站式创建知识库并查询"""
+    # 获取模型调用名额，过载时直接返回503/429和Retry-After
+    release = await admit(http_request)
     try:
+        knowledge_base = get_manager().get(KB_NAME)
         if not knowledge_base:
             raise HTTPException(status_code=500, detail="知识库未初始化")
         
@@ -220,16 +299,19 @@ async def create_and_query_knowledge_base(request: CreateAndQueryRequest):
         return KnowledgeBaseResponse(
             success=True,
             message="创建并查询知识库成功",
-            data=result
+            data=shape_result(result, request)
         )
     except Exception as e:
         logger.error(f"创建并查询知识库出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"创建并查询知识库出错: {str(e)}")
+    finally:
+        release()
 
-@app.post("/knowledge/process_word", tags=["Word文档处理"])
+@router.post("/knowledge/process_word", tags=["Word文档处理"])
 async def process_word_document(request: ProcessWordDocumentRequest):
     """处理Word文档并创建知识库"""
     try:
+        knowledge_base = get_manager().get(KB_NAME)
         if not knowledge_base:
             raise HTTPException(status_code=500, detail="知识库未初始化")
         
@@ -247,6 +329,14 @@ async def process_word_document(request: ProcessWordDocumentRequest):
         if not word_doc_path.endswith('.docx'):
             raise HTTPException(status_code=400, detail="仅支持.docx格式的Word文档")
         
+        # 多工作进程模式下转交主进程执行，所有工作进程统一切换到新知识库
+        if get_manager().forward_change(KB_NAME, action="process_word", doc_path=word_doc_path, save_path=request.save_path):
+            return KnowledgeBaseResponse(
+                success=True,
+                message="已提交Word文档处理，所有工作进程将依次切换",
+                data={"doc_path": word_doc_path, "save_path": request.save_path}
+            )
+        
         # 创建知识库
         success = knowledge_base.create_knowledge_base([word_doc_path])
         
@@ -275,10 +365,13 @@ async def process_word_document(request: ProcessWordDocumentRequest):
         logger.error(f"处理Word文档时发生错误: {str(e)}")
         raise HTTPException(status_code=500, detail=f"处理Word文档时发生错误: {str(e)}")
 
-@app.post("/knowledge/upload_and_query", tags=["文件上传"])
-async def upload_and_query_knowledge_base(files: List[UploadFile] = File(...), query: str = "请解释文档中的主要内容"):
+@router.post("/knowledge/upload_and_query", tags=["文件上传"], response_model=KnowledgeBaseResponse)
+async def upload_and_query_knowledge_base(http_request: Request, files: List[UploadFile] = File(...), query: str = "请解释文档中的主要内容"):
     """上传文件并查询知识库"""
+    # 获取模型调用名额，过载时直接返回503/429和Retry-After
+    release = await admit(http_request)
     try:
+        knowledge_base = get_manager().get(KB_NAME)
         if not knowledge_base:
             raise HTTPException(status_code=500, detail="知识库未初始化")
         
@@ -311,6 +404,35 @@ async def upload_and_query_knowledge_base(files: List[UploadFile] = File(...), q
     except Exception as e:
         logger.error(f"上传文件并查询知识库出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"上传文件并查询知识库出错: {str(e)}")
+    finally:
+        release()
+
+# 创建FastAPI应用
+app = FastAPI(title="LangChain多模型知识库API", 
+              description="基于FastAPI的知识库问答系统接口，支持多种大语言模型",
+              version="1.0.0",
+              lifespan=lifespan)
+
+# 配置CORS，允许所有来源
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# 注册请求计时中间件和Prometheus指标端点
+install_metrics(app, "api_server")
+
+# 较大的JSON响应以gzip压缩
+install_response_compression(app)
+# 按需性能剖析(PROFILING_ENABLED)，未启用时不注册
+install_profiling(app)
+# 请求ID(X-Request-ID)，写入知识库日志和慢查询日志
+install_request_id(app)
+
+app.include_router(router)
 
 # 运行服务器
 if __name__ == "__main__":
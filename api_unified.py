@@ -0,0 +1,147 @@
+# 合并的单进程API服务
+# 在一个进程内提供api_server.py、api_rag_knowledge.py和api_feishu_knowledge.py的全部接口，
+# 三组接口共享同一个知识库管理器、嵌入模型和模型路由层，内存占用约为三个独立进程的三分之一。
+# 兼容方式:
+#   - 合并应用: api_server的接口位于根路径，RAG接口位于/rag，飞书接口位于/feishu
+#   - 按原端口: 三组接口仍分别监听API_SERVER_PORT、RAG_API_PORT、FEISHU_API_PORT
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+
+import api_server
+import api_rag_knowledge
+import api_feishu_knowledge
+from knowledge_manager import get_manager
+from metrics import install_metrics
+from profiling import install_profiling
+from query_log import install_request_id
+from api_common import JSON_RESPONSE_CLASS, install_response_compression
+
+# 从.env文件加载环境变量
+from dotenv import load_dotenv
+load_dotenv()
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 各服务模块，决定初始化顺序
+SERVICES = (api_server, api_rag_knowledge, api_feishu_knowledge)
+
+
+def initialize_all():
+    """初始化尚未初始化的各服务知识库，所有知识库共享一个嵌入模型"""
+    manager = get_manager()
+    for service in SERVICES:
+        if manager.get(service.KB_NAME) is None:
+            service.initialize_knowledge_base()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期管理"""
+    # 启动时初始化
+    initialize_all()
+    
+    yield
+    
+    # 关闭时清理
+    logger.info("应用正在关闭...")
+
+
+def _add_common(app, app_name):
+    """为应用配置CORS、指标端点、响应压缩、性能剖析和请求ID"""
+    # 配置CORS，允许所有来源
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    # 注册请求计时中间件和Prometheus指标端点
+    install_metrics(app, app_name)
+    # 较大的JSON响应以gzip压缩
+    install_response_compression(app)
+    # 按需性能剖析(PROFILING_ENABLED)，未启用时不注册
+    install_profiling(app)
+    # 请求ID(X-Request-ID)，写入知识库日志和慢查询日志
+    install_request_id(app)
+
+
+# 创建合并的FastAPI应用
+app = FastAPI(title="知识库问答合并API",
+              description="在单个进程内提供完整API、RAG问答API和飞书问答API，共享知识库管理器和嵌入模型",
+              version="1.0.0",
+              default_response_class=JSON_RESPONSE_CLASS,
+              lifespan=lifespan)
+_add_common(app, "unified")
+
+
+@app.get("/unified/status", tags=["基础接口"])
+async def get_unified_status():
+    """获取合并服务中各知识库和共享嵌入模型的状态"""
+    return get_manager().status()
+
+
+app.include_router(api_server.router)
+app.include_router(api_rag_knowledge.router, prefix="/rag")
+app.include_router(api_feishu_knowledge.router, prefix="/feishu")
+
+
+def build_port_app(service, title, app_name):
+    """为某组接口创建独立监听端口的应用，知识库由合并进程统一初始化"""
+    port_app = FastAPI(title=title, version="1.0.0")
+    _add_common(port_app, app_name)
+    port_app.include_router(service.router)
+    return port_app
+
+
+def _port(name, default):
+    """从环境变量获取端口，处理空字符串和无效值的情况"""
+    port_str = os.getenv(name, str(default))
+    try:
+        return int(port_str) if port_str and port_str.strip() else default
+    except ValueError:
+        logger.warning(f"无效的端口配置 {name}='{port_str}'，使用默认端口 {default}")
+        return default
+
+
+def build_apps():
+    """返回合并应用和三个兼容端口应用及其端口
+
+    Returns:
+        list: (FastAPI应用, 端口)列表
+    """
+    return [
+        (app, _port("UNIFIED_API_PORT", 8003)),
+        (build_port_app(api_server, "LangChain多模型知识库API", "api_server"), _port("API_SERVER_PORT", 8000)),
+        (build_port_app(api_rag_knowledge, "RAG知识库问答API", "rag"), _port("RAG_API_PORT", 8001)),
+        (build_port_app(api_feishu_knowledge, "飞书知识库问答API", "feishu"), _port("FEISHU_API_PORT", 8002)),
+    ]
+
+
+async def serve(host="0.0.0.0"):
+    """在同一个事件循环中启动合并应用和三个兼容端口"""
+    import uvicorn
+
+    # 启动前统一初始化，各端口共享同一批知识库
+    initialize_all()
+
+    apps = build_apps()
+    servers = [
+        uvicorn.Server(uvicorn.Config(target, host=host, port=port, log_level="info"))
+        for target, port in apps
+    ]
+    for target, port in apps:
+        logger.info(f"{target.title} 监听端口 {port}")
+    await asyncio.gather(*(server.serve() for server in servers))
+
+
+# 运行服务器
+if __name__ == "__main__":
+    asyncio.run(serve())
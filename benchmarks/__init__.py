@@ -0,0 +1,3 @@
+# 离线基准测试工具包
+# 使用合成语料、确定性的假聊天模型和可选的假嵌入模型驱动DeepSeekKnowledgeBase，
+# 不访问任何外部服务，结果以JSON输出便于跨提交对比
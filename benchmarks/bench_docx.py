@@ -0,0 +1,184 @@
+# Word文档解析基准测试
+# 用法: python -m benchmarks.bench_docx --sizes-mb 50 200
+# 生成指定大小(document.xml解压后)的合成.docx，包含多级标题、正文、表格和嵌入图片，
+# 在全新的子进程中分别用Docx2txtLoader和流式解析器(docx_reader)加载，对比耗时和峰值内存
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+from benchmarks.utils import environment_info, write_results
+
+_W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+
+_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Default Extension="png" ContentType="image/png"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>
+</Types>"""
+
+_ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+_DOCUMENT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image" Target="media/image1.png"/>
+</Relationships>"""
+
+_STYLES = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:styles xmlns:w="{_W_NS}">
+<w:style w:type="paragraph" w:styleId="Heading1"><w:name w:val="heading 1"/><w:pPr><w:outlineLvl w:val="0"/></w:pPr></w:style>
+<w:style w:type="paragraph" w:styleId="Heading2"><w:name w:val="heading 2"/><w:pPr><w:outlineLvl w:val="1"/></w:pPr></w:style>
+<w:style w:type="paragraph" w:styleId="Heading3"><w:name w:val="heading 3"/><w:pPr><w:outlineLvl w:val="2"/></w:pPr></w:style>
+</w:styles>"""
+
+_DOCUMENT_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    f'<w:document xmlns:w="{_W_NS}" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" '
+    'xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing" '
+    'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main"><w:body>'
+)
+_DOCUMENT_TAIL = "<w:sectPr/></w:body></w:document>"
+
+_SENTENCES = [
+    "知识库系统将文档分割为片段并计算向量，检索时按相似度返回最相关的内容。",
+    "FAISS在内存中保存向量索引，支持精确检索和多种近似检索算法。",
+    "提示词模板决定了大语言模型如何结合检索到的上下文回答问题。",
+    "批量导入时应当控制单次处理的文档数量，避免内存峰值过高。",
+]
+
+
+def _paragraph(text, style=None):
+    ppr = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ""
+    return f"<w:p>{ppr}<w:r><w:t xml:space=\"preserve\">{text}</w:t></w:r></w:p>"
+
+
+def _table(section, rows=4, cols=3):
+    cells = lambda r: "".join(
+        f"<w:tc><w:p><w:r><w:t>第{section}节 表格{r}行{c}列</w:t></w:r></w:p></w:tc>" for c in range(cols)
+    )
+    return "<w:tbl>" + "".join(f"<w:tr>{cells(r)}</w:tr>" for r in range(rows)) + "</w:tbl>"
+
+
+def _image():
+    return (
+        '<w:p><w:r><w:drawing><wp:inline><wp:docPr id="1" name="图片 1" descr="示意图"/>'
+        '<a:graphic><a:graphicData><a:blip r:embed="rId2"/></a:graphicData></a:graphic>'
+        "</wp:inline></w:drawing></w:r></w:p>"
+    )
+
+
+def _section(index):
+    """生成一个包含三级标题、正文、表格和图片的章节XML片段"""
+    parts = [_paragraph(f"第{index}章", "Heading1")]
+    for sub in range(3):
+        parts.append(_paragraph(f"第{index}.{sub}节", "Heading2"))
+        parts.append(_paragraph(f"第{index}.{sub}.1小节", "Heading3"))
+        for i in range(8):
+            parts.append(_paragraph(f"[{index}.{sub}.{i}] " + _SENTENCES[i % len(_SENTENCES)] * 3))
+        parts.append(_table(f"{index}.{sub}"))
+    parts.append(_image())
+    return "".join(parts)
+
+
+def generate_docx(path, size_mb):
+    """流式写出document.xml约为size_mb MB的合成.docx，生成过程不在内存中保留整篇文档
+
+    Returns:
+        int: 生成的章节数量
+    """
+    target = size_mb * 1024 * 1024
+    written = 0
+    sections = 0
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        archive.writestr("_rels/.rels", _ROOT_RELS)
+        archive.writestr("word/_rels/document.xml.rels", _DOCUMENT_RELS)
+        archive.writestr("word/styles.xml", _STYLES)
+        archive.writestr("word/media/image1.png", b"\x89PNG\r\n\x1a\n" + os.urandom(4096))
+        with archive.open("word/document.xml", "w", force_zip64=True) as stream:
+            stream.write(_DOCUMENT_HEAD.encode("utf-8"))
+            while written < target:
+                chunk = _section(sections).encode("utf-8")
+                stream.write(chunk)
+                written += len(chunk)
+                sections += 1
+            stream.write(_DOCUMENT_TAIL.encode("utf-8"))
+    return sections
+
+
+# 在子进程中加载文档的脚本，输出耗时、峰值内存和文本统计
+_LOAD_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+if {loader!r} == "docx2txt":
+    from langchain_community.document_loaders import Docx2txtLoader
+    documents = Docx2txtLoader({path!r}).load()
+else:
+    from docx_reader import StructuredDocxLoader
+    documents = StructuredDocxLoader({path!r}).load()
+elapsed = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+peak = peak if sys.platform == "darwin" else peak * 1024
+print(json.dumps({{
+    "seconds": elapsed,
+    "peak_rss_mb": peak / 1024 / 1024,
+    "documents": len(documents),
+    "characters": sum(len(doc.page_content) for doc in documents),
+    "with_heading_path": sum(1 for doc in documents if doc.metadata.get("heading_path")),
+}}))
+"""
+
+LOADERS = ("docx2txt", "streaming")
+
+
+def _run_loader(loader, path):
+    """在全新的子进程中运行加载器，保证峰值内存互不影响"""
+    completed = subprocess.run(
+        [sys.executable, "-c", _LOAD_SCRIPT.format(loader=loader, path=path)],
+        capture_output=True, text=True, cwd=os.getcwd(),
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr else "子进程失败")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Word文档解析基准测试")
+    parser.add_argument("--sizes-mb", type=int, nargs="+", default=[20, 100],
+                        help="合成文档中document.xml的大小(MB)")
+    parser.add_argument("--loaders", nargs="+", choices=LOADERS, default=list(LOADERS), help="参与对比的加载器")
+    parser.add_argument("--output", default="benchmark_results/docx.json", help="结果JSON路径")
+    args = parser.parse_args(argv)
+
+    results = {"benchmark": "docx", "environment": environment_info(), "runs": []}
+    with tempfile.TemporaryDirectory(prefix="kb_docx_") as work_dir:
+        for size_mb in args.sizes_mb:
+            path = os.path.join(work_dir, f"synthetic_{size_mb}mb.docx")
+            sections = generate_docx(path, size_mb)
+            run = {"xml_size_mb": size_mb, "file_size_mb": round(os.path.getsize(path) / 1024 / 1024, 2),
+                   "sections": sections, "loaders": {}}
+            for loader in args.loaders:
+                stats = _run_loader(loader, path)
+                run["loaders"][loader] = {key: round(value, 3) if isinstance(value, float) else value
+                                          for key, value in stats.items()}
+                print(f"{size_mb:>5} MB {loader:>10}: {stats['seconds']:.2f} s，峰值内存 {stats['peak_rss_mb']:.0f} MB，"
+                      f"{stats['documents']} 个文档")
+            results["runs"].append(run)
+
+    write_results(results, args.output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# 知识库离线基准测试
+# 用法: python -m benchmarks.bench_knowledge_base --sizes 100,1000 --language zh --fake-embeddings
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.corpus import generate_corpus, generate_queries
+from benchmarks.fakes import FakeChatModel, make_fake_embeddings
+from benchmarks.utils import (
+    compare_results, current_rss_bytes, directory_size, environment_info,
+    latency_summary, write_results,
+)
+from metrics import INGEST_STAGE_SECONDS
+
+
+def _stage_seconds():
+    """读取入库各阶段的累计耗时"""
+    return {
+        stage: INGEST_STAGE_SECONDS.snapshot(stage=stage)["sum"]
+        for stage in ("parse", "split", "embed", "index", "save", "load")
+    }
+
+
+def _make_knowledge_base(args):
+    # 延迟导入，使--help等不需要加载知识库模块
+    from langchain_knowledge import DeepSeekKnowledgeBase
+    llm = FakeChatModel(latency=args.llm_latency, token_interval=args.token_interval)
+    embeddings = make_fake_embeddings(args.embedding_size) if args.fake_embeddings else None
+    return DeepSeekKnowledgeBase(llm=llm, embeddings=embeddings)
+
+
+def run_size(args, corpus_size, work_dir):
+    """在指定语料规模下运行一次完整的入库、保存、加载和查询基准
+
+    Returns:
+        dict: 本规模下的测量结果
+    """
+    corpus_dir = os.path.join(work_dir, f"corpus_{corpus_size}")
+    file_paths = generate_corpus(corpus_dir, corpus_size, language=args.language)
+    corpus_bytes = directory_size(corpus_dir)
+
+    rss_before = current_rss_bytes()
+    kb = _make_knowledge_base(args)
+
+    # 入库
+    before = _stage_seconds()
+    ingest_start = time.perf_counter()
+    if not kb.create_knowledge_base(file_paths):
+        raise RuntimeError("创建知识库失败")
+    ingest_seconds = time.perf_counter() - ingest_start
+    after = _stage_seconds()
+    num_chunks = kb.chunk_count()
+
+    # 保存与加载
+    save_path = os.path.join(work_dir, f"kb_{corpus_size}")
+    save_start = time.perf_counter()
+    kb.save_knowledge_base(save_path)
+    save_seconds = time.perf_counter() - save_start
+    load_start = time.perf_counter()
+    kb.load_knowledge_base(save_path)
+    load_seconds = time.perf_counter() - load_start
+
+    # 查询
+    queries = generate_queries(args.queries, language=args.language)
+    for question in queries[:args.warmup]:
+        kb.query_knowledge_base(question)
+    latencies = []
+    for question in queries:
+        start = time.perf_counter()
+        kb.query_knowledge_base(question)
+        latencies.append(time.perf_counter() - start)
+
+    stages = {stage: round(after[stage] - before[stage], 6) for stage in ("parse", "split", "embed", "index")}
+    return {
+        "corpus_size": corpus_size,
+        "corpus_bytes": corpus_bytes,
+        "chunks": num_chunks,
+        "ingest": {
+            "total_seconds": round(ingest_seconds, 6),
+            "stage_seconds": stages,
+            "documents_per_second": round(corpus_size / ingest_seconds, 3) if ingest_seconds else None,
+            "chunks_per_second": round(num_chunks / ingest_seconds, 3) if ingest_seconds else None,
+            "embed_chunks_per_second": round(num_chunks / stages["embed"], 3) if stages["embed"] else None,
+        },
+        "save_seconds": round(save_seconds, 6),
+        "load_seconds": round(load_seconds, 6),
+        "index_bytes": directory_size(save_path),
+        "rss_bytes": current_rss_bytes(),
+        "rss_delta_bytes": current_rss_bytes() - rss_before,
+        "query": latency_summary(latencies),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="知识库离线基准测试")
+    parser.add_argument("--sizes", default="100,1000", help="逗号分隔的语料文档数量")
+    parser.add_argument("--language", choices=["en", "zh"], default="en", help="语料语言")
+    parser.add_argument("--queries", type=int, default=200, help="每个规模的查询次数")
+    parser.add_argument("--warmup", type=int, default=10, help="预热查询次数")
+    parser.add_argument("--fake-embeddings", action="store_true", help="使用确定性假嵌入模型代替HuggingFace模型")
+    parser.add_argument("--embedding-size", type=int, default=384, help="假嵌入模型的向量维度")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="假聊天模型的首token延迟(秒)")
+    parser.add_argument("--token-interval", type=float, default=0.0, help="假聊天模型的逐token间隔(秒)")
+    parser.add_argument("--output", default="benchmark_results/knowledge_base.json", help="结果JSON路径")
+    parser.add_argument("--compare", help="可选，用于对比的基线结果JSON路径")
+    parser.add_argument("--keep-files", action="store_true", help="保留生成的语料和索引")
+    args = parser.parse_args(argv)
+
+    # 保证基准测试不访问网络
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+    work_dir = tempfile.mkdtemp(prefix="kb_bench_")
+    results = {
+        "benchmark": "knowledge_base",
+        "environment": environment_info(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "runs": [],
+    }
+    try:
+        for size in [int(item) for item in args.sizes.split(",") if item.strip()]:
+            print(f"正在运行语料规模 {size} 的基准测试...")
+            run = run_size(args, size, work_dir)
+            results["runs"].append(run)
+            print(
+                f"规模 {size}: {run['chunks']} 个片段，入库 {run['ingest']['total_seconds']:.2f}s，"
+                f"查询 p50={run['query']['p50_ms']}ms p95={run['query']['p95_ms']}ms p99={run['query']['p99_ms']}ms"
+            )
+    finally:
+        if args.keep_files:
+            print(f"语料和索引保留在 {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    write_results(results, args.output)
+    if args.compare:
+        compare_results(results, args.compare)
+    return results
+
+
+if __name__ == "__main__":
+    main()
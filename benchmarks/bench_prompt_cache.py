@@ -0,0 +1,105 @@
+# 提示词前缀缓存基准测试
+# 用法: python -m benchmarks.bench_prompt_cache --documents 200 --queries 300 --prefill-ms-per-1k 50
+# 在同一个知识库上分别以template和cache_friendly两种提示词组装方式执行两组查询：
+#   repeated: 名词原样重复出现(与线上的名词解释流量类似)，两种方式都能整段命中缓存
+#   phrased:  每个查询的写法都不同(大小写、追问句式)，只有问题之前的固定内容能命中缓存
+# 假聊天模型模拟供应商的提示词前缀缓存：按块记录见过的提示词前缀，并为未命中缓存的提示词token增加首token延迟。
+# 报告命中缓存的提示词token比例、首token延迟以及按缓存命中价格折算的提示词费用。
+import argparse
+import os
+import tempfile
+
+from benchmarks.corpus import generate_corpus, generate_queries
+from benchmarks.fakes import FakeChatModel, PrefixCache, make_fake_embeddings
+from benchmarks.utils import environment_info, latency_summary, write_results
+
+# phrased工作负载的问法，与查询序号一起保证每个查询都不相同
+_PHRASINGS = ("{term}", "{term_lower}", "{term}是什么", "what is {term}", "解释一下{term}")
+
+
+def phrased_queries(queries):
+    """把重复的名词改写成各不相同的问法"""
+    phrased = []
+    for i, term in enumerate(queries):
+        text = _PHRASINGS[i % len(_PHRASINGS)].format(term=term, term_lower=term.lower())
+        phrased.append(f"{text} #{i}")
+    return phrased
+
+
+def run_layout(layout, workload, queries, prefill_ms_per_1k, hit_cost_ratio, base):
+    """以指定的提示词组装方式执行全部查询
+
+    Returns:
+        dict: 缓存命中比例、首token延迟分布和相对费用
+    """
+    import query_log
+    from langchain_knowledge import DeepSeekKnowledgeBase
+
+    os.environ["PROMPT_LAYOUT"] = layout
+    llm = FakeChatModel(prefix_cache=PrefixCache(), prefill_seconds_per_1k_tokens=prefill_ms_per_1k / 1000)
+    kb = DeepSeekKnowledgeBase(llm=llm, embeddings=base.embeddings)
+    kb.vector_store = base.vector_store
+    kb._build_qa_chain()
+
+    first_token, prompt_tokens, cached_tokens = [], 0, 0
+    for question in queries:
+        with query_log.trace_query(question, log=False) as trace:
+            result = kb._execute_query(question)
+        first_token.append(trace.stages["llm_first_token"])
+        usage = result["usage"] or {}
+        prompt_tokens += usage.get("prompt_tokens") or 0
+        cached_tokens += usage.get("cached_prompt_tokens") or 0
+
+    uncached = prompt_tokens - cached_tokens
+    return {
+        "layout": layout,
+        "workload": workload,
+        "queries": len(queries),
+        "prompt_tokens": prompt_tokens,
+        "cached_prompt_tokens": cached_tokens,
+        "cache_hit_ratio": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else None,
+        # 以全部按未命中价格计费为1
+        "relative_prompt_cost": round((uncached + cached_tokens * hit_cost_ratio) / prompt_tokens, 4) if prompt_tokens else None,
+        "first_token_latency": latency_summary(first_token),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="提示词前缀缓存基准测试")
+    parser.add_argument("--documents", type=int, default=200, help="知识库的文档数量")
+    parser.add_argument("--queries", type=int, default=300, help="查询数量(名词会重复出现)")
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=50.0,
+                        help="未命中缓存的提示词每1000个token增加的首token延迟(毫秒)")
+    parser.add_argument("--hit-cost-ratio", type=float, default=0.1,
+                        help="命中缓存的提示词token价格与未命中价格之比")
+    parser.add_argument("--language", choices=("en", "zh"), default="en", help="合成语料语言")
+    parser.add_argument("--output", default="benchmark_results/prompt_cache.json", help="结果JSON路径")
+    args = parser.parse_args(argv)
+
+    from langchain_knowledge import DeepSeekKnowledgeBase
+
+    queries = generate_queries(args.queries, language=args.language)
+    workloads = {"repeated": queries, "phrased": phrased_queries(queries)}
+    results = {"benchmark": "prompt_cache", "environment": environment_info(),
+               "prefill_ms_per_1k": args.prefill_ms_per_1k, "hit_cost_ratio": args.hit_cost_ratio,
+               "distinct_queries": {name: len(set(items)) for name, items in workloads.items()}, "layouts": []}
+
+    with tempfile.TemporaryDirectory(prefix="kb_prompt_cache_") as work_dir:
+        file_paths = generate_corpus(os.path.join(work_dir, "corpus"), args.documents, language=args.language)
+        base = DeepSeekKnowledgeBase(llm=FakeChatModel(), embeddings=make_fake_embeddings())
+        if not base.create_knowledge_base(file_paths):
+            raise RuntimeError("创建知识库失败")
+        for workload, items in workloads.items():
+            for layout in ("template", "cache_friendly"):
+                level = run_layout(layout, workload, items, args.prefill_ms_per_1k, args.hit_cost_ratio, base)
+                results["layouts"].append(level)
+                print(f"{workload:>8} {layout:>14}: 缓存命中 {level['cache_hit_ratio']:.1%} 的提示词token，"
+                      f"首token p50 {level['first_token_latency']['p50_ms']:.1f} ms，"
+                      f"提示词费用 {level['relative_prompt_cost']:.2f}")
+
+    write_results(results, args.output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
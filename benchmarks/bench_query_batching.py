@@ -0,0 +1,126 @@
+# 查询微批处理基准测试
+# 用法: python -m benchmarks.bench_query_batching --documents 200 --concurrency 1,8,32 --window-ms 2
+# 在同一个知识库上分别关闭和开启微批处理，以不同并发数持续执行检索(问题向量+FAISS检索，即/query的检索阶段)，
+# 比较吞吐量和延迟。安装了sentence-transformers时默认使用真实嵌入模型，
+# 否则使用按矩阵乘法模拟模型计算量的假嵌入模型(批量计算时同样把一批文本拼接后做矩阵乘法)。
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from benchmarks.bench_thread_budget import make_embeddings
+from benchmarks.corpus import generate_corpus, generate_queries
+from benchmarks.fakes import FakeChatModel
+from benchmarks.utils import environment_info, latency_summary, write_results
+
+
+def _batch_size_snapshot():
+    from micro_batch import QUERY_BATCH_SIZE
+    return QUERY_BATCH_SIZE.snapshot()
+
+
+def run_level(kb, queries, concurrency, duration):
+    """以指定并发数持续检索duration秒
+
+    Returns:
+        dict: 吞吐量、延迟分布以及平均批大小
+    """
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    before = _batch_size_snapshot()
+
+    def worker(offset):
+        position = offset
+        local = []
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            kb._retrieve(queries[position % len(queries)], k=5)
+            local.append(time.perf_counter() - start)
+            position += concurrency
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    after = _batch_size_snapshot()
+    batches = after["count"] - before["count"]
+    return {
+        "concurrency": concurrency,
+        "throughput_qps": round(len(latencies) / elapsed, 1),
+        "latency": latency_summary(latencies),
+        "mean_batch_size": round((after["sum"] - before["sum"]) / batches, 2) if batches else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="查询微批处理基准测试")
+    parser.add_argument("--documents", type=int, default=200, help="知识库的文档数量")
+    parser.add_argument("--queries", type=int, default=500, help="轮流使用的问题数量")
+    parser.add_argument("--concurrency", default="1,8,32", help="逗号分隔的并发级别")
+    parser.add_argument("--duration", type=float, default=5.0, help="每个并发级别的持续时间(秒)")
+    parser.add_argument("--window-ms", type=float, default=2.0, help="开启微批处理时的QUERY_BATCH_WINDOW_MS")
+    parser.add_argument("--max-batch-size", type=int, default=32, help="开启微批处理时的QUERY_BATCH_MAX_SIZE")
+    parser.add_argument("--language", choices=("en", "zh"), default="en", help="合成语料语言")
+    parser.add_argument("--embeddings", choices=("auto", "real", "fake"), default="auto",
+                        help="嵌入模型，auto在安装了sentence-transformers时使用真实模型")
+    parser.add_argument("--output", default="benchmark_results/query_batching.json", help="结果JSON路径")
+    args = parser.parse_args(argv)
+
+    embeddings = args.embeddings
+    if embeddings == "auto":
+        try:
+            import sentence_transformers  # noqa: F401
+            embeddings = "real"
+        except ImportError:
+            embeddings = "fake"
+
+    from langchain_knowledge import DeepSeekKnowledgeBase
+
+    model = make_embeddings(embeddings)
+    levels = [int(item) for item in args.concurrency.split(",") if item.strip()]
+    queries = generate_queries(args.queries, language=args.language)
+    results = {"benchmark": "query_batching", "environment": environment_info(), "embeddings": embeddings,
+               "window_ms": args.window_ms, "max_batch_size": args.max_batch_size, "modes": {}}
+
+    with tempfile.TemporaryDirectory(prefix="kb_batching_") as work_dir:
+        file_paths = generate_corpus(os.path.join(work_dir, "corpus"), args.documents, language=args.language)
+        base = DeepSeekKnowledgeBase(llm=FakeChatModel(), embeddings=model)
+        if not base.create_knowledge_base(file_paths):
+            raise RuntimeError("创建知识库失败")
+
+        for mode, window_ms in (("unbatched", 0), ("batched", args.window_ms)):
+            # 微批处理的配置在创建知识库实例时读取，两种模式共享同一个向量存储
+            os.environ["QUERY_BATCH_WINDOW_MS"] = str(window_ms)
+            os.environ["QUERY_BATCH_MAX_SIZE"] = str(args.max_batch_size)
+            kb = DeepSeekKnowledgeBase(llm=FakeChatModel(), embeddings=model)
+            kb.vector_store = base.vector_store
+            for question in queries[:10]:
+                kb._retrieve(question, k=5)
+            results["modes"][mode] = []
+            for concurrency in levels:
+                level = run_level(kb, queries, concurrency, args.duration)
+                results["modes"][mode].append(level)
+                batch = f"，平均批大小 {level['mean_batch_size']}" if level["mean_batch_size"] else ""
+                print(f"{mode:>9} 并发 {concurrency:>3}: {level['throughput_qps']} 次/秒，"
+                      f"p50 {level['latency']['p50_ms']:.1f} ms，p95 {level['latency']['p95_ms']:.1f} ms{batch}")
+
+    for unbatched, batched in zip(results["modes"]["unbatched"], results["modes"]["batched"]):
+        speedup = batched["throughput_qps"] / unbatched["throughput_qps"] if unbatched["throughput_qps"] else None
+        if speedup:
+            print(f"并发 {unbatched['concurrency']:>3}: 吞吐量 x{speedup:.2f}，"
+                  f"p50延迟 {unbatched['latency']['p50_ms']:.1f} -> {batched['latency']['p50_ms']:.1f} ms")
+
+    write_results(results, args.output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# 进程启动耗时基准测试
+# 用法: python -m benchmarks.bench_startup --fake-embeddings
+# 在全新的子进程中分别测量导入各模块的耗时，以及从进程启动到知识库可以回答第一个问题的耗时
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.utils import environment_info, write_results
+
+# 测量单个模块导入耗时的子进程脚本
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in ("torch", "sentence_transformers", "faiss", "langchain.chains", "langchain_deepseek", "openai") if name in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy_modules_loaded": heavy}}))
+"""
+
+# 测量到首次可用耗时的子进程脚本：加载已保存的索引并回答一个问题
+READY_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from langchain_knowledge import DeepSeekKnowledgeBase
+from benchmarks.fakes import FakeChatModel, make_fake_embeddings
+imported = time.perf_counter()
+embeddings = make_fake_embeddings() if {fake_embeddings} else None
+kb = DeepSeekKnowledgeBase(llm=FakeChatModel(), embeddings=embeddings)
+constructed = time.perf_counter()
+kb.load_knowledge_base({index_path!r})
+loaded = time.perf_counter()
+kb.query_knowledge_base("LangChain")
+answered = time.perf_counter()
+print(json.dumps({{
+    "import_seconds": imported - start,
+    "construct_seconds": constructed - imported,
+    "load_index_seconds": loaded - constructed,
+    "first_query_seconds": answered - loaded,
+    "time_to_first_answer_seconds": answered - start,
+}}))
+"""
+
+# 需要测量导入耗时的模块
+MODULES = ("langchain_knowledge", "api_server", "api_rag_knowledge", "api_feishu_knowledge")
+
+
+def run_in_subprocess(script, repeats, cwd=None):
+    """在全新的子进程中运行脚本多次，返回每次输出的JSON
+
+    Args:
+        script: 子进程脚本，最后一行输出为JSON
+        repeats: 运行次数
+        cwd: 子进程的工作目录(需能导入项目模块)，默认为当前目录
+    """
+    env = dict(os.environ, HF_HUB_OFFLINE="1", TRANSFORMERS_OFFLINE="1")
+    results = []
+    for _ in range(repeats):
+        completed = subprocess.run(
+            [sys.executable, "-c", script],
+            capture_output=True, text=True, env=env, cwd=cwd or os.getcwd(),
+        )
+        if completed.returncode != 0:
+            raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr else "子进程失败")
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def build_index(index_path, fake_embeddings):
+    """构建一个小型知识库索引供启动测试加载"""
+    from benchmarks.corpus import generate_corpus
+    from benchmarks.fakes import FakeChatModel, make_fake_embeddings
+    from langchain_knowledge import DeepSeekKnowledgeBase
+    corpus_dir = os.path.join(os.path.dirname(index_path), "corpus")
+    paths = generate_corpus(corpus_dir, 20)
+    kb = DeepSeekKnowledgeBase(llm=FakeChatModel(), embeddings=make_fake_embeddings() if fake_embeddings else None)
+    kb.create_knowledge_base(paths)
+    kb.save_knowledge_base(index_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="进程启动耗时基准测试")
+    parser.add_argument("--repeats", type=int, default=3, help="每项测量的重复次数，取最小值")
+    parser.add_argument("--fake-embeddings", action="store_true", help="使用确定性假嵌入模型")
+    parser.add_argument("--output", default="benchmark_results/startup.json", help="结果JSON路径")
+    args = parser.parse_args(argv)
+
+    results = {"benchmark": "startup", "environment": environment_info(), "imports": {}, "ready": None}
+    for module in MODULES:
+        runs = run_in_subprocess(IMPORT_SCRIPT.format(module=module), args.repeats)
+        best = min(runs, key=lambda run: run["seconds"])
+        results["imports"][module] = {
+            "seconds": round(best["seconds"], 4),
+            "heavy_modules_loaded": best["heavy_modules_loaded"],
+        }
+        print(f"导入 {module}: {best['seconds'] * 1000:.1f} ms，已加载的重量级模块: {best['heavy_modules_loaded'] or '无'}")
+
+    with tempfile.TemporaryDirectory(prefix="kb_startup_") as work_dir:
+        index_path = os.path.join(work_dir, "kb")
+        build_index(index_path, args.fake_embeddings)
+        runs = run_in_subprocess(READY_SCRIPT.format(index_path=index_path, fake_embeddings=args.fake_embeddings), args.repeats)
+    best = min(runs, key=lambda run: run["time_to_first_answer_seconds"])
+    results["ready"] = {key: round(value, 4) for key, value in best.items()}
+    print(f"从启动到回答第一个问题: {best['time_to_first_answer_seconds'] * 1000:.1f} ms")
+
+    write_results(results, args.output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+# CPU线程预算基准测试
+# 用法: python -m benchmarks.bench_thread_budget --documents 200 --queries 200
+# 分别在全新的子进程中测量三种情况下的检索延迟(问题向量+FAISS检索)：
+#   idle: 只有查询；
+#   unbudgeted: 查询的同时持续入库，各线程库按整台机器的核数创建线程(未设置线程预算时的行为)；
+#   budgeted: 查询的同时持续入库，按KB_QUERY_THREADS/KB_INGEST_THREADS分别限制查询和入库的线程数。
+# 安装了sentence-transformers时默认使用真实嵌入模型(torch)，否则使用按矩阵乘法模拟模型计算量的假嵌入模型。
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.utils import environment_info, write_results
+
+# 在子进程中运行一种情况的脚本，输出检索延迟和入库吞吐
+_SCENARIO_SCRIPT = """
+import glob, json, threading, time
+import thread_budget
+from benchmarks.bench_thread_budget import make_embeddings
+from benchmarks.corpus import generate_queries
+from benchmarks.fakes import FakeChatModel
+from benchmarks.utils import latency_summary
+from langchain_knowledge import DeepSeekKnowledgeBase
+
+embeddings = make_embeddings({embeddings!r})
+kb = DeepSeekKnowledgeBase(llm=FakeChatModel(), embeddings=embeddings)
+kb.create_knowledge_base(sorted(glob.glob({query_corpus!r} + "/*.txt")))
+queries = generate_queries({queries}, language={language!r})
+for question in queries[:10]:
+    kb.search_knowledge_base(question, k=5)
+
+stop = threading.Event()
+ingested = []
+
+def ingest():
+    paths = sorted(glob.glob({ingest_corpus!r} + "/*.txt"))
+    while not stop.is_set():
+        start = time.perf_counter()
+        other = DeepSeekKnowledgeBase(llm=FakeChatModel(), embeddings=embeddings)
+        other.create_knowledge_base(paths)
+        ingested.append((other.vector_store.index.ntotal, time.perf_counter() - start))
+
+worker = threading.Thread(target=ingest, daemon=True)
+if {concurrent_ingest}:
+    worker.start()
+    time.sleep(0.5)
+
+latencies = []
+for question in queries:
+    start = time.perf_counter()
+    kb.search_knowledge_base(question, k=5)
+    latencies.append(time.perf_counter() - start)
+stop.set()
+if {concurrent_ingest}:
+    worker.join()
+
+chunks = sum(count for count, _ in ingested)
+seconds = sum(elapsed for _, elapsed in ingested)
+print(json.dumps({{
+    "query": latency_summary(latencies),
+    "ingest_runs": len(ingested),
+    "ingest_chunks_per_second": round(chunks / seconds, 1) if seconds else None,
+    "budget": thread_budget.status(),
+}}))
+"""
+
+# 模拟模型计算量的假嵌入模型：确定性向量再经过若干次矩阵乘法(走BLAS多线程)
+_FAKE_ROUNDS = 8
+_FAKE_HIDDEN = 1024
+
+
+class ComputeHeavyFakeEmbeddings:
+    """计算量接近小型句向量模型的假嵌入模型，用于没有torch的环境"""
+
+    def __init__(self, size=384, rounds=_FAKE_ROUNDS, hidden=_FAKE_HIDDEN):
+        import numpy as np
+        from benchmarks.fakes import make_fake_embeddings
+        rng = np.random.default_rng(0)
+        self._base = make_fake_embeddings(size)
+        self._up = rng.standard_normal((size, hidden), dtype=np.float32) / np.sqrt(size)
+        self._down = rng.standard_normal((hidden, size), dtype=np.float32) / np.sqrt(hidden)
+        self._rounds = rounds
+
+    def _encode(self, texts):
+        import numpy as np
+        # 每段文本按字符数展开成多个"token"，计算量随文本长度增长；
+        # 与真实模型一样，一批文本的token拼接后一起做矩阵乘法，批越大BLAS的效率越高
+        lengths = [max(1, len(text) // 16) for text in texts]
+        tokens = np.repeat(np.asarray(self._base.embed_documents(texts), dtype=np.float32), lengths, axis=0)
+        for _ in range(self._rounds):
+            tokens = np.tanh(tokens @ self._up) @ self._down
+        offsets = np.cumsum([0] + lengths)
+        return [tokens[start:end].mean(axis=0).tolist() for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def embed_documents(self, texts):
+        return self._encode(texts)
+
+    def embed_query(self, text):
+        return self._encode([text])[0]
+
+    def embed_queries(self, texts):
+        return self._encode(texts)
+
+
+def make_embeddings(kind):
+    """创建嵌入模型: real为sentence-transformers模型，fake为模拟计算量的假模型"""
+    if kind == "real":
+        from langchain_knowledge import LazyEmbeddings
+        return LazyEmbeddings()
+    from langchain_core.embeddings import Embeddings
+
+    class _Embeddings(ComputeHeavyFakeEmbeddings, Embeddings):
+        pass
+    return _Embeddings()
+
+
+# 三种情况: (名称, 是否同时入库, 是否按整机核数创建线程)
+SCENARIOS = (
+    ("idle", False, False),
+    ("unbudgeted", True, True),
+    ("budgeted", True, False),
+)
+
+# 线程库读取的环境变量
+_THREAD_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "RAYON_NUM_THREADS")
+
+
+def _scenario_env(machine_sized, args):
+    env = {key: value for key, value in os.environ.items()
+           if key not in _THREAD_ENV and not key.startswith("KB_")}
+    env.update(HF_HUB_OFFLINE="1", TRANSFORMERS_OFFLINE="1")
+    if machine_sized:
+        cpus = str(os.cpu_count() or 1)
+        env.update({name: cpus for name in _THREAD_ENV})
+        env.update(KB_CPU_BUDGET=cpus, KB_QUERY_THREADS=cpus, KB_INGEST_THREADS=cpus)
+    else:
+        for name, value in (("KB_CPU_BUDGET", args.cpu_budget), ("KB_QUERY_THREADS", args.query_threads),
+                            ("KB_INGEST_THREADS", args.ingest_threads)):
+            if value:
+                env[name] = str(value)
+    return env
+
+
+def _run_scenario(script, env):
+    completed = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True,
+                               env=env, cwd=os.getcwd())
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr else "子进程失败")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CPU线程预算基准测试")
+    parser.add_argument("--documents", type=int, default=200, help="查询用知识库的文档数量")
+    parser.add_argument("--ingest-documents", type=int, default=100, help="并发入库每轮的文档数量")
+    parser.add_argument("--queries", type=int, default=200, help="每种情况执行的检索次数")
+    parser.add_argument("--language", choices=("en", "zh"), default="en", help="合成语料语言")
+    parser.add_argument("--embeddings", choices=("auto", "real", "fake"), default="auto",
+                        help="嵌入模型，auto在安装了sentence-transformers时使用真实模型")
+    parser.add_argument("--cpu-budget", type=int, help="budgeted情况下的KB_CPU_BUDGET")
+    parser.add_argument("--query-threads", type=int, help="budgeted情况下的KB_QUERY_THREADS")
+    parser.add_argument("--ingest-threads", type=int, help="budgeted情况下的KB_INGEST_THREADS")
+    parser.add_argument("--output", default="benchmark_results/thread_budget.json", help="结果JSON路径")
+    args = parser.parse_args(argv)
+
+    embeddings = args.embeddings
+    if embeddings == "auto":
+        try:
+            import sentence_transformers  # noqa: F401
+            embeddings = "real"
+        except ImportError:
+            embeddings = "fake"
+
+    from benchmarks.corpus import generate_corpus
+
+    results = {"benchmark": "thread_budget", "environment": environment_info(),
+               "embeddings": embeddings, "scenarios": {}}
+    with tempfile.TemporaryDirectory(prefix="kb_threads_") as work_dir:
+        query_corpus = os.path.join(work_dir, "query_corpus")
+        ingest_corpus = os.path.join(work_dir, "ingest_corpus")
+        generate_corpus(query_corpus, args.documents, language=args.language)
+        generate_corpus(ingest_corpus, args.ingest_documents, language=args.language, seed=7)
+        for name, concurrent_ingest, machine_sized in SCENARIOS:
+            script = _SCENARIO_SCRIPT.format(
+                embeddings=embeddings, query_corpus=query_corpus, ingest_corpus=ingest_corpus,
+                queries=args.queries, language=args.language, concurrent_ingest=concurrent_ingest,
+            )
+            stats = _run_scenario(script, _scenario_env(machine_sized, args))
+            results["scenarios"][name] = stats
+            query = stats["query"]
+            ingest = f"，入库 {stats['ingest_chunks_per_second']} 片段/秒" if concurrent_ingest else ""
+            print(f"{name:>10}: 检索 p50 {query['p50_ms']:.1f} ms，p95 {query['p95_ms']:.1f} ms，"
+                  f"p99 {query['p99_ms']:.1f} ms{ingest}(查询 {stats['budget']['query_threads']} 线程，"
+                  f"入库 {stats['budget']['ingest_threads']} 线程)")
+
+    write_results(results, args.output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# 合成语料生成工具
+import os
+import random
+
+# 英文语料的词表和术语
+_EN_WORDS = (
+    "system model data index vector query search document chunk embedding "
+    "framework service latency throughput cache retrieval prompt answer token "
+    "pipeline network storage memory process thread request response cluster"
+).split()
+_EN_TERMS = (
+    "LangChain FAISS Transformer Embedding Tokenizer Retriever Reranker Docstore "
+    "Agent Chain Prompt Vectorstore Sharding Replica Snapshot Checkpoint"
+).split()
+
+# 中文语料的词表和术语
+_ZH_WORDS = (
+    "系统 模型 数据 索引 向量 查询 检索 文档 片段 嵌入 框架 服务 延迟 吞吐 缓存 "
+    "提示词 回答 令牌 流程 网络 存储 内存 进程 线程 请求 响应 集群 配置 部署 监控"
+).split()
+_ZH_TERMS = (
+    "知识库 向量数据库 大语言模型 检索增强生成 文本分割 嵌入模型 相似度搜索 提示工程 "
+    "上下文窗口 语义检索 分片索引 快照 检查点 负载均衡 限流 熔断"
+).split()
+
+
+def _vocabulary(language):
+    if language == "zh":
+        return _ZH_WORDS, _ZH_TERMS, ""
+    return _EN_WORDS, _EN_TERMS, " "
+
+
+def generate_paragraph(rng, language="en", sentences=5):
+    """生成一个包含若干句子的段落，每句都围绕一个术语展开"""
+    words, terms, sep = _vocabulary(language)
+    parts = []
+    for _ in range(sentences):
+        term = rng.choice(terms)
+        body = sep.join(rng.choice(words) for _ in range(rng.randint(8, 16)))
+        if language == "zh":
+            parts.append(f"{term}是{body}。")
+        else:
+            parts.append(f"{term} is {body}.")
+    return sep.join(parts)
+
+
+def generate_corpus(output_dir, num_documents, language="en", paragraphs_per_document=8, seed=42):
+    """生成合成语料文件
+
+    Args:
+        output_dir: 语料输出目录
+        num_documents: 文档数量
+        language: 语料语言，'en'或'zh'
+        paragraphs_per_document: 每个文档的段落数
+        seed: 随机种子，相同参数总是生成相同语料
+
+    Returns:
+        list: 生成的文件路径列表
+    """
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i in range(num_documents):
+        paragraphs = [generate_paragraph(rng, language) for _ in range(paragraphs_per_document)]
+        path = os.path.join(output_dir, f"doc_{language}_{i:06d}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n\n".join(paragraphs))
+        paths.append(path)
+    return paths
+
+
+def generate_queries(num_queries, language="en", seed=7):
+    """生成查询列表，查询内容为语料中的术语"""
+    rng = random.Random(seed)
+    _, terms, _ = _vocabulary(language)
+    return [rng.choice(terms) for _ in range(num_queries)]
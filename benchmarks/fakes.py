@@ -0,0 +1,111 @@
+# 基准测试使用的确定性假模型
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class PrefixCache:
+    """模拟供应商的提示词前缀缓存(如DeepSeek的上下文缓存、Ollama的前缀复用)
+
+    按固定长度的块记录见过的提示词前缀，新提示词与之前的提示词共同前缀中完整的块计为命中。
+    """
+
+    def __init__(self, block_chars=256, max_entries=100000):
+        """
+        Args:
+            block_chars: 缓存块的字符数(按4个字符一个token估算，默认约64个token)
+            max_entries: 最多记录的前缀块数量，超过后淘汰最久未使用的
+        """
+        self.block_chars = block_chars
+        self.max_entries = max_entries
+        self._prefixes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, prompt):
+        """返回提示词命中缓存的字符数，并把它的全部前缀块记入缓存"""
+        digests = []
+        digest = hashlib.sha256()
+        for end in range(self.block_chars, len(prompt) + 1, self.block_chars):
+            digest.update(prompt[end - self.block_chars:end].encode("utf-8"))
+            digests.append(digest.copy().hexdigest())
+        cached = 0
+        with self._lock:
+            for position, key in enumerate(digests):
+                if key not in self._prefixes:
+                    break
+                cached = (position + 1) * self.block_chars
+            for key in digests:
+                self._prefixes[key] = True
+                self._prefixes.move_to_end(key)
+            while len(self._prefixes) > self.max_entries:
+                self._prefixes.popitem(last=False)
+        return cached
+
+
+class FakeChatModel(BaseChatModel):
+    """确定性的假聊天模型
+
+    回答内容由提示词的哈希值决定，相同的提示词总是得到相同的回答；
+    可通过latency和token_interval模拟首token延迟和逐token生成速度。
+    设置prefix_cache(PrefixCache)时在用量中报告命中缓存的提示词token(input_token_details.cache_read)，
+    prefill_seconds_per_1k_tokens为未命中缓存的提示词每1000个token增加的首token延迟。
+    """
+    answer_tokens: int = 32
+    latency: float = 0.0
+    token_interval: float = 0.0
+    prefix_cache: Any = None
+    prefill_seconds_per_1k_tokens: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def _answer(self, messages):
+        prompt = "".join(str(message.content) for message in messages)
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        words = [f"tok{digest[(i * 4) % 60:(i * 4) % 60 + 4]}" for i in range(self.answer_tokens)]
+        usage = {
+            # 粗略按4个字符一个token估算提示词长度
+            "input_tokens": max(1, len(prompt) // 4),
+            "output_tokens": len(words),
+            "total_tokens": max(1, len(prompt) // 4) + len(words),
+        }
+        if self.prefix_cache is not None:
+            usage["input_token_details"] = {"cache_read": self.prefix_cache.lookup(prompt) // 4}
+        return words, usage
+
+    def _first_token_delay(self, usage):
+        cached = usage.get("input_token_details", {}).get("cache_read", 0)
+        return self.latency + self.prefill_seconds_per_1k_tokens * (usage["input_tokens"] - cached) / 1000
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        words, usage = self._answer(messages)
+        delay = self._first_token_delay(usage) + self.token_interval * len(words)
+        if delay:
+            time.sleep(delay)
+        message = AIMessage(content=" ".join(words), usage_metadata=usage)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        words, usage = self._answer(messages)
+        delay = self._first_token_delay(usage)
+        if delay:
+            time.sleep(delay)
+        for i, word in enumerate(words):
+            if i and self.token_interval:
+                time.sleep(self.token_interval)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else f" {word}"))
+        # 最后一个分块携带token用量，与主流供应商的流式接口一致
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage))
+
+
+def make_fake_embeddings(size=384):
+    """创建确定性的假嵌入模型，维度默认与all-MiniLM-L6-v2一致"""
+    return DeterministicFakeEmbedding(size=size)
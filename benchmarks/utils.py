@@ -0,0 +1,82 @@
+# 基准测试的公共工具函数
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+# percentile和write_results与索引调优、阈值校准等离线工具共用
+from report_utils import percentile, write_results  # noqa: F401
+
+
+def latency_summary(values):
+    """汇总延迟列表，单位为毫秒"""
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else None,
+        "p50_ms": round(percentile(values, 50) * 1000, 3) if values else None,
+        "p95_ms": round(percentile(values, 95) * 1000, 3) if values else None,
+        "p99_ms": round(percentile(values, 99) * 1000, 3) if values else None,
+        "max_ms": round(max(values) * 1000, 3) if values else None,
+    }
+
+
+def current_rss_bytes():
+    """返回当前进程的常驻内存，无法读取/proc时退回到峰值内存"""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS以字节为单位，Linux以KB为单位
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def directory_size(path):
+    """统计目录(或文件)占用的字节数"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def environment_info():
+    """记录运行环境和当前提交，便于跨提交对比结果"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare_results(current, baseline_path, keys=("p50_ms", "p95_ms", "p99_ms")):
+    """与基线结果对比，打印各语料规模下查询延迟的变化"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    baseline_runs = {run["corpus_size"]: run for run in baseline.get("runs", [])}
+    for run in current.get("runs", []):
+        base = baseline_runs.get(run["corpus_size"])
+        if not base:
+            continue
+        for key in keys:
+            old, new = base["query"].get(key), run["query"].get(key)
+            if old and new:
+                change = (new - old) / old * 100
+                print(f"规模 {run['corpus_size']:>6} {key}: {old:.3f} -> {new:.3f} ms ({change:+.1f}%)")
@@ -0,0 +1,373 @@
+# 离线批量入库
+# 通过create_knowledge_base为很大的文档归档构建索引是"全有或全无"的：save_knowledge_base只在最后执行，
+# 计算了几个小时向量之后进程崩溃，全部结果都会丢失。本工具按批(默认每批100个文件)加载、分割并计算向量，
+# 每批的片段和向量立即写入检查点目录中的段文件；累计一定数量的片段后把索引保存为快照检查点并清理段文件。
+# 中断后重新运行时先加载最近的索引检查点，再把之后写入的段文件直接加入索引(不重新计算向量)，
+# 然后跳过已入库的文件继续处理。全部完成后把知识库保存到输出目录(快照格式，可直接复制到API服务器加载)。
+# 再次运行时只处理新增和修改过的文件(按修改时间和大小判断)，--prune会删除已不在输入中的文件的片段。
+# 检查点目录(默认为"<输出目录>.checkpoint")的结构:
+#   checkpoint.json              当前索引检查点: 索引子目录、已包含的最后一个段编号、已入库文件清单
+#   index-<段编号>/              索引快照(与save_knowledge_base的格式相同)
+#   segment-<段编号>.npy/.json.gz 检查点之后每批的向量、片段和文件清单
+# 用法: python bulk_ingest.py --input /data/archive --output archive_knowledge_base
+#       python bulk_ingest.py --manifest files.txt --output archive_knowledge_base --batch-files 200 --checkpoint-chunks 50000
+import argparse
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import time
+
+# 从.env文件加载环境变量
+from dotenv import load_dotenv
+load_dotenv()
+
+from doc_watcher import list_documents
+from snapshot import atomic_write, fsync_directory
+
+CHECKPOINT_FILE = "checkpoint.json"
+CHECKPOINT_VERSION = 1
+
+# 段文件名: segment-000001.npy(向量)和segment-000001.json.gz(片段和文件清单，最后写入，作为该段完整的标志)
+_SEGMENT_NAME = re.compile(r"^segment-(\d{6})\.json\.gz$")
+_INDEX_NAME = re.compile(r"^index-(\d{6})$")
+
+
+def read_manifest(manifest_path):
+    """读取文件清单：每行一个路径(#开头为注释)，或每行一个含path字段的JSON对象；相对路径相对于清单所在目录
+
+    Returns:
+        list: 文件路径列表(保持清单中的顺序，去除重复)
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    paths = []
+    with open(manifest_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = json.loads(line)["path"] if line.startswith("{") else line
+            paths.append(path if os.path.isabs(path) else os.path.join(base_dir, path))
+    return list(dict.fromkeys(paths))
+
+
+def file_stat(path):
+    """文件的(修改时间ns, 大小)，与doc_watcher判断文件变化的依据相同；文件不存在时返回None"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class IngestCheckpoint:
+    """检查点目录：索引快照加上之后各批的段文件"""
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {"version": CHECKPOINT_VERSION, "index": None, "segment": 0, "files": {}, "chunks": 0}
+
+    def load(self):
+        """读取checkpoint.json并清理崩溃时遗留的未完成文件
+
+        Returns:
+            bool: 是否存在检查点
+        """
+        os.makedirs(self.path, exist_ok=True)
+        file_path = os.path.join(self.path, CHECKPOINT_FILE)
+        exists = os.path.isfile(file_path)
+        if exists:
+            with open(file_path, encoding="utf-8") as f:
+                self.state = json.load(f)
+        # 未被checkpoint.json引用的索引目录是保存中途中断的检查点，已包含在检查点中的段文件是清理前中断留下的
+        for name in os.listdir(self.path):
+            full_path = os.path.join(self.path, name)
+            if _INDEX_NAME.match(name) and name != self.state["index"]:
+                shutil.rmtree(full_path, ignore_errors=True)
+            elif ".tmp-" in name:
+                os.remove(full_path)
+        for sequence in self.segments(through=self.state["segment"]):
+            self._remove_segment(sequence)
+        return exists
+
+    def index_path(self):
+        """当前索引检查点的快照目录，还没有检查点时返回None"""
+        return os.path.join(self.path, self.state["index"]) if self.state["index"] else None
+
+    def segments(self, through=None):
+        """已完整写入的段编号(升序)；through不为None时只返回不大于它的编号，否则只返回检查点之后的段"""
+        sequences = []
+        for name in os.listdir(self.path):
+            match = _SEGMENT_NAME.match(name)
+            if match and os.path.isfile(os.path.join(self.path, f"segment-{match.group(1)}.npy")):
+                sequence = int(match.group(1))
+                if (sequence <= through) if through is not None else (sequence > self.state["segment"]):
+                    sequences.append(sequence)
+        return sorted(sequences)
+
+    def next_sequence(self):
+        return max([self.state["segment"], *self.segments()]) + 1
+
+    def write_segment(self, sequence, files, replaced, documents, vectors):
+        """把一批的向量、片段和文件清单落盘：先写向量，再原子写入片段文件
+
+        Args:
+            sequence: 段编号
+            files: 本批入库的文件 {路径: [修改时间ns, 大小, 片段数]}
+            replaced: 需要先删除旧片段的来源列表(修改过或已删除的文件)
+            documents: 本批的片段
+            vectors: 与片段对应的向量
+        """
+        import numpy as np
+
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(vectors, dtype="float32"), allow_pickle=False)
+        atomic_write(os.path.join(self.path, f"segment-{sequence:06d}.npy"), buffer.getvalue())
+        payload = {
+            "files": files,
+            "replaced": replaced,
+            "rows": [[doc.page_content, doc.metadata] for doc in documents],
+        }
+        atomic_write(
+            os.path.join(self.path, f"segment-{sequence:06d}.json.gz"),
+            gzip.compress(json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8"), compresslevel=1),
+        )
+
+    def read_segment(self, sequence):
+        """读取一个段
+
+        Returns:
+            tuple: (文件清单, 需要删除旧片段的来源列表, 片段列表, 向量数组)
+        """
+        import numpy as np
+        from langchain_core.documents import Document
+
+        vectors = np.load(os.path.join(self.path, f"segment-{sequence:06d}.npy"), allow_pickle=False)
+        with open(os.path.join(self.path, f"segment-{sequence:06d}.json.gz"), "rb") as f:
+            payload = json.loads(gzip.decompress(f.read()))
+        documents = [Document(page_content=content, metadata=metadata) for content, metadata in payload["rows"]]
+        return payload["files"], payload["replaced"], documents, vectors
+
+    def commit(self, kb, sequence, files, embedding_model):
+        """把当前索引保存为新的检查点，包含编号不大于sequence的全部段
+
+        先把快照写入新的index-<段编号>目录，再原子替换checkpoint.json，最后删除旧检查点和已包含的段文件，
+        任一步骤中断时上一个检查点仍然完整。
+        """
+        name = f"index-{sequence:06d}"
+        if kb.vector_store is not None and not kb.save_knowledge_base(os.path.join(self.path, name)):
+            raise RuntimeError("保存索引检查点失败")
+        previous = self.state["index"]
+        self.state = {
+            "version": CHECKPOINT_VERSION,
+            "index": name if kb.vector_store is not None else None,
+            "segment": sequence,
+            "files": files,
+            "chunks": kb.chunk_count(),
+            "embedding_model": embedding_model,
+            "build_params": kb.build_params,
+            "updated_at": time.time(),
+        }
+        self._write_state()
+        if previous and previous != self.state["index"]:
+            shutil.rmtree(os.path.join(self.path, previous), ignore_errors=True)
+        for old in self.segments(through=sequence):
+            self._remove_segment(old)
+
+    def mark_exported(self):
+        """记录当前检查点已保存到输出目录"""
+        self.state["exported"] = self.state["segment"]
+        self._write_state()
+
+    def _write_state(self):
+        atomic_write(
+            os.path.join(self.path, CHECKPOINT_FILE),
+            json.dumps(self.state, ensure_ascii=False).encode("utf-8"),
+        )
+        fsync_directory(self.path)
+
+    def _remove_segment(self, sequence):
+        # 先删除片段文件(段完整的标志)，中断时只会留下无用的向量文件
+        for suffix in (".json.gz", ".npy"):
+            try:
+                os.remove(os.path.join(self.path, f"segment-{sequence:06d}{suffix}"))
+            except OSError:
+                pass
+
+
+def _apply_segment(kb, files, replaced, documents, vectors, records):
+    """把一个段加入索引：先删除被替换来源的旧片段，再加入新片段，并更新已入库文件清单"""
+    kb.remove_sources(replaced)
+    for source in replaced:
+        records.pop(source, None)
+    kb.add_embedded_chunks(documents, vectors)
+    records.update(files)
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def bulk_ingest(paths, output, checkpoint_dir=None, batch_files=100, checkpoint_chunks=20000,
+                prune=False, restart=False, kb=None):
+    """分批入库并定期保存检查点，可从中断处继续
+
+    Args:
+        paths: 需要入库的文件路径列表
+        output: 知识库输出目录
+        checkpoint_dir: 检查点目录，默认为"<output>.checkpoint"
+        batch_files: 每批处理的文件数，中断时最多损失一批的计算
+        checkpoint_chunks: 距离上次检查点累计多少个片段后保存一次索引检查点
+        prune: 是否删除已入库但不在paths中的文件的片段
+        restart: 是否丢弃已有的检查点重新开始
+        kb: 知识库实例，默认由知识库管理器创建(共享嵌入模型)
+
+    Returns:
+        dict: 本次运行的统计(文件总数、跳过、新增、修改、删除、失败的文件数以及片段总数)
+    """
+    import thread_budget
+
+    checkpoint_dir = checkpoint_dir or f"{output.rstrip(os.sep)}.checkpoint"
+    if restart and os.path.isdir(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
+    if kb is None:
+        from knowledge_manager import get_manager
+        kb = get_manager().new_knowledge_base()
+    embedding_model = kb._embedding_model_name()
+
+    checkpoint = IngestCheckpoint(checkpoint_dir)
+    if checkpoint.load():
+        previous_model = checkpoint.state.get("embedding_model")
+        if previous_model and previous_model != embedding_model:
+            raise RuntimeError(f"检查点由嵌入模型 {previous_model} 构建，当前为 {embedding_model}，请使用--restart重新入库")
+        if checkpoint.index_path() and not kb.load_knowledge_base(checkpoint.index_path()):
+            raise RuntimeError(f"无法加载索引检查点 {checkpoint.index_path()}，请使用--restart重新入库")
+        print(f"从检查点继续: 已入库 {len(checkpoint.state['files'])} 个文件，{checkpoint.state['chunks']} 个片段")
+
+    records = dict(checkpoint.state["files"])
+    last_sequence = checkpoint.state["segment"]
+    pending_chunks = 0
+    # 重放检查点之后写入的段，不重新计算向量
+    for sequence in checkpoint.segments():
+        files, replaced, documents, vectors = checkpoint.read_segment(sequence)
+        _apply_segment(kb, files, replaced, documents, vectors, records)
+        last_sequence = sequence
+        pending_chunks += len(documents)
+        print(f"已重放段 {sequence}: {len(files)} 个文件，{len(documents)} 个片段")
+
+    def save_checkpoint(sequence):
+        nonlocal pending_chunks
+        checkpoint.commit(kb, sequence, records, embedding_model)
+        pending_chunks = 0
+        print(f"已保存检查点: {len(records)} 个文件，{kb.chunk_count()} 个片段")
+
+    # 对比文件的修改时间和大小，跳过已入库且未变化的文件
+    todo = []
+    summary = {"files": len(paths), "skipped": 0, "added": 0, "modified": 0, "removed": 0, "failed": 0}
+    for path in paths:
+        stat = file_stat(path)
+        if stat is None:
+            print(f"警告: 文件 {path} 不存在")
+            summary["failed"] += 1
+        elif path in records and records[path][:2] == stat:
+            summary["skipped"] += 1
+        else:
+            todo.append((path, stat))
+    removed = sorted(set(records) - set(paths)) if prune else []
+    print(f"共 {len(paths)} 个文件: 跳过已入库的 {summary['skipped']} 个，待处理 {len(todo)} 个"
+          + (f"，待删除 {len(removed)} 个" if removed else ""))
+
+    start = time.perf_counter()
+    processed = embedded = 0
+    with thread_budget.thread_budget("ingest"):
+        if removed:
+            last_sequence = checkpoint.next_sequence()
+            checkpoint.write_segment(last_sequence, {}, removed, [], [])
+            _apply_segment(kb, {}, removed, [], [], records)
+            summary["removed"] = len(removed)
+
+        for offset in range(0, len(todo), batch_files):
+            batch = todo[offset:offset + batch_files]
+            documents = kb.load_documents([path for path, _ in batch])
+            loaded = {doc.metadata.get("source") for doc in documents}
+            texts = kb.split_documents(documents) if documents else []
+            chunk_counts = {}
+            for doc in texts:
+                chunk_counts[doc.metadata.get("source")] = chunk_counts.get(doc.metadata.get("source"), 0) + 1
+            vectors = kb.embed_chunks(texts) if texts else []
+
+            files = {path: [*stat, chunk_counts.get(path, 0)] for path, stat in batch if path in loaded}
+            replaced = [path for path in files if path in records]
+            summary["failed"] += len(batch) - len(files)
+            summary["modified"] += len(replaced)
+            summary["added"] += len(files) - len(replaced)
+
+            last_sequence = checkpoint.next_sequence()
+            checkpoint.write_segment(last_sequence, files, replaced, texts, vectors)
+            _apply_segment(kb, files, replaced, texts, vectors, records)
+
+            processed += len(batch)
+            embedded += len(texts)
+            pending_chunks += len(texts)
+            elapsed = time.perf_counter() - start
+            remaining = elapsed / processed * (len(todo) - processed)
+            print(f"[段 {last_sequence}] 文件 {processed}/{len(todo)}，本次新增片段 {embedded}，"
+                  f"{embedded / elapsed if elapsed else 0:.1f} 片段/秒，预计剩余 {_format_duration(remaining)}")
+            if pending_chunks >= checkpoint_chunks:
+                save_checkpoint(last_sequence)
+
+    if last_sequence != checkpoint.state["segment"]:
+        save_checkpoint(last_sequence)
+
+    summary["chunks"] = kb.chunk_count()
+    if kb.vector_store is None:
+        print("错误: 没有任何文档入库")
+        return summary
+    # 输出目录只在检查点之后没有保存过(包括上次运行在保存输出前中断)时重新写入
+    if checkpoint.state.get("exported") != last_sequence or not os.path.exists(output):
+        if not kb.save_knowledge_base(output):
+            raise RuntimeError(f"保存知识库到 {output} 失败")
+        checkpoint.mark_exported()
+    else:
+        print(f"知识库 {output} 已是最新")
+    print(f"批量入库完成: 新增 {summary['added']} 个、修改 {summary['modified']} 个、删除 {summary['removed']} 个文件，"
+          f"跳过 {summary['skipped']} 个，失败 {summary['failed']} 个，知识库共 {summary['chunks']} 个片段，"
+          f"耗时 {_format_duration(time.perf_counter() - start)}")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="离线批量入库(分批计算向量，检查点续跑)")
+    parser.add_argument("--input", action="append", default=[], help="文档目录或文件(含子目录中的.docx和.txt)，可重复指定")
+    parser.add_argument("--manifest", help="文件清单(每行一个路径，或每行一个含path字段的JSON对象)")
+    parser.add_argument("--output", required=True, help="知识库输出目录")
+    parser.add_argument("--checkpoint-dir", help="检查点目录，默认为<输出目录>.checkpoint")
+    parser.add_argument("--batch-files", type=int, default=100, help="每批处理的文件数")
+    parser.add_argument("--checkpoint-chunks", type=int, default=20000, help="累计多少个片段后保存一次索引检查点")
+    parser.add_argument("--prune", action="store_true", help="删除已入库但不在本次输入中的文件的片段")
+    parser.add_argument("--restart", action="store_true", help="丢弃已有的检查点，重新入库")
+    args = parser.parse_args(argv)
+
+    paths = []
+    for path in args.input:
+        paths.extend(list_documents(path))
+    if args.manifest:
+        paths.extend(read_manifest(args.manifest))
+    paths = list(dict.fromkeys(paths))
+    if not paths:
+        parser.error("请通过--input或--manifest指定需要入库的文档")
+
+    try:
+        return bulk_ingest(paths, args.output, args.checkpoint_dir, max(1, args.batch_files),
+                           max(1, args.checkpoint_chunks), args.prune, args.restart)
+    except KeyboardInterrupt:
+        print("已中断，重新运行相同的命令即可从检查点继续")
+        return None
+
+
+if __name__ == "__main__":
+    main()
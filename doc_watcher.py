@@ -0,0 +1,253 @@
+# 文档目录监听
+# 监听文档目录(或单个文档)的变化，合并短时间内的连续变化(去抖)后，
+# 对比前后两次目录快照得到新增、修改和删除的文件，交给回调做增量重建索引。
+# 安装了watchdog时使用系统文件事件(Linux上为inotify)触发检查，否则定时轮询目录。
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+from query_log import get_logger
+
+# 会被入库的文档类型
+SUPPORTED_EXTENSIONS = (".txt", ".docx")
+
+logger = get_logger("doc_watcher")
+
+WATCH_LAG_SECONDS = REGISTRY.histogram(
+    "kb_watch_lag_seconds",
+    "文档发生变化到增量索引更新完成的延迟(秒)",
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0),
+)
+REINDEX_SECONDS = REGISTRY.histogram(
+    "kb_reindex_seconds",
+    "一次增量重建索引的耗时(秒)",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+REINDEX_FILES = REGISTRY.counter(
+    "kb_reindex_files_total",
+    "增量重建索引处理的文件数(change: added/modified/removed)",
+    ["change"],
+)
+WATCH_PENDING_FILES = REGISTRY.gauge(
+    "kb_watch_pending_files",
+    "已发现变化、等待重建索引的文件数",
+)
+
+
+def _is_document(name):
+    # 跳过Word编辑时产生的~$临时文件和隐藏文件
+    return name.lower().endswith(SUPPORTED_EXTENSIONS) and not name.startswith(("~$", "."))
+
+
+def list_documents(path):
+    """列出路径下所有可入库的文档(按路径排序)，path为单个文件时返回该文件"""
+    if os.path.isfile(path):
+        return [path]
+    documents = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        documents.extend(os.path.join(root, name) for name in files if _is_document(name))
+    return sorted(documents)
+
+
+def scan_documents(path):
+    """记录每个文档的修改时间和大小，用于对比变化
+
+    Returns:
+        dict: {文档路径: (修改时间ns, 大小)}
+    """
+    snapshot = {}
+    for document in list_documents(path):
+        try:
+            stat = os.stat(document)
+        except OSError:
+            continue
+        snapshot[document] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+def diff_snapshots(old, new):
+    """对比两次快照
+
+    Returns:
+        tuple: (新增文件列表, 修改文件列表, 删除文件列表)
+    """
+    added = sorted(path for path in new if path not in old)
+    modified = sorted(path for path in new if path in old and new[path] != old[path])
+    removed = sorted(path for path in old if path not in new)
+    return added, modified, removed
+
+
+class DocumentWatcher:
+    """监听文档目录并在变化平息后调用回调做增量更新"""
+
+    def __init__(self, path, on_change, debounce=2.0, poll_interval=5.0, max_delay=None):
+        """
+        Args:
+            path: 文档目录或单个文档路径
+            on_change: 回调函数on_change(变化的文件列表, 删除的文件列表)，
+                返回未能处理、需要稍后重试的文件列表(或None)
+            debounce: 最后一次变化后等待多久(秒)再重建，合并连续保存和批量复制产生的多次变化
+            poll_interval: 没有watchdog时轮询目录的间隔(秒)
+            max_delay: 持续有变化时最长等待多久(秒)也要重建一次，默认为debounce的10倍
+        """
+        self.path = path
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.max_delay = max_delay if max_delay is not None else debounce * 10
+        # 创建时记录快照，此后(包括首次入库期间)的变化都会被发现
+        self._snapshot = scan_documents(path)
+        # 轮询时与上一次看到的目录状态比较，文件仍在变化时每次轮询都会推迟重建
+        self._last_seen = self._snapshot
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        # 首次发现未处理变化的时间和最近一次变化的时间(time.monotonic)
+        self._first_event = None
+        self._last_event = None
+        self._thread = None
+        self._observer = None
+        self.mode = None
+        self.reindex_count = 0
+        self.last_reindex = None
+
+    def start(self):
+        """启动监听线程，优先使用watchdog的文件事件，不可用时轮询"""
+        if self._thread is not None:
+            return
+        self.mode = "poll"
+        try:
+            self._start_observer()
+            self.mode = "events"
+        except Exception as e:
+            if not isinstance(e, ImportError):
+                logger.error(f"文件事件监听启动失败，改为轮询: {str(e)}")
+        self._thread = threading.Thread(target=self._run, name="kb-doc-watcher", daemon=True)
+        self._thread.start()
+        logger.info(f"正在监听文档 {self.path} 的变化(方式: {self.mode})")
+
+    def _start_observer(self):
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+
+        watcher = self
+
+        class _Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                paths = [getattr(event, "src_path", ""), getattr(event, "dest_path", "")]
+                if event.is_directory or any(_is_document(os.path.basename(p)) for p in paths if p):
+                    watcher.notify()
+
+        directory = self.path if os.path.isdir(self.path) else os.path.dirname(os.path.abspath(self.path))
+        observer = Observer()
+        observer.schedule(_Handler(), directory, recursive=os.path.isdir(self.path))
+        observer.daemon = True
+        observer.start()
+        self._observer = observer
+
+    def stop(self):
+        """停止监听"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._observer is not None:
+            self._observer.stop()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def notify(self):
+        """记录一次变化并唤醒监听线程，连续变化会推迟重建直到变化平息"""
+        now = time.monotonic()
+        with self._lock:
+            if self._first_event is None:
+                self._first_event = now
+            self._last_event = now
+        self._wakeup.set()
+
+    def _due(self, now):
+        """是否应该开始重建：变化已平息debounce秒，或距首次变化已超过max_delay秒"""
+        with self._lock:
+            if self._first_event is None:
+                return False
+            return (now - self._last_event >= self.debounce
+                    or now - self._first_event >= self.max_delay)
+
+    def _run(self):
+        last_poll = time.monotonic()
+        while not self._stopping.is_set():
+            timeout = self.poll_interval if self.mode == "poll" else None
+            if self._first_event is not None:
+                timeout = min(timeout or self.debounce, self.debounce)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            if self._stopping.is_set():
+                break
+            now = time.monotonic()
+            if self.mode == "poll" and now - last_poll >= self.poll_interval:
+                last_poll = now
+                seen = scan_documents(self.path)
+                if seen != self._last_seen:
+                    self._last_seen = seen
+                    self.notify()
+            if self._due(time.monotonic()):
+                self.check()
+
+    def check(self):
+        """对比目录快照并对变化的文件做增量更新
+
+        Returns:
+            tuple: (新增文件列表, 修改文件列表, 删除文件列表)
+        """
+        with self._lock:
+            first_event = self._first_event
+            self._first_event = None
+            self._last_event = None
+        detected_at = time.time() - (time.monotonic() - first_event) if first_event is not None else time.time()
+
+        current = scan_documents(self.path)
+        added, modified, removed = diff_snapshots(self._snapshot, current)
+        if not (added or modified or removed):
+            return added, modified, removed
+        WATCH_PENDING_FILES.set(len(added) + len(modified) + len(removed))
+        logger.info(f"检测到文档变化: 新增 {len(added)} 个，修改 {len(modified)} 个，删除 {len(removed)} 个")
+
+        start = time.perf_counter()
+        try:
+            failed = self.on_change(added + modified, removed) or []
+        except Exception as e:
+            logger.error(f"增量重建索引出错，稍后重试: {str(e)}")
+            self.notify()
+            WATCH_PENDING_FILES.set(0)
+            return added, modified, removed
+        REINDEX_SECONDS.observe(time.perf_counter() - start)
+
+        # 未能处理的文件(如仍在写入)不计入快照，文件再次变化后重试
+        for path in failed:
+            if path in self._snapshot:
+                current[path] = self._snapshot[path]
+            else:
+                current.pop(path, None)
+        self._snapshot = current
+
+        # 延迟从最早发生变化的文件的修改时间(删除的文件没有修改时间，以发现变化的时间计)算起
+        changed_at = [current[path][0] / 1e9 for path in added + modified if path in current]
+        WATCH_LAG_SECONDS.observe(max(0.0, time.time() - min(changed_at + [detected_at])))
+        REINDEX_FILES.inc(len(added), change="added")
+        REINDEX_FILES.inc(len(modified), change="modified")
+        REINDEX_FILES.inc(len(removed), change="removed")
+        WATCH_PENDING_FILES.set(0)
+        self.reindex_count += 1
+        self.last_reindex = time.strftime("%Y-%m-%dT%H:%M:%S")
+        return added, modified, removed
+
+    def status(self):
+        """返回监听状态"""
+        return {
+            "path": self.path,
+            "mode": self.mode,
+            "documents": len(self._snapshot),
+            "pending": self._first_event is not None,
+            "reindex_count": self.reindex_count,
+            "last_reindex": self.last_reindex,
+        }
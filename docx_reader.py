@@ -0,0 +1,240 @@
+# 流式.docx读取器
+# 以iterparse逐个元素解析word/document.xml，不构建完整的DOM，内存占用与文档大小无关；
+# 按段落和表格行输出文本并记录所在的标题路径，跳过图片、域代码和已删除的修订内容。
+# 相比Docx2txtLoader(整篇读入后提取纯文本)，保留了标题和表格结构，分割时不会跨越章节。
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+
+# WordprocessingML命名空间
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_W = "{" + W_NS + "}"
+
+_P = _W + "p"
+_T = _W + "t"
+_TAB = _W + "tab"
+_BR = _W + "br"
+_CR = _W + "cr"
+_TBL = _W + "tbl"
+_TR = _W + "tr"
+_TC = _W + "tc"
+_BODY = _W + "body"
+_PPR = _W + "pPr"
+_PSTYLE = _W + "pStyle"
+_OUTLINE_LVL = _W + "outlineLvl"
+_VAL = _W + "val"
+_STYLE = _W + "style"
+_STYLE_ID = _W + "styleId"
+_NAME = _W + "name"
+# 图片、VML图形和嵌入对象，其中的文本框内容会在AlternateContent中重复出现，整体跳过
+_SKIPPED = (_W + "drawing", _W + "pict", _W + "object")
+
+# 样式名称中的标题级别，如"heading 1"、"Heading1"、"标题 1"
+_HEADING_NAME = re.compile(r"^(?:heading|标题)\s*(\d)$", re.IGNORECASE)
+# Word中"Title"样式作为最高一级标题
+_TITLE_NAMES = ("title", "标题")
+
+# 单个章节文档的最大字符数，超过后拆分为多个同一标题路径的文档，避免整章文本占用过多内存
+DEFAULT_MAX_SECTION_CHARS = 20000
+
+
+def _read_heading_styles(archive):
+    """从word/styles.xml中读取样式ID到标题级别(1起)的映射"""
+    try:
+        data = archive.read("word/styles.xml")
+    except KeyError:
+        return {}
+    levels = {}
+    for style in ET.fromstring(data).iter(_STYLE):
+        style_id = style.get(_STYLE_ID)
+        if not style_id:
+            continue
+        level = None
+        name = style.find(_NAME)
+        name = name.get(_VAL, "") if name is not None else ""
+        match = _HEADING_NAME.match(name.strip()) or _HEADING_NAME.match(style_id)
+        if match:
+            level = int(match.group(1))
+        elif name.strip().lower() in _TITLE_NAMES or style_id.lower() == "title":
+            level = 0
+        outline = style.find(f"{_PPR}/{_OUTLINE_LVL}")
+        if level is None and outline is not None and outline.get(_VAL, "").isdigit():
+            level = int(outline.get(_VAL)) + 1
+        if level is not None:
+            levels[style_id] = level
+    return levels
+
+
+def _paragraph_level(paragraph, heading_styles):
+    """段落的标题级别，不是标题时返回None"""
+    ppr = paragraph.find(_PPR)
+    if ppr is None:
+        return None
+    outline = ppr.find(_OUTLINE_LVL)
+    if outline is not None and outline.get(_VAL, "").isdigit() and int(outline.get(_VAL)) < 9:
+        return int(outline.get(_VAL)) + 1
+    style = ppr.find(_PSTYLE)
+    if style is not None:
+        style_id = style.get(_VAL, "")
+        if style_id in heading_styles:
+            return heading_styles[style_id]
+        match = _HEADING_NAME.match(style_id)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def _paragraph_text(paragraph):
+    """提取段落中的可见文本，忽略图片、域代码(w:instrText)和已删除内容(w:delText)"""
+    parts = []
+    for element in paragraph.iter():
+        tag = element.tag
+        if tag == _T:
+            if element.text:
+                parts.append(element.text)
+        elif tag == _TAB:
+            parts.append("\t")
+        elif tag in (_BR, _CR):
+            parts.append("\n")
+    return "".join(parts).strip()
+
+
+def iter_docx_blocks(path):
+    """流式读取.docx中的段落和表格行
+
+    Args:
+        path: .docx文件路径
+
+    Yields:
+        dict: {"type": "heading"|"paragraph"|"table_row", "text": 文本, "heading_path": 标题路径列表}
+    """
+    with zipfile.ZipFile(path) as archive:
+        heading_styles = _read_heading_styles(archive)
+        with archive.open("word/document.xml") as stream:
+            headings = []  # [(级别, 标题文本)]
+            body = None
+            depth = 0
+            table_depth = 0
+            skip_depth = 0
+            # 当前表格行(最外层表格)中各单元格的文本
+            row_cells = None
+            cell_parts = None
+
+            for event, element in ET.iterparse(stream, events=("start", "end")):
+                tag = element.tag
+                if event == "start":
+                    depth += 1
+                    if tag in _SKIPPED:
+                        skip_depth += 1
+                    elif tag == _BODY:
+                        body = element
+                    elif tag == _TBL:
+                        table_depth += 1
+                    elif tag == _TR and table_depth == 1:
+                        row_cells = []
+                    elif tag == _TC and table_depth == 1:
+                        cell_parts = []
+                    continue
+
+                depth -= 1
+                if tag in _SKIPPED:
+                    skip_depth -= 1
+                    element.clear()
+                elif skip_depth:
+                    # 图片和图形内部的段落直接丢弃
+                    if tag == _P:
+                        element.clear()
+                elif tag == _P:
+                    if table_depth:
+                        # 表格中的段落(包括嵌套表格)并入当前单元格
+                        text = _paragraph_text(element)
+                        if text and cell_parts is not None:
+                            cell_parts.append(text)
+                    else:
+                        text = _paragraph_text(element)
+                        level = _paragraph_level(element, heading_styles)
+                        if text and level is not None:
+                            while headings and headings[-1][0] >= level:
+                                headings.pop()
+                            headings.append((level, text))
+                            yield {"type": "heading", "text": text,
+                                   "heading_path": [title for _, title in headings]}
+                        elif text:
+                            yield {"type": "paragraph", "text": text,
+                                   "heading_path": [title for _, title in headings]}
+                    element.clear()
+                elif tag == _TC and table_depth == 1:
+                    if row_cells is not None:
+                        row_cells.append(" ".join(cell_parts or []))
+                    cell_parts = None
+                elif tag == _TR and table_depth == 1:
+                    if row_cells and any(row_cells):
+                        yield {"type": "table_row", "text": " | ".join(row_cells),
+                               "heading_path": [title for _, title in headings]}
+                    row_cells = None
+                    element.clear()
+                elif tag == _TBL:
+                    table_depth -= 1
+                    element.clear()
+
+                # body下的顶层元素处理完后从body中移除，保证已解析的部分可以被回收
+                if body is not None and depth == 2 and tag != _BODY:
+                    body.clear()
+
+
+def iter_docx_documents(path, max_section_chars=DEFAULT_MAX_SECTION_CHARS):
+    """按章节把.docx转换为langchain的Document，同一标题下的段落和表格行合并为一个文档
+
+    Args:
+        path: .docx文件路径
+        max_section_chars: 单个文档的最大字符数，超过后拆分
+
+    Yields:
+        Document: metadata包含source和heading_path(以" > "连接的标题路径)
+    """
+    from langchain_core.documents import Document
+
+    blocks = []
+    size = 0
+    current_path = None
+    # 当前章节是否已有正文；只有标题的章节(如紧跟子标题的上级标题)并入下一个章节，不单独成为文档
+    has_body = False
+
+    def flush():
+        return Document(
+            page_content="\n\n".join(blocks),
+            metadata={"source": path, "heading_path": " > ".join(current_path or [])},
+        )
+
+    for block in iter_docx_blocks(path):
+        block_path = block["heading_path"]
+        if block["type"] == "heading" or block_path != current_path or size >= max_section_chars:
+            if has_body:
+                yield flush()
+                blocks, size = [], 0
+            current_path = block_path
+            has_body = False
+        blocks.append(block["text"])
+        size += len(block["text"])
+        has_body = has_body or block["type"] != "heading"
+    if blocks:
+        yield flush()
+
+
+def load_docx(path, max_section_chars=DEFAULT_MAX_SECTION_CHARS):
+    """读取.docx并返回按章节划分的Document列表"""
+    return list(iter_docx_documents(path, max_section_chars))
+
+
+class StructuredDocxLoader:
+    """与langchain文档加载器接口一致的.docx加载器，供create_knowledge_base使用"""
+
+    def __init__(self, file_path, max_section_chars=DEFAULT_MAX_SECTION_CHARS):
+        self.file_path = file_path
+        self.max_section_chars = max_section_chars
+
+    def lazy_load(self):
+        return iter_docx_documents(self.file_path, self.max_section_chars)
+
+    def load(self):
+        return list(self.lazy_load())
@@ -0,0 +1,300 @@
+# 飞书事件订阅
+# 接收飞书开放平台推送的云文档变更事件(drive.file.*)：校验签名(含时间戳)和Verification Token、解密加密事件、
+# 按event_id去除飞书的重试推送，再把受影响的文档放入重建队列。队列合并同一文档短时间内的多次编辑，
+# 变化平息后只重建这些文档的索引，不需要重新处理全部飞书文档。
+# Token和Encrypt Key都未配置时无法确认事件来源，拒绝所有事件。
+import base64
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import REGISTRY
+from query_log import get_logger
+
+# 需要重建索引的文档事件: 事件类型 -> changed(重新获取内容)或removed(删除片段)
+DOCUMENT_EVENTS = {
+    "drive.file.edit_v1": "changed",
+    "drive.file.title_updated_v1": "changed",
+    "drive.file.created_in_folder_v1": "changed",
+    "drive.file.trashed_v1": "removed",
+    "drive.file.deleted_v1": "removed",
+}
+
+logger = get_logger("feishu_events")
+
+# 签名请求头中的时间戳与当前时间最多相差多少秒，超过时视为重放的旧请求
+SIGNATURE_MAX_AGE = 300
+
+FEISHU_EVENTS = REGISTRY.counter(
+    "kb_feishu_events_total",
+    "收到的飞书事件数(result: accepted/duplicate/ignored/rejected)",
+    ["event_type", "result"],
+)
+FEISHU_REINDEX_LAG_SECONDS = REGISTRY.histogram(
+    "kb_feishu_reindex_lag_seconds",
+    "飞书文档被编辑(事件产生)到索引更新完成的延迟(秒)",
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0),
+)
+FEISHU_REINDEX_SECONDS = REGISTRY.histogram(
+    "kb_feishu_reindex_seconds",
+    "一次飞书文档增量重建的耗时(秒)",
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+
+
+class EventRejected(Exception):
+    """事件未通过校验时抛出，携带建议的HTTP状态码"""
+
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def signature(timestamp, nonce, encrypt_key, body):
+    """飞书事件签名: sha256(timestamp + nonce + encrypt_key + 请求体)的十六进制摘要"""
+    return hashlib.sha256((timestamp + nonce + encrypt_key).encode("utf-8") + body).hexdigest()
+
+
+def decrypt(encrypted, encrypt_key):
+    """解密飞书加密事件(AES-256-CBC，密钥为encrypt_key的sha256，密文前16字节为IV)，需要安装cryptography"""
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    data = base64.b64decode(encrypted)
+    key = hashlib.sha256(encrypt_key.encode("utf-8")).digest()
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(data[:16])).decryptor()
+    plain = decryptor.update(data[16:]) + decryptor.finalize()
+    return plain[:-plain[-1]].decode("utf-8")
+
+
+def encrypt(plain, encrypt_key):
+    """按飞书的格式加密事件，供本地事件发送工具模拟加密推送"""
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    key = hashlib.sha256(encrypt_key.encode("utf-8")).digest()
+    iv = os.urandom(16)
+    data = plain.encode("utf-8")
+    padding = 16 - len(data) % 16
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return base64.b64encode(iv + encryptor.update(data + bytes([padding]) * padding) + encryptor.finalize()).decode()
+
+
+def parse_event(body, headers, verification_token="", encrypt_key="", max_age=SIGNATURE_MAX_AGE):
+    """校验并解析一次事件推送
+
+    Token和Encrypt Key都未配置时无法确认事件来自飞书，一律拒绝。
+
+    Args:
+        body: 原始请求体(bytes)
+        headers: 请求头(不区分大小写的映射)
+        verification_token: 飞书应用的Verification Token，为空时不校验
+        encrypt_key: 飞书应用的Encrypt Key，设置后要求签名请求头、校验签名和时间戳并解密加密事件
+        max_age: 签名时间戳与当前时间允许相差的秒数
+
+    Returns:
+        dict: 解析后的事件；URL校验请求返回{"type": "url_verification", "challenge": ...}
+
+    Raises:
+        EventRejected: 未配置校验方式、签名或Token校验失败、时间戳过期或请求体无法解析
+    """
+    if not verification_token and not encrypt_key:
+        raise EventRejected(403, "未配置FEISHU_EVENT_VERIFICATION_TOKEN或FEISHU_EVENT_ENCRYPT_KEY，不接收飞书事件")
+    if encrypt_key:
+        timestamp = headers.get("X-Lark-Request-Timestamp", "")
+        provided = headers.get("X-Lark-Signature", "")
+        if not timestamp or not provided:
+            raise EventRejected(401, "缺少事件签名请求头")
+        try:
+            age = abs(time.time() - float(timestamp))
+        except ValueError:
+            raise EventRejected(401, "事件签名时间戳格式错误")
+        if age > max_age:
+            raise EventRejected(401, "事件签名时间戳已过期")
+        expected = signature(timestamp, headers.get("X-Lark-Request-Nonce", ""), encrypt_key, body)
+        if not secrets.compare_digest(expected, provided):
+            raise EventRejected(401, "事件签名校验失败")
+    try:
+        payload = json.loads(body)
+        if "encrypt" in payload:
+            if not encrypt_key:
+                raise EventRejected(400, "收到加密事件，但未配置FEISHU_EVENT_ENCRYPT_KEY")
+            payload = json.loads(decrypt(payload["encrypt"], encrypt_key))
+    except EventRejected:
+        raise
+    except ImportError:
+        raise EventRejected(500, "解密飞书事件需要安装cryptography")
+    except Exception as e:
+        raise EventRejected(400, f"无法解析事件: {str(e)}")
+
+    # 1.0格式(含URL校验请求)的token在顶层，2.0格式在header中
+    header = payload.get("header") or {}
+    token = header.get("token", payload.get("token", ""))
+    if verification_token and not secrets.compare_digest(str(token), verification_token):
+        raise EventRejected(401, "Verification Token不匹配")
+    return payload
+
+
+def document_change(payload):
+    """从事件中提取受影响的文档
+
+    Returns:
+        tuple: (事件ID, 事件类型, 文档ID, changed或removed, 事件产生时间(秒))；不是文档事件时文档ID为None
+    """
+    header = payload.get("header") or {}
+    event = payload.get("event") or {}
+    event_type = header.get("event_type") or event.get("type", "")
+    event_id = header.get("event_id") or payload.get("uuid", "")
+    created_ms = header.get("create_time") or payload.get("ts")
+    try:
+        created_at = float(created_ms) / 1000 if created_ms else time.time()
+    except (TypeError, ValueError):
+        created_at = time.time()
+    action = DOCUMENT_EVENTS.get(event_type)
+    document_id = event.get("file_token") or event.get("document_id") or event.get("obj_token")
+    return event_id, event_type, document_id if action else None, action, created_at
+
+
+class EventDeduplicator:
+    """记录最近处理过的事件ID；飞书在未及时收到响应时会重试推送同一事件"""
+
+    def __init__(self, ttl=6 * 3600, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, event_id):
+        """事件ID已出现过时返回True，否则记录下来并返回False"""
+        now = time.monotonic()
+        with self._lock:
+            while self._seen and (len(self._seen) >= self.max_size
+                                  or now - next(iter(self._seen.values())) > self.ttl):
+                self._seen.popitem(last=False)
+            if event_id in self._seen:
+                return True
+            self._seen[event_id] = now
+            return False
+
+
+class DocumentReindexQueue:
+    """待重建的飞书文档队列，合并同一文档的连续编辑，变化平息后一次性重建"""
+
+    def __init__(self, on_reindex, debounce=1.0, max_delay=None, max_attempts=3):
+        """
+        Args:
+            on_reindex: 回调函数on_reindex(变化的文档ID列表, 删除的文档ID列表)，
+                返回获取失败、需要重试的文档ID列表(或None)
+            debounce: 文档最后一次变化后等待多久(秒)再重建，合并编辑时连续推送的多个事件
+            max_delay: 文档持续变化时最长等待多久(秒)也要重建一次，默认为debounce的10倍
+            max_attempts: 获取文档失败时的最多尝试次数
+        """
+        self.on_reindex = on_reindex
+        self.debounce = debounce
+        self.max_delay = max_delay if max_delay is not None else debounce * 10
+        self.max_attempts = max_attempts
+        # {文档ID: {"action", "first", "last", "created_at", "attempts"}}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.processed = 0
+        self.batches = 0
+        self.last_reindex = None
+
+    def start(self):
+        """启动后台重建线程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="kb-feishu-reindex", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """停止后台重建线程"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def submit(self, document_id, action, created_at=None):
+        """加入一个待重建的文档，已在队列中时以最新的事件为准并推迟重建"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._pending.get(document_id)
+            if entry is None:
+                entry = self._pending[document_id] = {"first": now, "attempts": 0,
+                                                      "created_at": created_at or time.time()}
+            entry["action"] = action
+            entry["last"] = now
+            entry["created_at"] = min(entry["created_at"], created_at or time.time())
+        self.start()
+        self._wakeup.set()
+
+    def _take_due(self, now):
+        """取出已到期的文档"""
+        with self._lock:
+            due = {doc_id: entry for doc_id, entry in self._pending.items()
+                   if now - entry["last"] >= self.debounce or now - entry["first"] >= self.max_delay}
+            for doc_id in due:
+                del self._pending[doc_id]
+            return due
+
+    def _next_timeout(self, now):
+        with self._lock:
+            if not self._pending:
+                return None
+            return max(0.0, min(min(entry["last"] + self.debounce, entry["first"] + self.max_delay) - now
+                                for entry in self._pending.values()))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self._next_timeout(time.monotonic()))
+            self._wakeup.clear()
+            if self._stopping.is_set():
+                break
+            due = self._take_due(time.monotonic())
+            if due:
+                self._reindex(due)
+
+    def _reindex(self, due):
+        changed = [doc_id for doc_id, entry in due.items() if entry["action"] == "changed"]
+        removed = [doc_id for doc_id, entry in due.items() if entry["action"] == "removed"]
+        start = time.perf_counter()
+        try:
+            failed = set(self.on_reindex(changed, removed) or [])
+        except Exception as e:
+            logger.error(f"飞书文档增量重建出错: {str(e)}")
+            failed = set(due)
+        FEISHU_REINDEX_SECONDS.observe(time.perf_counter() - start)
+
+        finished = time.time()
+        for doc_id, entry in due.items():
+            if doc_id not in failed:
+                FEISHU_REINDEX_LAG_SECONDS.observe(max(0.0, finished - entry["created_at"]))
+                self.processed += 1
+                continue
+            # 获取失败的文档稍后重试，超过次数后放弃(文档再次被编辑时会重新加入)
+            entry["attempts"] += 1
+            if entry["attempts"] < self.max_attempts:
+                with self._lock:
+                    if doc_id not in self._pending:
+                        entry["first"] = entry["last"] = time.monotonic() + self.debounce * entry["attempts"]
+                        self._pending[doc_id] = entry
+            else:
+                logger.error(f"飞书文档 {doc_id} 重建失败 {entry['attempts']} 次，放弃")
+        self.batches += 1
+        self.last_reindex = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    def status(self):
+        """返回队列状态"""
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "processed": self.processed,
+            "batches": self.batches,
+            "last_reindex": self.last_reindex,
+        }
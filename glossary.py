@@ -0,0 +1,333 @@
+# 名词解释预计算
+# 名词解释的问题集中在一批相对固定的术语上。本模块离线地为这些术语(从已入库的语料中提取，
+# 或由术语列表指定)调用知识库生成回答，写入SQLite，查询时直接返回预先生成的回答，
+# 只有未收录的术语才执行检索和模型调用。
+# 每条回答都记录生成时的索引指纹(片段内容、构建参数、提示词和模型的摘要)，知识库内容变化后
+# 指纹随之改变，旧回答不会再被使用，需要重新预计算。
+# 每生成一条回答立即提交，中断后重新运行会跳过已完成的术语(断点续跑)。
+# 用法: python glossary.py --knowledge-base word_knowledge_base --terms terms.txt --concurrency 4
+#       python glossary.py --knowledge-base word_knowledge_base --extract 500
+import os
+import re
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# 从.env文件加载环境变量
+from dotenv import load_dotenv
+load_dotenv()
+
+# 默认的预计算回答数据库路径
+DEFAULT_DB_PATH = "glossary.sqlite3"
+
+# 服务进程重新读取数据库的最短间隔(秒)，使离线任务新写入的回答无需重启即可生效
+REFRESH_INTERVAL = 5.0
+
+# 术语提取规则
+# 英文术语: 包含大写字母或数字的单词，如FAISS、LangChain、GPT-4
+_LATIN_TERM = re.compile(r"\b[A-Za-z][A-Za-z0-9]*(?:[-+.][A-Za-z0-9]+)*\b")
+# 引号和书名号中的中文短语
+_QUOTED_TERM = re.compile(r"[“\"「『《【]([^“”\"「」『』《》【】\n]{2,20})[”\"」』》】]")
+# 定义句式: "X是指..."、"X是一种..."、"所谓X"
+_DEFINED_TERM = re.compile(r"(?:^|[，。；\s])([一-鿿A-Za-z0-9]{2,12})(?:是指|是一种|是一个|指的是)")
+_SO_CALLED_TERM = re.compile(r"所谓(?:的)?[“\"]?([一-鿿A-Za-z0-9]{2,12})")
+# 词条句式: 行首"X：..."
+_ENTRY_TERM = re.compile(r"^\s*([一-鿿A-Za-z0-9 \-]{2,20})[：:]", re.MULTILINE)
+# 句首的"X是..."和"X is ..."，误报较多，需要达到出现次数才作为候选
+_SENTENCE_SUBJECT = re.compile(
+    r"(?:^|[。！？；.!?]\s*|\n)\s*([一-鿿]{2,8}|[A-Z][A-Za-z0-9\-]+(?: [A-Z][A-Za-z0-9\-]+){0,3})"
+    r"(?:是|\s(?:is|are|refers to|means)\s)"
+)
+
+# 明确标记为术语的句式，出现一次即作为候选
+_EXPLICIT_PATTERNS = (_QUOTED_TERM, _DEFINED_TERM, _SO_CALLED_TERM, _ENTRY_TERM)
+
+
+def normalize_term(term):
+    """术语的规范形式(合并空白、忽略大小写)，与查询合并使用相同的规则"""
+    return " ".join(term.split()).casefold()
+
+
+class GlossaryStore:
+    """以SQLite保存的预计算回答，按(规范术语, 索引指纹)索引
+
+    服务进程中按指纹把全部回答读入内存，查询时只是一次字典查找。
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH, refresh_interval=REFRESH_INTERVAL):
+        """
+        Args:
+            path: SQLite数据库路径
+            refresh_interval: 重新读取数据库的最短间隔(秒)
+        """
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " term_key TEXT NOT NULL,"
+            " fingerprint TEXT NOT NULL,"
+            " term TEXT NOT NULL,"
+            " answer TEXT NOT NULL,"
+            " sources TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " PRIMARY KEY (term_key, fingerprint))"
+        )
+        self._connection.commit()
+        # 当前指纹的内存缓存: (指纹, {规范术语: {"answer": 回答, "sources": 来源}}, 读取时间)
+        self._cache = (None, {}, 0.0)
+        # 读取缓存时数据库的data_version，其他连接提交后才会变化
+        self._data_version = None
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _answers(self, fingerprint):
+        """返回某个指纹下全部回答的内存字典，超过刷新间隔时重新读取"""
+        cached_fingerprint, answers, loaded_at = self._cache
+        now = time.monotonic()
+        if cached_fingerprint == fingerprint and now - loaded_at < self.refresh_interval:
+            return answers
+        with self._lock:
+            data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+            if cached_fingerprint == fingerprint and data_version == self._data_version:
+                # 其他进程没有写入新回答，继续使用缓存
+                self._cache = (fingerprint, answers, now)
+                return answers
+            self._data_version = data_version
+            rows = self._connection.execute(
+                "SELECT term_key, answer, sources FROM answers WHERE fingerprint = ?", (fingerprint,)
+            ).fetchall()
+        answers = {term_key: {"answer": answer, "sources": json.loads(sources)} for term_key, answer, sources in rows}
+        self._cache = (fingerprint, answers, now)
+        return answers
+
+    def get(self, term, fingerprint):
+        """查找预计算的回答
+
+        Returns:
+            dict: {"answer": str, "sources": list}，未收录时返回None
+        """
+        entry = self._answers(fingerprint).get(normalize_term(term))
+        # 每个调用方拿到各自的副本，避免调用方修改结果(如添加status)时影响缓存
+        return dict(entry) if entry is not None else None
+
+    def put(self, term, fingerprint, result):
+        """保存一条回答并立即提交"""
+        term_key = normalize_term(term)
+        sources = json.dumps(result.get("sources", []), ensure_ascii=False, default=str)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                (term_key, fingerprint, term, result["answer"], sources, time.time()),
+            )
+            self._connection.commit()
+        cached_fingerprint, answers, _ = self._cache
+        if cached_fingerprint == fingerprint:
+            answers[term_key] = {"answer": result["answer"], "sources": json.loads(sources)}
+
+    def completed_terms(self, fingerprint):
+        """某个指纹下已有回答的规范术语集合，用于断点续跑"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT term_key FROM answers WHERE fingerprint = ?", (fingerprint,)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def stats(self):
+        """各指纹下的回答数量"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT fingerprint, COUNT(*), MAX(created_at) FROM answers GROUP BY fingerprint"
+            ).fetchall()
+        return [{"fingerprint": fingerprint, "answers": count, "last_created_at": last}
+                for fingerprint, count, last in rows]
+
+    def prune(self, keep_fingerprint):
+        """删除不属于当前指纹的旧回答
+
+        Returns:
+            int: 删除的回答数量
+        """
+        with self._lock:
+            deleted = self._connection.execute(
+                "DELETE FROM answers WHERE fingerprint != ?", (keep_fingerprint,)
+            ).rowcount
+            self._connection.commit()
+        return deleted
+
+
+# 进程内共享的数据库连接，按路径缓存
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_glossary_store(path=None):
+    """获取GLOSSARY_DB_PATH对应的预计算回答库，未配置或文件不存在时返回None"""
+    path = path or os.getenv('GLOSSARY_DB_PATH', '')
+    if not path:
+        return None
+    store = _stores.get(path)
+    if store is not None:
+        return store
+    if not os.path.exists(path):
+        return None
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = GlossaryStore(path)
+        return _stores[path]
+
+
+def extract_terms(knowledge_base, limit=200, min_count=2):
+    """从已入库的片段中提取候选术语，按出现次数排序
+
+    Args:
+        knowledge_base: 已创建或加载的知识库
+        limit: 最多返回的术语数量
+        min_count: 至少出现的次数(定义句式和引号中的术语只需出现一次)
+
+    Returns:
+        list: 候选术语
+    """
+    counts = Counter()
+    explicit = set()
+    stores = getattr(knowledge_base.vector_store, "shards", [knowledge_base.vector_store])
+    for store in stores:
+        for doc in store.docstore._dict.values():
+            text = doc.page_content
+            for match in _LATIN_TERM.findall(text):
+                if len(match) >= 2 and (any(c.isupper() for c in match[1:]) or match.isupper()
+                                        or any(c.isdigit() for c in match)):
+                    counts[match] += 1
+            for match in _SENTENCE_SUBJECT.findall(text):
+                counts[match] += 1
+            for pattern in _EXPLICIT_PATTERNS:
+                for match in pattern.findall(text):
+                    match = match.strip()
+                    if match:
+                        counts[match] += 1
+                        explicit.add(match)
+
+    terms = []
+    seen = set()
+    for term, count in counts.most_common():
+        key = normalize_term(term)
+        if key in seen or (count < min_count and term not in explicit):
+            continue
+        seen.add(key)
+        terms.append(term)
+        if len(terms) >= limit:
+            break
+    return terms
+
+
+def precompute(knowledge_base, terms, store, concurrency=4, on_progress=None):
+    """为术语生成回答并写入预计算回答库，已有回答的术语会被跳过
+
+    Args:
+        knowledge_base: 已创建或加载的知识库
+        terms: 术语列表
+        store: GlossaryStore
+        concurrency: 同时进行的查询数量
+        on_progress: 每完成一个术语时调用on_progress(术语, 是否成功)
+
+    Returns:
+        dict: total、skipped、succeeded、failed、low_relevance(相关性不足、未写入)数量和使用的指纹
+    """
+    fingerprint = knowledge_base.index_fingerprint()
+    completed = store.completed_terms(fingerprint)
+    pending = []
+    for term in terms:
+        key = normalize_term(term)
+        if key and key not in completed:
+            completed.add(key)
+            pending.append(term)
+    summary = {"fingerprint": fingerprint, "total": len(terms),
+               "skipped": len(terms) - len(pending), "succeeded": 0, "failed": 0, "low_relevance": 0}
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="kb-glossary") as executor:
+        futures = {executor.submit(knowledge_base.query_knowledge_base, term): term for term in pending}
+        for future in as_completed(futures):
+            term = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"生成 {term} 的回答出错: {str(e)}")
+                result = None
+            ok = bool(result and result.get("answer"))
+            if ok and (result.get("relevance") or {}).get("decision") == "low":
+                # 相关性不足时的默认回复不写入，阈值调整后下次运行时重新判断
+                summary["low_relevance"] += 1
+            elif ok:
+                store.put(term, fingerprint, result)
+                summary["succeeded"] += 1
+            else:
+                # 失败的术语不写入，下次运行时重试
+                summary["failed"] += 1
+            if on_progress:
+                on_progress(term, ok)
+    return summary
+
+
+def _read_terms(path):
+    """读取术语列表文件，每行一个术语，忽略空行和#开头的注释"""
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="名词解释回答预计算")
+    parser.add_argument("--knowledge-base", default="word_knowledge_base", help="已保存的知识库路径")
+    parser.add_argument("--db", default=os.getenv('GLOSSARY_DB_PATH') or DEFAULT_DB_PATH, help="预计算回答数据库路径")
+    parser.add_argument("--terms", help="术语列表文件(每行一个)")
+    parser.add_argument("--extract", type=int, default=0, help="从语料中提取的候选术语数量")
+    parser.add_argument("--min-count", type=int, default=2, help="提取术语时至少出现的次数")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时进行的查询数量")
+    parser.add_argument("--prune", action="store_true", help="完成后删除旧索引指纹下的回答")
+    parser.add_argument("--stats", action="store_true", help="只显示数据库中各指纹的回答数量")
+    args = parser.parse_args(argv)
+
+    store = GlossaryStore(args.db)
+    if args.stats:
+        for row in store.stats():
+            print(f"{row['fingerprint']}: {row['answers']} 条回答")
+        return None
+
+    from knowledge_manager import get_manager
+    knowledge_base = get_manager().new_knowledge_base()
+    if not knowledge_base.load_knowledge_base(args.knowledge_base):
+        print(f"错误: 无法加载知识库 {args.knowledge_base}")
+        return None
+
+    terms = _read_terms(args.terms) if args.terms else []
+    if args.extract:
+        terms.extend(extract_terms(knowledge_base, args.extract, args.min_count))
+    if not terms:
+        print("错误: 请通过--terms提供术语列表或通过--extract从语料中提取")
+        return None
+
+    done = 0
+
+    def on_progress(term, ok):
+        nonlocal done
+        done += 1
+        print(f"[{done}] {term}: {'完成' if ok else '失败'}")
+
+    summary = precompute(knowledge_base, terms, store, args.concurrency, on_progress)
+    print(f"预计算完成(索引指纹 {summary['fingerprint']}): 共 {summary['total']} 个术语，"
+          f"跳过已完成 {summary['skipped']} 个，成功 {summary['succeeded']} 个，失败 {summary['failed']} 个，"
+          f"相关性不足未写入 {summary['low_relevance']} 个")
+    if args.prune:
+        print(f"已删除 {store.prune(summary['fingerprint'])} 条旧回答")
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+# 知识库索引参数调优
+# 在给定的语料和问题集上扫描分割参数(chunk_size、chunk_overlap)、检索索引类型(flat/hnsw/ivf)及其检索参数
+# (efSearch、nprobe)和检索片段数量k，对每组参数测量:
+#   hit_rate      问题标注的来源文档出现在前k个片段中的比例(检索质量，随分割参数和k变化)
+#   recall        近似索引的前k个结果与同一分割下精确检索(IndexFlat)前k个结果的重合比例
+#   p50_ms/p95_ms 单个问题的检索延迟(不含问题向量计算)
+#   memory_bytes  检索占用的内存(IndexFlat的向量加上近似索引)
+#   context_chars 前k个片段的总长度(提示词中上下文的大小，决定模型调用的耗时和费用)
+#   build_seconds 计算片段向量和构建近似索引的耗时
+# 输出Pareto最优的参数组合，按以下规则选出一组写入知识库配置(kb_config.py):
+# recall不低于--min-recall的组合中，hit_rate与最高值相差不超过--quality-tolerance的，取context_chars最小、其次延迟最低的一组。
+# 问题集可以是标注文件(JSON Lines，每行{"question": ..., "sources": ["a.docx"]})，
+# 未提供时从文档中随机截取一段文字作为问题，其来源文档即标注。
+# 用法: python index_tuner.py --input sample_docs
+#       python index_tuner.py --input /data/docs --queries labeled_queries.jsonl --chunk-sizes 500,800,1200 --k 3,5
+import argparse
+import json
+import os
+import random
+import time
+
+# 从.env文件加载环境变量
+from dotenv import load_dotenv
+load_dotenv()
+
+from bulk_ingest import read_manifest
+from doc_watcher import list_documents
+
+
+def _parse_list(text, cast=int):
+    """解析逗号分隔的参数列表，auto表示使用默认值(None)"""
+    return [None if item.strip() == "auto" else cast(item) for item in text.split(",") if item.strip()]
+
+
+def read_queries(path):
+    """读取标注的问题集
+
+    Args:
+        path: JSON Lines文件，每行包含question以及source或sources(来源文件路径或文件名)
+
+    Returns:
+        list: {"question": 问题, "sources": 来源列表}字典列表
+    """
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            sources = entry.get("sources") or ([entry["source"]] if entry.get("source") else [])
+            queries.append({"question": entry["question"], "sources": [str(source) for source in sources]})
+    return queries
+
+
+def generate_queries(documents, count, seed=0, words=12, characters=24):
+    """从文档中随机截取文字作为问题，截取位置所在的文档即标注的来源
+
+    Args:
+        documents: 加载得到的Document列表
+        count: 问题数量
+        seed: 随机种子，相同的语料和种子得到相同的问题集
+        words: 英文等以空格分词的文本截取的单词数
+        characters: 中文等不以空格分词的文本截取的字符数
+
+    Returns:
+        list: {"question": 问题, "sources": [来源]}字典列表
+    """
+    rng = random.Random(seed)
+    candidates = [doc for doc in documents if len(doc.page_content.strip()) >= characters * 2]
+    queries = []
+    for _ in range(count if candidates else 0):
+        doc = rng.choice(candidates)
+        text = " ".join(doc.page_content.split())
+        tokens = text.split(" ")
+        if len(tokens) >= words * 2:
+            start = rng.randrange(0, len(tokens) - words)
+            question = " ".join(tokens[start:start + words])
+        else:
+            start = rng.randrange(0, max(1, len(text) - characters))
+            question = text[start:start + characters]
+        queries.append({"question": question, "sources": [str(doc.metadata.get("source", ""))]})
+    return queries
+
+
+def _source_matches(source, labels):
+    """片段来源是否属于标注的来源(标注可以只写文件名)"""
+    source = str(source or "")
+    return any(source == label or os.path.basename(source) == label for label in labels)
+
+
+def index_configs(index_types, hnsw_m=(32,), ef_construction=40, ef_search=(16, 32, 64, 128),
+                  nlist=(None,), nprobe=(1, 4, 8, 16, 32)):
+    """展开需要扫描的索引配置
+
+    Returns:
+        list: (构建配置, 检索参数配置列表)，同一构建配置的索引只构建一次，再依次设置检索参数
+    """
+    configs = []
+    for index_type in index_types:
+        if index_type == "flat":
+            configs.append(({"type": "flat"}, [{"type": "flat"}]))
+        elif index_type == "hnsw":
+            for m in hnsw_m:
+                build = {"type": "hnsw", "m": m, "ef_construction": ef_construction}
+                configs.append((build, [{**build, "ef_search": ef} for ef in ef_search]))
+        elif index_type == "ivf":
+            for clusters in nlist:
+                build = {"type": "ivf", "nlist": clusters}
+                configs.append((build, [{**build, "nprobe": probes} for probes in nprobe]))
+        else:
+            raise ValueError(f"不支持的索引类型: {index_type}")
+    return configs
+
+
+def _search_all(index, query_vectors, k):
+    """逐个问题检索(与线上单个查询的检索方式相同)
+
+    Returns:
+        tuple: (每个问题的FAISS内部ID列表, 每个问题的检索耗时)
+    """
+    ids, latencies = [], []
+    for position in range(len(query_vectors)):
+        start = time.perf_counter()
+        _, found = index.search(query_vectors[position:position + 1], k)
+        latencies.append(time.perf_counter() - start)
+        ids.append([int(faiss_id) for faiss_id in found[0] if faiss_id != -1])
+    return ids, latencies
+
+
+def evaluate_chunking(kb, documents, chunk_size, chunk_overlap, queries, query_vectors, ks, configs):
+    """按一组分割参数分割、计算向量，再评估各索引配置和k
+
+    Returns:
+        list: 每个(索引配置, k)一条结果
+    """
+    import faiss
+    import numpy as np
+
+    import ann_index
+    from report_utils import percentile
+    from thread_budget import thread_budget
+
+    with thread_budget("ingest"):
+        chunks = kb.split_documents(documents, chunk_size, chunk_overlap)
+        embed_start = time.perf_counter()
+        vectors = np.asarray(kb.embed_chunks(chunks), dtype="float32")
+        embed_seconds = time.perf_counter() - embed_start
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+    sources = [chunk.metadata.get("source") for chunk in chunks]
+    lengths = [len(chunk.page_content) for chunk in chunks]
+    ks = list(dict.fromkeys(min(k, len(chunks)) for k in ks))
+
+    with thread_budget("query"):
+        exact = {k: _search_all(flat, query_vectors, k)[0] for k in ks}
+
+    results = []
+    for build, search_configs in configs:
+        with thread_budget("ingest"):
+            build_start = time.perf_counter()
+            search_index = ann_index.build_search_index(vectors, faiss.METRIC_L2, build)
+            build_seconds = time.perf_counter() - build_start
+        memory_bytes = ann_index.index_bytes(flat) + ann_index.index_bytes(search_index)
+        index = flat if search_index is None else search_index
+        for search_config in search_configs:
+            if search_index is not None:
+                ann_index.set_search_params(search_index, search_config)
+            index_config = dict(search_config)
+            if index_config["type"] == "ivf":
+                index_config["nlist_used"] = search_index.nlist
+            for k in ks:
+                with thread_budget("query"):
+                    _search_all(index, query_vectors[:10], k)
+                    found, latencies = _search_all(index, query_vectors, k)
+                recall = np.mean([len(set(ids) & set(truth)) / max(1, len(truth))
+                                  for ids, truth in zip(found, exact[k])])
+                hits = [any(_source_matches(sources[i], query["sources"]) for i in ids)
+                        for ids, query in zip(found, queries) if query["sources"]]
+                results.append({
+                    "chunk_size": chunk_size,
+                    "chunk_overlap": chunk_overlap,
+                    "chunks": len(chunks),
+                    "k": k,
+                    "index": index_config,
+                    "hit_rate": round(sum(hits) / len(hits), 4) if hits else None,
+                    "recall": round(float(recall), 4),
+                    "p50_ms": round(percentile(latencies, 50) * 1000, 4),
+                    "p95_ms": round(percentile(latencies, 95) * 1000, 4),
+                    "memory_bytes": memory_bytes,
+                    "context_chars": round(float(np.mean([sum(lengths[i] for i in ids) for ids in found])), 1),
+                    "build_seconds": {"embed": round(embed_seconds, 3), "index": round(build_seconds, 3)},
+                })
+    return results
+
+
+# Pareto比较的指标: (字段, 越大越好)
+_OBJECTIVES = (("hit_rate", True), ("recall", True), ("p95_ms", False), ("memory_bytes", False), ("context_chars", False))
+
+
+def _dominates(a, b):
+    """a在所有指标上不差于b且至少一项更好"""
+    better = False
+    for field, larger_is_better in _OBJECTIVES:
+        x, y = a[field], b[field]
+        if x is None or y is None:
+            continue
+        if x == y:
+            continue
+        if (x > y) != larger_is_better:
+            return False
+        better = True
+    return better
+
+
+def pareto_front(results):
+    """不被任何其他结果支配的结果"""
+    return [result for result in results if not any(_dominates(other, result) for other in results)]
+
+
+def choose(results, min_recall=0.95, quality_tolerance=0.02):
+    """从Pareto最优结果中选出写入配置的一组
+
+    recall不低于min_recall的结果中，hit_rate与最高值相差不超过quality_tolerance的，
+    取context_chars最小、其次p95延迟最低、内存最小的一组；没有满足recall要求的结果时返回None。
+    """
+    candidates = [result for result in pareto_front(results) if result["recall"] >= min_recall]
+    if not candidates:
+        return None
+    rated = [result["hit_rate"] for result in candidates if result["hit_rate"] is not None]
+    if rated:
+        best = max(rated)
+        candidates = [result for result in candidates
+                      if result["hit_rate"] is None or result["hit_rate"] >= best - quality_tolerance]
+    return min(candidates, key=lambda result: (result["context_chars"], result["p95_ms"], result["memory_bytes"]))
+
+
+def to_config(result):
+    """把选中的结果转换为知识库配置"""
+    index = {key: value for key, value in result["index"].items() if key != "nlist_used"}
+    return {
+        "chunk_size": result["chunk_size"],
+        "chunk_overlap": result["chunk_overlap"],
+        "k": result["k"],
+        "index": index,
+    }
+
+
+def tune(paths, queries=None, query_count=200, chunk_sizes=(500, 1000, 1500), chunk_overlaps=(0, 100, 200),
+         ks=(3, 5, 8), configs=None, min_recall=0.95, quality_tolerance=0.02, max_documents=None, seed=0, kb=None):
+    """扫描参数组合并选出推荐配置
+
+    Args:
+        paths: 语料文件路径列表
+        queries: 标注的问题集，未提供时从语料中生成query_count个问题
+        query_count: 自动生成的问题数量
+        chunk_sizes: 扫描的片段长度
+        chunk_overlaps: 扫描的重叠长度(不小于片段长度的组合被跳过)
+        ks: 扫描的检索片段数量
+        configs: index_configs展开的索引配置，默认只评估flat
+        min_recall: 近似索引相对精确检索的最低召回率
+        quality_tolerance: hit_rate允许比最高值低多少
+        max_documents: 最多使用的文件数(随机抽样)
+        seed: 抽样和生成问题的随机种子
+        kb: 知识库实例，默认由知识库管理器创建(共享嵌入模型)
+
+    Returns:
+        dict: 全部结果、Pareto最优结果和选中的结果
+    """
+    import numpy as np
+
+    from micro_batch import embed_queries
+
+    if kb is None:
+        from knowledge_manager import get_manager
+        kb = get_manager().new_knowledge_base()
+    paths = list(paths)
+    if max_documents and len(paths) > max_documents:
+        paths = sorted(random.Random(seed).sample(paths, max_documents))
+    documents = kb.load_documents(paths)
+    if not documents:
+        raise RuntimeError("没有加载到任何文档")
+    generated = not queries
+    queries = queries or generate_queries(documents, query_count, seed=seed)
+    if not queries:
+        raise RuntimeError("没有可用的问题")
+    print(f"语料: {len(paths)} 个文件，{len(documents)} 个文档；问题: {len(queries)} 个")
+
+    query_vectors = np.asarray(embed_queries(kb.embeddings, [query["question"] for query in queries]), dtype="float32")
+    configs = configs or index_configs(["flat"])
+
+    results = []
+    for chunk_size in chunk_sizes:
+        for chunk_overlap in chunk_overlaps:
+            if chunk_overlap >= chunk_size:
+                continue
+            chunking = evaluate_chunking(kb, documents, chunk_size, chunk_overlap, queries, query_vectors, ks, configs)
+            results.extend(chunking)
+            best = max(chunking, key=lambda result: (result["hit_rate"] or 0, result["recall"]))
+            print(f"chunk_size={chunk_size} chunk_overlap={chunk_overlap}: {chunking[0]['chunks']} 个片段，"
+                  f"计算向量 {chunking[0]['build_seconds']['embed']:.1f} 秒，最高hit_rate {best['hit_rate']}")
+
+    front = pareto_front(results)
+    return {
+        "documents": len(documents),
+        "files": len(paths),
+        "queries": len(queries),
+        "generated_queries": generated,
+        "min_recall": min_recall,
+        "quality_tolerance": quality_tolerance,
+        "results": results,
+        "pareto": front,
+        "chosen": choose(results, min_recall, quality_tolerance),
+    }
+
+
+def _describe(result):
+    index = result["index"]
+    params = ", ".join(f"{key}={'auto' if value is None else value}" for key, value in index.items()
+                       if key not in ("type", "nlist_used"))
+    return (f"chunk={result['chunk_size']}/{result['chunk_overlap']} k={result['k']} "
+            f"{index['type']}{f'({params})' if params else ''}")
+
+
+def main(argv=None):
+    import kb_config
+
+    parser = argparse.ArgumentParser(description="扫描分割参数、索引类型和k，输出Pareto最优配置并写入知识库配置")
+    parser.add_argument("--input", action="append", default=[], help="语料目录或文件(含子目录中的.docx和.txt)，可重复指定")
+    parser.add_argument("--manifest", help="文件清单(每行一个路径，或每行一个含path字段的JSON对象)")
+    parser.add_argument("--queries", help="标注的问题集(JSON Lines，每行含question和sources)，未提供时从语料中生成")
+    parser.add_argument("--generate-queries", type=int, default=200, help="自动生成的问题数量")
+    parser.add_argument("--max-documents", type=int, default=None, help="最多使用的文件数(随机抽样)")
+    parser.add_argument("--seed", type=int, default=0, help="抽样和生成问题的随机种子")
+    parser.add_argument("--chunk-sizes", default="500,1000,1500", help="逗号分隔的片段长度")
+    parser.add_argument("--chunk-overlaps", default="0,100,200", help="逗号分隔的重叠长度")
+    parser.add_argument("--k", default="3,5,8", help="逗号分隔的检索片段数量")
+    parser.add_argument("--index-types", default="flat,hnsw,ivf", help="逗号分隔的索引类型(flat、hnsw、ivf)")
+    parser.add_argument("--hnsw-m", default="32", help="逗号分隔的HNSW邻居数")
+    parser.add_argument("--ef-construction", type=int, default=40, help="HNSW构建时的候选数")
+    parser.add_argument("--ef-search", default="16,32,64,128", help="逗号分隔的HNSW检索候选数")
+    parser.add_argument("--nlist", default="auto", help="逗号分隔的IVF聚类数，auto为约4*sqrt(片段数)")
+    parser.add_argument("--nprobe", default="1,4,8,16,32", help="逗号分隔的IVF检索聚类数")
+    parser.add_argument("--min-recall", type=float, default=0.95, help="近似索引相对精确检索的最低recall@k")
+    parser.add_argument("--quality-tolerance", type=float, default=0.02, help="hit_rate允许比最高值低多少")
+    parser.add_argument("--config", default=kb_config.CONFIG_FILE, help="写入选中配置的知识库配置文件")
+    parser.add_argument("--no-write", action="store_true", help="只输出报告，不写入知识库配置")
+    parser.add_argument("--report", default="benchmark_results/index_tuning.json", help="完整结果JSON路径")
+    args = parser.parse_args(argv)
+
+    paths = []
+    for path in args.input:
+        paths.extend(list_documents(path))
+    if args.manifest:
+        paths.extend(read_manifest(args.manifest))
+    paths = list(dict.fromkeys(paths))
+    if not paths:
+        parser.error("请通过--input或--manifest指定语料")
+
+    configs = index_configs(
+        _parse_list(args.index_types, str),
+        hnsw_m=_parse_list(args.hnsw_m),
+        ef_construction=args.ef_construction,
+        ef_search=_parse_list(args.ef_search),
+        nlist=_parse_list(args.nlist),
+        nprobe=_parse_list(args.nprobe),
+    )
+    report = tune(
+        paths,
+        queries=read_queries(args.queries) if args.queries else None,
+        query_count=args.generate_queries,
+        chunk_sizes=_parse_list(args.chunk_sizes),
+        chunk_overlaps=_parse_list(args.chunk_overlaps),
+        ks=_parse_list(args.k),
+        configs=configs,
+        min_recall=args.min_recall,
+        quality_tolerance=args.quality_tolerance,
+        max_documents=args.max_documents,
+        seed=args.seed,
+    )
+
+    print(f"Pareto最优配置 ({len(report['pareto'])}/{len(report['results'])}):")
+    for result in sorted(report["pareto"], key=lambda result: (-(result["hit_rate"] or 0), result["p95_ms"])):
+        print(f"  {_describe(result):<60} hit_rate {result['hit_rate']}  recall {result['recall']}  "
+              f"p95 {result['p95_ms']:.3f} ms  内存 {result['memory_bytes'] / 1024 / 1024:.1f} MB  "
+              f"上下文 {result['context_chars']:.0f} 字符")
+
+    chosen = report["chosen"]
+    if chosen is None:
+        print(f"没有recall@k不低于 {args.min_recall} 的配置，未写入知识库配置")
+    else:
+        print(f"选中: {_describe(chosen)}")
+        if not args.no_write:
+            config = to_config(chosen)
+            config["tuning"] = {
+                "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "files": report["files"],
+                "queries": report["queries"],
+                "generated_queries": report["generated_queries"],
+                "hit_rate": chosen["hit_rate"],
+                "recall": chosen["recall"],
+                "p95_ms": chosen["p95_ms"],
+            }
+            kb_config.save_config(config, args.config)
+            print(f"已写入知识库配置 {args.config}，修改分割参数后需要重新创建知识库")
+
+    from report_utils import write_results
+    write_results(report, args.report)
+    return report
+
+
+if __name__ == "__main__":
+    main()
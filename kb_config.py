@@ -0,0 +1,119 @@
+# 知识库配置
+# 分割参数(chunk_size、chunk_overlap)、检索片段数量k、检索索引类型以及相关性阈值保存在一个JSON配置文件中
+# (KB_CONFIG_FILE，默认kb_config.json)，文件不存在时使用默认值(与之前写死的参数相同)。
+# 配置文件可以手工编写，也可以由index_tuner.py在语料上扫描参数后写入(相关性阈值由relevance_calibration.py写入)。示例:
+#   {
+#     "chunk_size": 800,
+#     "chunk_overlap": 100,
+#     "k": 4,
+#     "index": {"type": "hnsw", "m": 32, "ef_construction": 80, "ef_search": 64},
+#     "relevance": {"max_distance": 1.2, "on_low_relevance": "snippets"}
+#   }
+# index.type: flat为精确检索(默认)；hnsw和ivf为近似检索，参数见ann_index.py。
+# relevance.max_distance: 最相似片段的距离超过该值时不调用模型，直接返回默认回复(null为不启用，默认)；
+# 距离的尺度取决于嵌入模型，应由relevance_calibration.py在已保存的知识库上校准。
+# 内积(MAX_INNER_PRODUCT)向量存储的得分越大越相似，此时该值为最低得分，最相似片段的得分低于该值时不调用模型。
+# relevance.on_low_relevance: fallback只返回默认回复，snippets同时返回检索到的片段。
+import copy
+import json
+import os
+
+from snapshot import atomic_write
+
+CONFIG_FILE = os.getenv('KB_CONFIG_FILE', 'kb_config.json')
+
+INDEX_TYPES = ("flat", "hnsw", "ivf")
+
+LOW_RELEVANCE_ACTIONS = ("fallback", "snippets")
+
+# 按字段合并(而不是整体替换)的嵌套配置
+_NESTED = ("index", "relevance")
+
+DEFAULT_CONFIG = {
+    "chunk_size": 1000,
+    "chunk_overlap": 200,
+    "k": 5,
+    "index": {"type": "flat"},
+    "relevance": {"max_distance": None, "on_low_relevance": "fallback"},
+}
+
+
+def _merge(config, stored):
+    """把文件中的配置合并到config，嵌套配置按字段合并"""
+    nested = {key: {**config[key], **(stored.get(key) or {})} for key in _NESTED}
+    config.update(stored)
+    config.update(nested)
+    return config
+
+
+def validate_config(config):
+    """检查配置取值，不合法时抛出ValueError"""
+    if int(config["chunk_size"]) <= 0:
+        raise ValueError(f"chunk_size必须大于0: {config['chunk_size']}")
+    if not 0 <= int(config["chunk_overlap"]) < int(config["chunk_size"]):
+        raise ValueError(f"chunk_overlap必须在0到chunk_size之间: {config['chunk_overlap']}")
+    if int(config["k"]) <= 0:
+        raise ValueError(f"k必须大于0: {config['k']}")
+    index_type = config["index"].get("type", "flat")
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"不支持的索引类型: {index_type}，可选: {', '.join(INDEX_TYPES)}")
+    relevance = config["relevance"]
+    if relevance.get("max_distance") is not None:
+        try:
+            float(relevance["max_distance"])
+        except (TypeError, ValueError):
+            raise ValueError(f"relevance.max_distance必须是数值: {relevance['max_distance']}")
+    if relevance.get("on_low_relevance", "fallback") not in LOW_RELEVANCE_ACTIONS:
+        raise ValueError(f"不支持的on_low_relevance: {relevance['on_low_relevance']}，"
+                         f"可选: {', '.join(LOW_RELEVANCE_ACTIONS)}")
+    return config
+
+
+def load_config(path=None, **defaults):
+    """读取知识库配置，未设置的字段使用默认值
+
+    Args:
+        path: 配置文件路径，默认为KB_CONFIG_FILE
+        defaults: 覆盖的默认值(如飞书文档默认chunk_overlap=0)
+
+    Returns:
+        dict: 完整的配置
+
+    Raises:
+        ValueError: 配置文件格式错误或取值不合法
+    """
+    path = path or CONFIG_FILE
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    config.update(defaults)
+    if os.path.exists(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            raise ValueError(f"无法读取知识库配置 {path}: {e}")
+        _merge(config, stored)
+    return validate_config(config)
+
+
+def save_config(config, path=None):
+    """把配置写入配置文件(原子替换)，保留文件中已有的其他字段
+
+    Args:
+        config: 需要写入的配置字段
+        path: 配置文件路径，默认为KB_CONFIG_FILE
+
+    Returns:
+        dict: 写入后的完整配置
+    """
+    path = path or CONFIG_FILE
+    stored = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            stored = json.load(f)
+    stored.update(config)
+    validate_config(_merge(copy.deepcopy(DEFAULT_CONFIG), stored))
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    atomic_write(path, json.dumps(stored, ensure_ascii=False, indent=2).encode("utf-8"))
+    return stored
@@ -0,0 +1,120 @@
+# 知识库管理器
+# 在一个进程内集中管理各服务的知识库实例，所有实例共享同一个嵌入模型和模型路由层，
+# 避免每个服务各自加载一份torch/MiniLM和HTTP连接池
+import os
+import threading
+
+from dotenv import load_dotenv
+
+from langchain_knowledge import DeepSeekKnowledgeBase, LazyEmbeddings
+from llm_router import LLMRouter
+
+# 从.env文件加载环境变量
+load_dotenv()
+
+
+class KnowledgeBaseManager:
+    """进程内共享的知识库管理器
+
+    各服务以名称(如'server'、'rag'、'feishu')登记自己的知识库实例，
+    通过new_knowledge_base创建的实例共享嵌入模型和模型路由层。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._knowledge_bases = {}
+        self._embeddings = None
+        self._llm_router = None
+        # 多工作进程模式下，由工作进程设置，用于把知识库变更转交给主进程统一执行
+        self._change_forwarder = None
+
+    @property
+    def embeddings(self):
+        """进程内共享的嵌入模型"""
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = LazyEmbeddings()
+                load_mode = os.getenv('EMBEDDING_LOAD_MODE', 'lazy').lower()
+                if load_mode == 'background':
+                    self._embeddings.warm_up(background=True)
+                elif load_mode == 'eager':
+                    self._embeddings.warm_up(background=False)
+            return self._embeddings
+
+    @property
+    def llm_router(self):
+        """进程内共享的模型路由层(含HTTP连接池和供应商延迟统计)"""
+        with self._lock:
+            if self._llm_router is None:
+                self._llm_router = LLMRouter.from_env(float(os.getenv('TEMPERATURE', '0.7')))
+            return self._llm_router
+
+    def new_knowledge_base(self):
+        """创建一个共享嵌入模型和模型路由层的知识库实例"""
+        return DeepSeekKnowledgeBase(embeddings=self.embeddings, llm_router=self.llm_router)
+
+    def get(self, name):
+        """获取已登记的知识库实例，不存在时返回None"""
+        with self._lock:
+            return self._knowledge_bases.get(name)
+
+    def set(self, name, knowledge_base):
+        """登记(或替换)某个服务的知识库实例"""
+        with self._lock:
+            self._knowledge_bases[name] = knowledge_base
+
+    def set_change_forwarder(self, forwarder):
+        """设置知识库变更的转发函数(多工作进程模式下由工作进程调用)
+
+        Args:
+            forwarder: 接收(服务名称, 参数字典)的函数
+        """
+        self._change_forwarder = forwarder
+
+    def forward_change(self, name, **params):
+        """在多工作进程模式下把知识库变更转交主进程执行
+
+        主进程执行变更后会依次替换所有工作进程，保证每个进程看到同一份知识库。
+
+        Returns:
+            bool: 已转交返回True；单进程模式下返回False，调用方应在本进程内直接执行
+        """
+        if self._change_forwarder is None:
+            return False
+        self._change_forwarder(name, params)
+        return True
+
+    def names(self):
+        with self._lock:
+            return sorted(self._knowledge_bases)
+
+    def status(self):
+        """返回各知识库和共享模型的状态"""
+        with self._lock:
+            knowledge_bases = dict(self._knowledge_bases)
+            embeddings_loaded = self._embeddings.loaded if self._embeddings is not None else False
+        return {
+            "embedding_model_loaded": embeddings_loaded,
+            "knowledge_bases": {
+                name: {
+                    "initialized": kb is not None,
+                    "vector_store_ready": bool(kb and kb.vector_store),
+                    "chunks": kb.chunk_count() if kb else 0,
+                }
+                for name, kb in knowledge_bases.items()
+            },
+        }
+
+
+# 进程内唯一的管理器实例
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    """获取进程内唯一的知识库管理器"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = KnowledgeBaseManager()
+        return _manager
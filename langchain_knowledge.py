@@ -1,59 +1,37 @@
 # LangChain + 多模型知识库示例
 # 导入必要的库
+# FAISS、LangChain链、各供应商SDK以及sentence-transformers/torch都在首次使用时才导入，
+# 使只提供/status或只加载已保存索引的进程能够快速启动
+import contextvars
 import os
+import threading
+import time
 from dotenv import load_dotenv
-# 移除无效的导入语句
-# from huggingface_hub import set_proxy  # 修改导入
-import requests.adapters
-from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import TextLoader
-# 添加Word文档加载器
-try:
-    from langchain_community.document_loaders import Docx2txtLoader
-except ImportError:
-    print("警告: 未安装docx2txt库，将无法加载Word文档")
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.chains import RetrievalQA
-# 在文件顶部添加必要的导入
-from langchain_core.prompts import PromptTemplate
-
-# 导入不同模型的支持库
-# 首先获取并标准化模型类型
-model_type = os.getenv('MODEL_TYPE', 'deepseek').lower()
-
-# 根据选定的模型类型导入对应的库
-if model_type == 'deepseek':
-    try:
-        # DeepSeek模型支持
-        from langchain_deepseek import ChatDeepSeek
-    except ImportError:
-        print("警告: 未安装langchain_deepseek库，DeepSeek模型不可用")
-elif model_type == 'qianwen':
-    try:
-        # 千问模型支持
-        from langchain_community.chat_models import QianwenChat
-    except ImportError:
-        print("警告: 未安装千问模型相关依赖，千问模型不可用")
-elif model_type == 'doubao':
-    try:
-        # 豆包模型支持
-        from langchain_community.chat_models import DoubaoChat
-    except ImportError:
-        print("警告: 未安装豆包模型相关依赖，豆包模型不可用")
-elif model_type == 'ollama':
-    try:
-        # Ollama本地模型支持
-        from langchain_community.chat_models import ChatOllama
-    except ImportError:
-        print("警告: 未安装ChatOllama库，Ollama本地模型不可用")
-else:
-    print("警告: 未配置有效模型类型，默认使用DeepSeek模型")
-    # 默认尝试导入DeepSeek模型
-    try:
-        from langchain_deepseek import ChatDeepSeek
-    except ImportError:
-        print("警告: 未安装langchain_deepseek库，DeepSeek模型不可用")
+from langchain_core.embeddings import Embeddings
+# 导入指标模块，用于记录查询和入库各阶段的耗时
+from metrics import (
+    QUERY_TOTAL_SECONDS, LLM_TOKENS, ERRORS, CACHE_EVENTS, RELEVANCE_DECISIONS,
+    INGEST_STAGE_SECONDS, INGEST_DOCUMENTS, INGEST_CHUNKS, INGEST_CHARACTERS,
+)
+# 导入结构化日志，查询各阶段耗时同时计入当前查询的记录，超过阈值时写入慢查询日志
+import query_log
+from query_log import record_stage, stage_timer
+# 导入模型路由层，各供应商的SDK在创建模型时才导入
+from llm_router import LLMRouter, create_chat_model
+# 导入相同请求合并，同时到达的相同问题只检索和调用一次模型
+from singleflight import SingleFlight
+# 导入按需性能剖析，未启用时不改变被装饰的方法
+from profiling import profile_calls
+# 导入CPU线程预算，查询和入库分别使用各自的线程数
+import thread_budget
+from thread_budget import with_thread_budget
+# 导入查询微批处理，并发到达的查询合并为一次嵌入计算和一次FAISS搜索
+from micro_batch import MicroBatcher, embed_queries
+# 导入知识库配置(分割参数、检索片段数量和检索索引类型)和近似检索索引
+import ann_index
+import kb_config
+
+logger = query_log.get_logger("knowledge")
 
 
 # 从.env文件加载环境变量
@@ -62,30 +40,233 @@ load_dotenv()
 # 从环境变量加载HF_ENDPOINT配置，已在.env文件中设置
 # 不需要在代码中硬编码设置，dotenv会自动加载所有环境变量
 
+# 默认的嵌入模型，会记录在保存的知识库快照中
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# 提示词组装方式: template按RAG_PROMPT_TEMPLATE组装(默认)；cache_friendly把固定的说明放在最前面，
+# 上下文片段按片段ID排序，问题放在最后，使供应商的提示词前缀缓存(如DeepSeek上下文缓存、Ollama前缀复用)能够命中
+PROMPT_LAYOUTS = ("template", "cache_friendly")
+
+# cache_friendly方式的默认模板：{context}和{question}之前的内容对所有查询都相同
+CACHE_FRIENDLY_PROMPT_TEMPLATE = """<instruction>
+
+你是一个RAG专家，专注于回答名词解释。请按照以下步骤完成任务：
+1. 使用下方<input>中给出的名词，结合上下文信息生成准确、简洁的名词解释。
+2. 解释应包含该名词的基本定义、常见用途或相关背景（如适用）。
+3. 确保输出为纯文本，不包含任何XML标签或格式符号。
+4. 若名词无法识别或解释，请明确回复"无法提供该名词的解释"。
+</instruction>
+
+上下文信息:
+{context}
+
+<input>
+需要解释的名词：{question}
+</input>
+"""
+
+# 检索到的片段相关性不足(见kb_config.py中的relevance)时不调用模型，直接返回的回答
+LOW_RELEVANCE_ANSWER = "无法提供该名词的解释"
+
+def _create_default_embeddings():
+    """创建默认的HuggingFace嵌入模型(会导入sentence-transformers和torch)"""
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    # 通过清华镜像源下载模型
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL_NAME,
+        # 重要：首次下载时不要使用local_files_only，这样才能从镜像源下载
+        # model_kwargs={'local_files_only': True}  # 下载完成后可以取消注释这行
+    )
+
+
+class LazyEmbeddings(Embeddings):
+    """延迟加载的嵌入模型包装
+
+    在第一次计算向量时才加载真正的模型，也可以通过warm_up在后台线程中提前加载。
+    加载已保存的索引只需要持有嵌入对象，因此不会触发模型加载。
+    """
+
+    def __init__(self, factory=_create_default_embeddings, model_name=EMBEDDING_MODEL_NAME):
+        self._factory = factory
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+        self._warm_up_thread = None
+
+    @property
+    def loaded(self):
+        """嵌入模型是否已加载"""
+        return self._model is not None
+
+    def _get_model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    with INGEST_STAGE_SECONDS.time(stage="embedding_model_load"):
+                        self._model = self._factory()
+                    # 加载模型时才导入torch，需要重新为当前线程应用线程预算
+                    thread_budget.reapply()
+        return self._model
+
+    def warm_up(self, background=True):
+        """提前加载嵌入模型
+
+        Args:
+            background: 是否在后台线程中加载，不阻塞调用方
+        """
+        if not background:
+            self._get_model()
+            return
+        if self._warm_up_thread is None and not self.loaded:
+            self._warm_up_thread = threading.Thread(
+                target=self._get_model, name="embedding-warm-up", daemon=True,
+            )
+            self._warm_up_thread.start()
+
+    def embed_documents(self, texts):
+        return self._get_model().embed_documents(texts)
+
+    def embed_query(self, text):
+        return self._get_model().embed_query(text)
+
+    def embed_queries(self, texts):
+        """批量计算查询向量，供查询微批处理使用"""
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+
+        model = self._get_model()
+        # HuggingFaceEmbeddings的embed_query就是单条的embed_documents，多条查询可以合并为一次前向计算
+        if isinstance(model, HuggingFaceEmbeddings):
+            return model.embed_documents(texts)
+        return [model.embed_query(text) for text in texts]
+
+
+def _token_usage(message):
+    """从模型返回的消息中读取token用量，包括命中供应商提示词缓存的token数
+    
+    命中缓存的token数依次取自usage_metadata.input_token_details.cache_read(OpenAI兼容接口的
+    prompt_tokens_details.cached_tokens)和DeepSeek原始用量中的prompt_cache_hit_tokens；
+    供应商不报告缓存时cached_prompt_tokens和uncached_prompt_tokens为None。
+    
+    Returns:
+        dict: prompt_tokens、completion_tokens、cached_prompt_tokens和uncached_prompt_tokens，没有用量时返回None
+    """
+    usage = getattr(message, "usage_metadata", None) or {}
+    if not usage:
+        return None
+    prompt_tokens = usage.get("input_tokens", 0)
+    cached = (usage.get("input_token_details") or {}).get("cache_read")
+    if cached is None:
+        raw = (getattr(message, "response_metadata", None) or {}).get("token_usage") or {}
+        cached = raw.get("prompt_cache_hit_tokens")
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": usage.get("output_tokens", 0),
+        "cached_prompt_tokens": cached,
+        "uncached_prompt_tokens": max(0, prompt_tokens - cached) if cached is not None else None,
+    }
+
+
 class DeepSeekKnowledgeBase:
     """基于LangChain的多模型知识库类"""
-    def __init__(self):
+    def __init__(self, llm=None, embeddings=None, llm_router=None):
+        """
+        Args:
+            llm: 可选，自定义的大语言模型实例，未提供时根据环境变量初始化
+            embeddings: 可选，自定义的嵌入模型实例，未提供时使用HuggingFace嵌入模型
+            llm_router: 可选，共享的模型路由层，未提供时根据llm或环境变量创建
+        """
+        # 在加载torch、FAISS和分词器之前应用CPU线程预算(KB_CPU_BUDGET、KB_QUERY_THREADS、KB_INGEST_THREADS)
+        thread_budget.configure_process()
+        # 知识库日志通过队列由后台线程写出(KB_LOG_FORMAT、KB_LOG_LEVEL)
+        query_log.configure_logging()
+        
         # 从环境变量加载模型配置
         model_type = os.getenv('MODEL_TYPE', 'deepseek').lower()
         temperature = float(os.getenv('TEMPERATURE', '0.7'))
+        self.model_type = model_type
         
-        # 根据模型类型初始化不同的模型
-        self.llm = self._initialize_model(model_type, temperature)
+        self.temperature = temperature
+        
+        # 提示词组装方式(PROMPT_LAYOUT)
+        self.prompt_layout = os.getenv('PROMPT_LAYOUT', 'template').lower()
+        if self.prompt_layout not in PROMPT_LAYOUTS:
+            raise ValueError(f"不支持的提示词组装方式: {self.prompt_layout}，可选: {', '.join(PROMPT_LAYOUTS)}")
+        
+        # 根据模型类型初始化不同的模型，未指定时在首次访问llm时才创建
+        self._llm = llm
+        
+        # 模型路由层，负责查询时的超时、重试和多供应商故障转移
+        if llm_router is not None:
+            self.llm_router = llm_router
+        elif llm is not None:
+            self.llm_router = LLMRouter.from_env(temperature, providers=[(model_type, llm)])
+        else:
+            self.llm_router = LLMRouter.from_env(temperature)
         
         # 初始化嵌入模型 (使用开源的HuggingFace嵌入模型)
-        # 通过清华镜像源下载模型
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2",
-            # 重要：首次下载时不要使用local_files_only，这样才能从镜像源下载
-            # model_kwargs={'local_files_only': True}  # 下载完成后可以取消注释这行
-        )
+        # 默认在首次使用时加载；EMBEDDING_LOAD_MODE=background时在后台线程中预热，eager时立即加载
+        if embeddings is not None:
+            self.embeddings = embeddings
+        else:
+            self.embeddings = LazyEmbeddings()
+            load_mode = os.getenv('EMBEDDING_LOAD_MODE', 'lazy').lower()
+            if load_mode == 'background':
+                self.embeddings.warm_up(background=True)
+            elif load_mode == 'eager':
+                self.embeddings.warm_up(background=False)
         
         # 知识库向量存储
         self.vector_store = None
         
-        # 检索问答链
-        self.qa_chain = None
+        # 检索问答链，首次访问qa_chain时才创建
+        self._qa_chain = None
+        
+        # 提示词模板，在创建或加载知识库时初始化
+        self.prompt = None
+        
+        # 知识库配置(KB_CONFIG_FILE)：分割参数、检索片段数量k和检索索引类型，可由index_tuner.py生成
+        self.config = kb_config.load_config()
+        
+        # 构建参数(分割方式等)，保存时写入快照，加载快照时恢复
+        self.build_params = {}
+        
+        # 元数据过滤索引(每个分片一个)，首次带过滤条件检索时构建，向量存储变化后作废
+        self._metadata_indexes = {}
+        
+        # 索引版本，向量存储每次变化后递增，相同问题只在同一版本内合并
+        self.index_version = 0
         
+        # 正在执行的查询，同一版本下相同的问题共享一次检索和模型调用
+        self._query_flights = SingleFlight()
+        
+        # 近似检索索引: (索引版本, 向量存储, 索引或None)，配置了hnsw或ivf时在首次检索时于后台构建，构建完成前使用精确检索；
+        # 构建结果为None或构建失败时也记录下来，同一索引版本内不再重复构建
+        self._search_index = None
+        self._search_index_lock = threading.Lock()
+        self._search_index_thread = None
+        
+        # 索引指纹缓存: (索引版本, 指纹)，用于匹配预计算的名词解释回答
+        self._fingerprint = (None, None)
+        self._fingerprint_lock = threading.Lock()
+        self._fingerprint_thread = None
+        
+        # 查询微批处理(QUERY_BATCH_WINDOW_MS大于0时启用)：并发查询的问题向量一次批量计算，FAISS一次检索多个查询
+        batch_window = float(os.getenv('QUERY_BATCH_WINDOW_MS', '0') or 0) / 1000
+        self._query_batcher = MicroBatcher(
+            self._retrieve_batch,
+            window=batch_window,
+            max_batch_size=int(os.getenv('QUERY_BATCH_MAX_SIZE', '32') or 32),
+            name="kb-query-batch",
+            on_start=thread_budget.apply_query_budget,
+        ) if batch_window > 0 else None
+        
+    @property
+    def llm(self):
+        """大语言模型实例，首次访问时根据环境变量创建"""
+        if self._llm is None:
+            self._llm = self._initialize_model(self.model_type, self.temperature)
+        return self._llm
+    
     def _initialize_model(self, model_type, temperature):
         """根据模型类型初始化相应的大语言模型
         
@@ -97,55 +278,33 @@ class DeepSeekKnowledgeBase:
             初始化好的大语言模型实例
         """
         try:
-            if model_type == 'deepseek':
-                # DeepSeek模型
-                model_name = os.getenv('DEEPSEEK_MODEL', 'deepseek-chat')
-                return ChatDeepSeek(model=model_name, temperature=temperature)
-            
-            elif model_type == 'qianwen':
-                # 千问模型
-                model_name = os.getenv('QIANWEN_MODEL', 'qwen-turbo')
-                api_key = os.getenv('QIANWEN_API_KEY')
-                if not api_key:
-                    raise ValueError("千问模型需要配置QIANWEN_API_KEY环境变量")
-                return QianwenChat(model_name=model_name, api_key=api_key, temperature=temperature)
-            
-            elif model_type == 'doubao':
-                # 豆包模型
-                model_name = os.getenv('DOUBAO_MODEL', 'ERNIE-Bot')
-                api_key = os.getenv('DOUBAO_API_KEY')
-                if not api_key:
-                    raise ValueError("豆包模型需要配置DOUBAO_API_KEY环境变量")
-                return DoubaoChat(model=model_name, api_key=api_key, temperature=temperature)
-            
-            elif model_type == 'ollama':
-                # Ollama本地模型
-                model_name = os.getenv('OLLAMA_MODEL', 'llama3')
-                base_url = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
-                return ChatOllama(model=model_name, base_url=base_url, temperature=temperature)
-            
-            else:
-                raise ValueError(f"不支持的模型类型: {model_type}")
-                
+            return create_chat_model(model_type, temperature)
         except Exception as e:
-            print(f"初始化模型失败: {str(e)}")
-            print("将使用默认的DeepSeek模型作为备选")
+            logger.error(f"初始化模型失败: {str(e)}，将使用默认的DeepSeek模型作为备选")
             # 默认使用DeepSeek模型作为备选
-            return ChatDeepSeek(model=os.getenv('DEEPSEEK_MODEL', 'deepseek-chat'), 
-                               temperature=temperature)
+            return create_chat_model('deepseek', temperature)
     
     def _load_prompt_template(self):
         """从环境变量加载提示词模板
         
+        cache_friendly方式使用RAG_CACHE_PROMPT_TEMPLATE，未设置时使用内置的缓存友好模板。
+        
         Returns:
             str: 提示词模板字符串
         """
+        if self.prompt_layout == "cache_friendly":
+            template = os.getenv('RAG_CACHE_PROMPT_TEMPLATE') or CACHE_FRIENDLY_PROMPT_TEMPLATE
+            # 第一个变量之前的内容才是所有查询共享的前缀
+            if 0 <= template.find("{question}") < template.find("{context}"):
+                logger.warning("提示词模板中{question}位于{context}之前，上下文无法被供应商的前缀缓存复用")
+            return template
+        
         # 从环境变量获取提示词模板
         template = os.getenv('RAG_PROMPT_TEMPLATE')
         
         # 如果环境变量中没有，使用默认模板作为备用
         if not template:
-            print("警告: 未在环境变量中找到RAG_PROMPT_TEMPLATE，使用默认模板")
+            logger.warning("未在环境变量中找到RAG_PROMPT_TEMPLATE，使用默认模板")
             template = """
 <instruction>
 
@@ -166,14 +325,48 @@ class DeepSeekKnowledgeBase:
         
         return template
     
+    @profile_calls("ingest", lambda self, file_paths: f"create_knowledge_base: {len(file_paths)} 个文件")
+    @with_thread_budget("ingest")
     def create_knowledge_base(self, file_paths):
         """创建知识库
         Args:
             file_paths: 文档文件路径列表
         """
+        documents = self.load_documents(file_paths)
+        
+        if not documents:
+            logger.error("没有找到任何文档，请检查文件路径")
+            return False
+        
+        # 按知识库配置分割文档
+        texts = self.split_documents(documents, self.config["chunk_size"], self.config["chunk_overlap"])
+        
+        # 创建向量存储
+        self.vector_store = self._build_vector_store(texts)
+        INGEST_DOCUMENTS.inc(len(documents))
+        
+        # 创建检索问答链并使用自定义提示词
+        self._build_qa_chain()
+        
+        logger.info(f"成功创建知识库，共加载 {len(documents)} 个文档，分割为 {len(texts)} 个片段",
+                    extra={"fields": {"documents": len(documents), "chunks": len(texts)}})
+        return True
+    
+    def load_documents(self, file_paths):
+        """按文件扩展名加载文档，无法加载的文件会被跳过
+        
+        Args:
+            file_paths: 文档文件路径列表
+            
+        Returns:
+            list: 加载得到的Document列表
+        """
+        from langchain_community.document_loaders import TextLoader
+        
         documents = []
         
         # 加载每个文档
+        parse_start = time.perf_counter()
         for file_path in file_paths:
             if os.path.exists(file_path):
                 # 根据文件扩展名选择不同的加载器
@@ -181,90 +374,883 @@ class DeepSeekKnowledgeBase:
                     loader = TextLoader(file_path, encoding="utf-8")
                 elif file_path.endswith('.docx'):
                     try:
-                        loader = Docx2txtLoader(file_path)
+                        # 流式解析并按标题章节生成文档，分割时片段不会跨越章节
+                        from docx_reader import StructuredDocxLoader
+                        loader = StructuredDocxLoader(file_path)
                     except Exception as e:
-                        print(f"加载Word文档 {file_path} 出错: {str(e)}")
+                        logger.error(f"加载Word文档 {file_path} 出错: {str(e)}")
                         continue
                 else:
-                    print(f"警告: 不支持的文件格式: {file_path}")
+                    logger.warning(f"不支持的文件格式: {file_path}")
                     continue
                 
                 try:
                     document = loader.load()
                     documents.extend(document)
                 except Exception as e:
-                    print(f"加载文档 {file_path} 出错: {str(e)}")
+                    ERRORS.inc(operation="load_document")
+                    logger.error(f"加载文档 {file_path} 出错: {str(e)}")
             else:
-                print(f"警告: 文件 {file_path} 不存在")
+                logger.warning(f"文件 {file_path} 不存在")
+        INGEST_STAGE_SECONDS.observe(time.perf_counter() - parse_start, stage="parse")
+        return documents
+    
+    def split_documents(self, documents, chunk_size=None, chunk_overlap=None):
+        """把文档分割为片段
         
+        未指定分割参数时沿用当前知识库构建时的参数(增量更新与已有片段保持一致)，新知识库使用知识库配置。
+        
+        Args:
+            documents: Document列表
+            chunk_size: 片段长度
+            chunk_overlap: 相邻片段的重叠长度
+            
+        Returns:
+            list: 片段Document列表
+        """
+        from langchain.text_splitter import CharacterTextSplitter
+        
+        chunk_size = chunk_size or self.build_params.get("chunk_size") or self.config["chunk_size"]
+        if chunk_overlap is None:
+            chunk_overlap = self.build_params.get("chunk_overlap", self.config["chunk_overlap"])
+        with INGEST_STAGE_SECONDS.time(stage="split"):
+            text_splitter = CharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+            texts = text_splitter.split_documents(documents)
+        self.build_params = {"splitter": "CharacterTextSplitter", "chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+        return texts
+    
+    @profile_calls("ingest", lambda self, changed_paths=(), removed_paths=():
+                   f"update_sources: 变化 {len(changed_paths)} 个，删除 {len(removed_paths)} 个文件")
+    @with_thread_budget("ingest")
+    def update_sources(self, changed_paths=(), removed_paths=()):
+        """按来源文件增量更新知识库：删除变化和已删除文件的旧片段，重新加载变化的文件(见replace_sources)
+        
+        Args:
+            changed_paths: 新增或修改的文件路径列表
+            removed_paths: 已删除的文件路径列表
+            
+        Returns:
+            dict: removed_chunks、added_chunks，以及未能加载、旧片段被保留的文件列表failed
+        """
+        changed_paths, removed_paths = list(changed_paths), list(removed_paths)
+        documents = self.load_documents(changed_paths) if changed_paths else []
+        loaded = {doc.metadata.get("source") for doc in documents}
+        failed = [path for path in changed_paths if path not in loaded]
+        
+        texts = self.split_documents(documents) if documents else []
+        result = self.replace_sources(loaded | set(removed_paths), texts)
+        if documents:
+            INGEST_DOCUMENTS.inc(len(documents))
+        return {**result, "failed": failed}
+    
+    @profile_calls("ingest", lambda self, sources, texts: f"replace_sources: {len(sources)} 个来源")
+    @with_thread_budget("ingest")
+    def replace_sources(self, sources, texts):
+        """删除指定来源的全部旧片段，再加入这些来源的新片段
+        
+        在向量存储的副本上修改，完成后整体替换，更新期间的查询仍使用旧索引。
+        副本会使更新期间的内存占用暂时翻倍。
+        
+        Args:
+            sources: 需要替换或删除的来源(片段元数据中的source)集合
+            texts: 已分割的新片段列表，可以为空(只删除)
+            
+        Returns:
+            dict: 删除的片段数removed_chunks和新增的片段数added_chunks
+        """
+        sources = set(sources)
+        if self.vector_store is None:
+            if not texts:
+                return {"removed_chunks": 0, "added_chunks": 0}
+            self.vector_store = self._build_vector_store(texts)
+            self._build_qa_chain()
+            return {"removed_chunks": 0, "added_chunks": len(texts)}
+        
+        vector_store = self._copy_vector_store()
+        stale_ids = [
+            doc_id
+            for shard in getattr(vector_store, "shards", [vector_store])
+            for doc_id, doc in shard.docstore._dict.items()
+            if doc.metadata.get("source") in sources
+        ]
+        if stale_ids:
+            vector_store.delete(stale_ids)
+        if texts:
+            self._add_embeddings(vector_store, texts)
+        
+        self.vector_store = vector_store
+        self._on_index_changed()
+        if not self.prompt:
+            self._build_qa_chain()
+        logger.info(f"增量更新知识库: 删除 {len(stale_ids)} 个旧片段，新增 {len(texts)} 个片段",
+                    extra={"fields": {"removed_chunks": len(stale_ids), "added_chunks": len(texts)}})
+        return {"removed_chunks": len(stale_ids), "added_chunks": len(texts)}
+    
+    def source_metadata(self, source):
+        """返回某个来源任一片段的元数据(如飞书文档的标题)，知识库中没有该来源时返回None"""
+        if self.vector_store is None:
+            return None
+        for shard in getattr(self.vector_store, "shards", [self.vector_store]):
+            for doc in shard.docstore._dict.values():
+                if doc.metadata.get("source") == source:
+                    return dict(doc.metadata)
+        return None
+    
+    def _copy_vector_store(self):
+        """复制当前向量存储(索引、docstore和ID映射)，用于在不影响查询的情况下修改"""
+        from sharded_store import ShardedVectorStore, clone_faiss
+        
+        if isinstance(self.vector_store, ShardedVectorStore):
+            return self.vector_store.with_shards([clone_faiss(shard) for shard in self.vector_store.shards])
+        return clone_faiss(self.vector_store)
+    
+    @profile_calls("ingest", lambda self, documents: f"add_documents: {len(documents or [])} 个片段")
+    @with_thread_budget("ingest")
+    def add_documents(self, documents):
+        """向知识库追加已分割好的文档片段，知识库不存在时自动创建
+        
+        Args:
+            documents: 已分割的Document列表
+            
+        Returns:
+            bool: 是否添加成功
+        """
         if not documents:
-            print("错误: 没有找到任何文档，请检查文件路径")
             return False
         
-        # 分割文档
-        text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        texts = text_splitter.split_documents(documents)
+        if self.vector_store is None:
+            self.vector_store = self._build_vector_store(documents)
+        else:
+            self._add_embeddings(self.vector_store, documents)
+        self._on_index_changed()
         
-        # 创建向量存储
-        self.vector_store = FAISS.from_documents(texts, self.embeddings)
+        if not self.prompt:
+            self._build_qa_chain()
+        return True
+    
+    def _add_embeddings(self, vector_store, documents):
+        """计算片段向量并追加到已有的向量存储"""
+        vectors = self.embed_chunks(documents)
+        with INGEST_STAGE_SECONDS.time(stage="index"):
+            vector_store.add_embeddings(
+                zip([doc.page_content for doc in documents], vectors),
+                metadatas=[doc.metadata for doc in documents],
+            )
+
+    def embed_chunks(self, documents):
+        """为已分割的片段写入入库时间并计算向量，不修改向量存储
+
+        Args:
+            documents: 已分割的Document列表
+
+        Returns:
+            list: 与片段一一对应的向量
+        """
+        self._stamp_ingested_at(documents)
+        with INGEST_STAGE_SECONDS.time(stage="embed"):
+            vectors = self.embeddings.embed_documents([doc.page_content for doc in documents])
+        INGEST_CHUNKS.inc(len(documents))
+        INGEST_CHARACTERS.inc(sum(len(doc.page_content) for doc in documents))
+        return vectors
+
+    def add_embedded_chunks(self, documents, vectors):
+        """把已计算好向量的片段直接加入向量存储(见bulk_ingest.py)，知识库不存在时自动创建
+
+        KB_NUM_SHARDS大于1时新建的是分片存储。不创建检索问答链，也不复制向量存储，
+        只适用于没有并发查询的离线入库。
+
+        Args:
+            documents: 已分割的Document列表
+            vectors: 与片段一一对应的向量
+        """
+        from langchain_community.vectorstores import FAISS
+        from sharded_store import ShardedVectorStore
+
+        if not documents:
+            return
+        contents = [doc.page_content for doc in documents]
+        metadatas = [doc.metadata for doc in documents]
+        with INGEST_STAGE_SECONDS.time(stage="index"):
+            if self.vector_store is not None:
+                self.vector_store.add_embeddings(zip(contents, vectors), metadatas=metadatas)
+            elif int(os.getenv('KB_NUM_SHARDS', '1') or 1) > 1:
+                self.vector_store = ShardedVectorStore.from_embeddings_batches(
+                    [(contents, vectors, metadatas)], self.embeddings,
+                    int(os.getenv('KB_NUM_SHARDS')), os.getenv('KB_SHARD_BY', 'hash').lower(),
+                )
+            else:
+                self.vector_store = FAISS.from_embeddings(zip(contents, vectors), self.embeddings, metadatas=metadatas)
+        self._on_index_changed()
+
+    def remove_sources(self, sources):
+        """直接从当前向量存储中删除指定来源的全部片段(不复制向量存储，只适用于离线入库)
+
+        Returns:
+            int: 删除的片段数
+        """
+        sources = set(sources)
+        if self.vector_store is None or not sources:
+            return 0
+        stale_ids = [
+            doc_id
+            for shard in getattr(self.vector_store, "shards", [self.vector_store])
+            for doc_id, doc in shard.docstore._dict.items()
+            if doc.metadata.get("source") in sources
+        ]
+        if stale_ids:
+            self.vector_store.delete(stale_ids)
+            self._on_index_changed()
+        return len(stale_ids)
+    
+    def _build_vector_store(self, texts):
+        """对文档片段计算向量并构建FAISS索引，分别记录嵌入和建索引的耗时
+        
+        KB_NUM_SHARDS大于1时构建分片存储(见sharded_store.py)，KB_SHARD_BY指定按hash或source分片。
+        
+        Args:
+            texts: 已分割的Document列表
+            
+        Returns:
+            FAISS或ShardedVectorStore: 新建的向量存储
+        """
+        from langchain_community.vectorstores import FAISS
+        
+        self._stamp_ingested_at(texts)
+        num_shards = int(os.getenv('KB_NUM_SHARDS', '1') or 1)
+        if num_shards > 1:
+            return self._build_sharded_vector_store(texts, num_shards, os.getenv('KB_SHARD_BY', 'hash').lower())
+        
+        contents = [doc.page_content for doc in texts]
+        with INGEST_STAGE_SECONDS.time(stage="embed"):
+            vectors = self.embeddings.embed_documents(contents)
+        with INGEST_STAGE_SECONDS.time(stage="index"):
+            vector_store = FAISS.from_embeddings(
+                zip(contents, vectors),
+                self.embeddings,
+                metadatas=[doc.metadata for doc in texts],
+            )
+        INGEST_CHUNKS.inc(len(texts))
+        INGEST_CHARACTERS.inc(sum(len(content) for content in contents))
+        self._on_index_changed()
+        return vector_store
+    
+    def _build_sharded_vector_store(self, texts, num_shards, partition):
+        """分批计算向量并分配到各分片，峰值内存只包含一批片段的向量
+        
+        Args:
+            texts: 已分割的Document列表
+            num_shards: 分片数量
+            partition: 分片方式，'hash'或'source'
+            
+        Returns:
+            ShardedVectorStore: 新建的分片存储
+        """
+        from sharded_store import ShardedVectorStore, EMBED_BATCH_SIZE
+        
+        timings = {"embed": 0.0, "index": 0.0}
+        
+        def batches():
+            for start in range(0, len(texts), EMBED_BATCH_SIZE):
+                batch = texts[start:start + EMBED_BATCH_SIZE]
+                contents = [doc.page_content for doc in batch]
+                embed_start = time.perf_counter()
+                vectors = self.embeddings.embed_documents(contents)
+                timings["embed"] += time.perf_counter() - embed_start
+                # 生成器暂停期间即为调用方把这一批片段加入分片的耗时
+                index_start = time.perf_counter()
+                yield contents, vectors, [doc.metadata for doc in batch]
+                timings["index"] += time.perf_counter() - index_start
+        
+        vector_store = ShardedVectorStore.from_embeddings_batches(batches(), self.embeddings, num_shards, partition)
+        for stage, seconds in timings.items():
+            INGEST_STAGE_SECONDS.observe(seconds, stage=stage)
+        INGEST_CHUNKS.inc(len(texts))
+        INGEST_CHARACTERS.inc(sum(len(doc.page_content) for doc in texts))
+        self._on_index_changed()
+        return vector_store
+    
+    def chunk_count(self):
+        """知识库中的片段总数(分片存储时为各分片之和)"""
+        if self.vector_store is None:
+            return 0
+        shards = getattr(self.vector_store, "shards", None)
+        if shards is not None:
+            return sum(shard.index.ntotal for shard in shards)
+        return self.vector_store.index.ntotal
+    
+    @staticmethod
+    def _stamp_ingested_at(documents):
+        """为尚未记录入库时间的片段写入入库时间(Unix时间戳)，用于按时间范围过滤"""
+        from metadata_index import INGESTED_AT_FIELD
+        
+        now = time.time()
+        for doc in documents:
+            doc.metadata.setdefault(INGESTED_AT_FIELD, now)
+    
+    def _embedding_model_name(self):
+        """当前嵌入模型的名称，记录在快照中用于加载时核对"""
+        return (getattr(self.embeddings, "model_name", None)
+                or getattr(self.embeddings, "model", None)
+                or type(self.embeddings).__name__)
+    
+    def _on_index_changed(self):
+        """向量存储被创建、追加或加载后调用，使依赖索引内容的缓存失效"""
+        self._metadata_indexes = {}
+        self._search_index = None
+        self.index_version += 1
+    
+    def _build_qa_chain(self):
+        """基于当前向量存储准备提示词，检索问答链在首次访问时创建"""
+        from langchain_core.prompts import PromptTemplate
         
         # 从环境变量加载提示词模板
         template = self._load_prompt_template()
         
-        prompt = PromptTemplate(
+        self.prompt = PromptTemplate(
             template=template,
             input_variables=["context", "question"]
         )
-
-        # 创建检索问答链并使用自定义提示词
-        self.qa_chain = RetrievalQA.from_chain_type(
-            llm=self.llm,
-            chain_type="stuff",
-            retriever=self.vector_store.as_retriever(search_kwargs={"k": 5}),
-            return_source_documents=True,
-            chain_type_kwargs={"prompt": prompt}
-        )
         
-        print(f"成功创建知识库，共加载 {len(documents)} 个文档，分割为 {len(texts)} 个片段")
-        return True
+        # 向量存储已变化，之前创建的检索问答链作废
+        self._qa_chain = None
+    
+    @property
+    def qa_chain(self):
+        """检索问答链(RetrievalQA)，查询流程不依赖它，保留给直接调用链的场景"""
+        if self._qa_chain is None and self.vector_store is not None and self.prompt is not None:
+            from langchain.chains import RetrievalQA
+            
+            # 创建检索问答链并使用自定义提示词
+            self._qa_chain = RetrievalQA.from_chain_type(
+                llm=self.llm,
+                chain_type="stuff",
+                retriever=self.vector_store.as_retriever(search_kwargs={"k": self.config["k"]}),
+                return_source_documents=True,
+                chain_type_kwargs={"prompt": self.prompt}
+            )
+        return self._qa_chain
     
     def query_knowledge_base(self, question):
         """查询知识库
+        
+        同一索引版本下同时到达的相同问题(忽略大小写和多余空白)只执行一次检索和模型调用，
+        所有请求共享同一份结果。
+        
         Args:
             question: 查询问题
         Returns:
             回答和相关文档
         """
-        if not self.qa_chain:
-            print("错误: 知识库尚未创建，请先调用create_knowledge_base方法")
+        if not self.vector_store or not self.prompt:
+            logger.error("知识库尚未创建，请先调用create_knowledge_base方法")
             return None
         
-        try:
-            # 修改为与模板一致的变量名
-            result = self.qa_chain.invoke({
-                "query": question
-            })
+        flight = self._join_query_flight(question, background=False)
+        result = flight.result()
+        # 每个调用方拿到各自的副本，避免调用方修改结果时相互影响
+        return dict(result) if result else None
+    
+    def stream_knowledge_base(self, question):
+        """以流式方式查询知识库，与同时到达的相同问题共享一次检索和模型调用
+        
+        Args:
+            question: 查询问题
             
-            # 格式化回答
-            answer = result["result"]
-            source_documents = result["source_documents"]
+        Returns:
+            iterator: 依次产出回答文本片段的迭代器；知识库未创建时返回None
+        """
+        if not self.vector_store or not self.prompt:
+            logger.error("知识库尚未创建，请先调用create_knowledge_base方法")
+            return None
+        
+        # 由后台线程执行查询，即使发起的调用方中途断开，其他等待方仍能拿到完整回答
+        return self._join_query_flight(question, background=True).stream()
+    
+    def _join_query_flight(self, question, background):
+        """加入同一问题正在执行的查询，没有时发起一次新的查询
+        
+        Args:
+            question: 查询问题
+            background: 发起新查询时是否在后台线程中执行，否则在当前线程中执行完再返回
+            
+        Returns:
+            Flight: 可等待结果或流式读取的查询
+        """
+        key = (self.index_version, " ".join(question.split()).casefold())
+        flight, leader = self._query_flights.join(key)
+        if not leader:
+            CACHE_EVENTS.inc(cache="query_coalescing", result="hit")
+            return flight
+        
+        CACHE_EVENTS.inc(cache="query_coalescing", result="miss")
+        if background:
+            # 在发起请求的上下文中执行，使请求级的设置(如按需剖析)对后台查询同样生效
+            context = contextvars.copy_context()
+            threading.Thread(target=context.run, args=(self._run_query_flight, key, flight, question), daemon=True).start()
+        else:
+            self._run_query_flight(key, flight, question)
+        return flight
+    
+    @profile_calls("query", lambda self, key, flight, question: question)
+    def _run_query_flight(self, key, flight, question):
+        """执行一次查询，把流式片段和最终结果交给所有等待方
+        
+        查询的各阶段耗时写入查询日志，总耗时超过SLOW_QUERY_THRESHOLD_MS时写入慢查询日志。
+        """
+        result = None
+        try:
+            with query_log.trace_query(question, index_version=self.index_version,
+                                       index_fingerprint=self._cached_fingerprint(), model_type=self.model_type):
+                result = self._execute_query(question, on_chunk=flight.publish)
+        except Exception as e:
+            ERRORS.inc(operation="query")
+            logger.exception(f"查询出错: {str(e)}")
+        finally:
+            self._query_flights.done(key, flight, result)
+    
+    def _execute_query(self, question, on_chunk=None):
+        """分阶段执行检索问答：检索、组装提示词、流式调用模型
+        
+        配置了relevance.max_distance且最相似片段的距离超过该值时，不调用模型，直接返回LOW_RELEVANCE_ANSWER。
+        
+        Args:
+            question: 查询问题
+            on_chunk: 每收到一段模型输出时调用的函数
             
+        Returns:
+            dict: 回答和相关文档
+        """
+        query_start = time.perf_counter()
+        
+        # 分阶段执行检索问答，与stuff链的行为保持一致，便于记录各阶段耗时
+        docs_and_scores = self._retrieve(question)
+        source_documents = [doc for doc, _ in docs_and_scores]
+        query_log.annotate(
+            retrieved=[{"id": doc.id, "source": doc.metadata.get("source"), "score": round(float(score), 6)}
+                       for doc, score in docs_and_scores],
+        )
+        sources = [
+            {
+                "id": doc.id,
+                "content": doc.page_content,
+                "metadata": doc.metadata
+            } for doc in source_documents
+        ]
+        
+        relevance = self._judge_relevance(docs_and_scores)
+        if relevance and relevance["decision"] == "low":
+            # 最相似的片段也不够相关，模型只会回答无法解释，省去整次模型调用
+            if on_chunk is not None:
+                on_chunk(LOW_RELEVANCE_ANSWER)
+            QUERY_TOTAL_SECONDS.observe(time.perf_counter() - query_start)
+            snippets = self.config["relevance"].get("on_low_relevance") == "snippets"
             return {
-                "answer": answer,
-                "sources": [
-                    {
-                        "content": doc.page_content,
-                        "metadata": doc.metadata
-                    } for doc in source_documents
-                ]
+                "answer": LOW_RELEVANCE_ANSWER,
+                "usage": None,
+                "relevance": relevance,
+                "sources": sources if snippets else []
             }
+        
+        with stage_timer("prompt"):
+            prompt_text = self._assemble_prompt(question, source_documents)
+        query_log.annotate(prompt_chars=len(prompt_text))
+        
+        answer, usage = self._call_llm(prompt_text, on_chunk=on_chunk)
+        query_log.annotate(answer_chars=len(answer))
+        QUERY_TOTAL_SECONDS.observe(time.perf_counter() - query_start)
+        
+        result = {
+            "answer": answer,
+            "usage": usage,
+            "sources": sources
+        }
+        if relevance:
+            result["relevance"] = relevance
+        return result
+    
+    def larger_score_is_better(self):
+        """检索得分是否越大越相似：内积向量存储为True，L2距离(默认)为False"""
+        from langchain_community.vectorstores.utils import DistanceStrategy
+        store = self.vector_store
+        store = getattr(store, "shards", [store])[0]
+        return getattr(store, "distance_strategy", None) == DistanceStrategy.MAX_INNER_PRODUCT
+    
+    def _judge_relevance(self, docs_and_scores):
+        """按知识库配置中的relevance.max_distance判断检索结果是否足够相关
+        
+        L2距离越小越相似，最相似片段的距离不超过阈值时通过；内积得分越大越相似，最相似片段的得分不低于阈值时通过。
+        
+        Args:
+            docs_and_scores: 检索结果，(Document, 距离或得分)元组列表
+            
+        Returns:
+            dict: decision(pass或low)、最相似片段的距离best_distance和阈值max_distance；未启用时返回None
+        """
+        max_distance = self.config["relevance"].get("max_distance")
+        if max_distance is None:
+            return None
+        max_distance = float(max_distance)
+        scores = [float(score) for _, score in docs_and_scores]
+        if self.larger_score_is_better():
+            best_distance = max(scores, default=None)
+            passed = best_distance is not None and best_distance >= max_distance
+        else:
+            best_distance = min(scores, default=None)
+            passed = best_distance is not None and best_distance <= max_distance
+        decision = "pass" if passed else "low"
+        RELEVANCE_DECISIONS.inc(decision=decision)
+        query_log.annotate(relevance=decision, best_distance=best_distance)
+        return {"decision": decision, "best_distance": best_distance, "max_distance": max_distance}
+    
+    @with_thread_budget("query")
+    def _retrieve(self, question, k=None):
+        """计算问题向量并在FAISS中检索最相似的文档片段
+        
+        启用查询微批处理时交给批处理线程，与同时到达的其他查询一起计算向量和检索。
+        
+        Args:
+            question: 查询问题
+            k: 返回的片段数量，默认使用知识库配置
+            
+        Returns:
+            list: (Document, 距离)元组列表，距离越小越相似
+        """
+        k = k or self.config["k"]
+        if self._query_batcher is not None:
+            return self._submit_batched(question, k)
+        with stage_timer("embed"):
+            query_vector = self.embeddings.embed_query(question)
+        with stage_timer("search"):
+            vector_store = self.vector_store
+            search_index = self._approximate_index(vector_store)
+            if search_index is not None:
+                import numpy as np
+                from metadata_index import search_vector_store_batch
+                return search_vector_store_batch(
+                    vector_store, np.asarray([query_vector], dtype="float32"), k, index=search_index,
+                )[0]
+            return vector_store.similarity_search_with_score_by_vector(query_vector, k=k)
+    
+    def _embed_query(self, question):
+        """计算单个查询向量，启用查询微批处理时与同时到达的查询一起批量计算"""
+        if self._query_batcher is not None:
+            return self._submit_batched(question, None)
+        with stage_timer("embed"):
+            return self.embeddings.embed_query(question)
+    
+    def _submit_batched(self, question, k):
+        """交给查询微批处理并在当前线程记录各阶段耗时(排队时间记为batch_wait)"""
+        start = time.perf_counter()
+        result, timings = self._query_batcher.submit((question, k))
+        for stage, seconds in timings.items():
+            record_stage(stage, seconds)
+        record_stage("batch_wait", max(0.0, time.perf_counter() - start - sum(timings.values())))
+        return result
+    
+    def _retrieve_batch(self, items):
+        """批量执行一批查询：一次计算全部问题向量，需要检索的查询再用一次FAISS搜索完成
+        
+        Args:
+            items: (问题, k)列表，k为None时只计算向量
+            
+        Returns:
+            list: 与items对应的(结果, 各阶段耗时)，检索的查询结果为(Document, 距离)元组列表，只计算向量的查询为向量
+        """
+        import numpy as np
+        from metadata_index import search_vector_store_batch
+        from sharded_store import ShardedVectorStore
+        
+        embed_start = time.perf_counter()
+        vectors = np.asarray(embed_queries(self.embeddings, [question for question, _ in items]), dtype="float32")
+        embed_seconds = time.perf_counter() - embed_start
+        results = list(vectors)
+        
+        searches = [position for position, (_, k) in enumerate(items) if k is not None]
+        search_seconds = 0.0
+        if searches:
+            # 精确索引中前k条是前max_k条的前缀，按最大的k检索一次再分别截取
+            max_k = max(items[position][1] for position in searches)
+            search_start = time.perf_counter()
+            vector_store = self.vector_store
+            if isinstance(vector_store, ShardedVectorStore):
+                found = vector_store.search_batch(vectors[searches], max_k)
+            else:
+                found = search_vector_store_batch(vector_store, vectors[searches], max_k,
+                                                  index=self._approximate_index(vector_store))
+            search_seconds = time.perf_counter() - search_start
+            for position, docs_and_scores in zip(searches, found):
+                results[position] = docs_and_scores[:items[position][1]]
+        
+        # 批中每个查询都经历了整批的计算时间，由提交查询的线程记录
+        return [
+            (result, {"embed": embed_seconds, **({"search": search_seconds} if k is not None else {})})
+            for result, (_, k) in zip(results, items)
+        ]
+    
+    @with_thread_budget("query")
+    def retrieve_batch(self, questions, k=None):
+        """批量检索多个问题：一次计算全部问题向量，再用一次FAISS搜索完成检索(与线上查询使用同一个索引)
+        
+        Args:
+            questions: 问题列表
+            k: 每个问题返回的片段数量，默认使用知识库配置
+            
+        Returns:
+            list: 与questions对应的(Document, 距离)元组列表，距离越小越相似；知识库未创建时返回None
+        """
+        if not self.vector_store:
+            logger.error("知识库尚未创建，请先调用create_knowledge_base方法")
+            return None
+        if not questions:
+            return []
+        k = k or self.config["k"]
+        return [result for result, _ in self._retrieve_batch([(question, k) for question in questions])]
+    
+    def _approximate_index(self, vector_store):
+        """当前向量存储可用的近似检索索引，配置为flat、尚未构建完成或为分片存储时返回None
+        
+        首次调用时在后台线程中构建，构建期间仍使用精确检索，查询不会等待。
+        分片存储的各分片(以及已被替换的旧向量存储)不是当前向量存储，直接返回None，不会启动构建线程。
+        """
+        if self.config["index"]["type"] == "flat" or vector_store is None or vector_store is not self.vector_store:
+            return None
+        entry = self._search_index
+        if entry is not None and entry[0] == self.index_version and entry[1] is vector_store:
+            # 构建结果为None(如片段太少无法训练)或构建失败时同样记录，索引版本变化前不再重新构建
+            if entry[2] is None or entry[2].ntotal == vector_store.index.ntotal:
+                return entry[2]
+        from sharded_store import ShardedVectorStore
+        if not isinstance(vector_store, ShardedVectorStore):
+            with self._search_index_lock:
+                if self._search_index_thread is None:
+                    self._search_index_thread = threading.Thread(
+                        target=self._build_search_index, name="kb-search-index", daemon=True,
+                    )
+                    self._search_index_thread.start()
+        return None
+    
+    @with_thread_budget("ingest")
+    def _build_search_index(self):
+        """构建近似检索索引，构建期间向量存储发生变化时为新的向量存储重新构建"""
+        from sharded_store import ShardedVectorStore
+        version, vector_store = None, None
+        try:
+            while True:
+                version, vector_store = self.index_version, self.vector_store
+                if vector_store is None or isinstance(vector_store, ShardedVectorStore):
+                    with self._search_index_lock:
+                        self._search_index_thread = None
+                    return
+                start = time.perf_counter()
+                search_index = ann_index.build_for_vector_store(vector_store, self.config["index"])
+                with self._search_index_lock:
+                    if version == self.index_version and vector_store is self.vector_store:
+                        self._search_index = (version, vector_store, search_index)
+                        self._search_index_thread = None
+                        logger.info("近似检索索引构建完成", extra={"fields": {
+                            **self.config["index"], "chunks": vector_store.index.ntotal,
+                            "seconds": round(time.perf_counter() - start, 3),
+                        }})
+                        return
         except Exception as e:
-            print(f"查询出错: {str(e)}")
+            with self._search_index_lock:
+                if version == self.index_version and vector_store is self.vector_store:
+                    self._search_index = (version, vector_store, None)
+                self._search_index_thread = None
+            logger.exception(f"构建近似检索索引出错，索引版本变化前继续使用精确检索: {str(e)}")
+    
+    @with_thread_budget("query")
+    def search_knowledge_base(self, query, k=None, filters=None, ingested_after=None, ingested_before=None):
+        """只检索不调用大语言模型，返回最相似的文本片段及其距离
+        
+        过滤条件通过FAISS的IDSelector在向量搜索内部生效，满足条件的片段不少于k个时总能返回k条结果。
+        
+        Args:
+            query: 查询文本
+            k: 返回的片段数量，默认使用知识库配置
+            filters: 元数据精确匹配条件，如{"source": "a.docx"}或{"title": ["文档A", "文档B"]}
+            ingested_after: 入库时间下限(Unix时间戳，含)
+            ingested_before: 入库时间上限(Unix时间戳，不含)
+            
+        Returns:
+            list: 包含id、content、metadata和score(L2距离，越小越相似)的字典列表；知识库未创建时返回None
+        """
+        if not self.vector_store:
+            logger.error("知识库尚未创建，请先调用create_knowledge_base方法")
+            return None
+        
+        import numpy as np
+        from metadata_index import MetadataIndex, search_vector_store
+        from sharded_store import ShardedVectorStore
+        
+        k = k or self.config["k"]
+        filtering = bool(filters) or ingested_after is not None or ingested_before is not None
+        
+        def search_shard(position, vector_store):
+            selected_ids = None
+            if filtering:
+                metadata_index = self._metadata_indexes.get(position)
+                if metadata_index is None:
+                    metadata_index = MetadataIndex(vector_store)
+                    self._metadata_indexes[position] = metadata_index
+                selected_ids = metadata_index.select(filters, ingested_after, ingested_before)
+                if len(selected_ids) == 0:
+                    return []
+            # 近似检索索引只用于不带过滤条件的检索
+            search_index = None if filtering else self._approximate_index(vector_store)
+            return search_vector_store(vector_store, query_vector, k, selected_ids, index=search_index)
+        
+        query_vector = np.asarray([self._embed_query(query)], dtype="float32")
+        
+        with stage_timer("search"):
+            if isinstance(self.vector_store, ShardedVectorStore):
+                # 各分片并行检索，再按距离合并
+                return self.vector_store.merge(
+                    self.vector_store.map_shards(search_shard), k, score=lambda result: result["score"],
+                )
+            return search_shard(0, self.vector_store)
+    
+    def get_chunk(self, chunk_id):
+        """按片段ID读取片段的完整内容
+        
+        Args:
+            chunk_id: 片段ID(问答结果sources和检索结果中的id)
+            
+        Returns:
+            dict: 包含id、content和metadata的字典，不存在时返回None
+        """
+        if not self.vector_store:
+            return None
+        for store in getattr(self.vector_store, "shards", [self.vector_store]):
+            doc = store.docstore.search(chunk_id)
+            if not isinstance(doc, str):
+                return {"id": chunk_id, "content": doc.page_content, "metadata": doc.metadata}
+        return None
+    
+    def _assemble_prompt(self, question, documents):
+        """将检索到的片段拼接为上下文并填充提示词模板
+        
+        cache_friendly方式下片段按ID排序，检索到相同片段的查询得到相同的上下文前缀。
+        """
+        if self.prompt_layout == "cache_friendly":
+            documents = sorted(documents, key=lambda doc: str(doc.id or ""))
+        context = "\n\n".join(doc.page_content for doc in documents)
+        return self.prompt.format(context=context, question=question)
+    
+    def _call_llm(self, prompt_text, on_chunk=None):
+        """以流式方式调用大语言模型，记录首token耗时、总耗时和token用量
+        
+        Args:
+            prompt_text: 完整的提示词
+            on_chunk: 每收到一段模型输出时调用的函数，参数为该段文本
+            
+        Returns:
+            tuple: (模型回答, token用量)，供应商未返回用量时token用量为None
+        """
+        llm_start = time.perf_counter()
+        message = None
+        for chunk in self.llm_router.stream(prompt_text):
+            if message is None:
+                record_stage("llm_first_token", time.perf_counter() - llm_start)
+                message = chunk
+            else:
+                message = message + chunk
+            if on_chunk is not None and chunk.content:
+                on_chunk(chunk.content)
+        record_stage("llm_total", time.perf_counter() - llm_start)
+        
+        if message is None:
+            return "", None
+        
+        usage = _token_usage(message)
+        if usage:
+            LLM_TOKENS.inc(usage["prompt_tokens"], model_type=self.model_type, kind="prompt")
+            LLM_TOKENS.inc(usage["completion_tokens"], model_type=self.model_type, kind="completion")
+            if usage["cached_prompt_tokens"] is not None:
+                LLM_TOKENS.inc(usage["cached_prompt_tokens"], model_type=self.model_type, kind="prompt_cache_hit")
+                LLM_TOKENS.inc(usage["uncached_prompt_tokens"], model_type=self.model_type, kind="prompt_cache_miss")
+                CACHE_EVENTS.inc(cache="llm_prompt", result="hit" if usage["cached_prompt_tokens"] else "miss")
+            query_log.annotate(**usage)
+        return message.content, usage
+    
+    def index_fingerprint(self):
+        """知识库内容的指纹：片段内容、构建参数、提示词模板和模型类型的摘要
+        
+        与进程内递增的index_version不同，同样内容的知识库在不同进程中(包括保存后重新加载)指纹相同，
+        用于判断预计算的回答是否仍然有效。
+        
+        Returns:
+            str: 十六进制摘要；知识库未创建时返回None
+        """
+        if not self.vector_store:
+            return None
+        index_version = self.index_version
+        version, fingerprint = self._fingerprint
+        if version == index_version:
+            return fingerprint
+        
+        import hashlib
+        import json
+        
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            "build_params": self.build_params,
+            "prompt": self.prompt.template if self.prompt else None,
+            "model_type": self.model_type,
+        }, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        vector_store = self.vector_store
+        for store in getattr(vector_store, "shards", [vector_store]):
+            for position in range(store.index.ntotal):
+                doc = store.docstore.search(store.index_to_docstore_id[position])
+                digest.update(doc.page_content.encode("utf-8"))
+                digest.update(b"\0")
+        fingerprint = digest.hexdigest()[:16]
+        self._fingerprint = (index_version, fingerprint)
+        return fingerprint
+    
+    def precomputed_answer(self, term):
+        """查找GLOSSARY_DB_PATH中为当前知识库内容预先生成的回答(见glossary.py)
+        
+        Args:
+            term: 术语
+            
+        Returns:
+            dict: {"answer": str, "sources": list}，未配置、未收录或知识库内容已变化时返回None
+        """
+        from glossary import get_glossary_store
+        
+        store = get_glossary_store()
+        if store is None or not self.vector_store:
+            return None
+        version, fingerprint = self._fingerprint
+        if version != self.index_version:
+            # 知识库变化后需要遍历全部片段重新计算指纹，放到后台线程中，计算完成前按未收录处理
+            self._refresh_fingerprint()
+            CACHE_EVENTS.inc(cache="glossary", result="miss")
             return None
+        result = store.get(term, fingerprint)
+        CACHE_EVENTS.inc(cache="glossary", result="hit" if result else "miss")
+        return result
+    
+    def _cached_fingerprint(self):
+        """已计算好的当前版本索引指纹，尚未计算时返回None(不触发计算)"""
+        version, fingerprint = self._fingerprint
+        return fingerprint if version == self.index_version else None
+    
+    def _refresh_fingerprint(self):
+        """在后台线程中计算索引指纹，同一时刻只计算一次"""
+        with self._fingerprint_lock:
+            if self._fingerprint_thread is not None and self._fingerprint_thread.is_alive():
+                return
+            self._fingerprint_thread = threading.Thread(target=self.index_fingerprint, daemon=True)
+            self._fingerprint_thread.start()
     
     def get_knowledge_answer(self, term_to_explain, use_fallback=False):
         """获取知识库中关于特定术语的解释（封装增强版查询方法）
         
+        已预计算的术语直接返回预先生成的回答，其余术语执行检索和模型调用；
+        检索到的片段相关性不足时不调用模型，status为low_relevance。
+        
         Args:
             term_to_explain: 需要解释的术语
             use_fallback: 当查询失败时是否使用默认回复
@@ -276,12 +1262,13 @@ class DeepSeekKnowledgeBase:
         if not term_to_explain or not isinstance(term_to_explain, str):
             return {"answer": "请提供有效的查询术语", "sources": []}
         
-        # 尝试查询知识库
-        result = self.query_knowledge_base(term_to_explain)
+        # 优先使用预计算的回答，否则查询知识库
+        result = self.precomputed_answer(term_to_explain) or self.query_knowledge_base(term_to_explain)
         
         if result:
             # 添加查询成功的信息
-            result["status"] = "success"
+            low = (result.get("relevance") or {}).get("decision") == "low"
+            result["status"] = "low_relevance" if low else "success"
             return result
         elif use_fallback:
             # 使用默认回复
@@ -322,11 +1309,15 @@ class DeepSeekKnowledgeBase:
     
     def save_knowledge_base(self, file_path):
         """保存知识库
+        
+        默认保存为带版本和校验和的快照(见snapshot.py)，SNAPSHOT_VECTOR_DTYPE=float16时向量以半精度存储；
+        KB_SAVE_FORMAT=faiss时仍使用FAISS.save_local的旧格式。
+        
         Args:
             file_path: 保存路径
         """
         if not self.vector_store:
-            print("错误: 没有知识库可保存")
+            logger.error("没有知识库可保存")
             return False
         
         try:
@@ -336,44 +1327,119 @@ class DeepSeekKnowledgeBase:
                 os.makedirs(dir_path)
             
             # 保存向量存储
-            self.vector_store.save_local(file_path)
-            print(f"知识库已保存到 {file_path}")
+            with INGEST_STAGE_SECONDS.time(stage="save"):
+                from snapshot import write_snapshot, write_sharded_snapshot
+                from sharded_store import ShardedVectorStore
+                
+                snapshot_options = {
+                    "embedding_model": self._embedding_model_name(),
+                    "build_params": self.build_params,
+                    "vector_dtype": os.getenv('SNAPSHOT_VECTOR_DTYPE', 'float32').lower(),
+                }
+                if isinstance(self.vector_store, ShardedVectorStore):
+                    # 每个分片保存为独立的快照子目录
+                    write_sharded_snapshot(self.vector_store, file_path, **snapshot_options)
+                elif os.getenv('KB_SAVE_FORMAT', 'snapshot').lower() == 'faiss':
+                    self.vector_store.save_local(file_path)
+                else:
+                    write_snapshot(self.vector_store, file_path, **snapshot_options)
+            logger.info(f"知识库已保存到 {file_path}")
             return True
         except Exception as e:
-            print(f"保存知识库出错: {str(e)}")
+            ERRORS.inc(operation="save")
+            logger.error(f"保存知识库出错: {str(e)}")
             return False
     
     def load_knowledge_base(self, file_path):
-        """加载已保存的知识库
+        """加载已保存的知识库，同时支持快照格式和FAISS.save_local的旧格式
+        
+        快照中的数据文件会校验sha256，损坏时加载失败，原有知识库保持不变。
+        
         Args:
             file_path: 知识库文件路径
         """
         try:
+            from langchain_community.vectorstores import FAISS
+            from snapshot import is_snapshot, is_sharded_snapshot, read_snapshot, read_sharded_snapshot
+            
             # 加载向量存储
-            self.vector_store = FAISS.load_local(file_path, self.embeddings, allow_dangerous_deserialization=True)
+            with INGEST_STAGE_SECONDS.time(stage="load"):
+                if is_sharded_snapshot(file_path):
+                    # 各分片并行加载
+                    vector_store, manifest = read_sharded_snapshot(file_path, self.embeddings)
+                    self.build_params = manifest.get("build_params", {})
+                elif is_snapshot(file_path):
+                    vector_store, manifest = read_snapshot(file_path, self.embeddings)
+                    current_model = self._embedding_model_name()
+                    if manifest.get("embedding_model") and manifest["embedding_model"] != current_model:
+                        logger.warning(f"知识库由嵌入模型 {manifest['embedding_model']} 构建，当前使用 {current_model}，检索结果可能不准确")
+                    self.build_params = manifest.get("build_params", {})
+                else:
+                    vector_store = FAISS.load_local(file_path, self.embeddings, allow_dangerous_deserialization=True)
+                    self.build_params = {}
+                    # 旧版本保存的Document可能没有id，补上docstore中的ID，使问答结果中的来源可以按ID读取全文
+                    for docstore_id, doc in vector_store.docstore._dict.items():
+                        if getattr(doc, "id", None) is None:
+                            doc.id = docstore_id
+                self.vector_store = vector_store
+            self._on_index_changed()
             
-            # 从环境变量加载提示词模板
-            template = self._load_prompt_template()
-            
-            prompt = PromptTemplate(
-                template=template,
-                input_variables=["context", "question"]
-            )
+            built_with = (self.build_params.get("chunk_size"), self.build_params.get("chunk_overlap"))
+            if built_with[0] and built_with != (self.config["chunk_size"], self.config["chunk_overlap"]):
+                logger.info(f"知识库的分割参数 {built_with} 与知识库配置不同，增量更新沿用原参数，重新创建知识库后生效")
             
             # 创建检索问答链并使用自定义提示词
-            self.qa_chain = RetrievalQA.from_chain_type(
-                llm=self.llm,
-                chain_type="stuff",
-                # 保持与上面相同的k值调整
-                retriever=self.vector_store.as_retriever(search_kwargs={"k": 5}),
-                return_source_documents=True,
-                chain_type_kwargs={"prompt": prompt}  # 添加这一行以使用自定义提示词
-            )
+            self._build_qa_chain()
             
-            print(f"成功加载知识库: {file_path}")
+            logger.info(f"成功加载知识库: {file_path}")
+            return True
+        except Exception as e:
+            ERRORS.inc(operation="load")
+            logger.error(f"加载知识库出错: {str(e)}")
+            return False
+    
+    def save_shard(self, file_path, shard_id):
+        """只保存分片存储中的一个分片，其余分片的快照保持不变
+        
+        Args:
+            file_path: 分片快照所在的知识库目录
+            shard_id: 分片编号
+        """
+        from snapshot import write_shard_snapshot
+        
+        try:
+            with INGEST_STAGE_SECONDS.time(stage="save"):
+                write_shard_snapshot(
+                    self.vector_store, file_path, shard_id,
+                    embedding_model=self._embedding_model_name(),
+                    build_params=self.build_params,
+                    vector_dtype=os.getenv('SNAPSHOT_VECTOR_DTYPE', 'float32').lower(),
+                )
+            logger.info(f"分片 {shard_id} 已保存到 {file_path}")
+            return True
+        except Exception as e:
+            ERRORS.inc(operation="save")
+            logger.error(f"保存分片出错: {str(e)}")
+            return False
+    
+    def load_shard(self, file_path, shard_id):
+        """只重新加载分片存储中的一个分片(例如该分片在其他节点上重建后)
+        
+        Args:
+            file_path: 分片快照所在的知识库目录
+            shard_id: 分片编号
+        """
+        from snapshot import read_shard_snapshot
+        
+        try:
+            with INGEST_STAGE_SECONDS.time(stage="load"):
+                self.vector_store.shards[shard_id] = read_shard_snapshot(file_path, shard_id, self.embeddings)
+            self._on_index_changed()
+            logger.info(f"成功加载分片 {shard_id}: {file_path}")
             return True
         except Exception as e:
-            print(f"加载知识库出错: {str(e)}")
+            ERRORS.inc(operation="load")
+            logger.error(f"加载分片出错: {str(e)}")
             return False
     
     def load_and_query_knowledge_base(self, file_path, query):
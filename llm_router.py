@@ -0,0 +1,451 @@
+# 大语言模型路由层
+# 在多个模型供应商(deepseek, qianwen, doubao, ollama)之间路由请求，
+# 提供连接池、单次调用超时、有限次数重试、按延迟选择供应商、故障熔断以及可选的对冲请求
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY
+from query_log import get_logger
+
+logger = get_logger("llm_router")
+
+# 支持的模型供应商
+SUPPORTED_PROVIDERS = ("deepseek", "qianwen", "doubao", "ollama")
+
+LLM_PROVIDER_SECONDS = REGISTRY.histogram(
+    "kb_llm_provider_seconds",
+    "各模型供应商单次调用耗时(秒)",
+    ["provider", "outcome"],
+)
+LLM_PROVIDER_FIRST_TOKEN_SECONDS = REGISTRY.histogram(
+    "kb_llm_provider_first_token_seconds",
+    "各模型供应商首token耗时(秒)",
+    ["provider"],
+)
+LLM_ROUTER_EVENTS = REGISTRY.counter(
+    "kb_llm_router_events_total",
+    "路由层事件次数(重试、故障转移、对冲、熔断)",
+    ["provider", "event"],
+)
+
+
+class LLMCallError(Exception):
+    """所有供应商都调用失败或超出调用期限时抛出"""
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    try:
+        return float(value) if value not in (None, "") else default
+    except ValueError:
+        return default
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    try:
+        return int(value) if value not in (None, "") else default
+    except ValueError:
+        return default
+
+
+def create_chat_model(model_type, temperature, timeout=None, http_client=None):
+    """根据模型类型创建聊天模型实例
+
+    Args:
+        model_type: 模型类型，如'deepseek', 'qianwen', 'doubao', 'ollama'
+        temperature: 模型温度参数
+        timeout: 可选，单次请求超时(秒)
+        http_client: 可选，共享连接池的httpx.Client，仅OpenAI兼容的客户端使用
+
+    Returns:
+        初始化好的大语言模型实例
+    """
+    if model_type == 'deepseek':
+        from langchain_deepseek import ChatDeepSeek
+        model_name = os.getenv('DEEPSEEK_MODEL', 'deepseek-chat')
+        kwargs = {"model": model_name, "temperature": temperature, "stream_usage": True}
+        if timeout is not None:
+            # 重试由路由层统一控制，客户端自身不再重试
+            kwargs.update(timeout=timeout, max_retries=0)
+        if http_client is not None:
+            kwargs["http_client"] = http_client
+        return ChatDeepSeek(**kwargs)
+
+    elif model_type == 'qianwen':
+        from langchain_community.chat_models import QianwenChat
+        model_name = os.getenv('QIANWEN_MODEL', 'qwen-turbo')
+        api_key = os.getenv('QIANWEN_API_KEY')
+        if not api_key:
+            raise ValueError("千问模型需要配置QIANWEN_API_KEY环境变量")
+        return QianwenChat(model_name=model_name, api_key=api_key, temperature=temperature)
+
+    elif model_type == 'doubao':
+        from langchain_community.chat_models import DoubaoChat
+        model_name = os.getenv('DOUBAO_MODEL', 'ERNIE-Bot')
+        api_key = os.getenv('DOUBAO_API_KEY')
+        if not api_key:
+            raise ValueError("豆包模型需要配置DOUBAO_API_KEY环境变量")
+        return DoubaoChat(model=model_name, api_key=api_key, temperature=temperature)
+
+    elif model_type == 'ollama':
+        from langchain_community.chat_models import ChatOllama
+        model_name = os.getenv('OLLAMA_MODEL', 'llama3')
+        base_url = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
+        kwargs = {"model": model_name, "base_url": base_url, "temperature": temperature}
+        if timeout is not None:
+            kwargs["timeout"] = int(timeout)
+        return ChatOllama(**kwargs)
+
+    raise ValueError(f"不支持的模型类型: {model_type}")
+
+
+class ModelFactory:
+    """延迟创建模型实例的工厂，使供应商SDK在首次调用时才导入"""
+
+    def __init__(self, create):
+        self.create = create
+
+
+class ProviderState:
+    """单个供应商的延迟统计和熔断状态"""
+
+    def __init__(self, name, model, window=200):
+        self.name = name
+        self._model = model
+        self._model_lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.first_token_latencies = deque(maxlen=window)
+        self.ewma = None
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def model(self):
+        """模型实例，由ModelFactory提供时在首次访问时创建，创建失败会作为一次调用失败处理"""
+        if isinstance(self._model, ModelFactory):
+            with self._model_lock:
+                if isinstance(self._model, ModelFactory):
+                    self._model = self._model.create()
+        return self._model
+
+    def record_success(self, seconds, first_token_seconds=None, alpha=0.2):
+        with self.lock:
+            self.latencies.append(seconds)
+            if first_token_seconds is not None:
+                self.first_token_latencies.append(first_token_seconds)
+            self.ewma = seconds if self.ewma is None else alpha * seconds + (1 - alpha) * self.ewma
+            self.consecutive_failures = 0
+            self.last_used = time.monotonic()
+
+    def record_failure(self, threshold, cooldown):
+        """记录失败，连续失败次数达到阈值时打开熔断
+
+        Returns:
+            bool: 本次失败是否触发了熔断
+        """
+        with self.lock:
+            self.consecutive_failures += 1
+            self.last_used = time.monotonic()
+            if self.consecutive_failures >= threshold:
+                self.open_until = time.monotonic() + cooldown
+                return True
+            return False
+
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def percentile(self, pct, first_token=False):
+        with self.lock:
+            values = sorted(self.first_token_latencies if first_token else self.latencies)
+        if len(values) < 5:
+            return None
+        return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+    def status(self):
+        return {
+            "provider": self.name,
+            "ewma_seconds": round(self.ewma, 4) if self.ewma is not None else None,
+            "p95_seconds": self.percentile(95),
+            "p95_first_token_seconds": self.percentile(95, first_token=True),
+            "consecutive_failures": self.consecutive_failures,
+            "circuit_open": self.is_open(),
+        }
+
+
+class LLMRouter:
+    """按延迟和健康状况在多个供应商之间路由的模型客户端
+
+    - 每次尝试有独立超时(timeout)，整次调用有总期限(deadline)
+    - 失败后最多重试max_retries次，每次重试都会重新选择供应商
+    - 连续失败达到阈值的供应商会被熔断一段时间
+    - 开启对冲后，首选供应商在其p95延迟内未返回首个token时，会向下一个供应商再发一次请求，先返回者胜出
+    """
+
+    def __init__(self, providers, timeout=30.0, deadline=60.0, max_retries=2,
+                 failure_threshold=3, circuit_cooldown=30.0, probe_interval=60.0,
+                 hedge=False, hedge_delay=None):
+        """
+        Args:
+            providers: (名称, 模型实例)列表，按优先级排序
+            timeout: 单次尝试的超时(秒)
+            deadline: 整次调用的总期限(秒)
+            max_retries: 最大重试次数
+            failure_threshold: 触发熔断的连续失败次数
+            circuit_cooldown: 熔断持续时间(秒)
+            probe_interval: 供应商闲置超过该时间后重新探测其延迟(秒)
+            hedge: 是否开启对冲请求
+            hedge_delay: 固定的对冲等待时间(秒)，未设置时使用首选供应商首token耗时的p95
+        """
+        if not providers:
+            raise ValueError("至少需要一个模型供应商")
+        self.providers = [ProviderState(name, model) for name, model in providers]
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.failure_threshold = failure_threshold
+        self.circuit_cooldown = circuit_cooldown
+        self.probe_interval = probe_interval
+        self.hedge = hedge and len(self.providers) > 1
+        self.hedge_delay = hedge_delay
+        self._executor = ThreadPoolExecutor(
+            max_workers=_env_int('LLM_ROUTER_THREADS', 32), thread_name_prefix="llm-router",
+        )
+
+    @classmethod
+    def from_env(cls, temperature, providers=None):
+        """根据环境变量创建路由器
+
+        LLM_PROVIDERS指定逗号分隔的供应商列表(按优先级)，未设置时只使用MODEL_TYPE对应的供应商。
+        各供应商的模型和共享连接池在首次调用时才创建。
+
+        Args:
+            temperature: 模型温度参数
+            providers: 可选，直接指定(名称, 模型实例)列表，此时不再根据环境变量创建模型
+        """
+        model_type = os.getenv('MODEL_TYPE', 'deepseek').lower()
+        timeout = _env_float('LLM_TIMEOUT', 30.0)
+        if providers is not None:
+            return cls(providers, **cls._options_from_env(timeout))
+
+        names = [item.strip().lower() for item in os.getenv('LLM_PROVIDERS', model_type).split(",") if item.strip()]
+
+        # OpenAI兼容客户端共享的HTTP连接池
+        pool = {"client": None, "created": False}
+        pool_lock = threading.Lock()
+
+        def shared_http_client():
+            with pool_lock:
+                if not pool["created"]:
+                    pool["created"] = True
+                    try:
+                        import httpx
+                        pool["client"] = httpx.Client(
+                            limits=httpx.Limits(
+                                max_connections=_env_int('LLM_MAX_CONNECTIONS', 20),
+                                max_keepalive_connections=_env_int('LLM_MAX_KEEPALIVE_CONNECTIONS', 20),
+                            ),
+                            timeout=timeout,
+                        )
+                    except ImportError:
+                        logger.warning("未安装httpx库，模型客户端将不使用共享连接池")
+                return pool["client"]
+
+        def factory(name):
+            return ModelFactory(lambda: create_chat_model(
+                name, temperature, timeout=timeout, http_client=shared_http_client(),
+            ))
+
+        providers = []
+        for name in names:
+            if name not in SUPPORTED_PROVIDERS:
+                logger.warning(f"不支持的模型供应商: {name}")
+                continue
+            providers.append((name, factory(name)))
+
+        if not providers:
+            logger.warning("未配置有效模型类型，默认使用DeepSeek模型")
+            providers.append(('deepseek', factory('deepseek')))
+
+        return cls(providers, **cls._options_from_env(timeout))
+
+    @staticmethod
+    def _options_from_env(timeout):
+        """从环境变量读取超时、重试、熔断和对冲配置"""
+        return {
+            "timeout": timeout,
+            "deadline": _env_float('LLM_DEADLINE', 60.0),
+            "max_retries": _env_int('LLM_MAX_RETRIES', 2),
+            "failure_threshold": _env_int('LLM_FAILURE_THRESHOLD', 3),
+            "circuit_cooldown": _env_float('LLM_CIRCUIT_COOLDOWN', 30.0),
+            "probe_interval": _env_float('LLM_PROBE_INTERVAL', 60.0),
+            "hedge": os.getenv('LLM_HEDGE', 'false').lower() in ('1', 'true', 'yes'),
+            "hedge_delay": _env_float('LLM_HEDGE_DELAY', 0.0) or None,
+        }
+
+    def _ranked(self, exclude=()):
+        """按健康状况和延迟排序候选供应商
+
+        熔断中的排在最后；成功过但闲置过久的首选供应商优先探测一次，
+        其余按延迟的指数移动平均排序，延迟变高的供应商自然被绕开，从未成功过的供应商按配置顺序排在最后。
+        """
+        now = time.monotonic()
+
+        def key(item):
+            index, state = item
+            latency = float("inf") if state.ewma is None else state.ewma
+            # 闲置过久的供应商只在首选位置、成功过且未熔断时重新探测，避免把流量导向未知的备选或一直超时的供应商
+            if index == 0 and state.ewma is not None and not state.is_open() \
+                    and now - state.last_used > self.probe_interval:
+                latency = 0.0
+            return (state.is_open(), latency, index)
+
+        candidates = [(i, s) for i, s in enumerate(self.providers) if s.name not in exclude]
+        return [state for _, state in sorted(candidates, key=key)]
+
+    def _hedge_delay(self, state):
+        if self.hedge_delay:
+            return self.hedge_delay
+        p95 = state.percentile(95, first_token=True)
+        return p95 if p95 is not None else self.timeout / 2
+
+    def _record_timeout(self, state):
+        """记录供应商超时未返回：计入连续失败(可能触发熔断)，被取消的请求线程不会再记录"""
+        LLM_ROUTER_EVENTS.inc(provider=state.name, event="timeout")
+        if state.record_failure(self.failure_threshold, self.circuit_cooldown):
+            LLM_ROUTER_EVENTS.inc(provider=state.name, event="circuit_open")
+
+    def _stream_worker(self, state, prompt, out, cancelled):
+        """在线程池中流式调用单个供应商，把分块放入队列；被取消后关闭上游的流式响应"""
+        start = time.perf_counter()
+        first_token = None
+        upstream = None
+        try:
+            upstream = state.model.stream(prompt)
+            for chunk in upstream:
+                if cancelled.is_set():
+                    return
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                    LLM_PROVIDER_FIRST_TOKEN_SECONDS.observe(first_token, provider=state.name)
+                out.put((state, "chunk", chunk))
+            elapsed = time.perf_counter() - start
+            state.record_success(elapsed, first_token)
+            LLM_PROVIDER_SECONDS.observe(elapsed, provider=state.name, outcome="success")
+            out.put((state, "done", None))
+        except Exception as e:
+            if cancelled.is_set():
+                return
+            LLM_PROVIDER_SECONDS.observe(time.perf_counter() - start, provider=state.name, outcome="error")
+            if state.record_failure(self.failure_threshold, self.circuit_cooldown):
+                LLM_ROUTER_EVENTS.inc(provider=state.name, event="circuit_open")
+            out.put((state, "error", e))
+        finally:
+            close = getattr(upstream, "close", None)
+            if close is not None:
+                close()
+
+    def stream(self, prompt):
+        """流式调用模型，首个token返回前可以重试、故障转移和对冲
+
+        调用方提前停止迭代(如客户端断开)时，正在进行的供应商请求会被取消，不再继续生成。
+
+        Args:
+            prompt: 提示词
+
+        Yields:
+            模型返回的消息分块
+        """
+        call_deadline = time.monotonic() + self.deadline
+        attempts = 0
+        tried = set()
+        last_error = None
+
+        while attempts <= self.max_retries:
+            candidates = self._ranked(exclude=tried) or self._ranked()
+            primary = candidates[0]
+            attempts += 1
+            if attempts > 1:
+                LLM_ROUTER_EVENTS.inc(provider=primary.name, event="retry")
+            tried.add(primary.name)
+
+            out = queue.Queue()
+            cancelled = threading.Event()
+            try:
+                self._executor.submit(self._stream_worker, primary, prompt, out, cancelled)
+                running = {primary.name: primary}
+                winner = None
+                hedge_at = time.monotonic() + self._hedge_delay(primary) if self.hedge and len(candidates) > 1 else None
+
+                # 等待首个token，期间可能发起对冲请求
+                while winner is None and running:
+                    now = time.monotonic()
+                    wait_until = min(call_deadline, now + self.timeout)
+                    if hedge_at is not None:
+                        wait_until = min(wait_until, hedge_at)
+                    try:
+                        state, kind, payload = out.get(timeout=max(0.0, wait_until - now))
+                    except queue.Empty:
+                        if hedge_at is not None and time.monotonic() >= hedge_at:
+                            backup = candidates[1]
+                            LLM_ROUTER_EVENTS.inc(provider=backup.name, event="hedge")
+                            tried.add(backup.name)
+                            self._executor.submit(self._stream_worker, backup, prompt, out, cancelled)
+                            running[backup.name] = backup
+                            hedge_at = None
+                            continue
+                        last_error = TimeoutError(f"模型供应商 {', '.join(sorted(running))} 在期限内未返回")
+                        for state in running.values():
+                            self._record_timeout(state)
+                        break
+                    if kind == "chunk":
+                        winner = state
+                        yield payload
+                    else:
+                        running.pop(state.name, None)
+                        if kind == "error":
+                            last_error = payload
+                            logger.error(f"模型供应商 {state.name} 调用失败: {str(payload)}")
+                        elif kind == "done":
+                            # 没有任何输出就结束，视为空回答
+                            return
+
+                if winner is not None:
+                    # 已开始输出，只消费胜出供应商的分块，其余请求的结果被丢弃
+                    while True:
+                        remaining = call_deadline - time.monotonic()
+                        if remaining <= 0:
+                            LLM_ROUTER_EVENTS.inc(provider=winner.name, event="timeout")
+                            raise LLMCallError(f"模型供应商 {winner.name} 超出调用期限")
+                        try:
+                            state, kind, payload = out.get(timeout=min(remaining, self.timeout))
+                        except queue.Empty:
+                            self._record_timeout(winner)
+                            raise LLMCallError(f"模型供应商 {winner.name} 输出中断")
+                        if state is not winner:
+                            continue
+                        if kind == "chunk":
+                            yield payload
+                        elif kind == "done":
+                            return
+                        else:
+                            raise LLMCallError(f"模型供应商 {winner.name} 输出过程中出错: {str(payload)}")
+            finally:
+                # 正常结束、出错、转移到下一个供应商或调用方停止迭代时，都通知本轮的供应商请求停止生成
+                cancelled.set()
+
+            if time.monotonic() >= call_deadline:
+                break
+            LLM_ROUTER_EVENTS.inc(provider=primary.name, event="failover")
+
+        raise LLMCallError(f"所有模型供应商调用失败: {str(last_error)}")
+
+    def status(self):
+        """返回各供应商的延迟和熔断状态"""
+        return [state.status() for state in self.providers]
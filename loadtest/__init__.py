@@ -0,0 +1,3 @@
+# 端到端压测工具包
+# 包含本地的OpenAI兼容聊天接口替身、飞书开放平台替身和并发压测生成器，
+# 压测时三个API服务通过环境变量指向这些替身，不访问任何外部服务
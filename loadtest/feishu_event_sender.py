@@ -0,0 +1,131 @@
+# 本地飞书事件发送工具
+# 模拟飞书开放平台向事件订阅地址推送云文档变更事件(带签名，可选加密)，用于在本地测试按文档增量重建索引。
+# 用法:
+#   # 先让飞书替身中的文档内容发生变化，再推送编辑事件，等待服务完成重建并报告延迟
+#   python -m loadtest.feishu_event_sender --url http://127.0.0.1:8002/feishu/events \
+#       --document-id mock_doc_00003 --mock-feishu http://127.0.0.1:9100 --wait
+#   # 发送URL校验请求
+#   python -m loadtest.feishu_event_sender --url http://127.0.0.1:8002/feishu/events --challenge
+#   # 同一事件重复推送3次，验证去重
+#   python -m loadtest.feishu_event_sender --url http://127.0.0.1:8002/feishu/events --document-id mock_doc_00001 --repeat 3
+import argparse
+import json
+import os
+import time
+import uuid
+
+import requests
+
+from feishu_events import encrypt, signature
+
+
+def build_event(document_id, event_type="drive.file.edit_v1", token="", event_id=None, file_type="docx"):
+    """构造2.0格式的云文档事件"""
+    return {
+        "schema": "2.0",
+        "header": {
+            "event_id": event_id or uuid.uuid4().hex,
+            "event_type": event_type,
+            "create_time": str(int(time.time() * 1000)),
+            "token": token,
+            "app_id": "cli_mock",
+            "tenant_key": "mock_tenant",
+        },
+        "event": {
+            "file_token": document_id,
+            "file_type": file_type,
+            "operator_id_list": [{"open_id": "ou_mock"}],
+        },
+    }
+
+
+def build_challenge(token=""):
+    """构造飞书配置请求地址时发送的URL校验请求"""
+    return {"challenge": uuid.uuid4().hex, "token": token, "type": "url_verification"}
+
+
+def send_event(url, payload, encrypt_key="", timeout=10):
+    """按飞书的方式推送事件：设置了encrypt_key时加密请求体并附带签名请求头
+
+    Returns:
+        requests.Response: 服务的响应
+    """
+    body = json.dumps(payload, ensure_ascii=False)
+    if encrypt_key:
+        body = json.dumps({"encrypt": encrypt(body, encrypt_key)})
+    data = body.encode("utf-8")
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+    if encrypt_key:
+        timestamp, nonce = str(int(time.time())), uuid.uuid4().hex
+        headers.update({
+            "X-Lark-Request-Timestamp": timestamp,
+            "X-Lark-Request-Nonce": nonce,
+            "X-Lark-Signature": signature(timestamp, nonce, encrypt_key, data),
+        })
+    return requests.post(url, data=data, headers=headers, timeout=timeout)
+
+
+def wait_for_reindex(status_url, processed_before, expected, timeout=60.0, interval=0.1):
+    """轮询服务的/status，直到重建队列处理完expected个文档
+
+    Returns:
+        float: 等待的秒数，超时返回None
+    """
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        status = requests.get(status_url, timeout=5).json().get("feishu_events") or {}
+        if status.get("processed", 0) >= processed_before + expected and not status.get("pending"):
+            return time.perf_counter() - start
+        time.sleep(interval)
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地飞书事件发送工具")
+    parser.add_argument("--url", default="http://127.0.0.1:8002/feishu/events", help="事件订阅地址")
+    parser.add_argument("--document-id", action="append", default=[], help="发生变化的文档ID，可重复指定")
+    parser.add_argument("--event-type", default="drive.file.edit_v1", help="事件类型，如drive.file.trashed_v1")
+    parser.add_argument("--repeat", type=int, default=1, help="同一事件的推送次数(模拟飞书重试)")
+    parser.add_argument("--challenge", action="store_true", help="发送URL校验请求")
+    parser.add_argument("--verification-token", default=os.getenv("FEISHU_EVENT_VERIFICATION_TOKEN", ""))
+    parser.add_argument("--encrypt-key", default=os.getenv("FEISHU_EVENT_ENCRYPT_KEY", ""),
+                        help="设置后加密事件并附带签名(需要安装cryptography)")
+    parser.add_argument("--mock-feishu", help="飞书替身地址，推送前先让文档内容发生变化，如http://127.0.0.1:9100")
+    parser.add_argument("--wait", action="store_true", help="等待服务完成重建并报告从推送到索引更新的耗时")
+    args = parser.parse_args(argv)
+
+    if args.challenge:
+        payload = build_challenge(args.verification_token)
+        response = send_event(args.url, payload, args.encrypt_key)
+        ok = response.ok and response.json().get("challenge") == payload["challenge"]
+        print(f"URL校验: {response.status_code} {'通过' if ok else '失败'}")
+        return 0 if ok else 1
+
+    if not args.document_id:
+        parser.error("需要--document-id或--challenge")
+
+    status_url = args.url.rsplit("/feishu/events", 1)[0] + "/status"
+    processed_before = 0
+    if args.wait:
+        processed_before = (requests.get(status_url, timeout=5).json().get("feishu_events") or {}).get("processed", 0)
+
+    for document_id in args.document_id:
+        if args.mock_feishu:
+            revision = requests.post(f"{args.mock_feishu}/mock/edit/{document_id}", timeout=5).json()["revision"]
+            print(f"飞书替身中的文档 {document_id} 已更新到第 {revision} 版")
+        payload = build_event(document_id, args.event_type, args.verification_token)
+        for _ in range(args.repeat):
+            response = send_event(args.url, payload, args.encrypt_key)
+            print(f"推送 {args.event_type} {document_id}: {response.status_code} {response.text}")
+
+    if args.wait:
+        elapsed = wait_for_reindex(status_url, processed_before, len(set(args.document_id)))
+        if elapsed is None:
+            print("等待重建超时")
+            return 1
+        print(f"索引已更新，从推送到重建完成 {elapsed:.2f} 秒")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,184 @@
+# 并发压测生成器
+# 用法: python -m loadtest.load_generator --url http://127.0.0.1:8001 --path /query --concurrency 1,4,16,64
+# 对每个并发级别以闭环方式持续发送请求，统计吞吐、延迟百分位、错误率和事件循环延迟
+import argparse
+import asyncio
+import re
+import time
+
+import httpx
+
+from benchmarks.corpus import generate_queries
+from benchmarks.utils import environment_info, latency_summary, percentile, write_results
+
+# 各服务的默认查询接口和请求体
+TARGETS = {
+    "api_server": ("/knowledge/query", lambda q: {"question": q, "use_fallback": True}),
+    "rag": ("/query", lambda q: {"question": q, "use_fallback": True}),
+    "feishu": ("/query", lambda q: {"question": q, "use_fallback": True}),
+}
+
+_LAG_LINE = re.compile(r'^kb_event_loop_lag_seconds_(bucket|sum|count)\{([^}]*)\} (\S+)$')
+
+
+async def scrape_event_loop_lag(client, base_url):
+    """从服务的/metrics读取事件循环延迟直方图
+
+    Returns:
+        dict: {"sum": float, "count": int, "buckets": {上界: 累计次数}}，无法读取时返回None
+    """
+    try:
+        response = await client.get(f"{base_url}/metrics", timeout=5)
+        response.raise_for_status()
+    except Exception:
+        return None
+    result = {"sum": 0.0, "count": 0, "buckets": {}}
+    for line in response.text.splitlines():
+        match = _LAG_LINE.match(line)
+        if not match:
+            continue
+        kind, labels, value = match.groups()
+        if kind == "sum":
+            result["sum"] += float(value)
+        elif kind == "count":
+            result["count"] += int(float(value))
+        else:
+            le = re.search(r'le="([^"]+)"', labels).group(1)
+            bound = float("inf") if le == "+Inf" else float(le)
+            result["buckets"][bound] = result["buckets"].get(bound, 0) + int(float(value))
+    return result
+
+
+def _lag_delta(before, after):
+    """计算压测期间服务端事件循环延迟的均值和近似p99(取所在分桶上界)"""
+    if not before or not after:
+        return None
+    count = after["count"] - before["count"]
+    if count <= 0:
+        return {"samples": 0}
+    total = after["sum"] - before["sum"]
+    p99_bound = None
+    for bound in sorted(after["buckets"]):
+        delta = after["buckets"][bound] - before["buckets"].get(bound, 0)
+        if delta >= count * 0.99:
+            p99_bound = bound
+            break
+    return {
+        "samples": count,
+        "mean_ms": round(total / count * 1000, 3),
+        "p99_upper_bound_ms": None if p99_bound in (None, float("inf")) else round(p99_bound * 1000, 3),
+    }
+
+
+async def _client_lag_monitor(samples, stop, interval=0.05):
+    """测量压测进程自身的事件循环延迟，确认压测端没有成为瓶颈"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - start - interval))
+
+
+async def run_level(client, args, concurrency, questions):
+    """在单个并发级别下压测
+
+    Returns:
+        dict: 该级别的统计结果
+    """
+    path, make_payload = args.path, TARGETS[args.target][1]
+    latencies = []
+    statuses = {}
+    deadline = time.perf_counter() + args.duration
+    counter = {"next": 0}
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            index = counter["next"]
+            counter["next"] += 1
+            question = questions[index % len(questions)]
+            start = time.perf_counter()
+            try:
+                response = await client.post(
+                    f"{args.url}{path}", json=make_payload(question), timeout=args.timeout,
+                )
+                status = str(response.status_code)
+            except httpx.TimeoutException:
+                status = "timeout"
+            except httpx.HTTPError:
+                status = "connection_error"
+            elapsed = time.perf_counter() - start
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == "200":
+                latencies.append(elapsed)
+
+    lag_before = await scrape_event_loop_lag(client, args.url)
+    client_lag = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(_client_lag_monitor(client_lag, stop))
+    level_start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - level_start
+    stop.set()
+    await monitor
+    lag_after = await scrape_event_loop_lag(client, args.url)
+
+    total = sum(statuses.values())
+    errors = total - statuses.get("200", 0)
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(statuses.get("200", 0) / wall, 3) if wall else None,
+        "error_rate": round(errors / total, 4) if total else None,
+        "statuses": statuses,
+        "latency": latency_summary(latencies),
+        "server_event_loop_lag": _lag_delta(lag_before, lag_after),
+        "client_event_loop_lag_p99_ms": round(percentile(client_lag, 99) * 1000, 3) if client_lag else None,
+    }
+
+
+async def run(args):
+    questions = generate_queries(max(args.questions, 1), language=args.language)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    results = {
+        "benchmark": "load_test",
+        "environment": environment_info(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "levels": [],
+    }
+    async with httpx.AsyncClient(limits=limits) as client:
+        for concurrency in [int(item) for item in args.concurrency.split(",") if item.strip()]:
+            print(f"正在以并发 {concurrency} 压测 {args.url}{args.path} ...")
+            level = await run_level(client, args, concurrency, questions)
+            results["levels"].append(level)
+            print(
+                f"并发 {concurrency}: {level['throughput_rps']} req/s，错误率 {level['error_rate']}，"
+                f"p50={level['latency']['p50_ms']}ms p99={level['latency']['p99_ms']}ms，"
+                f"服务端事件循环延迟 {level['server_event_loop_lag']}"
+            )
+            if args.cooldown:
+                await asyncio.sleep(args.cooldown)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="知识库API并发压测")
+    parser.add_argument("--url", default="http://127.0.0.1:8001", help="被测服务地址")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="rag", help="被测服务类型，决定默认接口和请求体")
+    parser.add_argument("--path", help="查询接口路径，默认根据--target确定")
+    parser.add_argument("--concurrency", default="1,4,16,64", help="逗号分隔的并发级别")
+    parser.add_argument("--duration", type=float, default=20.0, help="每个并发级别的持续时间(秒)")
+    parser.add_argument("--cooldown", type=float, default=2.0, help="级别之间的间隔(秒)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="单个请求超时(秒)")
+    parser.add_argument("--questions", type=int, default=200, help="问题池大小")
+    parser.add_argument("--language", choices=["en", "zh"], default="zh", help="问题语言")
+    parser.add_argument("--output", default="benchmark_results/load_test.json", help="结果JSON路径")
+    args = parser.parse_args(argv)
+    if not args.path:
+        args.path = TARGETS[args.target][0]
+    results = asyncio.run(run(args))
+    write_results(results, args.output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# 本地飞书开放平台替身
+# 用法: python -m loadtest.mock_feishu_server --port 9100 --documents 50
+# 然后让飞书服务指向它: FEISHU_API_BASE_URL=http://127.0.0.1:9100/open-apis
+#   FEISHU_APP_ID=mock FEISHU_APP_SECRET=mock FEISHU_KNOWLEDGE_BASE_ID=mock_kb
+import argparse
+import asyncio
+import os
+import random
+
+from fastapi import FastAPI, Request
+
+from benchmarks.corpus import generate_paragraph
+
+app = FastAPI(title="Mock Feishu Open API", description="本地飞书开放平台替身，用于压测")
+
+
+class MockFeishuConfig:
+    """替身的行为配置"""
+
+    def __init__(self):
+        self.documents = int(os.getenv("MOCK_FEISHU_DOCUMENTS", "20"))
+        self.paragraphs = int(os.getenv("MOCK_FEISHU_PARAGRAPHS", "8"))
+        self.language = os.getenv("MOCK_FEISHU_LANGUAGE", "zh")
+        # 每个接口调用的模拟延迟(秒)
+        self.latency = float(os.getenv("MOCK_FEISHU_LATENCY", "0.05"))
+
+
+config = MockFeishuConfig()
+stats = {"token_requests": 0, "content_requests": 0, "list_requests": 0}
+# 文档内容缓存，保证同一文档多次获取内容一致；revision用于模拟文档被编辑
+_revisions = {}
+
+
+def _document_id(index):
+    return f"mock_doc_{index:05d}"
+
+
+def document_content(doc_id):
+    """生成确定性的文档内容，文档被编辑(revision递增)后内容随之变化"""
+    revision = _revisions.get(doc_id, 0)
+    rng = random.Random(f"{doc_id}:{revision}")
+    paragraphs = [generate_paragraph(rng, config.language) for _ in range(config.paragraphs)]
+    return "\n\n".join(paragraphs)
+
+
+@app.post("/open-apis/auth/v3/tenant_access_token/internal")
+async def tenant_access_token(request: Request):
+    stats["token_requests"] += 1
+    await asyncio.sleep(config.latency)
+    return {"code": 0, "msg": "ok", "tenant_access_token": "t-mock-token", "expire": 7200}
+
+
+@app.get("/open-apis/doc/v2/{doc_id}/content")
+async def get_document_content(doc_id: str):
+    stats["content_requests"] += 1
+    await asyncio.sleep(config.latency)
+    return {"code": 0, "msg": "ok", "data": {"content": document_content(doc_id)}}
+
+
+@app.get("/open-apis/knowledge/v1/bases/{kb_id}/documents")
+async def list_documents(kb_id: str):
+    stats["list_requests"] += 1
+    await asyncio.sleep(config.latency)
+    documents = [
+        {"document_id": _document_id(i), "title": f"模拟文档 {i}"}
+        for i in range(config.documents)
+    ]
+    return {"code": 0, "msg": "ok", "data": {"documents": documents}}
+
+
+@app.post("/mock/edit/{doc_id}")
+async def edit_document(doc_id: str):
+    """模拟文档被编辑，之后获取的内容会变化"""
+    _revisions[doc_id] = _revisions.get(doc_id, 0) + 1
+    return {"document_id": doc_id, "revision": _revisions[doc_id]}
+
+
+@app.get("/mock/stats")
+async def get_stats():
+    return {**stats, "documents": config.documents, "latency": config.latency}
+
+
+def main(argv=None):
+    import uvicorn
+    parser = argparse.ArgumentParser(description="本地飞书开放平台替身")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--documents", type=int, default=config.documents, help="直属库中的文档数量")
+    parser.add_argument("--paragraphs", type=int, default=config.paragraphs, help="每个文档的段落数")
+    parser.add_argument("--language", choices=["en", "zh"], default=config.language)
+    parser.add_argument("--latency", type=float, default=config.latency, help="每次接口调用的延迟(秒)")
+    args = parser.parse_args(argv)
+    config.documents = args.documents
+    config.paragraphs = args.paragraphs
+    config.language = args.language
+    config.latency = args.latency
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
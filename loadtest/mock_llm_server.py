@@ -0,0 +1,221 @@
+# 本地OpenAI兼容聊天接口替身(DeepSeek的API与OpenAI兼容)
+# 用法: python -m loadtest.mock_llm_server --port 9000 --latency 0.3 --tokens-per-second 50
+# 然后让API服务指向它: DEEPSEEK_API_BASE=http://127.0.0.1:9000/v1 DEEPSEEK_API_KEY=mock
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from benchmarks.fakes import PrefixCache
+
+
+class MockLLMConfig:
+    """替身的行为配置，可通过命令行、环境变量或/mock/config接口调整"""
+
+    def __init__(self):
+        # 首token前的延迟(秒)
+        self.latency = float(os.getenv("MOCK_LLM_LATENCY", "0.2"))
+        # 延迟的随机抖动比例
+        self.jitter = float(os.getenv("MOCK_LLM_JITTER", "0.1"))
+        # 每秒生成的token数，0表示不限速
+        self.tokens_per_second = float(os.getenv("MOCK_LLM_TOKENS_PER_SECOND", "50"))
+        # 每次回答的token数
+        self.answer_tokens = int(os.getenv("MOCK_LLM_ANSWER_TOKENS", "64"))
+        # 返回500错误的比例
+        self.error_rate = float(os.getenv("MOCK_LLM_ERROR_RATE", "0"))
+        # 模拟提示词前缀缓存，用量中按DeepSeek的格式报告命中缓存的token数
+        self.prefix_cache = os.getenv("MOCK_LLM_PREFIX_CACHE", "true").lower() == "true"
+        # 未命中缓存的提示词每1000个token增加的首token延迟(秒)
+        self.prefill_seconds_per_1k_tokens = float(os.getenv("MOCK_LLM_PREFILL_SECONDS_PER_1K", "0"))
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+config = MockLLMConfig()
+app = FastAPI(title="Mock Chat Completions", description="本地OpenAI兼容聊天接口替身，用于压测")
+
+# 简单的调用统计
+stats = {"requests": 0, "streaming_requests": 0, "errors": 0, "in_flight": 0, "max_in_flight": 0,
+         "prompt_tokens": 0, "prompt_cache_hit_tokens": 0}
+prefix_cache = PrefixCache()
+
+
+def _answer_tokens(messages):
+    """根据请求内容生成确定性的回答token"""
+    prompt = "".join(str(message.get("content", "")) for message in messages)
+    digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    tokens = [f"tok{digest[(i * 4) % 60:(i * 4) % 60 + 4]}" for i in range(config.answer_tokens)]
+    return prompt, tokens
+
+
+def _usage(prompt, tokens):
+    prompt_tokens = max(1, len(prompt) // 4)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(tokens),
+        "total_tokens": prompt_tokens + len(tokens),
+    }
+    if config.prefix_cache:
+        cached = min(prompt_tokens, prefix_cache.lookup(prompt) // 4)
+        # DeepSeek同时返回prompt_cache_hit/miss_tokens和OpenAI格式的prompt_tokens_details.cached_tokens
+        usage.update(
+            prompt_cache_hit_tokens=cached,
+            prompt_cache_miss_tokens=prompt_tokens - cached,
+            prompt_tokens_details={"cached_tokens": cached},
+        )
+        stats["prompt_cache_hit_tokens"] += cached
+    stats["prompt_tokens"] += prompt_tokens
+    return usage
+
+
+def _first_token_delay(usage):
+    uncached = usage.get("prompt_cache_miss_tokens", usage["prompt_tokens"])
+    prefill = config.prefill_seconds_per_1k_tokens * uncached / 1000
+    return max(0.0, config.latency * (1 + random.uniform(-config.jitter, config.jitter))) + prefill
+
+
+def _token_delay():
+    return 1.0 / config.tokens_per_second if config.tokens_per_second > 0 else 0.0
+
+
+@app.post("/v1/chat/completions")
+@app.post("/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "mock-model")
+    messages = body.get("messages", [])
+    stream = bool(body.get("stream"))
+    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+    prompt, tokens = _answer_tokens(messages)
+
+    stats["requests"] += 1
+    if random.random() < config.error_rate:
+        stats["errors"] += 1
+        return JSONResponse(status_code=500, content={"error": {"message": "mock error", "type": "server_error"}})
+    usage = _usage(prompt, tokens)
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+
+    if not stream:
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(_first_token_delay(usage) + _token_delay() * len(tokens))
+        finally:
+            stats["in_flight"] -= 1
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": " ".join(tokens)},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        }
+
+    stats["streaming_requests"] += 1
+
+    async def event_stream():
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(_first_token_delay(usage))
+            for i, token in enumerate(tokens):
+                if i:
+                    await asyncio.sleep(_token_delay())
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"role": "assistant", "content": token if i == 0 else f" {token}"},
+                        "finish_reason": None,
+                    }],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            final = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }
+            yield f"data: {json.dumps(final)}\n\n"
+            if include_usage:
+                usage_chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [],
+                    "usage": usage,
+                }
+                yield f"data: {json.dumps(usage_chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+        finally:
+            stats["in_flight"] -= 1
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "mock-model", "object": "model", "owned_by": "mock"}]}
+
+
+@app.get("/mock/stats")
+async def get_stats():
+    """返回替身收到的调用统计"""
+    return {**stats, "config": config.as_dict()}
+
+
+@app.post("/mock/config")
+async def update_config(request: Request):
+    """在压测过程中动态调整替身行为，例如模拟供应商变慢或报错"""
+    updates = await request.json()
+    for key, value in updates.items():
+        if hasattr(config, key):
+            setattr(config, key, type(getattr(config, key))(value))
+    return config.as_dict()
+
+
+def main(argv=None):
+    import uvicorn
+    parser = argparse.ArgumentParser(description="本地OpenAI兼容聊天接口替身")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=config.latency, help="首token延迟(秒)")
+    parser.add_argument("--jitter", type=float, default=config.jitter, help="延迟抖动比例")
+    parser.add_argument("--tokens-per-second", type=float, default=config.tokens_per_second, help="生成速度，0为不限速")
+    parser.add_argument("--answer-tokens", type=int, default=config.answer_tokens, help="每次回答的token数")
+    parser.add_argument("--error-rate", type=float, default=config.error_rate, help="返回500错误的比例")
+    parser.add_argument("--no-prefix-cache", action="store_true", help="不模拟提示词前缀缓存")
+    parser.add_argument("--prefill-seconds-per-1k", type=float, default=config.prefill_seconds_per_1k_tokens,
+                        help="未命中缓存的提示词每1000个token增加的首token延迟(秒)")
+    args = parser.parse_args(argv)
+    config.latency = args.latency
+    config.jitter = args.jitter
+    config.tokens_per_second = args.tokens_per_second
+    config.answer_tokens = args.answer_tokens
+    config.error_rate = args.error_rate
+    config.prefix_cache = config.prefix_cache and not args.no_prefix_cache
+    config.prefill_seconds_per_1k_tokens = args.prefill_seconds_per_1k
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# 慢查询重放工具
+# 读取慢查询日志(SLOW_QUERY_LOG，JSON Lines)，在指定的知识库(索引版本)上重新执行记录的查询，
+# 对比记录的延迟与重放的延迟(总耗时和各阶段耗时)，以及检索到的片段是否一致，用于确认慢查询能否复现、
+# 索引或配置调整后是否变快。
+# 用法:
+#   # 只重放检索阶段(问题向量+FAISS检索)，不调用大语言模型
+#   python -m loadtest.query_replay --log logs/slow_queries.jsonl --knowledge-base word_knowledge_base --retrieval-only
+#   # 完整重放，模型调用指向本地替身(见loadtest/mock_llm_server.py)
+#   DEEPSEEK_API_BASE=http://127.0.0.1:9000/v1 DEEPSEEK_API_KEY=mock \
+#       python -m loadtest.query_replay --log logs/slow_queries.jsonl --knowledge-base word_knowledge_base
+import argparse
+import json
+import os
+import statistics
+import sys
+
+from benchmarks.utils import latency_summary, write_results
+
+# 只重放检索时参与对比的阶段
+RETRIEVAL_STAGES = ("embed", "search", "batch_wait")
+
+
+def read_queries(path, limit=None):
+    """读取慢查询日志中的查询，跳过无法解析或没有问题的行
+
+    Args:
+        path: JSON Lines文件路径，每行至少包含question字段
+        limit: 最多读取的查询数量
+
+    Returns:
+        list: 记录的查询字典列表
+    """
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(entry, dict) and entry.get("question"):
+                entries.append(entry)
+                if limit and len(entries) >= limit:
+                    break
+    return entries
+
+
+def _overlap(recorded, replayed):
+    """记录与重放结果的重合比例(以记录的结果为基准)，没有记录时返回None"""
+    recorded = [item for item in recorded if item is not None]
+    if not recorded:
+        return None
+    return round(len(set(recorded) & set(replayed)) / len(set(recorded)), 3)
+
+
+def replay_one(kb, entry, retrieval_only=False, repeat=1, k=5):
+    """重放一条记录的查询repeat次，取总耗时的中位数对应的一次作为结果
+
+    Returns:
+        dict: 记录与重放的总耗时、各阶段耗时以及检索结果的重合比例
+    """
+    import query_log
+
+    question = entry["question"]
+    runs = []
+    for _ in range(max(1, repeat)):
+        with query_log.trace_query(question, log=False) as trace:
+            if retrieval_only:
+                docs_and_scores = kb._retrieve(question, k=k)
+                query_log.annotate(retrieved=[
+                    {"id": doc.id, "source": doc.metadata.get("source"), "score": round(float(score), 6)}
+                    for doc, score in docs_and_scores
+                ])
+            else:
+                kb._execute_query(question)
+        runs.append(trace)
+    runs.sort(key=lambda trace: trace.total_seconds)
+    trace = runs[len(runs) // 2]
+
+    recorded_stages = entry.get("stages_ms") or {}
+    replayed_stages = {stage: round(seconds * 1000, 3) for stage, seconds in trace.stages.items()}
+    if retrieval_only:
+        # 记录的总耗时包括模型调用，只对比检索相关阶段之和
+        recorded_ms = sum(recorded_stages.get(stage, 0.0) for stage in RETRIEVAL_STAGES) or None
+        replayed_ms = round(sum(replayed_stages.get(stage, 0.0) for stage in RETRIEVAL_STAGES), 3)
+    else:
+        recorded_ms = entry.get("total_ms")
+        replayed_ms = round(trace.total_seconds * 1000, 3)
+
+    recorded_retrieved = entry.get("retrieved") or []
+    replayed_retrieved = trace.fields.get("retrieved") or []
+    return {
+        "question": question,
+        "request_id": entry.get("request_id"),
+        "recorded_ms": recorded_ms,
+        "replayed_ms": replayed_ms,
+        "ratio": round(replayed_ms / recorded_ms, 3) if recorded_ms else None,
+        "recorded_stages_ms": recorded_stages,
+        "replayed_stages_ms": replayed_stages,
+        # 同一索引版本中片段ID不变；重建后的索引片段ID不同，可参考来源的重合比例
+        "id_overlap": _overlap([item.get("id") for item in recorded_retrieved],
+                               [item.get("id") for item in replayed_retrieved]),
+        "source_overlap": _overlap([item.get("source") for item in recorded_retrieved],
+                                   [item.get("source") for item in replayed_retrieved]),
+        "error": trace.error,
+    }
+
+
+def summarize(results, retrieval_only=False):
+    """汇总记录与重放的延迟分布以及各阶段耗时的中位数"""
+    completed = [result for result in results if not result["error"]]
+    recorded = [result["recorded_ms"] / 1000 for result in completed if result["recorded_ms"]]
+    replayed = [result["replayed_ms"] / 1000 for result in completed]
+    stages = {}
+    for result in completed:
+        for source in ("recorded", "replayed"):
+            for stage, ms in result[f"{source}_stages_ms"].items():
+                if retrieval_only and stage not in RETRIEVAL_STAGES:
+                    continue
+                stages.setdefault(stage, {"recorded": [], "replayed": []})[source].append(ms)
+    return {
+        "queries": len(results),
+        "errors": len(results) - len(completed),
+        "recorded": latency_summary(recorded),
+        "replayed": latency_summary(replayed),
+        "stages_median_ms": {
+            stage: {source: round(statistics.median(values), 3) if values else None
+                    for source, values in samples.items()}
+            for stage, samples in stages.items()
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="在指定知识库上重放慢查询日志并对比延迟")
+    parser.add_argument("--log", required=True, help="慢查询日志(JSON Lines)")
+    parser.add_argument("--knowledge-base", required=True, help="知识库目录(save_knowledge_base保存的路径)")
+    parser.add_argument("--retrieval-only", action="store_true", help="只重放检索阶段，不调用大语言模型")
+    parser.add_argument("--limit", type=int, default=None, help="最多重放的查询数量")
+    parser.add_argument("--repeat", type=int, default=1, help="每条查询重放次数，取中位数")
+    parser.add_argument("--regression-factor", type=float, default=1.5,
+                        help="重放耗时超过记录耗时的多少倍时视为变慢")
+    parser.add_argument("--fail-on-regression", action="store_true", help="存在变慢的查询时以非零状态退出")
+    parser.add_argument("--output", default=None, help="结果JSON路径")
+    args = parser.parse_args(argv)
+
+    entries = read_queries(args.log, limit=args.limit)
+    if not entries:
+        print(f"{args.log} 中没有可重放的查询")
+        return 1
+
+    from knowledge_manager import get_manager
+
+    kb = get_manager().new_knowledge_base()
+    if not kb.load_knowledge_base(args.knowledge_base):
+        print(f"无法加载知识库: {args.knowledge_base}")
+        return 1
+    if not args.retrieval_only:
+        kb._build_qa_chain()
+
+    fingerprint = kb.index_fingerprint()
+    recorded_fingerprints = {entry.get("index_fingerprint") for entry in entries} - {None}
+    print(f"知识库 {args.knowledge_base}: {kb.chunk_count()} 个片段，索引指纹 {fingerprint}")
+    if recorded_fingerprints and recorded_fingerprints != {fingerprint}:
+        print(f"注意: 记录时的索引指纹为 {', '.join(sorted(recorded_fingerprints))}，与当前索引不同，"
+              f"检索结果可能不一致")
+
+    # 预热嵌入模型，避免第一条查询包含模型加载时间
+    kb._retrieve(entries[0]["question"], k=1)
+
+    results = []
+    for entry in entries:
+        result = replay_one(kb, entry, retrieval_only=args.retrieval_only, repeat=args.repeat)
+        results.append(result)
+        recorded = f"{result['recorded_ms']:.1f}" if result["recorded_ms"] else "-"
+        overlap = result["id_overlap"] if result["id_overlap"] is not None else "-"
+        status = f" 出错: {result['error']}" if result["error"] else ""
+        print(f"{recorded:>9} -> {result['replayed_ms']:>9.1f} ms  片段重合 {overlap}  "
+              f"{result['question'][:40]}{status}")
+
+    summary = summarize(results, retrieval_only=args.retrieval_only)
+    regressions = [result for result in results
+                   if result["ratio"] is not None and result["ratio"] > args.regression_factor]
+    print(f"记录 p50 {summary['recorded']['p50_ms']} ms / p95 {summary['recorded']['p95_ms']} ms，"
+          f"重放 p50 {summary['replayed']['p50_ms']} ms / p95 {summary['replayed']['p95_ms']} ms")
+    for stage, medians in summary["stages_median_ms"].items():
+        print(f"  {stage:>16}: 记录 {medians['recorded']} ms，重放 {medians['replayed']} ms")
+    if regressions:
+        print(f"{len(regressions)} 条查询的重放耗时超过记录的 {args.regression_factor} 倍:")
+        for result in regressions:
+            print(f"  x{result['ratio']}: {result['question'][:60]}")
+
+    if args.output:
+        write_results({
+            "knowledge_base": os.path.abspath(args.knowledge_base),
+            "index_fingerprint": fingerprint,
+            "retrieval_only": args.retrieval_only,
+            "repeat": args.repeat,
+            "summary": summary,
+            "regressions": len(regressions),
+            "queries": results,
+        }, args.output)
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+# 元数据过滤索引
+# 为FAISS向量存储中的文本片段建立"元数据值 -> FAISS内部ID"的倒排表，
+# 检索时把满足过滤条件的ID集合交给FAISS的IDSelector，在向量搜索内部完成过滤，
+# 而不是先取top-k再丢弃不满足条件的结果(那样过滤条件较严时会返回不足k条)
+import os
+
+import numpy as np
+
+# 支持精确匹配过滤的元数据字段
+# source: 原始文件路径(也可以只写文件名)；title/document_id: 飞书文档标题和ID
+FILTERABLE_FIELDS = ("source", "title", "document_id")
+
+# 入库时间字段(Unix时间戳，秒)，支持范围过滤
+INGESTED_AT_FIELD = "ingested_at"
+
+
+class MetadataIndex:
+    """基于向量存储docstore构建的元数据倒排索引
+
+    向量存储发生变化(创建、追加、加载)后需要重新构建。
+    """
+
+    def __init__(self, vector_store):
+        """
+        Args:
+            vector_store: langchain的FAISS向量存储
+        """
+        self.ntotal = vector_store.index.ntotal
+        # {字段: {值: [FAISS内部ID]}}
+        postings = {field: {} for field in FILTERABLE_FIELDS}
+        # 按FAISS内部ID排列的入库时间，没有记录入库时间的片段为NaN，不会被时间范围命中
+        ingested_at = np.full(self.ntotal, np.nan, dtype="float64")
+
+        for faiss_id, docstore_id in vector_store.index_to_docstore_id.items():
+            doc = vector_store.docstore.search(docstore_id)
+            metadata = getattr(doc, "metadata", None) or {}
+            for field in FILTERABLE_FIELDS:
+                value = metadata.get(field)
+                if value is None:
+                    continue
+                postings[field].setdefault(str(value), []).append(faiss_id)
+                if field == "source":
+                    # 允许只按文件名过滤
+                    name = os.path.basename(str(value))
+                    if name != value:
+                        postings[field].setdefault(name, []).append(faiss_id)
+            timestamp = metadata.get(INGESTED_AT_FIELD)
+            if timestamp is not None and faiss_id < self.ntotal:
+                ingested_at[faiss_id] = float(timestamp)
+
+        self._postings = {
+            field: {value: np.unique(np.asarray(ids, dtype="int64")) for value, ids in values.items()}
+            for field, values in postings.items()
+        }
+        self._ingested_at = ingested_at
+
+    def select(self, filters=None, ingested_after=None, ingested_before=None):
+        """计算满足全部过滤条件的FAISS内部ID
+
+        Args:
+            filters: {字段: 值或值列表}，同一字段的多个值为"或"，不同字段之间为"且"
+            ingested_after: 入库时间下限(Unix时间戳，含)
+            ingested_before: 入库时间上限(Unix时间戳，不含)
+
+        Returns:
+            numpy.ndarray或None: 满足条件的ID数组；没有任何过滤条件时返回None，表示不过滤
+        """
+        selected = None
+
+        for field, values in (filters or {}).items():
+            if field not in self._postings:
+                raise ValueError(f"不支持按元数据字段 {field} 过滤，可用字段: {', '.join(FILTERABLE_FIELDS)}")
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            matched = [self._postings[field].get(str(value)) for value in values]
+            matched = [ids for ids in matched if ids is not None]
+            ids = np.unique(np.concatenate(matched)) if matched else np.empty(0, dtype="int64")
+            selected = ids if selected is None else np.intersect1d(selected, ids, assume_unique=True)
+
+        if ingested_after is not None or ingested_before is not None:
+            mask = ~np.isnan(self._ingested_at)
+            if ingested_after is not None:
+                mask &= self._ingested_at >= ingested_after
+            if ingested_before is not None:
+                mask &= self._ingested_at < ingested_before
+            ids = np.nonzero(mask)[0].astype("int64")
+            selected = ids if selected is None else np.intersect1d(selected, ids, assume_unique=True)
+
+        return selected
+
+
+def search_vector_store(vector_store, query_vector, k, selected_ids=None, index=None):
+    """在单个FAISS向量存储中检索，可通过IDSelector限定候选片段
+
+    Args:
+        vector_store: langchain的FAISS向量存储
+        query_vector: 形状为(1, 维度)的float32查询向量
+        k: 返回的片段数量
+        selected_ids: 可选，允许返回的FAISS内部ID数组
+        index: 可选，代替vector_store.index检索的近似索引
+
+    Returns:
+        list: 包含id、content、metadata和score的字典列表
+    """
+    return [
+        {"id": doc.id, "content": doc.page_content, "metadata": doc.metadata, "score": distance}
+        for doc, distance in search_vector_store_batch(vector_store, query_vector, k, selected_ids, index)[0]
+    ]
+
+
+def search_vector_store_batch(vector_store, query_vectors, k, selected_ids=None, index=None):
+    """用一次FAISS搜索检索多个查询向量
+
+    Args:
+        vector_store: langchain的FAISS向量存储
+        query_vectors: 形状为(查询数, 维度)的float32查询向量
+        k: 每个查询返回的片段数量
+        selected_ids: 可选，允许返回的FAISS内部ID数组
+        index: 可选，代替vector_store.index检索的近似索引(内部ID与之一致，不能与selected_ids同时使用)
+
+    Returns:
+        list: 每个查询一个(Document, 距离)元组列表
+    """
+    import faiss
+
+    index = vector_store.index if index is None else index
+    k = min(k, index.ntotal if selected_ids is None else len(selected_ids))
+    if k <= 0:
+        return [[] for _ in range(len(query_vectors))]
+    if vector_store._normalize_L2:
+        # 原地归一化，复制一份避免影响其他分片使用的查询向量
+        query_vectors = query_vectors.copy()
+        faiss.normalize_L2(query_vectors)
+    if selected_ids is None:
+        distances, indices = index.search(query_vectors, k)
+    else:
+        params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(selected_ids))
+        distances, indices = index.search(query_vectors, k, params=params)
+
+    results = []
+    for row_indices, row_distances in zip(indices, distances):
+        row = []
+        for faiss_id, distance in zip(row_indices, row_distances):
+            if faiss_id == -1:
+                continue
+            docstore_id = vector_store.index_to_docstore_id[int(faiss_id)]
+            doc = vector_store.docstore.search(docstore_id)
+            if getattr(doc, "id", None) is None:
+                doc.id = docstore_id
+            row.append((doc, float(distance)))
+        results.append(row)
+    return results
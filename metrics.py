@@ -0,0 +1,485 @@
+# 知识库服务的轻量级指标模块
+# 以Prometheus文本格式暴露直方图、计数器和仪表盘，不依赖prometheus_client
+# 多工作进程服务(serve_workers.py)中各进程定期把指标写入共享目录，/metrics返回所有进程的合计
+import asyncio
+import copy
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# 默认的延迟分桶(秒)，覆盖毫秒级检索到数十秒的LLM调用
+DEFAULT_LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    """将标签格式化为Prometheus文本格式"""
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.extend(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    """格式化数值，整数不带小数点"""
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """指标基类，负责标签管理和线程安全"""
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self):
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+
+    def reset(self):
+        """清空所有已记录的值(主要用于基准测试)"""
+        with self._lock:
+            self._values.clear()
+
+    def dump(self):
+        """返回可JSON序列化的全部取值，用于多进程汇总"""
+        with self._lock:
+            return [[list(key), copy.deepcopy(value)] for key, value in self._values.items()]
+
+    def _combine(self, current, value):
+        return current + value
+
+    def merged(self, dumps):
+        """返回与本指标定义相同、取值为多份dump之和的新指标"""
+        metric = copy.copy(self)
+        metric._lock = threading.Lock()
+        metric._values = {}
+        for rows in dumps:
+            for key, value in rows:
+                key = tuple(key)
+                current = metric._values.get(key)
+                metric._values[key] = copy.deepcopy(value) if current is None else self._combine(current, value)
+        return metric
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("计数器只能递增")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def collect(self):
+        lines = self._header()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    """可增可减的仪表盘"""
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def collect(self):
+        lines = self._header()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    """分桶直方图，记录观测值的分布、总和与次数"""
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                self._values[key] = state
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """以上下文管理器的方式记录代码块耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _combine(self, current, value):
+        return {
+            "counts": [a + b for a, b in zip(current["counts"], value["counts"])],
+            "sum": current["sum"] + value["sum"],
+            "count": current["count"] + value["count"],
+        }
+
+    def snapshot(self, **labels):
+        """返回某组标签下的计数与总和，便于在进程内读取"""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            if state is None:
+                return {"count": 0, "sum": 0.0}
+            return {"count": state["count"], "sum": state["sum"]}
+
+    def collect(self):
+        lines = self._header()
+        with self._lock:
+            for key, state in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, state["counts"]):
+                    cumulative += count
+                    le = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                base = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{base} {_format_value(state['sum'])}")
+                lines.append(f"{self.name}_count{base} {state['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表，按注册顺序输出所有指标"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # 重复注册时返回已存在的指标，避免模块重载导致报错
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def generate_latest(self, dumps=None):
+        """生成Prometheus文本格式的全部指标
+
+        Args:
+            dumps: 可选，多个进程的dump()结果，提供时输出它们的合计而不是本进程的取值
+        """
+        lines = []
+        for metric in self.metrics():
+            if dumps is not None:
+                metric = metric.merged([dump.get(metric.name, []) for dump in dumps])
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+    def dump(self):
+        """返回本进程全部指标的取值: {指标名: 取值列表}"""
+        return {metric.name: metric.dump() for metric in self.metrics()}
+
+    def reset_after_fork(self):
+        """在fork出的子进程中清空从父进程继承的取值，并重建锁(fork时父进程的其他线程可能正持有锁)"""
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._lock = threading.Lock()
+            metric._values = {}
+
+
+# 全局注册表
+REGISTRY = MetricsRegistry()
+
+# Prometheus文本格式的Content-Type
+CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MultiprocessMetrics:
+    """多进程服务的指标汇总
+
+    每个进程把本进程的指标写入共享目录中的<PID>.json，任一进程响应/metrics时合并目录中的全部文件。
+    已退出进程的计数器和直方图由主进程并入archived.json，仪表盘只统计仍在运行的进程。
+    """
+
+    ARCHIVE_FILE = "archived.json"
+
+    def __init__(self, directory, registry=None, interval=5.0):
+        """
+        Args:
+            directory: 各进程共享的指标目录
+            registry: 指标注册表，默认为全局注册表
+            interval: 工作进程写入指标文件的间隔(秒)
+        """
+        self.directory = directory
+        self.registry = registry or REGISTRY
+        self.interval = interval
+        self._thread = None
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def _write_json(self, path, data):
+        temp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    def _read_json(self, path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self):
+        """把本进程的指标写入共享目录"""
+        self._write_json(self._path(os.getpid()), self.registry.dump())
+
+    def start(self):
+        """在后台线程中定期写入本进程的指标(在fork出的工作进程中调用)"""
+        def loop():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.write()
+                except OSError:
+                    pass
+
+        self._thread = threading.Thread(target=loop, name="kb-metrics-writer", daemon=True)
+        self._thread.start()
+
+    def archive(self, pid):
+        """把已退出进程的计数器和直方图并入archived.json并删除其指标文件，只由主进程调用"""
+        path = self._path(pid)
+        dump = self._read_json(path)
+        if dump is None:
+            return
+        gauges = {metric.name for metric in self.registry.metrics() if isinstance(metric, Gauge)}
+        archived = self._read_json(os.path.join(self.directory, self.ARCHIVE_FILE)) or {}
+        for metric in self.registry.metrics():
+            if metric.name in gauges:
+                continue
+            rows = metric.merged([archived.get(metric.name, []), dump.get(metric.name, [])]).dump()
+            if rows:
+                archived[metric.name] = rows
+        self._write_json(os.path.join(self.directory, self.ARCHIVE_FILE), archived)
+        os.remove(path)
+
+    def generate_latest(self):
+        """先写入本进程的最新指标，再输出所有进程的合计"""
+        self.write()
+        dumps = []
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            dump = self._read_json(path)
+            if dump is not None:
+                dumps.append(dump)
+        return self.registry.generate_latest(dumps)
+
+
+# 多进程模式下的指标汇总，由serve_workers.py启用
+_multiprocess = None
+
+
+def enable_multiprocess(directory, interval=5.0):
+    """启用多进程指标汇总，之后/metrics返回共享目录中所有进程的合计
+
+    Returns:
+        MultiprocessMetrics: 指标汇总对象
+    """
+    global _multiprocess
+    _multiprocess = MultiprocessMetrics(directory, interval=interval)
+    return _multiprocess
+
+
+def generate_latest():
+    """/metrics输出的指标：启用多进程汇总时为所有进程的合计，否则为本进程的指标"""
+    if _multiprocess is not None:
+        return _multiprocess.generate_latest()
+    return REGISTRY.generate_latest()
+
+# ---- 查询链路各阶段 ----
+QUERY_STAGE_SECONDS = REGISTRY.histogram(
+    "kb_query_stage_seconds",
+    "知识库查询各阶段耗时(秒)",
+    ["stage"],
+)
+QUERY_TOTAL_SECONDS = REGISTRY.histogram(
+    "kb_query_seconds",
+    "知识库查询总耗时(秒)",
+)
+LLM_TOKENS = REGISTRY.counter(
+    "kb_llm_tokens_total",
+    "LLM消耗的token数量",
+    ["model_type", "kind"],
+)
+CACHE_EVENTS = REGISTRY.counter(
+    "kb_cache_events_total",
+    "各类缓存的命中与未命中次数",
+    ["cache", "result"],
+)
+RELEVANCE_DECISIONS = REGISTRY.counter(
+    "kb_relevance_decisions_total",
+    "检索相关性判断的结果(pass为调用模型，low为相关性不足、未调用模型)",
+    ["decision"],
+)
+ERRORS = REGISTRY.counter(
+    "kb_errors_total",
+    "知识库各操作的错误次数",
+    ["operation"],
+)
+
+# ---- 文档入库 ----
+INGEST_STAGE_SECONDS = REGISTRY.histogram(
+    "kb_ingest_stage_seconds",
+    "文档入库各阶段耗时(秒)",
+    ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0),
+)
+INGEST_DOCUMENTS = REGISTRY.counter(
+    "kb_ingest_documents_total",
+    "已入库的原始文档数量",
+)
+INGEST_CHUNKS = REGISTRY.counter(
+    "kb_ingest_chunks_total",
+    "已入库的文本片段数量",
+)
+INGEST_CHARACTERS = REGISTRY.counter(
+    "kb_ingest_characters_total",
+    "已入库的文本字符数",
+)
+
+# ---- HTTP接口 ----
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "kb_http_request_seconds",
+    "HTTP请求耗时(秒)",
+    ["app", "method", "path", "status"],
+)
+HTTP_REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    "kb_http_requests_in_flight",
+    "正在处理的HTTP请求数",
+    ["app"],
+)
+EVENT_LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "kb_event_loop_lag_seconds",
+    "事件循环调度延迟(秒)，同步阻塞代码会使其升高",
+    ["app"],
+)
+
+# 事件循环延迟的采样间隔(秒)
+EVENT_LOOP_LAG_INTERVAL = 0.1
+
+
+async def _monitor_event_loop_lag(app_name, interval=EVENT_LOOP_LAG_INTERVAL):
+    """周期性休眠并测量实际唤醒时间与预期的差值"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = time.perf_counter() - start - interval
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, lag), app=app_name)
+
+
+def install_metrics(app, app_name):
+    """为FastAPI应用注册请求计时中间件和/metrics端点
+
+    Args:
+        app: FastAPI应用实例
+        app_name: 应用名称，作为指标标签区分不同服务
+    """
+    from fastapi import Response
+
+    # 事件循环延迟监控任务，在第一个请求到达时于服务的事件循环中启动
+    monitor = {"task": None}
+
+    @app.middleware("http")
+    async def _metrics_middleware(request, call_next):
+        if monitor["task"] is None or monitor["task"].done():
+            monitor["task"] = asyncio.create_task(_monitor_event_loop_lag(app_name))
+        # 使用路由模板作为path标签，避免路径参数导致标签基数膨胀
+        HTTP_REQUESTS_IN_FLIGHT.inc(app=app_name)
+        start = time.perf_counter()
+        status = "500"
+        try:
+            response = await call_next(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            route = request.scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                app=app_name, method=request.method, path=path, status=status,
+            )
+            HTTP_REQUESTS_IN_FLIGHT.dec(app=app_name)
+
+    @app.get("/metrics", tags=["基础接口"], include_in_schema=False)
+    async def metrics_endpoint():
+        """以Prometheus文本格式输出服务指标"""
+        return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
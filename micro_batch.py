@@ -0,0 +1,109 @@
+# 查询微批处理
+# 每个/query都单独调用一次embed_query，并发较高时CPU上执行的是大量batch size为1的前向计算，
+# 这是使用嵌入模型效率最低的方式。MicroBatcher把并发到达的请求收集起来(最多等待一个很短的时间窗口，
+# 或凑满最大批大小)，一次批量执行后再把结果分发给各个请求。
+# 时间窗口从批中第一个请求到达时开始计算：上一批执行期间排队的请求已经等待超过窗口，会立即组成下一批，
+# 因此负载越高批越大，而单个请求额外等待的时间不超过窗口。
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import REGISTRY
+
+QUERY_BATCH_SIZE = REGISTRY.histogram(
+    "kb_query_batch_size",
+    "一次批量执行的查询数",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+QUERY_BATCH_WAIT_SECONDS = REGISTRY.histogram(
+    "kb_query_batch_wait_seconds",
+    "查询从进入批处理队列到开始执行的等待时间(秒)",
+    buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+)
+
+# 批处理线程空闲多久(秒)后退出，下一个请求到达时重新启动
+_IDLE_TIMEOUT = 60.0
+
+
+class MicroBatcher:
+    """把并发提交的请求合并为批，在后台线程中批量执行"""
+
+    def __init__(self, run_batch, window=0.002, max_batch_size=32, name="kb-micro-batch", on_start=None):
+        """
+        Args:
+            run_batch: 批量执行函数run_batch(请求列表)，按顺序返回与请求一一对应的结果列表
+            window: 批中第一个请求最多等待多久(秒)让后续请求加入
+            max_batch_size: 每批最多包含的请求数，凑满后立即执行
+            name: 批处理线程名称
+            on_start: 批处理线程启动时调用的函数(如为该线程应用CPU线程预算)
+        """
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch_size = max(1, max_batch_size)
+        self.name = name
+        self.on_start = on_start
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, item):
+        """提交一个请求并等待结果，批量执行出错时在每个请求中抛出同样的异常"""
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        self._ensure_thread()
+        return future.result()
+
+    def _ensure_thread(self):
+        with self._lock:
+            # fork出的子进程中线程对象仍在但线程已不存在，is_alive返回False时重新启动
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _collect(self, first):
+        """从第一个请求开始收集一批，直到凑满或第一个请求的等待时间达到窗口"""
+        batch = [first]
+        deadline = first[2] + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get_nowait() if timeout <= 0 else self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        if self.on_start is not None:
+            self.on_start()
+        while True:
+            try:
+                first = self._queue.get(timeout=_IDLE_TIMEOUT)
+            except queue.Empty:
+                with self._lock:
+                    # 退出前再次检查，避免刚提交的请求无人处理
+                    if self._queue.empty():
+                        self._thread = None
+                        return
+                continue
+            batch = self._collect(first)
+            started = time.perf_counter()
+            for _, _, enqueued in batch:
+                QUERY_BATCH_WAIT_SECONDS.observe(started - enqueued)
+            QUERY_BATCH_SIZE.observe(len(batch))
+            try:
+                results = self.run_batch([item for item, _, _ in batch])
+            except BaseException as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+
+def embed_queries(embeddings, texts):
+    """批量计算查询向量：嵌入模型提供embed_queries时一次前向计算完成，否则逐条调用embed_query"""
+    batch = getattr(embeddings, "embed_queries", None)
+    if batch is not None:
+        return batch(texts)
+    return [embeddings.embed_query(text) for text in texts]
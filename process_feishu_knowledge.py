@@ -2,13 +2,15 @@
 import os
 import requests
 from dotenv import load_dotenv
-from langchain_knowledge import DeepSeekKnowledgeBase
-from langchain_community.document_loaders import TextLoader
-from langchain.text_splitter import CharacterTextSplitter
+from knowledge_manager import get_manager
+from kb_config import load_config
+from query_log import get_logger
 
 # 从.env文件加载环境变量
 load_dotenv()
 
+logger = get_logger("feishu")
+
 class FeishuKnowledgeProcessor:
     """飞书云文档和直属库处理类"""
     def __init__(self):
@@ -28,7 +30,7 @@ class FeishuKnowledgeProcessor:
     def _get_tenant_access_token(self):
         """获取飞书应用的tenant_access_token"""
         if not self.app_id or not self.app_secret:
-            print("错误: 未配置飞书APP ID或APP Secret")
+            logger.error("未配置飞书APP ID或APP Secret")
             return
 
         url = f"{self.api_base_url}/auth/v3/tenant_access_token/internal"
@@ -46,13 +48,13 @@ class FeishuKnowledgeProcessor:
                 result = response.json()
                 if result.get('code') == 0:
                     self.tenant_access_token = result.get('tenant_access_token')
-                    print("成功获取飞书访问令牌")
+                    logger.info("成功获取飞书访问令牌")
                 else:
-                    print(f"获取飞书访问令牌失败: {result.get('msg')}")
+                    logger.error(f"获取飞书访问令牌失败: {result.get('msg')}")
             else:
-                print(f"获取飞书访问令牌请求失败: {response.status_code}")
+                logger.error(f"获取飞书访问令牌请求失败: {response.status_code}")
         except Exception as e:
-            print(f"获取飞书访问令牌发生异常: {str(e)}")
+            logger.error(f"获取飞书访问令牌发生异常: {str(e)}")
 
     def get_document_content(self, document_id=None):
         """获取飞书云文档内容
@@ -64,12 +66,12 @@ class FeishuKnowledgeProcessor:
             str: 文档内容，若失败则返回None
         """
         if not self.tenant_access_token:
-            print("错误: 飞书访问令牌未初始化")
+            logger.error("飞书访问令牌未初始化")
             return None
 
         doc_id = document_id if document_id else self.document_id
         if not doc_id:
-            print("错误: 未提供文档ID")
+            logger.error("未提供文档ID")
             return None
 
         url = f"{self.api_base_url}/doc/v2/{doc_id}/content"
@@ -87,30 +89,30 @@ class FeishuKnowledgeProcessor:
                     content = result.get('data', {}).get('content', '')
                     return content
                 else:
-                    print(f"获取文档内容失败: {result.get('msg')}")
+                    logger.error(f"获取文档内容失败: {result.get('msg')}")
             else:
-                print(f"获取文档内容请求失败: {response.status_code}")
+                logger.error(f"获取文档内容请求失败: {response.status_code}")
         except Exception as e:
-            print(f"获取文档内容发生异常: {str(e)}")
+            logger.error(f"获取文档内容发生异常: {str(e)}")
 
         return None
 
-    def get_knowledge_base_content(self, knowledge_base_id=None):
-        """获取飞书直属库内容
+    def list_knowledge_base_documents(self, knowledge_base_id=None):
+        """获取飞书直属库的文档列表
 
         Args:
             knowledge_base_id: 直属库ID，默认为None（使用环境变量配置的值）
 
         Returns:
-            list: 文档内容列表，若失败则返回None
+            list: [{'document_id', 'title'}]文档列表，若失败则返回None
         """
         if not self.tenant_access_token:
-            print("错误: 飞书访问令牌未初始化")
+            logger.error("飞书访问令牌未初始化")
             return None
 
         kb_id = knowledge_base_id if knowledge_base_id else self.knowledge_base_id
         if not kb_id:
-            print("错误: 未提供直属库ID")
+            logger.error("未提供直属库ID")
             return None
 
         # 这里需要根据飞书直属库API的实际接口进行实现
@@ -128,30 +130,135 @@ class FeishuKnowledgeProcessor:
                 if result.get('code') == 0:
                     # 提取文档列表
                     documents = result.get('data', {}).get('documents', [])
-                    document_contents = []
-
-                    # 遍历文档并获取内容
-                    for doc in documents:
-                        doc_id = doc.get('document_id')
-                        doc_title = doc.get('title')
-                        print(f"正在获取文档: {doc_title}")
-                        doc_content = self.get_document_content(doc_id)
-                        if doc_content:
-                            document_contents.append({
-                                'title': doc_title,
-                                'content': doc_content
-                            })
-
-                    return document_contents
+                    return [{'document_id': doc.get('document_id'), 'title': doc.get('title')} for doc in documents]
                 else:
-                    print(f"获取直属库文档列表失败: {result.get('msg')}")
+                    logger.error(f"获取直属库文档列表失败: {result.get('msg')}")
             else:
-                print(f"获取直属库文档列表请求失败: {response.status_code}")
+                logger.error(f"获取直属库文档列表请求失败: {response.status_code}")
         except Exception as e:
-            print(f"获取直属库内容发生异常: {str(e)}")
+            logger.error(f"获取直属库内容发生异常: {str(e)}")
 
         return None
 
+    def get_knowledge_base_content(self, knowledge_base_id=None):
+        """获取飞书直属库内容
+
+        Args:
+            knowledge_base_id: 直属库ID，默认为None（使用环境变量配置的值）
+
+        Returns:
+            list: 文档内容列表，若失败则返回None
+        """
+        documents = self.list_knowledge_base_documents(knowledge_base_id)
+        if documents is None:
+            return None
+
+        document_contents = []
+        # 遍历文档并获取内容
+        for doc in documents:
+            doc_id = doc.get('document_id')
+            doc_title = doc.get('title')
+            logger.info(f"正在获取文档: {doc_title}")
+            doc_content = self.get_document_content(doc_id)
+            if doc_content:
+                document_contents.append({
+                    'document_id': doc_id,
+                    'title': doc_title,
+                    'content': doc_content
+                })
+
+        return document_contents
+
+    @staticmethod
+    def split_document(content, document_id, title=None):
+        """把一篇飞书文档的内容分割为片段
+
+        Args:
+            content: 文档内容
+            document_id: 文档ID
+            title: 文档标题，直属库中的文档才有
+
+        Returns:
+            list: 分割后的Document列表，元数据记录飞书文档信息(source为"feishu:文档ID")，供检索接口按文档过滤
+        """
+        from langchain_core.documents import Document
+        from langchain.text_splitter import CharacterTextSplitter
+
+        metadata = {'source': f"feishu:{document_id}", 'document_id': document_id}
+        if title:
+            metadata['title'] = title
+        # 飞书文档默认不重叠，知识库配置文件中设置的分割参数优先
+        config = load_config(chunk_overlap=0)
+        text_splitter = CharacterTextSplitter(chunk_size=config["chunk_size"], chunk_overlap=config["chunk_overlap"])
+        return text_splitter.split_documents([Document(page_content=content, metadata=metadata)])
+
+    def reindex_documents(self, kb, changed_ids=(), removed_ids=()):
+        """只重建指定飞书文档的索引：重新获取变化文档的内容，删除已删除文档的片段
+
+        只处理属于本知识库的文档(配置的云文档、已入库的文档或直属库中的文档)，其他文档被忽略；
+        删除只对已入库、且不在直属库最新文档列表中的文档生效。
+
+        Args:
+            kb: 知识库实例
+            changed_ids: 内容或标题发生变化的文档ID列表
+            removed_ids: 已删除的文档ID列表
+
+        Returns:
+            dict: removed_chunks、added_chunks，获取内容或文档列表失败(旧片段被保留)的文档列表failed，
+                以及不属于本知识库而被忽略的文档列表ignored
+        """
+        removed_ids = list(dict.fromkeys(removed_ids))
+        changed_ids = [doc_id for doc_id in dict.fromkeys(changed_ids) if doc_id not in removed_ids]
+        ignored = []
+        failed = []
+        # 删除事件只对已入库的文档生效，伪造的或其他应用的事件不能删除片段
+        indexed_removed = []
+        for doc_id in removed_ids:
+            if kb.source_metadata(f"feishu:{doc_id}") is None:
+                ignored.append(doc_id)
+            else:
+                indexed_removed.append(doc_id)
+        # 直属库中的文档以最新的文档列表为准(标题可能刚被修改)，每批变化只获取一次列表
+        listed = {}
+        if (changed_ids or indexed_removed) and self.knowledge_base_id:
+            documents = self.list_knowledge_base_documents()
+            listed = {doc['document_id']: doc['title'] for doc in documents or []}
+            if documents is None:
+                # 无法确认文档是否已从直属库删除，稍后重试
+                failed.extend(indexed_removed)
+                indexed_removed = []
+        removed_ids = []
+        for doc_id in indexed_removed:
+            if doc_id in listed:
+                # 文档仍在直属库中，删除事件与实际不符
+                ignored.append(doc_id)
+            else:
+                removed_ids.append(doc_id)
+        titles = {}
+        for doc_id in changed_ids:
+            metadata = kb.source_metadata(f"feishu:{doc_id}")
+            if doc_id in listed:
+                titles[doc_id] = listed[doc_id]
+            elif metadata is not None:
+                titles[doc_id] = metadata.get('title')
+            elif doc_id == self.document_id:
+                titles[doc_id] = None
+            else:
+                ignored.append(doc_id)
+
+        texts = []
+        replaced = set(f"feishu:{doc_id}" for doc_id in removed_ids)
+        for doc_id, title in titles.items():
+            content = self.get_document_content(doc_id)
+            if content is None:
+                failed.append(doc_id)
+                continue
+            texts.extend(self.split_document(content, doc_id, title))
+            replaced.add(f"feishu:{doc_id}")
+
+        result = kb.replace_sources(replaced, texts) if replaced else {"removed_chunks": 0, "added_chunks": 0}
+        return {**result, "failed": failed, "ignored": ignored}
+
     def process_feishu_documents(self, save_path="feishu_knowledge_base"):
         """处理飞书文档并创建知识库
 
@@ -162,64 +269,32 @@ class FeishuKnowledgeProcessor:
             DeepSeekKnowledgeBase: 初始化并创建好的知识库实例，若失败则返回None
         """
         try:
-            # 初始化知识库
-            kb = DeepSeekKnowledgeBase()
+            # 初始化知识库，与进程内其他知识库共享嵌入模型和模型路由层
+            kb = get_manager().new_knowledge_base()
 
             # 处理飞书云文档
             if self.document_id:
-                print("正在处理飞书云文档...")
+                logger.info("正在处理飞书云文档...")
                 doc_content = self.get_document_content()
                 if doc_content:
-                    # 将文档内容写入临时文件
-                    temp_file = "temp_feishu_doc.txt"
-                    with open(temp_file, 'w', encoding='utf-8') as f:
-                        f.write(doc_content)
-
-                    # 加载文档
-                    loader = TextLoader(temp_file, encoding="utf-8")
-                    document = loader.load()
-
-                    # 分割文档
-                    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-                    docs = text_splitter.split_documents(document)
-
-                    # 添加到知识库
-                    kb.add_documents(docs)
-
-                    # 删除临时文件
-                    os.remove(temp_file)
+                    # 分割文档并添加到知识库
+                    kb.add_documents(self.split_document(doc_content, self.document_id))
 
             # 处理飞书直属库
             if self.knowledge_base_id:
-                print("正在处理飞书直属库...")
+                logger.info("正在处理飞书直属库...")
                 kb_documents = self.get_knowledge_base_content()
                 if kb_documents:
                     for doc in kb_documents:
-                        # 将文档内容写入临时文件
-                        temp_file = f"temp_feishu_kb_{doc['title'].replace(' ', '_')}.txt"
-                        with open(temp_file, 'w', encoding='utf-8') as f:
-                            f.write(doc['content'])
-
-                        # 加载文档
-                        loader = TextLoader(temp_file, encoding="utf-8")
-                        document = loader.load()
-
-                        # 分割文档
-                        text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-                        docs = text_splitter.split_documents(document)
-
-                        # 添加到知识库
-                        kb.add_documents(docs)
-
-                        # 删除临时文件
-                        os.remove(temp_file)
+                        # 分割文档并添加到知识库
+                        kb.add_documents(self.split_document(doc['content'], doc.get('document_id'), doc['title']))
 
             # 保存知识库
             kb.save_knowledge_base(save_path)
 
             return kb
         except Exception as e:
-            print(f"处理飞书文档时发生错误: {str(e)}")
+            logger.error(f"处理飞书文档时发生错误: {str(e)}")
             return None
 
     @staticmethod
@@ -1,11 +1,14 @@
 # 导入必要的库
 import os
 from dotenv import load_dotenv
-from langchain_knowledge import DeepSeekKnowledgeBase
+from knowledge_manager import get_manager
+from query_log import get_logger
 
 # 从.env文件加载环境变量
 load_dotenv()
 
+logger = get_logger("word")
+
 # 从环境变量加载HF_ENDPOINT配置，已在.env文件中设置
 # load_dotenv()会自动加载所有环境变量，包括模型配置
 
@@ -17,7 +20,8 @@ class WordKnowledgeProcessor:
         """处理Word文档并创建知识库
         
         Args:
-            doc_path: Word文档路径，默认为None（将从环境变量获取）
+            doc_path: Word文档路径或文档目录，默认为None（将从环境变量获取）；
+                为目录时加载其中(含子目录)全部.docx和.txt文档
             save_path: 知识库保存路径
             
         Returns:
@@ -28,22 +32,23 @@ class WordKnowledgeProcessor:
         
         # 验证文档路径
         if not word_doc_path:
-            print("错误: 未提供文档路径且未配置WORD_DOC_PATH环境变量")
+            logger.error("未提供文档路径且未配置WORD_DOC_PATH环境变量")
             return None
         
         if not os.path.exists(word_doc_path):
-            print(f"错误: 文件 {word_doc_path} 不存在")
+            logger.error(f"文件 {word_doc_path} 不存在")
             return None
         
         try:
-            # 初始化知识库
-            kb = DeepSeekKnowledgeBase()
+            # 初始化知识库，与进程内其他知识库共享嵌入模型和模型路由层
+            kb = get_manager().new_knowledge_base()
             
             # 创建知识库
-            success = kb.create_knowledge_base([word_doc_path])
+            from doc_watcher import list_documents
+            success = kb.create_knowledge_base(list_documents(word_doc_path))
             
             if not success:
-                print("创建知识库失败")
+                logger.error("创建知识库失败")
                 return None
             
             # 保存知识库
@@ -51,7 +56,7 @@ class WordKnowledgeProcessor:
             
             return kb
         except Exception as e:
-            print(f"处理文档时发生错误: {str(e)}")
+            logger.error(f"处理文档时发生错误: {str(e)}")
             return None
             
     @staticmethod
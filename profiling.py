@@ -0,0 +1,336 @@
+# 按需性能剖析
+# 线上某次查询变慢时，对单个请求(请求头X-Profile或查询参数profile)或按比例抽样的查询和入库
+# 采集cProfile(确定性，统计每个函数的调用次数和耗时)或采样剖析(定时抓取线程调用栈，开销小，
+# 可导出为火焰图使用的折叠栈格式)，通过受保护的/debug/profiles接口查看和下载。
+# 未设置PROFILING_ENABLED时不注册中间件和接口，被剖析的函数保持原样，没有额外开销。
+import contextvars
+import functools
+import io
+import itertools
+import json
+import marshal
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+
+from query_log import get_logger
+
+logger = get_logger("profiling")
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    try:
+        return float(value) if value not in (None, "") else default
+    except ValueError:
+        return default
+
+
+# 是否启用剖析功能
+ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+# 自动剖析的查询和入库比例(0~1)，0表示只剖析显式要求的请求
+SAMPLE_RATE = _env_float("PROFILING_SAMPLE_RATE", 0.0)
+# 抽样剖析和未指定方式时使用的剖析器: cprofile或sample
+DEFAULT_MODE = os.getenv("PROFILING_MODE", "sample")
+# 采样剖析抓取调用栈的间隔(秒)
+SAMPLE_INTERVAL = _env_float("PROFILING_SAMPLE_INTERVAL", 0.005)
+# 内存中保留的剖析结果数量
+MAX_PROFILES = int(_env_float("PROFILING_MAX_PROFILES", 50))
+# 访问/debug/profiles和触发剖析需要的令牌(请求头X-Debug-Token)；未设置时只允许本机访问
+TOKEN = os.getenv("PROFILING_TOKEN", "")
+# 保存剖析结果的目录；多进程部署(serve_workers.py)时设置，使任一工作进程都能查到其他进程的结果
+PROFILE_DIR = os.getenv("PROFILING_DIR", "")
+
+MODES = ("cprofile", "sample")
+
+# 当前请求要求的剖析方式，以及记录本次请求产生的剖析ID的列表
+_requested = contextvars.ContextVar("profiling_requested", default=None)
+# 当前上下文中是否已在剖析，嵌套的入库步骤(如create_knowledge_base中的add_documents)不重复剖析
+_active = contextvars.ContextVar("profiling_active", default=False)
+
+_profiles = deque(maxlen=MAX_PROFILES)
+_profiles_lock = threading.Lock()
+_ids = itertools.count(1)
+
+
+class _StackSampler:
+    """在后台线程中定时抓取目标线程的调用栈，统计各调用栈出现的次数"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="kb-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+
+def _collapsed(stacks):
+    """折叠栈格式(每行"调用栈 次数")，可直接用于flamegraph.pl、inferno或speedscope"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def _sample_summary(stacks, samples, limit=40):
+    """按自身耗时(栈顶出现次数)和累计耗时(出现在栈中的次数)列出最耗时的函数"""
+    own, total = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    lines = [f"共 {samples} 次采样", "", f"{'自身%':>7} {'累计%':>7}  函数"]
+    for frame, count in own.most_common(limit):
+        lines.append(f"{100 * count / max(samples, 1):7.1f} {100 * total[frame] / max(samples, 1):7.1f}  {frame}")
+    return "\n".join(lines) + "\n"
+
+
+def _store(record, artifacts):
+    """保存剖析结果，设置了PROFILING_DIR时同时写入目录"""
+    record["_artifacts"] = artifacts
+    with _profiles_lock:
+        _profiles.append(record)
+    if PROFILE_DIR:
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            meta = {key: value for key, value in record.items() if key != "_artifacts"}
+            base = os.path.join(PROFILE_DIR, record["id"])
+            for fmt, data in artifacts.items():
+                with open(f"{base}.{fmt}", "wb") as f:
+                    f.write(data if isinstance(data, bytes) else data.encode("utf-8"))
+            with open(f"{base}.json", "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            _prune_dir()
+        except OSError as e:
+            logger.error(f"保存剖析结果失败: {str(e)}")
+
+
+def _prune_dir():
+    """目录中只保留最近的MAX_PROFILES份结果"""
+    metas = sorted((name for name in os.listdir(PROFILE_DIR) if name.endswith(".json")),
+                   key=lambda name: os.path.getmtime(os.path.join(PROFILE_DIR, name)))
+    for name in metas[:-MAX_PROFILES] if MAX_PROFILES else metas:
+        profile_id = name[:-len(".json")]
+        for fmt in ("json", "text", "collapsed", "pstats"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, f"{profile_id}.{fmt}"))
+            except OSError:
+                pass
+
+
+def _choose_mode():
+    """决定当前这段代码是否剖析以及使用的方式，不剖析时返回None"""
+    if _active.get():
+        return None
+    requested = _requested.get()
+    if requested is not None:
+        return requested[0]
+    if SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE:
+        return DEFAULT_MODE
+    return None
+
+
+def profiled(kind, label=""):
+    """剖析一段查询或入库代码
+
+    Args:
+        kind: 类别，如query、ingest
+        label: 说明，如问题文本或文件数量
+
+    Returns:
+        上下文管理器；未启用或本次不剖析时为空上下文
+    """
+    if not ENABLED:
+        return nullcontext()
+    mode = _choose_mode()
+    if mode is None:
+        return nullcontext()
+    return _profile(kind, label, mode)
+
+
+def profile_calls(kind, describe=None):
+    """装饰器：剖析每次调用；未启用时原样返回被装饰的函数
+
+    Args:
+        kind: 类别，如query、ingest
+        describe: 可选，由调用参数生成说明的函数describe(*args, **kwargs)
+    """
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            label = describe(*args, **kwargs) if describe else func.__name__
+            with profiled(kind, label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def _profile(kind, label, mode):
+    token = _active.set(True)
+    started_at = time.time()
+    start = time.perf_counter()
+    profiler = None
+    sampler = None
+    if mode == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # 同一线程中已有其他剖析器(如外部调试工具)在运行
+            profiler = None
+    else:
+        sampler = _StackSampler(threading.get_ident(), SAMPLE_INTERVAL)
+        sampler.start()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        _active.reset(token)
+        if profiler is not None:
+            profiler.disable()
+        if sampler is not None:
+            sampler.stop()
+        if profiler is not None or sampler is not None:
+            record = {
+                "id": f"{os.getpid()}-{next(_ids)}",
+                "kind": kind,
+                "label": str(label)[:200],
+                "mode": mode,
+                "pid": os.getpid(),
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started_at)),
+                "duration": round(duration, 4),
+            }
+            if profiler is not None:
+                import pstats
+                profiler.create_stats()
+                # 先导出原始数据，pstats.Stats读取后会清空剖析器中的统计
+                raw = marshal.dumps(profiler.stats)
+                text = io.StringIO()
+                pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(60)
+                artifacts = {"text": text.getvalue(), "pstats": raw}
+            else:
+                record["samples"] = sampler.samples
+                artifacts = {"text": _sample_summary(sampler.stacks, sampler.samples),
+                             "collapsed": _collapsed(sampler.stacks)}
+            record["formats"] = sorted(artifacts)
+            requested = _requested.get()
+            if requested is not None:
+                requested[1].append(record["id"])
+            _store(record, artifacts)
+
+
+def list_profiles():
+    """列出已保存的剖析结果(最新的在前)"""
+    if PROFILE_DIR and os.path.isdir(PROFILE_DIR):
+        metas = []
+        for name in os.listdir(PROFILE_DIR):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(PROFILE_DIR, name), encoding="utf-8") as f:
+                        metas.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return sorted(metas, key=lambda meta: meta["started_at"], reverse=True)
+    with _profiles_lock:
+        return [{key: value for key, value in record.items() if key != "_artifacts"}
+                for record in reversed(_profiles)]
+
+
+def get_profile_data(profile_id, fmt):
+    """读取剖析结果的指定格式(text、collapsed或pstats)，不存在时返回None"""
+    with _profiles_lock:
+        for record in _profiles:
+            if record["id"] == profile_id:
+                return record["_artifacts"].get(fmt)
+    if PROFILE_DIR and "/" not in profile_id and "\\" not in profile_id and ".." not in profile_id:
+        path = os.path.join(PROFILE_DIR, f"{profile_id}.{fmt}")
+        if fmt in ("text", "collapsed", "pstats") and os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+    return None
+
+
+def _authorized(request):
+    """设置了PROFILING_TOKEN时校验X-Debug-Token，否则只允许本机访问"""
+    if TOKEN:
+        return secrets.compare_digest(request.headers.get("X-Debug-Token", ""), TOKEN)
+    return request.client is not None and request.client.host in ("127.0.0.1", "::1", "localhost")
+
+
+def install_profiling(app):
+    """为FastAPI应用注册剖析中间件和/debug/profiles接口，未启用时不做任何事
+
+    Args:
+        app: FastAPI应用实例
+    """
+    if not ENABLED:
+        return
+    from fastapi import HTTPException, Request, Response
+
+    @app.middleware("http")
+    async def _profiling_middleware(request, call_next):
+        mode = request.headers.get("X-Profile") or request.query_params.get("profile")
+        if not mode or not _authorized(request):
+            return await call_next(request)
+        mode = mode.lower() if mode.lower() in MODES else DEFAULT_MODE
+        # 线程池和查询后台线程会复制当前上下文，查询代码由此得知本次请求需要剖析
+        profile_ids = []
+        token = _requested.set((mode, profile_ids))
+        try:
+            response = await call_next(request)
+        finally:
+            _requested.reset(token)
+        if profile_ids:
+            response.headers["X-Profile-Id"] = ",".join(profile_ids)
+        return response
+
+    def _check(request):
+        if not _authorized(request):
+            raise HTTPException(status_code=403, detail="需要有效的X-Debug-Token")
+
+    @app.get("/debug/profiles", tags=["调试"], include_in_schema=False)
+    async def list_profiles_endpoint(request: Request):
+        """列出已采集的剖析结果"""
+        _check(request)
+        return {"profiles": list_profiles(), "sample_rate": SAMPLE_RATE, "default_mode": DEFAULT_MODE}
+
+    @app.get("/debug/profiles/{profile_id}", tags=["调试"], include_in_schema=False)
+    async def get_profile_endpoint(request: Request, profile_id: str, format: str = "text"):
+        """下载剖析结果: text为可读摘要，collapsed为火焰图折叠栈(采样剖析)，pstats为cProfile原始数据"""
+        _check(request)
+        data = get_profile_data(profile_id, format)
+        if data is None:
+            raise HTTPException(status_code=404, detail=f"剖析结果 {profile_id} 没有 {format} 格式")
+        if format == "pstats":
+            return Response(content=data, media_type="application/octet-stream",
+                            headers={"Content-Disposition": f'attachment; filename="{profile_id}.prof"'})
+        return Response(content=data, media_type="text/plain; charset=utf-8")
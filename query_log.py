@@ -0,0 +1,269 @@
+# 结构化日志与慢查询日志
+# 知识库模块的日志统一写入"kb"日志记录器：记录器只把日志放入队列(QueueHandler)，由后台线程(QueueListener)
+# 格式化并写出，查询线程不会因为写日志而阻塞。每条日志带有请求ID(X-Request-ID请求头，未提供时自动生成)，
+# KB_LOG_FORMAT=json时每行输出一个JSON对象，便于日志系统按字段检索。
+# 每次查询记录各阶段耗时(问题向量、检索、提示词、模型首token和总耗时)，总耗时超过SLOW_QUERY_THRESHOLD_MS的查询
+# 写入慢查询日志(SLOW_QUERY_LOG，JSON Lines)：问题、检索到的片段ID和距离、提示词长度以及各阶段耗时，
+# 可以用loadtest/query_replay.py在指定的知识库上重放并对比延迟。
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+import uuid
+
+from metrics import QUERY_STAGE_SECONDS, REGISTRY
+
+# 日志格式: text(默认)或json
+LOG_FORMAT = os.getenv('KB_LOG_FORMAT', 'text').lower()
+# 知识库日志级别
+LOG_LEVEL = os.getenv('KB_LOG_LEVEL', 'INFO').upper()
+# 慢查询阈值(毫秒，包括模型调用)，0表示不记录慢查询
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '5000') or 0)
+# 慢查询日志文件，未设置时慢查询只以WARNING级别写入知识库日志
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', '')
+
+SLOW_QUERIES = REGISTRY.counter(
+    "kb_slow_queries_total",
+    "总耗时超过SLOW_QUERY_THRESHOLD_MS的查询数",
+)
+
+# 当前请求的ID，由请求中间件设置，线程池和查询后台线程会复制上下文
+_request_id = contextvars.ContextVar("kb_request_id", default=None)
+# 当前正在记录的查询
+_current_trace = contextvars.ContextVar("kb_query_trace", default=None)
+
+_configure_lock = threading.Lock()
+_listener = None
+_queue_handler = None
+
+
+def get_request_id():
+    """当前请求的ID，不在请求中时返回None"""
+    return _request_id.get()
+
+
+@contextlib.contextmanager
+def request_context(request_id=None):
+    """在代码块内设置请求ID(离线任务和测试中使用)，未提供时生成一个新的ID"""
+    token = _request_id.set(request_id or uuid.uuid4().hex[:16])
+    try:
+        yield _request_id.get()
+    finally:
+        _request_id.reset(token)
+
+
+class _ContextFilter(logging.Filter):
+    """在日志放入队列之前记录当前请求ID(后台线程中已经无法读取请求的上下文)"""
+
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = _request_id.get() or "-"
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    """text格式在消息后附加key=value字段，json格式输出一个JSON对象
+
+    结构化字段通过extra={"fields": {...}}传入。
+    """
+
+    def __init__(self, json_format=False):
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s")
+        self.json_format = json_format
+
+    def format(self, record):
+        fields = getattr(record, "fields", None) or {}
+        if self.json_format:
+            entry = {
+                "time": self.formatTime(record),
+                "logger": record.name,
+                "level": record.levelname,
+                "request_id": getattr(record, "request_id", "-"),
+                "message": record.getMessage(),
+                **fields,
+            }
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        line = super().format(record)
+        if fields:
+            line += " " + " ".join(f"{key}={json.dumps(value, ensure_ascii=False, default=str)}"
+                                   for key, value in fields.items())
+        return line
+
+
+def configure_logging():
+    """为"kb"日志记录器配置队列日志(只配置一次)，获取日志记录器时自动调用"""
+    global _listener, _queue_handler
+    with _configure_lock:
+        if _listener is not None:
+            return
+        handlers = []
+        console = logging.StreamHandler()
+        console.setFormatter(StructuredFormatter(LOG_FORMAT == "json"))
+        handlers.append(console)
+        if SLOW_QUERY_LOG:
+            directory = os.path.dirname(SLOW_QUERY_LOG)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            slow_log = logging.FileHandler(SLOW_QUERY_LOG, encoding="utf-8")
+            slow_log.setFormatter(logging.Formatter("%(message)s"))
+            slow_log.addFilter(lambda record: record.name == "kb.slow_query")
+            handlers.append(slow_log)
+            # 慢查询已写入文件，控制台只保留普通日志
+            console.addFilter(lambda record: record.name != "kb.slow_query")
+
+        log_queue = queue.SimpleQueue()
+        _queue_handler = logging.handlers.QueueHandler(log_queue)
+        _queue_handler.addFilter(_ContextFilter())
+        logger = logging.getLogger("kb")
+        logger.setLevel(LOG_LEVEL)
+        logger.addHandler(_queue_handler)
+        # 不再交给根记录器，避免API服务的basicConfig重复输出
+        logger.propagate = False
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        # 进程退出前写出队列中剩余的日志
+        atexit.register(lambda: _listener.stop())
+        # serve_workers.py预加载后fork出的工作进程中没有写日志的后台线程，需要重新创建
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=_restart_listener)
+
+
+def _restart_listener():
+    global _listener
+    log_queue = queue.SimpleQueue()
+    _queue_handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def get_logger(name):
+    """返回"kb"下的日志记录器，如get_logger("knowledge")为kb.knowledge"""
+    configure_logging()
+    return logging.getLogger(f"kb.{name}")
+
+
+_slow_logger = get_logger("slow_query")
+_query_logger = get_logger("query")
+
+
+class QueryTrace:
+    """一次查询的记录：各阶段耗时、检索到的片段和提示词大小"""
+
+    def __init__(self, question, **fields):
+        self.question = question
+        self.request_id = _request_id.get()
+        self.started_at = time.time()
+        self.stages = {}
+        self.fields = dict(fields)
+        self.total_seconds = None
+        self.error = None
+
+    def add_stage(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def as_dict(self):
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "request_id": self.request_id,
+            "question": self.question,
+            "total_ms": round(self.total_seconds * 1000, 3) if self.total_seconds is not None else None,
+            "stages_ms": {stage: round(seconds * 1000, 3) for stage, seconds in self.stages.items()},
+            **self.fields,
+            **({"error": self.error} if self.error else {}),
+        }
+
+
+@contextlib.contextmanager
+def trace_query(question, log=True, **fields):
+    """记录代码块内执行的一次查询
+
+    Args:
+        question: 查询问题
+        log: 结束时是否写出查询日志，超过阈值时写入慢查询日志(重放工具关闭)
+        fields: 额外记录的字段，如索引版本
+
+    Yields:
+        QueryTrace: 本次查询的记录
+    """
+    trace = QueryTrace(question, **fields)
+    token = _current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    except Exception as e:
+        trace.error = str(e)
+        raise
+    finally:
+        trace.total_seconds = time.perf_counter() - start
+        _current_trace.reset(token)
+        if log:
+            _finish(trace)
+
+
+def _finish(trace):
+    entry = trace.as_dict()
+    _query_logger.info("查询完成", extra={"fields": {
+        "total_ms": entry["total_ms"], "stages_ms": entry["stages_ms"],
+        # 相关性不足时没有模型调用阶段，记录判断结果便于区分
+        **({"relevance": entry["relevance"]} if "relevance" in entry else {}),
+        **({"error": trace.error} if trace.error else {}),
+    }})
+    if SLOW_QUERY_THRESHOLD_MS > 0 and entry["total_ms"] >= SLOW_QUERY_THRESHOLD_MS:
+        SLOW_QUERIES.inc()
+        _slow_logger.warning(json.dumps(entry, ensure_ascii=False, default=str))
+
+
+def current_trace():
+    """当前正在记录的查询，没有时返回None"""
+    return _current_trace.get()
+
+
+def annotate(**fields):
+    """为当前查询补充记录的字段(如检索到的片段、提示词长度)，不在查询中时不做任何事"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.fields.update(fields)
+
+
+def record_stage(stage, seconds):
+    """记录查询某一阶段的耗时：写入kb_query_stage_seconds指标，并计入当前查询的记录"""
+    QUERY_STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_stage(stage, seconds)
+
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """以代码块的执行时间调用record_stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def install_request_id(app):
+    """为FastAPI应用注册请求ID中间件：沿用X-Request-ID请求头或生成新的ID，并在响应头中返回
+
+    Args:
+        app: FastAPI应用实例
+    """
+    @app.middleware("http")
+    async def _request_id_middleware(request, call_next):
+        request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+        token = _request_id.set(request_id[:64])
+        try:
+            response = await call_next(request)
+        finally:
+            _request_id.reset(token)
+        response.headers["X-Request-ID"] = request_id[:64]
+        return response
@@ -0,0 +1,217 @@
+# 检索相关性阈值校准
+# 在已保存的知识库上计算两组问题的最相似片段距离:
+#   知识库能回答的问题(--queries，未提供时从片段中随机截取短语)
+#   知识库外的问题(--negative-queries，如线上回答为"无法提供该名词的解释"的名词)
+# 取能回答的问题中--min-pass-rate比例都能通过的最小距离作为relevance.max_distance，写入知识库配置(kb_config.py)，
+# 并报告该阈值下知识库外问题被拦截(不调用模型)的比例。距离的尺度取决于嵌入模型和索引，更换嵌入模型后需要重新校准。
+# 内积向量存储的得分越大越相似，此时取的是能通过的最低得分。
+# 问题文件每行一个问题，或每行一个含question字段的JSON对象(慢查询日志可以直接使用)。
+# 用法: python relevance_calibration.py --knowledge-base word_knowledge_base --queries terms.txt --negative-queries unknown_terms.txt
+#       python relevance_calibration.py --knowledge-base word_knowledge_base --min-pass-rate 0.95 --on-low-relevance snippets --no-write
+import argparse
+import json
+import math
+import sys
+import time
+
+# 从.env文件加载环境变量
+from dotenv import load_dotenv
+load_dotenv()
+
+# 一次批量计算向量和检索的问题数量
+_BATCH_SIZE = 256
+
+
+def read_questions(path):
+    """读取问题文件，每行一个问题或一个含question字段的JSON对象
+
+    Returns:
+        list: 问题列表(已去除空行)
+    """
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                try:
+                    line = (json.loads(line).get("question") or "").strip()
+                except json.JSONDecodeError:
+                    pass
+            if line:
+                questions.append(line)
+    return questions
+
+
+def generate_questions(kb, count, seed=0):
+    """从知识库的片段中随机截取短语作为能回答的问题
+
+    截取的短语与片段原文一致，距离通常比真实的名词查询更小，得到的阈值偏严，有真实问题时应优先使用。
+    """
+    from index_tuner import generate_queries
+
+    documents = []
+    for store in getattr(kb.vector_store, "shards", [kb.vector_store]):
+        documents.extend(store.docstore.search(doc_id) for doc_id in store.index_to_docstore_id.values())
+    return [query["question"] for query in generate_queries(documents, count, seed=seed, words=3, characters=6)]
+
+
+def best_distances(kb, questions):
+    """批量检索每个问题最相似片段的距离或得分(与线上查询使用同一个索引)
+
+    Returns:
+        list: 与questions对应的距离，知识库为空时为None
+    """
+    distances = []
+    for start in range(0, len(questions), _BATCH_SIZE):
+        for docs_and_scores in kb.retrieve_batch(questions[start:start + _BATCH_SIZE], k=1):
+            distances.append(float(docs_and_scores[0][1]) if docs_and_scores else None)
+    return distances
+
+
+def _passes(distance, threshold, larger_is_better):
+    if distance is None:
+        return False
+    return distance >= threshold if larger_is_better else distance <= threshold
+
+
+def choose_threshold(distances, min_pass_rate, larger_is_better=False):
+    """能回答的问题中至少min_pass_rate比例都能通过的最严格阈值
+
+    L2距离取通过(距离不超过阈值)的最小阈值，内积得分取通过(得分不低于阈值)的最大阈值。
+    """
+    ordered = sorted((distance for distance in distances if distance is not None), reverse=larger_is_better)
+    if not ordered:
+        return None
+    rank = min(len(ordered), max(1, math.ceil(min_pass_rate * len(ordered))))
+    return ordered[rank - 1]
+
+
+def pass_rate(distances, threshold, larger_is_better=False):
+    """通过阈值(会调用模型)的问题比例"""
+    if not distances:
+        return None
+    return round(sum(1 for distance in distances if _passes(distance, threshold, larger_is_better)) / len(distances), 4)
+
+
+def calibrate(kb, questions, negatives=(), min_pass_rate=0.98):
+    """计算两组问题的距离分布并选出阈值
+
+    Args:
+        kb: 已加载的知识库
+        questions: 知识库能回答的问题
+        negatives: 知识库外的问题
+        min_pass_rate: 能回答的问题中至少有多少比例不被拦截
+
+    Returns:
+        dict: 阈值、两组问题的通过比例、距离分位数和不同阈值下的通过比例
+    """
+    from report_utils import percentile
+
+    larger = kb.larger_score_is_better()
+    positive = best_distances(kb, list(questions))
+    negative = best_distances(kb, list(negatives)) if negatives else []
+    threshold = choose_threshold(positive, min_pass_rate, larger)
+
+    def quantiles(distances):
+        values = [distance for distance in distances if distance is not None]
+        return {f"p{pct}": round(percentile(values, pct), 6) if values else None for pct in (5, 25, 50, 75, 95)}
+
+    # 以能回答的问题的距离分位数为候选阈值，便于查看拦截比例与误拦截之间的取舍
+    candidates = sorted({choose_threshold(positive, rate / 100, larger) for rate in (80, 90, 95, 98, 99, 100)} - {None},
+                        reverse=larger)
+    return {
+        "queries": len(positive),
+        "negative_queries": len(negative),
+        "min_pass_rate": min_pass_rate,
+        "larger_score_is_better": larger,
+        "max_distance": threshold,
+        "pass_rate": pass_rate(positive, threshold, larger) if threshold is not None else None,
+        # 知识库外的问题中被拦截(不调用模型)的比例
+        "negative_reject_rate": (round(1 - pass_rate(negative, threshold, larger), 4)
+                                 if negative and threshold is not None else None),
+        "distances": {"queries": quantiles(positive), "negative_queries": quantiles(negative)},
+        "sweep": [
+            {
+                "max_distance": candidate,
+                "pass_rate": pass_rate(positive, candidate, larger),
+                "negative_reject_rate": round(1 - pass_rate(negative, candidate, larger), 4) if negative else None,
+            } for candidate in candidates
+        ],
+    }
+
+
+def main(argv=None):
+    import kb_config
+
+    parser = argparse.ArgumentParser(description="在已保存的知识库上校准检索相关性阈值并写入知识库配置")
+    parser.add_argument("--knowledge-base", required=True, help="知识库目录(save_knowledge_base保存的路径)")
+    parser.add_argument("--queries", help="知识库能回答的问题文件，未提供时从片段中随机截取短语")
+    parser.add_argument("--negative-queries", help="知识库外的问题文件")
+    parser.add_argument("--generate-queries", type=int, default=500, help="自动生成的问题数量")
+    parser.add_argument("--seed", type=int, default=0, help="生成问题的随机种子")
+    parser.add_argument("--min-pass-rate", type=float, default=0.98, help="能回答的问题中至少有多少比例不被拦截")
+    parser.add_argument("--on-low-relevance", choices=kb_config.LOW_RELEVANCE_ACTIONS, default=None,
+                        help="相关性不足时的返回方式，默认沿用配置文件中的设置")
+    parser.add_argument("--config", default=kb_config.CONFIG_FILE, help="写入阈值的知识库配置文件")
+    parser.add_argument("--no-write", action="store_true", help="只输出报告，不写入知识库配置")
+    parser.add_argument("--report", default="benchmark_results/relevance_calibration.json", help="完整结果JSON路径")
+    args = parser.parse_args(argv)
+    if not 0 < args.min_pass_rate <= 1:
+        parser.error("--min-pass-rate必须在0到1之间")
+
+    from knowledge_manager import get_manager
+
+    kb = get_manager().new_knowledge_base()
+    if not kb.load_knowledge_base(args.knowledge_base):
+        print(f"无法加载知识库: {args.knowledge_base}")
+        return 1
+
+    generated = not args.queries
+    questions = read_questions(args.queries) if args.queries else generate_questions(kb, args.generate_queries, args.seed)
+    negatives = read_questions(args.negative_queries) if args.negative_queries else []
+    if not questions:
+        print("没有可用的问题")
+        return 1
+    print(f"知识库 {args.knowledge_base}: {kb.chunk_count()} 个片段；能回答的问题 {len(questions)} 个"
+          f"{'(从片段中截取)' if generated else ''}，知识库外的问题 {len(negatives)} 个")
+
+    report = calibrate(kb, questions, negatives, args.min_pass_rate)
+    report["generated_queries"] = generated
+    report["embedding_model"] = kb._embedding_model_name()
+    for row in report["sweep"]:
+        rejected = f"，拦截知识库外问题 {row['negative_reject_rate']:.1%}" if row["negative_reject_rate"] is not None else ""
+        print(f"  max_distance {row['max_distance']:.4f}: 能回答的问题通过 {row['pass_rate']:.1%}{rejected}")
+
+    threshold = report["max_distance"]
+    if threshold is None:
+        print("知识库为空，无法校准")
+        return 1
+    print(f"选中 max_distance {threshold:.4f}(能回答的问题通过 {report['pass_rate']:.1%})")
+    if report["negative_reject_rate"] is not None and report["negative_reject_rate"] < 0.5:
+        print("注意: 该阈值下一半以上的知识库外问题仍会调用模型，两组问题的距离分布重叠较多")
+    if not args.no_write:
+        relevance = dict(kb_config.load_config(args.config)["relevance"])
+        relevance["max_distance"] = threshold
+        if args.on_low_relevance:
+            relevance["on_low_relevance"] = args.on_low_relevance
+        relevance["calibration"] = {
+            "calibrated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "embedding_model": report["embedding_model"],
+            "queries": report["queries"],
+            "negative_queries": report["negative_queries"],
+            "generated_queries": generated,
+            "pass_rate": report["pass_rate"],
+            "negative_reject_rate": report["negative_reject_rate"],
+        }
+        kb_config.save_config({"relevance": relevance}, args.config)
+        print(f"已写入知识库配置 {args.config}，重启服务后生效")
+
+    from report_utils import write_results
+    write_results(report, args.report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
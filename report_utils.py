@@ -0,0 +1,26 @@
+# 离线工具(基准测试、索引调优、阈值校准)共用的统计和结果输出函数
+import json
+import os
+
+
+def percentile(values, pct):
+    """计算百分位数(线性插值)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * pct / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def write_results(results, output_path):
+    """将结果写入JSON文件"""
+    dir_path = os.path.dirname(output_path)
+    if dir_path:
+        os.makedirs(dir_path, exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {output_path}")
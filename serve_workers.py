@@ -0,0 +1,315 @@
+# 多工作进程服务(预加载后fork)
+# 主进程加载嵌入模型并初始化各服务的知识库，然后fork出多个工作进程共享同一批监听端口，
+# 工作进程以写时复制的方式共享模型权重和FAISS索引，不需要各自重建知识库。
+# 知识库变更(重新加载、创建、加载)由接收请求的工作进程转交主进程执行，
+# 主进程执行后依次替换所有工作进程，保证每个工作进程看到同一份知识库。
+# 各进程的指标写入共享目录，/metrics返回所有进程的合计；准入控制的上限按工作进程数量平分。
+# 用法: python serve_workers.py --workers 4
+#       kill -HUP <主进程PID>  重新初始化所有知识库并滚动替换工作进程
+import os
+import gc
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import asyncio
+import logging
+import shutil
+import argparse
+import tempfile
+
+# 从.env文件加载环境变量
+from dotenv import load_dotenv
+load_dotenv()
+
+import api_server
+import api_rag_knowledge
+import api_feishu_knowledge
+import admission
+from api_unified import build_apps, initialize_all
+from knowledge_manager import get_manager
+from metrics import REGISTRY, enable_multiprocess
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def apply_change(name, params):
+    """在主进程内执行工作进程转交的知识库变更
+
+    Args:
+        name: 服务在知识库管理器中的名称
+        params: 变更参数
+
+    Returns:
+        bool: 是否执行成功
+    """
+    if name == api_rag_knowledge.KB_NAME and ("changed_paths" in params or "removed_paths" in params):
+        # 文档目录监听发现的变化，只增量更新变化的文件
+        api_rag_knowledge.update_documents(params.get("changed_paths", []), params.get("removed_paths", []))
+        return True
+    if name == api_rag_knowledge.KB_NAME:
+        return bool(api_rag_knowledge.rebuild_knowledge_base(params.get("knowledge_base_path", "word_knowledge_base")))
+    if name == api_feishu_knowledge.KB_NAME and ("document_ids" in params or "removed_document_ids" in params):
+        # 飞书事件触发的变化，只重建受影响的文档
+        api_feishu_knowledge.update_feishu_documents(params.get("document_ids", []),
+                                                     params.get("removed_document_ids", []))
+        return True
+    if name == api_feishu_knowledge.KB_NAME:
+        return bool(api_feishu_knowledge.rebuild_knowledge_base(params.get("knowledge_base_path", "feishu_knowledge_base")))
+    if name == api_server.KB_NAME:
+        return bool(api_server.apply_change(**params))
+    logger.warning(f"未知的知识库服务: {name}")
+    return False
+
+
+def _bind_socket(host, port, backlog=2048):
+    """创建可被工作进程继承的监听套接字"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class WorkerMaster:
+    """预加载后fork的主进程，负责管理工作进程和执行知识库变更"""
+
+    def __init__(self, num_workers, host="0.0.0.0"):
+        self.num_workers = num_workers
+        self.host = host
+        self.workers = set()
+        # 正在被替换、等待退出的旧工作进程
+        self.retiring = set()
+        self.stopping = False
+        self.reload_requested = False
+        self.apps = []
+        self.sockets = []
+        # 工作进程通过管道通知主进程有待执行的变更，变更内容写入spool目录中的文件
+        self.change_read_fd = None
+        self.change_write_fd = None
+        self.spool_dir = None
+        # 管道中尚未读到换行符的部分，一次读取可能在文件名中间截断
+        self.change_buffer = b""
+        # 各进程共享的指标目录
+        self.metrics = None
+
+    # ---- 主进程 ----
+
+    def preload(self):
+        """初始化知识库并加载嵌入模型，之后fork的工作进程共享这些内存"""
+        initialize_all()
+        try:
+            get_manager().embeddings.warm_up(background=False)
+        except Exception as e:
+            logger.warning(f"预加载嵌入模型失败，工作进程将在首次使用时各自加载: {str(e)}")
+        # 把已有对象移出垃圾回收的跟踪范围，避免工作进程中的GC触碰这些页面导致写时复制
+        gc.collect()
+        gc.freeze()
+
+    def run(self):
+        """启动主进程循环，直到收到SIGTERM或SIGINT"""
+        self.change_read_fd, self.change_write_fd = os.pipe()
+        self.spool_dir = tempfile.mkdtemp(prefix="kb_changes_")
+        self.metrics = enable_multiprocess(tempfile.mkdtemp(prefix="kb_metrics_"))
+        admission.set_worker_count(self.num_workers)
+        # 主进程中的文档目录监听线程同样通过spool目录提交变更，由主循环执行后滚动替换工作进程
+        get_manager().set_change_forwarder(self._forward_change)
+        self.preload()
+        self.apps = build_apps()
+        self.sockets = [_bind_socket(self.host, port) for _, port in self.apps]
+
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+
+        for _ in range(self.num_workers):
+            self._spawn_worker()
+        logger.info(f"主进程 {os.getpid()} 已启动 {self.num_workers} 个工作进程，"
+                    f"监听端口: {', '.join(str(port) for _, port in self.apps)}")
+
+        next_metrics_write = 0.0
+        while not self.stopping:
+            if time.monotonic() >= next_metrics_write:
+                # 主进程的指标(知识库变更、文档监听)在主循环中写入，不使用后台线程，fork时不会有线程持有指标锁
+                self.metrics.write()
+                next_metrics_write = time.monotonic() + self.metrics.interval
+            try:
+                readable, _, _ = select.select([self.change_read_fd], [], [], 1.0)
+            except InterruptedError:
+                readable = []
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                readable = []
+            if readable:
+                self._process_changes()
+            if self.reload_requested:
+                self.reload_requested = False
+                self._reload_all()
+            self._reap_workers()
+
+        self._shutdown()
+
+    def _handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def _handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker()
+        self.workers.add(pid)
+        return pid
+
+    def _reap_workers(self):
+        """回收已退出的工作进程，意外退出的会被补充"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.metrics.archive(pid)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            if pid in self.workers:
+                self.workers.discard(pid)
+                if not self.stopping:
+                    logger.warning(f"工作进程 {pid} 意外退出(状态 {status})，正在补充")
+                    self._spawn_worker()
+
+    def _roll_workers(self):
+        """先启动新的工作进程，再让旧的工作进程处理完手头请求后退出"""
+        old_workers = list(self.workers)
+        for pid in old_workers:
+            self._spawn_worker()
+            self.workers.discard(pid)
+            self.retiring.add(pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.retiring.discard(pid)
+        logger.info(f"已用新的工作进程替换 {len(old_workers)} 个旧工作进程")
+
+    def _process_changes(self):
+        """读取并执行工作进程转交的知识库变更，执行后滚动替换工作进程"""
+        self.change_buffer += os.read(self.change_read_fd, 65536)
+        *lines, self.change_buffer = self.change_buffer.split(b"\n")
+        changed = False
+        for file_name in filter(None, (line.decode("utf-8") for line in lines)):
+            path = os.path.join(self.spool_dir, file_name)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    change = json.load(f)
+                os.remove(path)
+            except (OSError, ValueError) as e:
+                logger.error(f"读取知识库变更 {file_name} 失败: {str(e)}")
+                continue
+            logger.info(f"主进程正在执行知识库变更: {change['name']} {change['params']}")
+            try:
+                if apply_change(change["name"], change["params"]):
+                    changed = True
+                else:
+                    logger.error(f"知识库变更执行失败: {change['name']}")
+            except Exception as e:
+                logger.error(f"知识库变更执行出错: {str(e)}")
+        if changed:
+            gc.freeze()
+            self._roll_workers()
+
+    def _reload_all(self):
+        """重新初始化所有知识库(SIGHUP)并滚动替换工作进程"""
+        logger.info("收到SIGHUP，正在重新初始化所有知识库...")
+        manager = get_manager()
+        for name in manager.names():
+            manager.set(name, None)
+        initialize_all()
+        gc.freeze()
+        self._roll_workers()
+
+    def _shutdown(self):
+        logger.info("主进程正在关闭所有工作进程...")
+        for pid in list(self.workers) + list(self.retiring):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + 30
+        while (self.workers or self.retiring) and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            self.workers.discard(pid)
+            self.retiring.discard(pid)
+        for sock in self.sockets:
+            sock.close()
+        shutil.rmtree(self.metrics.directory, ignore_errors=True)
+
+    # ---- 工作进程 ----
+
+    def _forward_change(self, name, params):
+        """工作进程把知识库变更写入spool目录并通知主进程"""
+        fd, path = tempfile.mkstemp(dir=self.spool_dir, suffix=".json")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"name": name, "params": params}, f, ensure_ascii=False)
+        # 文件名很短，单次写入管道是原子的
+        os.write(self.change_write_fd, (os.path.basename(path) + "\n").encode("utf-8"))
+
+    def _run_worker(self):
+        """工作进程入口，不会返回"""
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            os.close(self.change_read_fd)
+            # 从主进程继承的指标已计入主进程的指标文件，工作进程从零开始统计
+            REGISTRY.reset_after_fork()
+            self.metrics.start()
+            get_manager().set_change_forwarder(self._forward_change)
+            asyncio.run(self._serve())
+        except Exception as e:
+            logger.error(f"工作进程 {os.getpid()} 出错: {str(e)}")
+            exit_code = 1
+        finally:
+            try:
+                self.metrics.write()
+            except OSError:
+                pass
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+    async def _serve(self):
+        import uvicorn
+        servers = [
+            uvicorn.Server(uvicorn.Config(app, log_level="info"))
+            for app, _ in self.apps
+        ]
+        await asyncio.gather(*(
+            server.serve(sockets=[sock]) for server, sock in zip(servers, self.sockets)
+        ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="预加载后fork的多工作进程知识库服务")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_WORKERS", "0") or 0) or os.cpu_count(),
+                        help="工作进程数量，默认读取WEB_WORKERS环境变量，否则为CPU核数")
+    parser.add_argument("--host", default="0.0.0.0", help="监听地址")
+    args = parser.parse_args(argv)
+    WorkerMaster(max(1, args.workers), host=args.host).run()
+
+
+if __name__ == "__main__":
+    main()
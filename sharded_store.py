@@ -0,0 +1,234 @@
+# 分片向量存储
+# 把文本片段按来源或按哈希划分到多个FAISS索引分片中，检索时在线程池中并行搜索各分片，
+# 再按距离合并各分片的top-k结果(scatter-gather)。
+# 每个分片是一个独立的FAISS向量存储，可以单独保存、加载和重建。
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.vectorstores import VectorStore
+
+from thread_budget import apply_query_budget
+
+# 分片方式: hash按片段内容哈希均匀分布；source按来源文件分布，同一文件的片段位于同一分片
+PARTITION_MODES = ("hash", "source")
+
+# 分片构建时每批计算向量的片段数量，避免一次性为全部片段计算向量占用过多内存
+EMBED_BATCH_SIZE = 512
+
+
+def shard_for(content, metadata, num_shards, partition="hash"):
+    """计算片段所属的分片编号
+
+    Args:
+        content: 片段内容
+        metadata: 片段元数据
+        num_shards: 分片数量
+        partition: 分片方式，'hash'或'source'
+
+    Returns:
+        int: 分片编号
+    """
+    if partition == "source":
+        key = str((metadata or {}).get("source", ""))
+    else:
+        key = content
+    return zlib.crc32(key.encode("utf-8")) % num_shards
+
+
+def _empty_faiss(embeddings, dimension):
+    """创建一个空的FAISS向量存储作为分片"""
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+
+    return FAISS(
+        embedding_function=embeddings,
+        index=faiss.IndexFlatL2(dimension),
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+    )
+
+
+def clone_faiss(vector_store):
+    """复制FAISS向量存储的索引、docstore和ID映射，修改副本不会影响原存储上的检索"""
+    import copy
+
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+
+    clone = copy.copy(vector_store)
+    clone.index = faiss.clone_index(vector_store.index)
+    clone.docstore = InMemoryDocstore(dict(vector_store.docstore._dict))
+    clone.index_to_docstore_id = dict(vector_store.index_to_docstore_id)
+    return clone
+
+
+class ShardedVectorStore(VectorStore):
+    """由多个FAISS分片组成的向量存储，对外提供与FAISS相同的检索和追加接口"""
+
+    def __init__(self, shards, embeddings, partition="hash", max_workers=None):
+        """
+        Args:
+            shards: FAISS向量存储列表
+            embeddings: 嵌入模型
+            partition: 分片方式，'hash'或'source'
+            max_workers: 并行检索的线程数，默认等于分片数量
+        """
+        if partition not in PARTITION_MODES:
+            raise ValueError(f"不支持的分片方式: {partition}，可选: {', '.join(PARTITION_MODES)}")
+        self.shards = list(shards)
+        self.partition = partition
+        self._embeddings = embeddings
+        # FAISS检索时会释放GIL，多个分片可以在线程中真正并行
+        # 检索线程按查询的线程预算设置FAISS的OpenMP线程数
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or len(self.shards), thread_name_prefix="kb-shard",
+            initializer=apply_query_budget,
+        )
+
+    def with_shards(self, shards):
+        """用新的分片列表创建分片存储，与当前存储共用检索线程池"""
+        store = ShardedVectorStore.__new__(ShardedVectorStore)
+        store.shards = list(shards)
+        store.partition = self.partition
+        store._embeddings = self._embeddings
+        store._executor = self._executor
+        return store
+
+    @property
+    def embeddings(self):
+        return self._embeddings
+
+    @property
+    def ntotal(self):
+        """所有分片的片段总数"""
+        return sum(shard.index.ntotal for shard in self.shards)
+
+    def map_shards(self, fn):
+        """在线程池中对每个分片并行执行fn(分片编号, 分片)，按分片顺序返回结果"""
+        if len(self.shards) == 1:
+            return [fn(0, self.shards[0])]
+        futures = [self._executor.submit(fn, i, shard) for i, shard in enumerate(self.shards)]
+        return [future.result() for future in futures]
+
+    def _larger_is_better(self):
+        from langchain_community.vectorstores.utils import DistanceStrategy
+        return self.shards[0].distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT
+
+    def merge(self, shard_results, k, score=lambda item: item[1]):
+        """按得分合并各分片的结果并取前k条"""
+        merged = [item for results in shard_results for item in results]
+        merged.sort(key=score, reverse=self._larger_is_better())
+        return merged[:k]
+
+    @classmethod
+    def from_embeddings_batches(cls, batches, embeddings, num_shards, partition="hash"):
+        """逐批把已计算好向量的片段分配到各分片中构建分片存储
+
+        Args:
+            batches: 可迭代的批次，每批为(内容列表, 向量列表, 元数据列表)
+            embeddings: 嵌入模型
+            num_shards: 分片数量
+            partition: 分片方式
+
+        Returns:
+            ShardedVectorStore: 新建的分片存储
+        """
+        store = None
+        for contents, vectors, metadatas in batches:
+            if store is None:
+                dimension = len(vectors[0])
+                store = cls([_empty_faiss(embeddings, dimension) for _ in range(num_shards)],
+                            embeddings, partition=partition)
+            store.add_embeddings(zip(contents, vectors), metadatas=metadatas)
+        return store
+
+    def add_embeddings(self, text_embeddings, metadatas=None, ids=None, **kwargs):
+        """按分片方式把片段分配到各分片并追加"""
+        text_embeddings = list(text_embeddings)
+        metadatas = metadatas or [{} for _ in text_embeddings]
+        groups = {}
+        for position, ((content, vector), metadata) in enumerate(zip(text_embeddings, metadatas)):
+            shard_id = shard_for(content, metadata, len(self.shards), self.partition)
+            groups.setdefault(shard_id, []).append(position)
+
+        added_ids = [None] * len(text_embeddings)
+        for shard_id, positions in groups.items():
+            shard_ids = self.shards[shard_id].add_embeddings(
+                [text_embeddings[p] for p in positions],
+                metadatas=[metadatas[p] for p in positions],
+                ids=[ids[p] for p in positions] if ids else None,
+            )
+            for position, doc_id in zip(positions, shard_ids):
+                added_ids[position] = doc_id
+        return added_ids
+
+    def delete(self, ids=None, **kwargs):
+        """按片段ID从所在分片中删除片段"""
+        groups = {}
+        for doc_id in ids or []:
+            for shard_id, shard in enumerate(self.shards):
+                if doc_id in shard.docstore._dict:
+                    groups.setdefault(shard_id, []).append(doc_id)
+                    break
+        for shard_id, shard_ids in groups.items():
+            self.shards[shard_id].delete(shard_ids)
+        return True
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        texts = list(texts)
+        return self.add_embeddings(zip(texts, self._embeddings.embed_documents(texts)), metadatas=metadatas, **kwargs)
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20, **kwargs):
+        """在各分片中并行检索并按距离合并top-k"""
+        shard_results = self.map_shards(
+            lambda _, shard: shard.similarity_search_with_score_by_vector(
+                embedding, k=k, filter=filter, fetch_k=fetch_k, **kwargs
+            ) if shard.index.ntotal else []
+        )
+        return self.merge(shard_results, k)
+
+    def search_batch(self, query_vectors, k):
+        """检索多个查询向量：每个分片只执行一次批量搜索，再按查询分别合并top-k
+
+        Args:
+            query_vectors: 形状为(查询数, 维度)的float32查询向量
+            k: 每个查询返回的片段数量
+
+        Returns:
+            list: 每个查询一个(Document, 距离)元组列表
+        """
+        from metadata_index import search_vector_store_batch
+
+        shard_results = self.map_shards(lambda _, shard: search_vector_store_batch(shard, query_vectors, k))
+        return [self.merge([results[i] for results in shard_results], k) for i in range(len(query_vectors))]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score_by_vector(self._embeddings.embed_query(query), k=k, **kwargs)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        return self.shards[0]._select_relevance_score_fn()
+
+    def get_by_ids(self, ids):
+        """按片段ID在各分片中查找片段"""
+        found = []
+        for doc_id in ids:
+            for shard in self.shards:
+                doc = shard.docstore.search(doc_id)
+                if not isinstance(doc, str):
+                    found.append(doc)
+                    break
+        return found
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, num_shards=None, partition="hash", **kwargs):
+        texts = list(texts)
+        num_shards = num_shards or int(os.getenv("KB_NUM_SHARDS", "2"))
+        return cls.from_embeddings_batches(
+            [(texts, embedding.embed_documents(texts), metadatas or [{} for _ in texts])],
+            embedding, num_shards, partition,
+        )
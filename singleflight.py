@@ -0,0 +1,84 @@
+# 相同请求合并(single-flight)
+# 同一时刻到达的多个相同请求只执行一次，所有请求共享同一份结果；
+# 执行过程中产生的流式片段会被缓存，后加入的请求从头回放后继续接收新片段。
+# 执行结束后立即移除，之后到达的请求会重新执行，因此不会返回过期结果。
+import threading
+
+
+class Flight:
+    """一次正在执行的请求，可被多个调用方等待结果或流式读取"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._chunks = []
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def publish(self, chunk):
+        """追加一个流式片段"""
+        with self._condition:
+            self._chunks.append(chunk)
+            self._condition.notify_all()
+
+    def finish(self, result=None, error=None):
+        """标记执行结束并唤醒所有等待方"""
+        with self._condition:
+            self._result = result
+            self._error = error
+            self._done = True
+            self._condition.notify_all()
+
+    def result(self, timeout=None):
+        """阻塞等待执行结果，执行出错时抛出同一个异常"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._done, timeout):
+                raise TimeoutError("等待合并请求的结果超时")
+            if self._error is not None:
+                raise self._error
+            return self._result
+
+    def stream(self):
+        """依次产出已缓存和后续到达的流式片段，直到执行结束"""
+        index = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._done or index < len(self._chunks))
+                chunks = self._chunks[index:]
+                done = self._done
+                error = self._error
+            index += len(chunks)
+            yield from chunks
+            if done and index >= len(self._chunks):
+                if error is not None:
+                    raise error
+                return
+
+
+class SingleFlight:
+    """按键合并正在执行的相同请求"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def join(self, key):
+        """加入某个键上正在执行的请求，不存在时创建
+
+        Returns:
+            tuple: (Flight, 是否为发起者)；发起者负责执行并调用done
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = Flight()
+            self._flights[key] = flight
+            return flight, True
+
+    def done(self, key, flight, result=None, error=None):
+        """发起者执行结束后调用：先移除键，再把结果交给所有等待方"""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(result, error)
@@ -0,0 +1,389 @@
+# 知识库快照格式
+# 替代FAISS.save_local的"原始float32索引 + pickle"，快照目录包含:
+#   manifest.json            格式版本、嵌入模型、向量维度、片段数量、构建参数以及各数据文件的校验和
+#   vectors-<摘要>.npy       按FAISS内部ID排列的向量，可选float16存储，体积减半
+#   docstore-<摘要>.json.gz  gzip压缩的片段内容和元数据(JSON，加载时不执行任何代码)
+# 数据文件名包含内容摘要，先写数据文件再原子替换manifest.json，
+# 写入中途失败时旧快照仍然完整可用；加载时并行读取并校验各数据文件。
+# 分片存储保存为shards.json加上每个分片一个快照子目录(shard-000、shard-001...)，各分片可以单独保存和加载。
+# 同一目录只保留一种格式：写入一种格式后会删除另一种格式的文件，避免加载到旧数据。
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SNAPSHOT_FORMAT = "kb-snapshot"
+SNAPSHOT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+SHARDED_FORMAT = "kb-sharded-snapshot"
+SHARDS_FILE = "shards.json"
+
+# 支持的向量存储精度
+VECTOR_DTYPES = ("float32", "float16")
+
+# 数据文件名前缀，写入新快照后会清理同前缀的旧文件
+_DATA_PREFIXES = ("vectors-", "docstore-")
+
+# 分片快照子目录名
+_SHARD_DIR_PATTERN = re.compile(r"shard-\d+$")
+
+
+class SnapshotError(Exception):
+    """快照格式不支持、文件缺失或校验失败时抛出"""
+
+
+def is_snapshot(path):
+    """判断路径是否为快照目录(而不是FAISS.save_local的旧格式)"""
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def atomic_write(file_path, data):
+    """先写临时文件并落盘，再重命名为目标文件"""
+    temp_path = f"{file_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def fsync_directory(path):
+    """把目录项的变更(重命名)落盘，Windows上不支持时忽略"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _remove_file(file_path):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_sharded_snapshot(path):
+    """删除目录中的分片快照(shards.json和各分片子目录)，先删除shards.json使目录不再被识别为分片快照"""
+    if not os.path.isdir(path):
+        return
+    _remove_file(os.path.join(path, SHARDS_FILE))
+    fsync_directory(path)
+    for name in os.listdir(path):
+        if _SHARD_DIR_PATTERN.match(name) and os.path.isdir(os.path.join(path, name)):
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def _remove_snapshot(path):
+    """删除目录中的非分片快照(manifest.json和数据文件)，先删除manifest.json使目录不再被识别为快照"""
+    if not os.path.isdir(path):
+        return
+    _remove_file(os.path.join(path, MANIFEST_FILE))
+    fsync_directory(path)
+    for name in os.listdir(path):
+        if name.startswith(_DATA_PREFIXES) and ".tmp-" not in name:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+
+def write_snapshot(vector_store, path, embedding_model=None, build_params=None, vector_dtype="float32"):
+    """把FAISS向量存储写为快照
+
+    目录中原有的分片快照会在新的manifest.json写入后删除。
+
+    Args:
+        vector_store: langchain的FAISS向量存储(底层为IndexFlat)
+        path: 快照目录
+        embedding_model: 构建索引所用的嵌入模型名称
+        build_params: 构建参数(如chunk_size、chunk_overlap)
+        vector_dtype: 向量存储精度，'float32'或'float16'
+
+    Returns:
+        dict: 写入的manifest
+    """
+    import faiss
+    import numpy as np
+
+    if vector_dtype not in VECTOR_DTYPES:
+        raise SnapshotError(f"不支持的向量精度: {vector_dtype}，可选: {', '.join(VECTOR_DTYPES)}")
+
+    index = vector_store.index
+    if not isinstance(index, faiss.IndexFlat):
+        raise SnapshotError(f"快照只支持IndexFlat索引，当前为 {type(index).__name__}")
+
+    ntotal = index.ntotal
+    vectors = index.reconstruct_n(0, ntotal) if ntotal else np.empty((0, index.d), dtype="float32")
+    buffer = io.BytesIO()
+    np.save(buffer, vectors.astype(vector_dtype), allow_pickle=False)
+    vector_bytes = buffer.getvalue()
+
+    rows = []
+    for faiss_id in range(ntotal):
+        docstore_id = vector_store.index_to_docstore_id[faiss_id]
+        doc = vector_store.docstore.search(docstore_id)
+        rows.append([docstore_id, doc.page_content, doc.metadata])
+    docstore_bytes = gzip.compress(
+        json.dumps(rows, ensure_ascii=False, default=str).encode("utf-8"), compresslevel=6,
+    )
+
+    os.makedirs(path, exist_ok=True)
+    files = {}
+    for prefix, suffix, data in (("vectors-", ".npy", vector_bytes), ("docstore-", ".json.gz", docstore_bytes)):
+        digest = hashlib.sha256(data).hexdigest()
+        name = f"{prefix}{digest[:16]}{suffix}"
+        atomic_write(os.path.join(path, name), data)
+        files[name] = {"sha256": digest, "bytes": len(data)}
+
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "created_at": time.time(),
+        "embedding_model": embedding_model,
+        "dimension": index.d,
+        "chunks": ntotal,
+        "metric": "inner_product" if index.metric_type == faiss.METRIC_INNER_PRODUCT else "l2",
+        "normalize_L2": bool(getattr(vector_store, "_normalize_L2", False)),
+        "distance_strategy": str(getattr(vector_store.distance_strategy, "value", vector_store.distance_strategy)),
+        "vector_dtype": vector_dtype,
+        "build_params": build_params or {},
+        "files": files,
+        "vectors_file": next(name for name in files if name.startswith("vectors-")),
+        "docstore_file": next(name for name in files if name.startswith("docstore-")),
+    }
+    atomic_write(
+        os.path.join(path, MANIFEST_FILE),
+        json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"),
+    )
+    fsync_directory(path)
+    _remove_sharded_snapshot(path)
+
+    # manifest切换完成后再清理旧快照的数据文件
+    for name in os.listdir(path):
+        if name.startswith(_DATA_PREFIXES) and name not in files and ".tmp-" not in name:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+    return manifest
+
+
+def read_manifest(path):
+    """读取并检查快照的manifest
+
+    Raises:
+        SnapshotError: 格式或版本不受支持
+    """
+    try:
+        with open(os.path.join(path, MANIFEST_FILE), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"读取快照清单失败: {str(e)}")
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        raise SnapshotError(f"不是知识库快照: {path}")
+    if manifest.get("version", 0) > SNAPSHOT_VERSION:
+        raise SnapshotError(f"快照版本 {manifest.get('version')} 高于当前支持的版本 {SNAPSHOT_VERSION}，请升级程序")
+    return manifest
+
+
+def _read_verified(path, name, expected):
+    """读取数据文件并校验大小和sha256"""
+    file_path = os.path.join(path, name)
+    try:
+        with open(file_path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        raise SnapshotError(f"快照数据文件缺失: {name} ({str(e)})")
+    if len(data) != expected["bytes"] or hashlib.sha256(data).hexdigest() != expected["sha256"]:
+        raise SnapshotError(f"快照数据文件校验失败，文件可能已损坏: {name}")
+    return data
+
+
+def read_snapshot(path, embeddings):
+    """加载快照为FAISS向量存储，向量和片段数据并行读取和校验
+
+    Args:
+        path: 快照目录
+        embeddings: 查询时使用的嵌入模型
+
+    Returns:
+        tuple: (FAISS向量存储, manifest)
+
+    Raises:
+        SnapshotError: 格式不受支持、文件缺失或校验失败
+    """
+    import faiss
+    import numpy as np
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.vectorstores.utils import DistanceStrategy
+    from langchain_core.documents import Document
+
+    manifest = read_manifest(path)
+    files = manifest["files"]
+
+    def load_vectors():
+        data = _read_verified(path, manifest["vectors_file"], files[manifest["vectors_file"]])
+        return np.load(io.BytesIO(data), allow_pickle=False).astype("float32", copy=False)
+
+    def load_docstore():
+        data = _read_verified(path, manifest["docstore_file"], files[manifest["docstore_file"]])
+        rows = json.loads(gzip.decompress(data).decode("utf-8"))
+        # 在读取线程中直接构造Document，与向量的解码和建索引重叠进行
+        documents = {
+            docstore_id: Document(id=docstore_id, page_content=content, metadata=metadata)
+            for docstore_id, content, metadata in rows
+        }
+        return documents, [row[0] for row in rows]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        vectors_future = executor.submit(load_vectors)
+        docstore_future = executor.submit(load_docstore)
+        vectors = vectors_future.result()
+
+        if vectors.shape != (manifest["chunks"], manifest["dimension"]):
+            raise SnapshotError("快照向量与清单记录的片段数量或向量维度不一致")
+        if manifest["metric"] == "inner_product":
+            index = faiss.IndexFlatIP(manifest["dimension"])
+        else:
+            index = faiss.IndexFlatL2(manifest["dimension"])
+        if len(vectors):
+            index.add(np.ascontiguousarray(vectors))
+
+        documents, docstore_ids = docstore_future.result()
+
+    if len(docstore_ids) != manifest["chunks"]:
+        raise SnapshotError("快照片段数据与清单记录的片段数量不一致")
+
+    docstore = InMemoryDocstore(documents)
+    index_to_docstore_id = dict(enumerate(docstore_ids))
+
+    vector_store = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+        normalize_L2=manifest.get("normalize_L2", False),
+        distance_strategy=DistanceStrategy(manifest.get("distance_strategy", DistanceStrategy.EUCLIDEAN_DISTANCE.value)),
+    )
+    return vector_store, manifest
+
+
+def is_sharded_snapshot(path):
+    """判断路径是否为分片存储的快照目录"""
+    return os.path.isfile(os.path.join(path, SHARDS_FILE))
+
+
+def _shard_path(path, shard_id):
+    return os.path.join(path, f"shard-{shard_id:03d}")
+
+
+def write_shard_snapshot(sharded_store, path, shard_id, **options):
+    """只保存分片存储中的一个分片
+
+    Args:
+        sharded_store: ShardedVectorStore分片存储
+        path: 分片快照所在的知识库目录
+        shard_id: 分片编号
+        options: 传给write_snapshot的其他参数
+    """
+    return write_snapshot(sharded_store.shards[shard_id], _shard_path(path, shard_id), **options)
+
+
+def write_sharded_snapshot(sharded_store, path, **options):
+    """保存分片存储：先写各分片的快照，最后原子写入shards.json
+
+    目录中原有的非分片快照会在shards.json写入后删除，多出的旧分片子目录也会一并删除。
+
+    Args:
+        sharded_store: ShardedVectorStore分片存储
+        path: 知识库目录
+        options: 传给write_snapshot的其他参数(embedding_model、build_params、vector_dtype)
+
+    Returns:
+        dict: 写入的分片清单
+    """
+    os.makedirs(path, exist_ok=True)
+    shard_manifests = sharded_store.map_shards(
+        lambda shard_id, shard: write_snapshot(shard, _shard_path(path, shard_id), **options)
+    )
+    manifest = {
+        "format": SHARDED_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "created_at": time.time(),
+        "partition": sharded_store.partition,
+        "embedding_model": options.get("embedding_model"),
+        "build_params": options.get("build_params") or {},
+        "chunks": sum(shard_manifest["chunks"] for shard_manifest in shard_manifests),
+        "shards": [os.path.basename(_shard_path(path, i)) for i in range(len(shard_manifests))],
+    }
+    atomic_write(
+        os.path.join(path, SHARDS_FILE),
+        json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"),
+    )
+    fsync_directory(path)
+    _remove_snapshot(path)
+    for name in os.listdir(path):
+        if _SHARD_DIR_PATTERN.match(name) and name not in manifest["shards"]:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    return manifest
+
+
+def read_shard_snapshot(path, shard_id, embeddings):
+    """只加载分片存储中的一个分片
+
+    Returns:
+        FAISS: 该分片的向量存储
+    """
+    vector_store, _ = read_snapshot(_shard_path(path, shard_id), embeddings)
+    return vector_store
+
+
+def read_sharded_snapshot(path, embeddings):
+    """并行加载所有分片
+
+    Args:
+        path: 知识库目录
+        embeddings: 查询时使用的嵌入模型
+
+    Returns:
+        tuple: (ShardedVectorStore, 分片清单)
+
+    Raises:
+        SnapshotError: 格式不受支持、文件缺失或校验失败
+    """
+    from sharded_store import ShardedVectorStore
+
+    try:
+        with open(os.path.join(path, SHARDS_FILE), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"读取分片清单失败: {str(e)}")
+    if manifest.get("format") != SHARDED_FORMAT:
+        raise SnapshotError(f"不是分片知识库快照: {path}")
+    if manifest.get("version", 0) > SNAPSHOT_VERSION:
+        raise SnapshotError(f"快照版本 {manifest.get('version')} 高于当前支持的版本 {SNAPSHOT_VERSION}，请升级程序")
+
+    with ThreadPoolExecutor(max_workers=len(manifest["shards"])) as executor:
+        futures = [
+            executor.submit(read_snapshot, os.path.join(path, name), embeddings)
+            for name in manifest["shards"]
+        ]
+        shards = [future.result()[0] for future in futures]
+    return ShardedVectorStore(shards, embeddings, partition=manifest.get("partition", "hash")), manifest
@@ -0,0 +1,106 @@
+# 准入控制的测试：并发和队列上限、排队超时、优先级、客户端配额以及空闲令牌桶的清理
+import asyncio
+
+import pytest
+
+import admission
+from admission import PRIORITY_BATCH, PRIORITY_INTERACTIVE, AdmissionController, AdmissionRejected
+
+
+def _run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_queue_full_rejected_with_503():
+    async def scenario():
+        controller = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=5)
+        await controller.acquire()
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire()
+        assert rejected.value.status_code == 503
+        assert rejected.value.retry_after >= 1
+        assert controller.status()["queued"] == 1
+
+        controller.release(0.1)
+        await waiter
+        assert (controller.status()["active"], controller.status()["queued"]) == (1, 0)
+
+    _run(scenario())
+
+
+def test_queue_timeout_rejected_and_removed_from_queue():
+    async def scenario():
+        controller = AdmissionController(max_concurrent=1, max_queue=4, queue_timeout=0.05)
+        await controller.acquire()
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire()
+        assert rejected.value.status_code == 503
+        assert controller.status()["queued"] == 0
+
+    _run(scenario())
+
+
+def test_interactive_requests_admitted_before_batch():
+    async def scenario():
+        controller = AdmissionController(max_concurrent=1, max_queue=4, queue_timeout=5)
+        await controller.acquire()
+        order = []
+
+        async def wait(name, priority):
+            await controller.acquire(priority=priority)
+            order.append(name)
+
+        batch = asyncio.create_task(wait("batch", PRIORITY_BATCH))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(wait("interactive", PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+
+        controller.release()
+        await interactive
+        controller.release()
+        await batch
+        assert order == ["interactive", "batch"]
+
+    _run(scenario())
+
+
+def test_client_quota_rejected_with_429(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+
+    async def scenario():
+        controller = AdmissionController(max_concurrent=0, client_rate=1.0, client_burst=2)
+        await controller.acquire("key:a")
+        await controller.acquire("key:a")
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire("key:a")
+        assert rejected.value.status_code == 429
+
+        # 其他客户端不受影响，令牌按速率恢复
+        await controller.acquire("key:b")
+        now[0] += 1.0
+        await controller.acquire("key:a")
+
+    _run(scenario())
+
+
+def test_idle_client_buckets_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    controller = AdmissionController(max_concurrent=0, client_rate=1.0, client_burst=2)
+
+    async def scenario():
+        for i in range(100):
+            await controller.acquire(f"ip:10.0.0.{i}")
+
+    _run(scenario())
+    assert len(controller._buckets) == 100
+
+    # 空闲超过回满所需时间(burst / rate = 2秒)后，下一次检查配额时清理
+    now[0] += 2.0
+    _run(controller.acquire("ip:10.0.1.1"))
+    assert list(controller._buckets) == ["ip:10.0.1.1"]
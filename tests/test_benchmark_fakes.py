@@ -0,0 +1,72 @@
+# 基准测试工具的测试：合成语料和查询可复现、假模型的回答和用量确定、流式最后一块携带用量
+import os
+
+from langchain_core.messages import HumanMessage
+
+from benchmarks.corpus import generate_corpus, generate_queries
+from benchmarks.fakes import FakeChatModel, PrefixCache, make_fake_embeddings
+
+
+def _read(paths):
+    contents = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            contents.append(f.read())
+    return contents
+
+
+def test_corpus_is_deterministic(tmp_path):
+    first = generate_corpus(str(tmp_path / "a"), 3, paragraphs_per_document=2)
+    second = generate_corpus(str(tmp_path / "b"), 3, paragraphs_per_document=2)
+
+    assert [os.path.basename(path) for path in first] == ["doc_en_000000.txt", "doc_en_000001.txt", "doc_en_000002.txt"]
+    assert _read(first) == _read(second)
+    assert _read(first) != _read(generate_corpus(str(tmp_path / "c"), 3, paragraphs_per_document=2, seed=1))
+
+
+def test_chinese_corpus_and_queries(tmp_path):
+    paths = generate_corpus(str(tmp_path), 1, language="zh", paragraphs_per_document=1)
+
+    assert "是" in _read(paths)[0]
+    assert generate_queries(5, "zh") == generate_queries(5, "zh")
+    assert len(generate_queries(5)) == 5
+
+
+def test_fake_embeddings_are_deterministic():
+    embeddings = make_fake_embeddings(size=8)
+
+    assert len(embeddings.embed_query("LangChain")) == 8
+    assert embeddings.embed_query("LangChain") == make_fake_embeddings(size=8).embed_query("LangChain")
+    assert embeddings.embed_query("LangChain") != embeddings.embed_query("FAISS")
+
+
+def test_fake_chat_model_answer_depends_only_on_prompt():
+    model = FakeChatModel(answer_tokens=4)
+
+    first = model.invoke([HumanMessage(content="question")])
+    assert first.content == model.invoke([HumanMessage(content="question")]).content
+    assert first.content != model.invoke([HumanMessage(content="other")]).content
+    assert len(first.content.split()) == 4
+    assert first.usage_metadata["output_tokens"] == 4
+
+
+def test_stream_matches_invoke_and_ends_with_usage():
+    model = FakeChatModel(answer_tokens=4)
+    prompt = [HumanMessage(content="question")]
+
+    chunks = list(model.stream(prompt))
+
+    assert "".join(chunk.content for chunk in chunks) == model.invoke(prompt).content
+    assert all(chunk.usage_metadata is None for chunk in chunks[:-1])
+    assert chunks[-1].content == "" and chunks[-1].usage_metadata["output_tokens"] == 4
+
+
+def test_prefix_cache_reports_shared_prefix():
+    model = FakeChatModel(prefix_cache=PrefixCache(block_chars=16))
+    prefix = "x" * 64
+
+    first = model.invoke([HumanMessage(content=prefix + "first question")])
+    second = model.invoke([HumanMessage(content=prefix + "second question")])
+
+    assert first.usage_metadata["input_token_details"]["cache_read"] == 0
+    assert second.usage_metadata["input_token_details"]["cache_read"] == 64 // 4
@@ -0,0 +1,107 @@
+# 文档目录监听的测试：快照对比、跳过临时文件、未处理的文件下次重试、去抖判断
+import os
+
+import pytest
+
+from doc_watcher import DocumentWatcher, diff_snapshots, list_documents, scan_documents
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+
+def _touch_later(path, content):
+    """改写文件并把修改时间推后，避免与上次写入落在同一时间戳内"""
+    before = os.stat(path).st_mtime_ns
+    _write(path, content)
+    os.utime(path, ns=(before + 10**9, before + 10**9))
+
+
+def test_diff_snapshots():
+    old = {"a": (1, 10), "b": (1, 10), "c": (1, 10)}
+    new = {"a": (1, 10), "b": (2, 12), "d": (1, 5)}
+
+    assert diff_snapshots(old, new) == (["d"], ["b"], ["c"])
+
+
+def test_list_documents_skips_temporary_and_hidden_files(tmp_path):
+    for name in ("a.docx", "b.txt", "~$a.docx", ".hidden.txt", "c.pdf", "sub/d.txt", ".git/e.txt"):
+        _write(str(tmp_path / name), "x")
+
+    names = [os.path.relpath(path, tmp_path) for path in list_documents(str(tmp_path))]
+
+    assert names == ["a.docx", "b.txt", os.path.join("sub", "d.txt")]
+
+
+@pytest.fixture
+def watched(tmp_path):
+    _write(str(tmp_path / "keep.txt"), "keep")
+    _write(str(tmp_path / "edit.txt"), "v1")
+    _write(str(tmp_path / "gone.txt"), "bye")
+    calls = []
+
+    def on_change(changed, removed):
+        calls.append((sorted(os.path.basename(path) for path in changed),
+                      sorted(os.path.basename(path) for path in removed)))
+        return watcher.failed
+
+    # failed为下一次回调返回的未处理文件
+    watcher = DocumentWatcher(str(tmp_path), on_change, debounce=0.5)
+    watcher.failed = []
+    watcher.calls = calls
+    return watcher
+
+
+def test_check_reports_added_modified_removed(watched, tmp_path):
+    _write(str(tmp_path / "new.txt"), "new")
+    _touch_later(str(tmp_path / "edit.txt"), "v2")
+    os.remove(tmp_path / "gone.txt")
+
+    watched.check()
+
+    assert watched.calls == [(["edit.txt", "new.txt"], ["gone.txt"])]
+    assert set(watched._snapshot) == set(scan_documents(str(tmp_path)))
+
+    # 没有新的变化时不调用回调
+    watched.check()
+    assert len(watched.calls) == 1
+
+
+def test_failed_files_retried_on_next_check(watched, tmp_path):
+    _write(str(tmp_path / "new.txt"), "partial")
+    watched.failed = [str(tmp_path / "new.txt")]
+    watched.check()
+
+    watched.failed = []
+    watched.check()
+
+    assert watched.calls == [(["new.txt"], []), (["new.txt"], [])]
+
+
+def test_callback_error_keeps_changes_pending(watched, tmp_path):
+    def broken(changed, removed):
+        raise RuntimeError("index busy")
+
+    watched.on_change = broken
+    _write(str(tmp_path / "new.txt"), "new")
+    watched.check()
+    assert watched.status()["pending"]
+
+    watched.on_change = lambda changed, removed: watched.calls.append(sorted(map(os.path.basename, changed)))
+    watched.check()
+    assert watched.calls == [["new.txt"]]
+
+
+def test_debounce_and_max_delay(watched):
+    assert not watched._due(0.0)
+
+    watched._first_event = watched._last_event = 100.0
+    assert not watched._due(100.2)
+    assert watched._due(100.5)
+
+    # 持续有变化时最长等待max_delay(默认为debounce的10倍)
+    watched._last_event = 104.9
+    assert not watched._due(104.95)
+    assert watched._due(105.0)
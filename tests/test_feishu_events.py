@@ -0,0 +1,85 @@
+# 飞书事件订阅的校验测试：未签名、签名过期或未配置校验方式的事件不能进入重建队列
+import json
+import time
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api_feishu_knowledge
+from feishu_events import EventRejected, parse_event, signature
+
+ENCRYPT_KEY = "test_encrypt_key"
+
+
+def _deleted_event(document_id="doc_victim"):
+    return json.dumps({
+        "schema": "2.0",
+        "header": {"event_id": uuid.uuid4().hex, "event_type": "drive.file.deleted_v1",
+                   "create_time": str(int(time.time() * 1000)), "token": ""},
+        "event": {"file_token": document_id},
+    }).encode("utf-8")
+
+
+def _signed_headers(body, timestamp=None):
+    timestamp = str(int(timestamp if timestamp is not None else time.time()))
+    nonce = uuid.uuid4().hex
+    return {
+        "X-Lark-Request-Timestamp": timestamp,
+        "X-Lark-Request-Nonce": nonce,
+        "X-Lark-Signature": signature(timestamp, nonce, ENCRYPT_KEY, body),
+    }
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    """替换重建队列的submit，记录进入队列的文档"""
+    documents = []
+    monkeypatch.setattr(api_feishu_knowledge._reindex_queue, "submit",
+                        lambda document_id, action, created_at=None: documents.append((document_id, action)))
+    return documents
+
+
+def _post(body, headers=None):
+    client = TestClient(api_feishu_knowledge.app)
+    return client.post("/feishu/events", content=body, headers={"Content-Type": "application/json", **(headers or {})})
+
+
+def test_unsigned_event_rejected_when_encrypt_key_configured(monkeypatch, submitted):
+    monkeypatch.setenv("FEISHU_EVENT_ENCRYPT_KEY", ENCRYPT_KEY)
+    monkeypatch.delenv("FEISHU_EVENT_VERIFICATION_TOKEN", raising=False)
+
+    response = _post(_deleted_event())
+
+    assert response.status_code == 401
+    assert submitted == []
+
+
+def test_event_rejected_when_nothing_configured(monkeypatch, submitted):
+    monkeypatch.delenv("FEISHU_EVENT_ENCRYPT_KEY", raising=False)
+    monkeypatch.delenv("FEISHU_EVENT_VERIFICATION_TOKEN", raising=False)
+
+    response = _post(_deleted_event())
+
+    assert response.status_code == 403
+    assert submitted == []
+
+
+def test_signed_event_accepted(monkeypatch, submitted):
+    monkeypatch.setenv("FEISHU_EVENT_ENCRYPT_KEY", ENCRYPT_KEY)
+    monkeypatch.delenv("FEISHU_EVENT_VERIFICATION_TOKEN", raising=False)
+    body = _deleted_event("doc_signed")
+
+    response = _post(body, _signed_headers(body))
+
+    assert response.status_code == 200
+    assert submitted == [("doc_signed", "removed")]
+
+
+def test_stale_or_forged_signature_rejected():
+    body = _deleted_event()
+    with pytest.raises(EventRejected, match="过期"):
+        parse_event(body, _signed_headers(body, timestamp=time.time() - 600), encrypt_key=ENCRYPT_KEY)
+    headers = _signed_headers(body)
+    with pytest.raises(EventRejected, match="签名校验失败"):
+        parse_event(_deleted_event("doc_other"), headers, encrypt_key=ENCRYPT_KEY)
@@ -0,0 +1,48 @@
+# 知识库检索路径的测试：分片存储的近似检索索引
+import pytest
+from langchain_community.vectorstores import FAISS
+
+import kb_config
+from benchmarks.fakes import FakeChatModel, make_fake_embeddings
+from langchain_knowledge import DeepSeekKnowledgeBase
+from sharded_store import ShardedVectorStore
+
+TEXTS = [f"term{i} explanation number {i}" for i in range(40)]
+
+
+@pytest.fixture
+def kb(monkeypatch, tmp_path):
+    """使用假模型和默认知识库配置的知识库"""
+    monkeypatch.setattr(kb_config, "CONFIG_FILE", str(tmp_path / "kb_config.json"))
+    return DeepSeekKnowledgeBase(llm=FakeChatModel(), embeddings=make_fake_embeddings(size=16))
+
+
+def _use(kb, vector_store):
+    kb.vector_store = vector_store
+    kb._on_index_changed()
+
+
+def test_sharded_search_does_not_start_index_builds(kb, monkeypatch):
+    builds = []
+    monkeypatch.setattr(kb, "_build_search_index", lambda: builds.append(1))
+    kb.config["index"] = {"type": "hnsw", "m": 16, "ef_construction": 40, "ef_search": 32}
+    _use(kb, ShardedVectorStore.from_texts(TEXTS, kb.embeddings, num_shards=3))
+
+    for _ in range(5):
+        assert len(kb.search_knowledge_base("term3", k=4)) == 4
+
+    assert builds == []
+    assert kb._search_index_thread is None
+
+
+def test_unsharded_search_builds_index_once(kb, monkeypatch):
+    builds = []
+    monkeypatch.setattr(kb, "_build_search_index", lambda: builds.append(1))
+    kb.config["index"] = {"type": "hnsw", "m": 16, "ef_construction": 40, "ef_search": 32}
+    _use(kb, FAISS.from_texts(TEXTS, kb.embeddings))
+
+    for _ in range(5):
+        kb.search_knowledge_base("term3", k=4)
+
+    # 构建线程被替换为不做事的函数，未清除_search_index_thread，后续查询不会重复启动
+    assert builds == [1]
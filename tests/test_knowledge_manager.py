@@ -0,0 +1,61 @@
+# 知识库管理器的测试：实例共享嵌入模型和模型路由层、变更转发、状态汇总
+import pytest
+
+import kb_config
+from knowledge_manager import KnowledgeBaseManager, get_manager
+
+
+@pytest.fixture
+def manager(monkeypatch, tmp_path):
+    monkeypatch.setattr(kb_config, "CONFIG_FILE", str(tmp_path / "kb_config.json"))
+    monkeypatch.setenv("EMBEDDING_LOAD_MODE", "lazy")
+    return KnowledgeBaseManager()
+
+
+def test_knowledge_bases_share_embeddings_and_router(manager):
+    first = manager.new_knowledge_base()
+    second = manager.new_knowledge_base()
+
+    assert first is not second
+    assert first.embeddings is second.embeddings is manager.embeddings
+    assert first.llm_router is second.llm_router is manager.llm_router
+    # 惰性加载模式下创建知识库不加载嵌入模型
+    assert not manager.embeddings.loaded
+
+
+def test_get_and_set(manager):
+    kb = manager.new_knowledge_base()
+
+    assert manager.get("server") is None
+    manager.set("server", kb)
+    manager.set("feishu", None)
+
+    assert manager.get("server") is kb
+    assert manager.names() == ["feishu", "server"]
+
+
+def test_forward_change(manager):
+    assert manager.forward_change("rag", action="reload") is False
+
+    forwarded = []
+    manager.set_change_forwarder(lambda name, params: forwarded.append((name, params)))
+
+    assert manager.forward_change("rag", action="reload") is True
+    assert forwarded == [("rag", {"action": "reload"})]
+
+
+def test_status(manager):
+    manager.set("server", manager.new_knowledge_base())
+    manager.set("feishu", None)
+
+    assert manager.status() == {
+        "embedding_model_loaded": False,
+        "knowledge_bases": {
+            "server": {"initialized": True, "vector_store_ready": False, "chunks": 0},
+            "feishu": {"initialized": False, "vector_store_ready": False, "chunks": 0},
+        },
+    }
+
+
+def test_get_manager_is_singleton():
+    assert get_manager() is get_manager()
@@ -0,0 +1,114 @@
+# 模型路由的测试：失败转移、熔断、首token超时计入失败、调用方提前停止时取消供应商请求
+import threading
+import time
+
+import pytest
+
+from llm_router import LLMCallError, LLMRouter
+
+
+class _Model:
+    """按给定分块流式返回，可以在首个分块前阻塞或直接抛出异常"""
+
+    def __init__(self, chunks=("ok",), error=None, hang=None, delay=0.0):
+        self.chunks = chunks
+        self.error = error
+        self.hang = hang
+        self.delay = delay
+        self.calls = 0
+        self.produced = 0
+        self.closed = threading.Event()
+
+    def stream(self, prompt):
+        self.calls += 1
+        return self._generate()
+
+    def _generate(self):
+        try:
+            if self.hang is not None:
+                self.hang.wait()
+            if self.error is not None:
+                raise self.error
+            for chunk in self.chunks:
+                time.sleep(self.delay)
+                self.produced += 1
+                yield chunk
+        finally:
+            self.closed.set()
+
+
+@pytest.fixture
+def release():
+    """阻塞中的供应商在测试结束时放行，避免线程池中的线程一直挂起"""
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def test_failover_to_next_provider_on_error():
+    primary = _Model(error=RuntimeError("boom"))
+    backup = _Model(chunks=("a", "b"))
+    router = LLMRouter([("primary", primary), ("backup", backup)], timeout=2, deadline=5)
+
+    assert "".join(router.stream("q")) == "ab"
+    assert router.providers[0].consecutive_failures == 1
+    assert router.providers[1].ewma is not None
+
+
+def test_circuit_opens_after_consecutive_failures():
+    primary = _Model(error=RuntimeError("boom"))
+    router = LLMRouter([("primary", primary), ("backup", _Model())], timeout=2, deadline=5,
+                       max_retries=0, failure_threshold=2, circuit_cooldown=60)
+
+    for _ in range(2):
+        with pytest.raises(LLMCallError):
+            list(router.stream("q"))
+    assert router.providers[0].is_open()
+
+    assert "".join(router.stream("q")) == "ok"
+    assert primary.calls == 2
+
+
+def test_all_providers_failing_raises():
+    router = LLMRouter([("only", _Model(error=RuntimeError("boom")))], timeout=2, deadline=5, max_retries=1)
+
+    with pytest.raises(LLMCallError):
+        list(router.stream("q"))
+
+
+def test_first_token_timeout_counts_as_failure(release):
+    hung = _Model(hang=release)
+    backup = _Model()
+    router = LLMRouter([("hung", hung), ("backup", backup)], timeout=0.2, deadline=5,
+                       failure_threshold=1, circuit_cooldown=60)
+
+    assert "".join(router.stream("q")) == "ok"
+    assert router.providers[0].consecutive_failures == 1
+    assert router.providers[0].is_open()
+
+    # 熔断后直接使用备选供应商，不再等待超时
+    start = time.monotonic()
+    assert "".join(router.stream("q")) == "ok"
+    assert time.monotonic() - start < 0.2
+    assert hung.calls == 1
+
+
+def test_never_succeeded_provider_does_not_get_probe_priority(release):
+    hung = _Model(hang=release)
+    backup = _Model()
+    router = LLMRouter([("hung", hung), ("backup", backup)], timeout=0.2, deadline=5, failure_threshold=3)
+
+    "".join(router.stream("q"))
+    assert [state.name for state in router._ranked()] == ["backup", "hung"]
+
+
+def test_consumer_stopping_early_cancels_provider():
+    model = _Model(chunks=[f"t{i}" for i in range(50)], delay=0.02)
+    router = LLMRouter([("slow", model)], timeout=2, deadline=5)
+
+    chunks = router.stream("q")
+    assert next(chunks) == "t0"
+    chunks.close()
+
+    assert model.closed.wait(1)
+    assert model.produced < 10
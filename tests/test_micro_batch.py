@@ -0,0 +1,92 @@
+# 查询微批处理的测试：并发请求合并成批、结果按请求分发、批大小上限、异常分发到批中每个请求
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langchain_community.vectorstores import FAISS
+
+import kb_config
+from benchmarks.fakes import FakeChatModel, make_fake_embeddings
+from langchain_knowledge import DeepSeekKnowledgeBase
+from micro_batch import MicroBatcher, embed_queries
+
+
+def test_concurrent_requests_batched_and_results_fanned_out():
+    batches = []
+
+    def run_batch(items):
+        batches.append(list(items))
+        return [item * 10 for item in items]
+
+    batcher = MicroBatcher(run_batch, window=0.05, max_batch_size=64)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(batcher.submit, range(16)))
+
+    assert results == [item * 10 for item in range(16)]
+    assert sum(len(batch) for batch in batches) == 16
+    assert len(batches) < 16
+
+
+def test_batch_size_limited():
+    batches = []
+    started = threading.Event()
+
+    def run_batch(items):
+        started.wait(5)
+        batches.append(len(items))
+        return items
+
+    batcher = MicroBatcher(run_batch, window=0.5, max_batch_size=4)
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        futures = [executor.submit(batcher.submit, item) for item in range(10)]
+        started.set()
+        assert sorted(future.result() for future in futures) == list(range(10))
+
+    assert max(batches) <= 4
+
+
+def test_batch_error_raised_in_every_request():
+    failing = [True]
+
+    def run_batch(items):
+        if failing[0]:
+            raise RuntimeError("batch failed")
+        return items
+
+    batcher = MicroBatcher(run_batch, window=0.05)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(batcher.submit, item) for item in range(4)]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="batch failed"):
+                future.result()
+
+    # 出错后批处理线程继续处理后续请求
+    failing[0] = False
+    assert batcher.submit(1) == 1
+
+
+def test_embed_queries_falls_back_to_single_queries():
+    embeddings = make_fake_embeddings(size=8)
+
+    assert embed_queries(embeddings, ["a", "b"]) == [embeddings.embed_query("a"), embeddings.embed_query("b")]
+
+
+def _knowledge_base(vector_store=None):
+    kb = DeepSeekKnowledgeBase(llm=FakeChatModel(), embeddings=make_fake_embeddings(size=16))
+    kb.vector_store = vector_store or FAISS.from_texts([f"term{i} explanation {i}" for i in range(30)], kb.embeddings)
+    kb._on_index_changed()
+    return kb
+
+
+def test_batched_retrieval_matches_unbatched(monkeypatch, tmp_path):
+    monkeypatch.setattr(kb_config, "CONFIG_FILE", str(tmp_path / "kb_config.json"))
+    unbatched = _knowledge_base()
+    monkeypatch.setenv("QUERY_BATCH_WINDOW_MS", "50")
+    batched = _knowledge_base(unbatched.vector_store)
+    questions = [f"term{i}" for i in range(8)]
+
+    expected = [[(doc.id, score) for doc, score in unbatched._retrieve(question, k=3)] for question in questions]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda question: batched._retrieve(question, k=3), questions))
+
+    assert [[(doc.id, pytest.approx(score)) for doc, score in result] for result in results] == expected
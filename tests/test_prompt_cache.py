@@ -0,0 +1,93 @@
+# 提示词缓存的测试：cache_friendly组装方式的共享前缀、token用量中命中缓存的部分
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage
+
+import kb_config
+from benchmarks.fakes import FakeChatModel, PrefixCache, make_fake_embeddings
+from langchain_knowledge import DeepSeekKnowledgeBase, _token_usage
+
+TEXTS = [f"term{i} explanation number {i}" for i in range(20)]
+
+
+@pytest.fixture
+def make_kb(monkeypatch, tmp_path):
+    monkeypatch.setattr(kb_config, "CONFIG_FILE", str(tmp_path / "kb_config.json"))
+
+    def make(layout, llm=None):
+        monkeypatch.setenv("PROMPT_LAYOUT", layout)
+        kb = DeepSeekKnowledgeBase(llm=llm or FakeChatModel(), embeddings=make_fake_embeddings(size=16))
+        kb.vector_store = FAISS.from_texts(TEXTS, kb.embeddings)
+        kb._on_index_changed()
+        kb._build_qa_chain()
+        return kb
+
+    return make
+
+
+def _docs(*ids):
+    return [Document(id=doc_id, page_content=f"content of {doc_id}") for doc_id in ids]
+
+
+def test_cache_friendly_layout_shares_prefix(make_kb):
+    kb = make_kb("cache_friendly")
+
+    first = kb._assemble_prompt("LangChain", _docs("b", "a", "c"))
+    second = kb._assemble_prompt("FAISS", _docs("c", "b", "a"))
+
+    # 片段按ID排序，问题在最后，两个提示词只在问题处不同
+    assert first.index("content of a") < first.index("content of b") < first.index("content of c")
+    assert first.replace("LangChain", "FAISS") == second
+    assert first.rstrip().endswith("</input>")
+
+
+def test_template_layout_keeps_retrieval_order(make_kb):
+    kb = make_kb("template")
+
+    prompt = kb._assemble_prompt("LangChain", _docs("b", "a"))
+
+    assert prompt.index("content of b") < prompt.index("content of a")
+
+
+def test_unknown_layout_rejected(make_kb):
+    with pytest.raises(ValueError):
+        make_kb("random")
+
+
+def test_token_usage_from_openai_style_details():
+    message = AIMessage(content="x", usage_metadata={
+        "input_tokens": 100, "output_tokens": 5, "total_tokens": 105, "input_token_details": {"cache_read": 64},
+    })
+
+    assert _token_usage(message) == {
+        "prompt_tokens": 100, "completion_tokens": 5, "cached_prompt_tokens": 64, "uncached_prompt_tokens": 36,
+    }
+
+
+def test_token_usage_from_deepseek_response_metadata():
+    message = AIMessage(content="x", usage_metadata={"input_tokens": 100, "output_tokens": 5, "total_tokens": 105},
+                        response_metadata={"token_usage": {"prompt_cache_hit_tokens": 80}})
+
+    assert _token_usage(message)["cached_prompt_tokens"] == 80
+    assert _token_usage(message)["uncached_prompt_tokens"] == 20
+
+
+def test_token_usage_without_cache_report():
+    message = AIMessage(content="x", usage_metadata={"input_tokens": 10, "output_tokens": 2, "total_tokens": 12})
+
+    usage = _token_usage(message)
+    assert usage["cached_prompt_tokens"] is None and usage["uncached_prompt_tokens"] is None
+    assert _token_usage(AIMessage(content="x")) is None
+
+
+def test_repeated_prefix_reported_as_cached(make_kb):
+    kb = make_kb("cache_friendly", llm=FakeChatModel(prefix_cache=PrefixCache(block_chars=64)))
+
+    first = kb.get_knowledge_answer("term1")
+    second = kb.get_knowledge_answer("term2")
+
+    assert first["usage"]["cached_prompt_tokens"] == 0
+    assert second["usage"]["cached_prompt_tokens"] > 0
+    assert second["usage"]["cached_prompt_tokens"] + second["usage"]["uncached_prompt_tokens"] == \
+        second["usage"]["prompt_tokens"]
@@ -0,0 +1,106 @@
+# 检索相关性判断的测试：L2距离和内积得分两种方向的阈值、相关性不足时不调用模型、阈值校准
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+import kb_config
+from benchmarks.fakes import FakeChatModel, make_fake_embeddings
+from langchain_knowledge import LOW_RELEVANCE_ANSWER, DeepSeekKnowledgeBase
+from relevance_calibration import calibrate, choose_threshold, pass_rate
+from sharded_store import ShardedVectorStore
+
+TEXTS = [f"term{i} explanation number {i}" for i in range(20)]
+
+
+@pytest.fixture
+def kb(monkeypatch, tmp_path):
+    monkeypatch.setattr(kb_config, "CONFIG_FILE", str(tmp_path / "kb_config.json"))
+    return DeepSeekKnowledgeBase(llm=FakeChatModel(), embeddings=make_fake_embeddings(size=16))
+
+
+def _use(kb, vector_store, max_distance):
+    kb.vector_store = vector_store
+    kb._on_index_changed()
+    kb._build_qa_chain()
+    kb.config["relevance"] = {"max_distance": max_distance, "on_low_relevance": "fallback"}
+
+
+def _judge(kb, *scores):
+    return kb._judge_relevance([(None, score) for score in scores])
+
+
+def test_disabled_by_default(kb):
+    _use(kb, FAISS.from_texts(TEXTS, kb.embeddings), None)
+
+    assert _judge(kb, 100.0) is None
+
+
+def test_l2_distance_passes_at_or_below_threshold(kb):
+    _use(kb, FAISS.from_texts(TEXTS, kb.embeddings), 1.0)
+
+    assert _judge(kb, 1.5, 0.8)["decision"] == "pass"
+    assert _judge(kb, 1.0)["decision"] == "pass"
+    assert _judge(kb, 1.5, 1.2) == {"decision": "low", "best_distance": 1.2, "max_distance": 1.0}
+    assert _judge(kb)["decision"] == "low"
+
+
+def test_inner_product_passes_at_or_above_threshold(kb):
+    vector_store = FAISS.from_texts(TEXTS, kb.embeddings, distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT)
+    _use(kb, vector_store, 0.5)
+
+    assert kb.larger_score_is_better()
+    assert _judge(kb, 0.9, 0.1) == {"decision": "pass", "best_distance": 0.9, "max_distance": 0.5}
+    assert _judge(kb, 0.4, 0.1)["decision"] == "low"
+
+
+def test_sharded_inner_product_store(kb):
+    vector_store = ShardedVectorStore([
+        FAISS.from_texts(TEXTS[:10], kb.embeddings, distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT),
+        FAISS.from_texts(TEXTS[10:], kb.embeddings, distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT),
+    ], kb.embeddings)
+    _use(kb, vector_store, 0.5)
+
+    assert kb.larger_score_is_better()
+    assert _judge(kb, 0.6)["decision"] == "pass"
+
+
+def test_low_relevance_skips_model(kb, monkeypatch):
+    _use(kb, FAISS.from_texts(TEXTS, kb.embeddings), 0.0)
+    monkeypatch.setattr(kb, "_call_llm", lambda *args, **kwargs: pytest.fail("相关性不足时不应调用模型"))
+
+    result = kb.get_knowledge_answer("something unrelated")
+
+    assert result["status"] == "low_relevance"
+    assert result["answer"] == LOW_RELEVANCE_ANSWER
+    assert result["sources"] == []
+
+
+def test_best_match_of_inner_product_store_reaches_model(kb, monkeypatch):
+    vector_store = FAISS.from_texts(TEXTS, kb.embeddings, distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT)
+    best = vector_store.similarity_search_with_score(TEXTS[3], k=1)[0][1]
+    _use(kb, vector_store, best - 1e-3)
+    monkeypatch.setattr(kb, "_call_llm", lambda *args, **kwargs: ("answer", None))
+
+    assert kb.get_knowledge_answer(TEXTS[3])["status"] == "success"
+
+
+def test_choose_threshold_both_directions():
+    distances = [0.1, 0.2, 0.3, 0.4, None]
+
+    assert choose_threshold(distances, 0.75) == 0.3
+    assert pass_rate(distances, 0.3) == 0.6
+    assert choose_threshold(distances, 0.75, larger_is_better=True) == 0.2
+    assert pass_rate(distances, 0.2, larger_is_better=True) == 0.6
+
+
+def test_calibrate_inner_product_store(kb):
+    vector_store = FAISS.from_texts(TEXTS, kb.embeddings, distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT)
+    _use(kb, vector_store, None)
+
+    report = calibrate(kb, TEXTS[:10], min_pass_rate=1.0)
+
+    assert report["larger_score_is_better"]
+    assert report["pass_rate"] == 1.0
+    kb.config["relevance"]["max_distance"] = report["max_distance"]
+    assert all(kb._judge_relevance(result)["decision"] == "pass"
+               for result in kb.retrieve_batch(TEXTS[:10], k=1))
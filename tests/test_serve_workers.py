@@ -0,0 +1,128 @@
+# 多工作进程服务的测试：变更管道按整行读取、各进程指标合计、准入上限按工作进程数量平分
+import json
+import os
+
+import pytest
+
+import admission
+import serve_workers
+from metrics import MetricsRegistry, MultiprocessMetrics
+
+
+@pytest.fixture
+def master(tmp_path, monkeypatch):
+    """只初始化变更管道和spool目录的主进程，执行变更和替换工作进程的操作被记录下来"""
+    applied = []
+    monkeypatch.setattr(serve_workers, "apply_change", lambda name, params: applied.append((name, params)) or True)
+    worker_master = serve_workers.WorkerMaster(2)
+    monkeypatch.setattr(worker_master, "_roll_workers", lambda: None)
+    worker_master.change_read_fd, worker_master.change_write_fd = os.pipe()
+    worker_master.spool_dir = str(tmp_path)
+    worker_master.applied = applied
+    yield worker_master
+    os.close(worker_master.change_read_fd)
+    os.close(worker_master.change_write_fd)
+
+
+def _spool(master, file_name, params):
+    with open(os.path.join(master.spool_dir, file_name), "w", encoding="utf-8") as f:
+        json.dump({"name": "rag", "params": params}, f, ensure_ascii=False)
+
+
+def test_partial_line_waits_for_rest(master):
+    file_name = "变更_1.json"
+    _spool(master, file_name, {"changed_paths": ["a.docx"]})
+    line = (file_name + "\n").encode("utf-8")
+
+    # 在多字节字符中间截断
+    os.write(master.change_write_fd, line[:2])
+    master._process_changes()
+    assert master.applied == []
+
+    os.write(master.change_write_fd, line[2:])
+    master._process_changes()
+    assert master.applied == [("rag", {"changed_paths": ["a.docx"]})]
+    assert master.change_buffer == b""
+
+
+def test_multiple_lines_in_one_read(master):
+    for i in range(3):
+        _spool(master, f"{i}.json", {"changed_paths": [f"{i}.docx"]})
+        # 与工作进程写入的格式相同: 文件名加换行符
+        os.write(master.change_write_fd, f"{i}.json\n".encode("utf-8"))
+
+    master._process_changes()
+
+    assert [params["changed_paths"] for _, params in master.applied] == [["0.docx"], ["1.docx"], ["2.docx"]]
+
+
+def _registry():
+    registry = MetricsRegistry()
+    counter = registry.counter("test_requests_total", "请求数", ["path"])
+    gauge = registry.gauge("test_in_flight", "正在处理的请求数")
+    histogram = registry.histogram("test_seconds", "耗时", buckets=(0.1, 1.0))
+    return registry, counter, gauge, histogram
+
+
+def test_metrics_summed_across_processes(tmp_path):
+    registry, counter, gauge, histogram = _registry()
+    metrics = MultiprocessMetrics(str(tmp_path), registry=registry)
+
+    # 另一个进程写入的指标文件
+    other, other_counter, other_gauge, other_histogram = _registry()
+    other_counter.inc(2, path="/query")
+    other_gauge.set(3)
+    other_histogram.observe(0.5)
+    with open(tmp_path / "99999.json", "w", encoding="utf-8") as f:
+        json.dump(other.dump(), f)
+
+    counter.inc(1, path="/query")
+    gauge.set(1)
+    histogram.observe(0.05)
+    text = metrics.generate_latest()
+
+    assert 'test_requests_total{path="/query"} 3' in text
+    assert "test_in_flight 4" in text
+    assert 'test_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_seconds_bucket{le="1"} 2' in text
+    assert "test_seconds_count 2" in text
+
+
+def test_exited_process_keeps_counters_but_not_gauges(tmp_path):
+    registry, counter, gauge, _ = _registry()
+    metrics = MultiprocessMetrics(str(tmp_path), registry=registry)
+    counter.inc(5, path="/query")
+    gauge.set(2)
+    metrics.write()
+
+    metrics.archive(os.getpid())
+    assert not os.path.exists(tmp_path / f"{os.getpid()}.json")
+
+    registry.reset_after_fork()
+    text = metrics.generate_latest()
+    assert 'test_requests_total{path="/query"} 5' in text
+    assert "\ntest_in_flight " not in text
+
+
+def test_admission_limits_divided_by_workers(monkeypatch):
+    monkeypatch.setenv("ADMISSION_MAX_CONCURRENT", "16")
+    monkeypatch.setenv("ADMISSION_MAX_QUEUE", "10")
+    monkeypatch.setenv("CLIENT_RATE_LIMIT", "8")
+    monkeypatch.setenv("CLIENT_BURST", "10")
+
+    controller = admission.AdmissionController.from_env(workers=4)
+
+    assert controller.max_concurrent == 4
+    assert controller.max_queue == 3
+    assert controller.client_rate == 2
+    assert controller.client_burst == 3
+
+
+def test_unlimited_admission_stays_unlimited(monkeypatch):
+    monkeypatch.setenv("ADMISSION_MAX_CONCURRENT", "0")
+    monkeypatch.setenv("CLIENT_RATE_LIMIT", "0")
+
+    controller = admission.AdmissionController.from_env(workers=4)
+
+    assert controller.max_concurrent == 0
+    assert controller.client_rate == 0
@@ -0,0 +1,131 @@
+# 相同请求合并的测试：同一键只执行一次、结束后不再复用、流式片段回放、按索引版本区分
+import threading
+import time
+
+import pytest
+
+import kb_config
+from benchmarks.fakes import FakeChatModel, make_fake_embeddings
+from langchain_knowledge import DeepSeekKnowledgeBase
+from metrics import CACHE_EVENTS
+from singleflight import SingleFlight
+
+
+def test_concurrent_joins_share_one_flight():
+    flights = SingleFlight()
+
+    flight, leader = flights.join("q")
+    other, other_leader = flights.join("q")
+
+    assert leader and not other_leader
+    assert other is flight
+    flights.done("q", flight, result={"answer": "a"})
+    assert other.result(timeout=1) == {"answer": "a"}
+
+
+def test_finished_flight_is_not_reused():
+    flights = SingleFlight()
+    flight, _ = flights.join("q")
+    flights.done("q", flight, result=1)
+
+    again, leader = flights.join("q")
+
+    assert leader
+    assert again is not flight
+
+
+def test_late_stream_reader_replays_published_chunks():
+    flights = SingleFlight()
+    flight, _ = flights.join("q")
+    flight.publish("a")
+    flight.publish("b")
+
+    reader = flight.stream()
+    assert next(reader) == "a"
+    flight.publish("c")
+    flights.done("q", flight, result="abc")
+
+    assert list(reader) == ["b", "c"]
+    assert list(flight.stream()) == ["a", "b", "c"]
+
+
+def test_error_is_raised_to_every_waiter():
+    flights = SingleFlight()
+    flight, _ = flights.join("q")
+    follower, _ = flights.join("q")
+    flights.done("q", flight, error=RuntimeError("boom"))
+
+    with pytest.raises(RuntimeError):
+        follower.result(timeout=1)
+    with pytest.raises(RuntimeError):
+        list(follower.stream())
+
+
+@pytest.fixture
+def kb(monkeypatch, tmp_path):
+    """查询执行被替换为阻塞到放行为止的函数，用于观察合并行为"""
+    monkeypatch.setattr(kb_config, "CONFIG_FILE", str(tmp_path / "kb_config.json"))
+    knowledge_base = DeepSeekKnowledgeBase(llm=FakeChatModel(), embeddings=make_fake_embeddings(size=16))
+    knowledge_base.vector_store = object()
+    knowledge_base.prompt = object()
+    knowledge_base.release = threading.Event()
+    knowledge_base.executed = []
+
+    def execute(question, on_chunk=None):
+        knowledge_base.executed.append((knowledge_base.index_version, question))
+        knowledge_base.release.wait(5)
+        return {"answer": f"answer to {question}"}
+
+    monkeypatch.setattr(knowledge_base, "_execute_query", execute)
+    monkeypatch.setattr(knowledge_base, "_cached_fingerprint", lambda: None)
+    yield knowledge_base
+    knowledge_base.release.set()
+
+
+def _query_in_thread(kb, question, results):
+    thread = threading.Thread(target=lambda: results.append(kb.get_knowledge_answer(question)))
+    thread.start()
+    return thread
+
+
+def _wait_until(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("等待超时")
+        time.sleep(0.01)
+
+
+def _coalesced():
+    return CACHE_EVENTS.get(cache="query_coalescing", result="hit")
+
+
+def test_same_question_coalesced_within_index_version(kb):
+    results = []
+    coalesced = _coalesced()
+    first = _query_in_thread(kb, "What is  RAG", results)
+    _wait_until(lambda: kb.executed)
+    second = _query_in_thread(kb, "what is rag ", results)
+    _wait_until(lambda: _coalesced() > coalesced)
+
+    kb.release.set()
+    first.join(5)
+    second.join(5)
+
+    assert len(kb.executed) == 1
+    assert results[0] == results[1] and results[0] is not results[1]
+
+
+def test_new_index_version_does_not_join_old_flight(kb):
+    results = []
+    first = _query_in_thread(kb, "what is rag", results)
+    _wait_until(lambda: len(kb.executed) == 1)
+    kb._on_index_changed()
+    second = _query_in_thread(kb, "what is rag", results)
+    _wait_until(lambda: len(kb.executed) == 2)
+
+    kb.release.set()
+    first.join(5)
+    second.join(5)
+
+    assert [version for version, _ in kb.executed] == [kb.index_version - 1, kb.index_version]
@@ -0,0 +1,97 @@
+# 知识库快照的测试：往返读写、数据文件损坏时拒绝加载、同一目录切换保存格式后加载新数据
+import json
+import os
+
+import pytest
+from langchain_community.vectorstores import FAISS
+
+from benchmarks.fakes import make_fake_embeddings
+from sharded_store import ShardedVectorStore
+from snapshot import (MANIFEST_FILE, SnapshotError, is_sharded_snapshot, is_snapshot, read_sharded_snapshot,
+                      read_snapshot, write_sharded_snapshot, write_snapshot)
+
+EMBEDDINGS = make_fake_embeddings(size=16)
+
+
+def _store(texts):
+    return FAISS.from_texts(texts, EMBEDDINGS, metadatas=[{"source": f"doc{i}"} for i in range(len(texts))])
+
+
+def _contents(vector_store):
+    return sorted(doc.page_content for doc in vector_store.docstore._dict.values())
+
+
+def test_round_trip(tmp_path):
+    texts = ["alpha", "beta", "gamma"]
+    manifest = write_snapshot(_store(texts), str(tmp_path), embedding_model="fake", build_params={"chunk_size": 100})
+
+    vector_store, loaded = read_snapshot(str(tmp_path), EMBEDDINGS)
+
+    assert _contents(vector_store) == texts
+    assert vector_store.index.ntotal == 3
+    assert loaded["files"] == manifest["files"]
+    assert loaded["build_params"] == {"chunk_size": 100}
+
+
+def test_corrupted_data_file_rejected(tmp_path):
+    manifest = write_snapshot(_store(["alpha", "beta"]), str(tmp_path))
+    vectors_path = os.path.join(tmp_path, manifest["vectors_file"])
+    with open(vectors_path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+
+    with pytest.raises(SnapshotError, match="校验失败"):
+        read_snapshot(str(tmp_path), EMBEDDINGS)
+
+
+def test_missing_data_file_rejected(tmp_path):
+    manifest = write_snapshot(_store(["alpha"]), str(tmp_path))
+    os.remove(os.path.join(tmp_path, manifest["docstore_file"]))
+
+    with pytest.raises(SnapshotError, match="缺失"):
+        read_snapshot(str(tmp_path), EMBEDDINGS)
+
+
+def test_newer_version_rejected(tmp_path):
+    write_snapshot(_store(["alpha"]), str(tmp_path))
+    manifest_path = os.path.join(tmp_path, MANIFEST_FILE)
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest["version"] += 1
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+
+    with pytest.raises(SnapshotError, match="版本"):
+        read_snapshot(str(tmp_path), EMBEDDINGS)
+
+
+def test_plain_snapshot_replaces_sharded_snapshot(tmp_path):
+    path = str(tmp_path)
+    write_sharded_snapshot(ShardedVectorStore.from_texts(["old1", "old2", "old3"], EMBEDDINGS, num_shards=2), path)
+    assert is_sharded_snapshot(path)
+
+    write_snapshot(_store(["new"]), path)
+
+    # 加载时先判断分片格式，旧的shards.json和分片子目录必须已被删除
+    assert not is_sharded_snapshot(path)
+    assert is_snapshot(path)
+    assert not [name for name in os.listdir(path) if name.startswith("shard-")]
+    vector_store, _ = read_snapshot(path, EMBEDDINGS)
+    assert _contents(vector_store) == ["new"]
+
+
+def test_sharded_snapshot_replaces_plain_snapshot(tmp_path):
+    path = str(tmp_path)
+    write_snapshot(_store(["old"]), path)
+    write_sharded_snapshot(ShardedVectorStore.from_texts(["new1", "new2", "new3"], EMBEDDINGS, num_shards=3), path)
+
+    write_sharded_snapshot(ShardedVectorStore.from_texts(["new1", "new2", "new3"], EMBEDDINGS, num_shards=2), path)
+
+    assert is_sharded_snapshot(path)
+    assert not is_snapshot(path)
+    assert sorted(os.listdir(path)) == ["shard-000", "shard-001", "shards.json"]
+    sharded_store, manifest = read_sharded_snapshot(path, EMBEDDINGS)
+    assert manifest["chunks"] == 3
+    assert sorted(content for shard in sharded_store.shards for content in _contents(shard)) == ["new1", "new2", "new3"]
@@ -0,0 +1,32 @@
+# 启动耗时测试：在全新的子进程中导入服务模块、加载已保存的知识库并回答第一个问题，耗时不超过预算
+# 预算远高于正常耗时(导入约1秒)，用于发现重新在导入时加载torch、FAISS或模型SDK之类的回退；
+# 详细的耗时分解见python -m benchmarks.bench_startup
+import os
+
+import pytest
+
+from benchmarks.bench_startup import IMPORT_SCRIPT, MODULES, READY_SCRIPT, build_index, run_in_subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 导入单个服务模块的耗时预算(秒)
+IMPORT_BUDGET_SECONDS = 5.0
+# 从进程启动到回答第一个问题的耗时预算(秒)
+READY_BUDGET_SECONDS = 15.0
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_import_time_within_budget(module):
+    result = run_in_subprocess(IMPORT_SCRIPT.format(module=module), 1, cwd=REPO_ROOT)[0]
+
+    assert result["heavy_modules_loaded"] == []
+    assert result["seconds"] < IMPORT_BUDGET_SECONDS
+
+
+def test_time_to_first_answer_within_budget(tmp_path):
+    index_path = str(tmp_path / "kb")
+    build_index(index_path, fake_embeddings=True)
+
+    result = run_in_subprocess(READY_SCRIPT.format(index_path=index_path, fake_embeddings=True), 1, cwd=REPO_ROOT)[0]
+
+    assert result["time_to_first_answer_seconds"] < READY_BUDGET_SECONDS
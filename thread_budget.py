@@ -0,0 +1,150 @@
+# CPU线程预算
+# torch的intra-op线程、FAISS的OpenMP线程和HuggingFace分词器的线程池默认都按整台机器的核数创建，
+# 多个服务部署在同一容器中、入库与查询同时进行时会严重超额订阅CPU，查询延迟出现尖峰。
+# 这里集中配置本进程可用的线程数，并把查询路径和入库路径的预算分开：
+# 进程启动时按查询预算设置各线程库的默认线程数，入库代码在执行期间切换到入库预算。
+# OpenMP和torch的线程数是按调用线程生效的，因此查询和入库可以在各自的线程中使用不同的预算。
+import functools
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+from query_log import get_logger
+
+logger = get_logger("thread_budget")
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    try:
+        return int(value) if value not in (None, "") else default
+    except ValueError:
+        return default
+
+
+def available_cpus():
+    """本进程实际可用的CPU数量，考虑CPU亲和性和容器(cgroup)的CPU配额"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+    # cgroup v2: "配额 周期"，如"200000 100000"表示2个CPU；v1分别在两个文件中
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()[:2]
+            if limit != "max":
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota:
+        cpus = min(cpus, max(1, int(quota)))
+    return max(1, cpus)
+
+
+# 本进程可使用的线程总数；同一容器中部署了多个服务时按各自的份额设置
+CPU_BUDGET = _env_int("KB_CPU_BUDGET", available_cpus())
+# 查询路径(问题向量、FAISS检索)每个请求使用的线程数；单条问题的计算量小，多线程收益有限，
+# 少量线程让并发的多个查询互不争抢
+QUERY_THREADS = max(1, _env_int("KB_QUERY_THREADS", min(4, max(1, CPU_BUDGET // 4))))
+# 入库路径(批量计算向量、建索引、分词)使用的线程数，默认占预算的一半，为同时进行的查询留出CPU
+INGEST_THREADS = max(1, _env_int("KB_INGEST_THREADS", max(1, CPU_BUDGET // 2)))
+
+BUDGETS = {"query": QUERY_THREADS, "ingest": INGEST_THREADS}
+
+_configured = False
+_configure_lock = threading.Lock()
+# 当前线程已应用的线程数
+_local = threading.local()
+
+
+def configure_process():
+    """在进程启动时应用线程预算(可重复调用，只生效一次)
+
+    各线程库在加载时读取环境变量，未显式设置的变量按查询预算设置；
+    分词器(Rust的rayon线程池)主要在入库时批量分词，按入库预算设置。
+    已加载的库立即对当前线程生效。
+
+    Returns:
+        dict: 生效的预算
+    """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return status()
+        for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+            os.environ.setdefault(name, str(QUERY_THREADS))
+        os.environ.setdefault("RAYON_NUM_THREADS", str(INGEST_THREADS))
+        _configured = True
+    _apply(QUERY_THREADS, force=True)
+    logger.info(f"CPU线程预算: 共 {CPU_BUDGET}，查询 {QUERY_THREADS}，入库 {INGEST_THREADS}")
+    return status()
+
+
+def _apply(threads, force=False):
+    """为当前线程设置torch和FAISS的线程数(只处理已加载的库，不触发导入)"""
+    if not force and getattr(_local, "threads", None) == threads:
+        return
+    faiss = sys.modules.get("faiss")
+    if faiss is not None and hasattr(faiss, "omp_set_num_threads"):
+        faiss.omp_set_num_threads(threads)
+    torch = sys.modules.get("torch")
+    if torch is not None and hasattr(torch, "set_num_threads"):
+        torch.set_num_threads(threads)
+    _local.threads = threads
+
+
+def reapply():
+    """库刚在当前线程中加载(如首次加载嵌入模型导入了torch)后，重新应用当前线程的预算"""
+    _apply(getattr(_local, "threads", None) or QUERY_THREADS, force=True)
+
+
+def apply_query_budget():
+    """把当前线程设置为查询预算，可作为检索线程池的initializer"""
+    _apply(QUERY_THREADS)
+
+
+@contextmanager
+def thread_budget(kind):
+    """在代码块执行期间使用查询(query)或入库(ingest)预算，结束后恢复
+
+    Args:
+        kind: "query"或"ingest"
+    """
+    previous = getattr(_local, "threads", None) or QUERY_THREADS
+    _apply(BUDGETS[kind])
+    try:
+        yield
+    finally:
+        _apply(previous)
+
+
+def with_thread_budget(kind):
+    """装饰器：被装饰的函数在指定预算下执行"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with thread_budget(kind):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def status():
+    """返回生效的预算，用于/status和基准测试记录"""
+    return {
+        "cpu_budget": CPU_BUDGET,
+        "available_cpus": available_cpus(),
+        "query_threads": QUERY_THREADS,
+        "ingest_threads": INGEST_THREADS,
+        "configured": _configured,
+    }